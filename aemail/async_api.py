@@ -0,0 +1,720 @@
+"""
+Asyncio REST API, served on the event loop of the SMTP server.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from .compression import COMPRESSIBLE_TYPES, ResponseCompressor, StaticAsset
+from .data import MESSAGE_PARTS, EmailData
+from .metrics import MetricsRegistry
+from .snapshot import SnapshotReplica
+from .utils import parse_timestamp
+
+
+logger = logging.getLogger(__name__)
+
+# EmailData methods available as coroutines on AsyncEmailData
+ASYNC_METHODS = frozenset({
+    'get_all_messages', 'get_messages_from', 'get_messages_to', 'get_message_count',
+    'get_message', 'get_message_part', 'get_message_parts', 'get_tokens',
+    'get_latest_token', 'get_unread_count', 'mark_read', 'search_messages', 'get_stats',
+    'get_messages_by_header', 'get_changes',
+})
+
+# Longest a /wait request may be held open, in seconds
+MAX_WAIT = 300.0
+
+REASONS = {
+    200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+    405: 'Method Not Allowed', 500: 'Internal Server Error', 503: 'Service Unavailable',
+}
+
+# Response: status, headers, body
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+class AsyncEmailData:
+    """
+    EmailData for coroutines.
+
+    Every call runs on one dedicated database thread, so the event loop
+    never blocks on SQLite and the connection is only ever used from that
+    thread and the writers that already share it. The lookups of EmailData
+    listed in ASYNC_METHODS are available under the same names and
+    arguments, as coroutines.
+
+    Waiting for new mail needs no thread at all: a waiter is a future,
+    resolved when EmailData reports a store to the waiter's mailbox.
+    """
+
+    def __init__(self, data_store: EmailData):
+        """
+        Initialize the wrapper.
+
+        Args:
+            data_store: EmailData instance to run the lookups on
+        """
+        self.data_store = data_store
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aemail-db')
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._waiters: Dict[str, Set[asyncio.Future]] = {}
+        data_store.listeners.append(self._stored)
+
+    def __getattr__(self, name: str) -> Callable[..., Awaitable[Any]]:
+        if name not in ASYNC_METHODS:
+            raise AttributeError(name)
+        method = getattr(self.data_store, name)
+
+        async def call(*args, **kwargs):
+            return await self.run(method, *args, **kwargs)
+        return call
+
+    async def run(self, function: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run any blocking call, such as a metrics collection, on the database thread.
+
+        Args:
+            function: Function to call
+            *args, **kwargs: Its arguments
+
+        Returns:
+            What it returns
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """Attach to the event loop waiters are resolved on."""
+        self.loop = loop
+
+    def _stored(self, recipients: List[str]):
+        """Store listener; called on the thread that stored the mail."""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        if any(recipient in self._waiters for recipient in recipients):
+            loop.call_soon_threadsafe(self._wake, recipients)
+
+    def _wake(self, recipients: List[str]):
+        """Resolve the waiters of the given mailboxes."""
+        for recipient in recipients:
+            for waiter in self._waiters.pop(recipient, ()):
+                if not waiter.done():
+                    waiter.set_result(True)
+
+    def wake_all(self):
+        """Resolve every waiter, e.g. on shutdown."""
+        self._wake(list(self._waiters))
+
+    @contextmanager
+    def listening(self, recipient: str) -> Iterator[asyncio.Future]:
+        """
+        Listen for mail to a recipient for the duration of the block.
+
+        The waiter is registered before the block runs, so a store that
+        lands while the block looks the mailbox up still resolves it.
+
+        Args:
+            recipient: Email address of the recipient
+
+        Yields:
+            Future resolved when mail is stored for the recipient (or
+            waiters are woken)
+        """
+        key = self.data_store.normalizer.canonicalize(recipient)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, set()).add(waiter)
+        try:
+            yield waiter
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[key]
+
+    @staticmethod
+    async def arrival(waiter: asyncio.Future, timeout: float) -> bool:
+        """
+        Wait for a waiter from listening to resolve.
+
+        Returns:
+            True if mail arrived (or waiters were woken), False on timeout
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait_for_mail(self, recipient: str, timeout: float) -> bool:
+        """
+        Wait until mail is stored for a recipient.
+
+        Args:
+            recipient: Email address of the recipient
+            timeout: Seconds to wait at most
+
+        Returns:
+            True if mail arrived (or waiters were woken), False on timeout
+        """
+        with self.listening(recipient) as waiter:
+            return await self.arrival(waiter, timeout)
+
+    def close(self):
+        """Stop the database thread and detach from the data store."""
+        if self._stored in self.data_store.listeners:
+            self.data_store.listeners.remove(self._stored)
+        self.executor.shutdown(wait=True)
+
+
+class AsyncSnapshot:
+    """
+    The lookups of AsyncEmailData, run on the newest snapshot of a replica.
+
+    Snapshot reads get a thread of their own, so a long export or
+    aggregate never queues up behind, or ahead of, the live lookups.
+    """
+
+    def __init__(self, replica: SnapshotReplica):
+        """
+        Initialize the wrapper.
+
+        Args:
+            replica: Replica whose current snapshot to read
+        """
+        self.replica = replica
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aemail-snapshot-read')
+
+    def __getattr__(self, name: str) -> Callable[..., Awaitable[Any]]:
+        if name not in ASYNC_METHODS or name == 'mark_read':
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            method = getattr(self.replica.data, name)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(method, *args, **kwargs))
+        return call
+
+    def close(self):
+        """Stop the snapshot read thread."""
+        self.executor.shutdown(wait=True)
+
+
+class Request:
+    """A parsed HTTP request."""
+
+    __slots__ = ('method', 'path', 'args', 'headers', 'version')
+
+    def __init__(self, method: str, target: str, version: str, headers: Dict[str, str]):
+        url = urlsplit(target)
+        self.method = method
+        self.path = unquote(url.path)
+        self.args = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        self.headers = headers
+        self.version = version
+
+    @property
+    def keep_alive(self) -> bool:
+        """Whether the connection stays open after the response."""
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+
+def _json(data: Any, status: int = 200) -> Response:
+    """A JSON response, serialized like Flask's jsonify."""
+    body = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    body = (body + '\n').encode('utf-8')
+    return status, {'Content-Type': 'application/json'}, body
+
+
+def _error(message: str, status: int) -> Response:
+    """A JSON error response."""
+    return _json({"error": message}, status)
+
+
+def _page_args(request: Request) -> Tuple[int, int, bool]:
+    """The limit, offset and summary flag of a list request."""
+    limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
+    offset = max(int(request.args.get('offset', 0)), 0)
+    return limit, offset, request.args.get('view') == 'summary'
+
+
+class AsyncEmailAPI:
+    """
+    The REST API of EmailAPI as an asyncio HTTP/1.1 server.
+
+    Serves the same routes and responses, plus long polling on
+    /to/<address>/wait, on the event loop of the SMTP controller. Request
+    handling never blocks the loop: lookups run on the database thread of
+    AsyncEmailData, and idle keep-alive connections and pending waits cost
+    a task each rather than a thread.
+    """
+
+    def __init__(self, data_store: EmailData, static_dir: Optional[str] = None,
+                 metrics: Optional[MetricsRegistry] = None,
+                 compressor: Optional[ResponseCompressor] = None,
+                 snapshot: Optional[SnapshotReplica] = None):
+        """
+        Initialize the API.
+
+        Args:
+            data_store: EmailData instance for accessing stored emails
+            static_dir: Directory containing static files (optional)
+            metrics: Registry served at /metrics (optional)
+            compressor: Response compression settings (optional)
+            snapshot: Replica serving ?consistency=snapshot reads (optional)
+        """
+        self.data = AsyncEmailData(data_store)
+        self.snapshot = snapshot
+        self.snapshot_data = AsyncSnapshot(snapshot) if snapshot is not None else None
+        self.metrics = metrics or MetricsRegistry()
+        self.compressor = compressor or ResponseCompressor()
+
+        if static_dir is None:
+            static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+        self.index_page = StaticAsset.load(Path(static_dir) / 'index.html')
+
+        self.server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._active_requests = 0
+        self._closing = False
+
+    async def start(self, host: str = '127.0.0.1', port: int = 14000,
+                    sock: Optional[socket.socket] = None):
+        """
+        Start serving on the running event loop.
+
+        Args:
+            host: Host to bind to
+            port: Port to bind to
+            sock: Already bound listening socket to use instead
+        """
+        self.data.bind(asyncio.get_running_loop())
+        if sock is not None:
+            self.server = await asyncio.start_server(self._handle_connection, sock=sock)
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Async web API listening on {host}:{port}")
+
+    def listening_socket(self) -> Optional[socket.socket]:
+        """The socket the server accepts connections on, while it runs."""
+        if self.server is None or not self.server.sockets:
+            return None
+        return self.server.sockets[0]
+
+    async def shutdown(self, timeout: float = 10.0):
+        """
+        Stop accepting, answer the requests in progress, then close every connection.
+
+        Pending waits are answered right away with what they have.
+
+        Args:
+            timeout: Seconds to wait for requests in progress
+        """
+        self._closing = True
+        if self.server is not None:
+            self.server.close()
+        self.data.wake_all()
+        deadline = time.monotonic() + timeout
+        while self._active_requests > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._active_requests > 0:
+            logger.warning(f"Closing web API with {self._active_requests} requests in progress")
+        for writer in list(self._connections):
+            writer.close()
+        self.server = None
+        self.data.close()
+        if self.snapshot_data is not None:
+            self.snapshot_data.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Request]:
+        """Read the next request of a connection, or None once it is closed."""
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise ValueError(f"Malformed request line: {line[:100]!r}")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        # Bodies are not used by any route, but must not be taken for the next request
+        length = int(headers.get('content-length', 0) or 0)
+        if length:
+            await reader.readexactly(length)
+        return Request(method, target, version, headers)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter):
+        """Serve the requests of one keep-alive connection."""
+        self._connections.add(writer)
+        try:
+            while not self._closing:
+                try:
+                    request = await self._read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                    logger.debug(f"Bad request: {e}")
+                    writer.write(self._serialize(None, _error("Bad request", 400), False))
+                    break
+                if request is None:
+                    break
+
+                self._active_requests += 1
+                try:
+                    response = await self._dispatch(request)
+                finally:
+                    self._active_requests -= 1
+                keep_alive = request.keep_alive and not self._closing
+                writer.write(self._serialize(request, response, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    def _serialize(self, request: Optional[Request], response: Response,
+                   keep_alive: bool) -> bytes:
+        """Encode a response, compressing it when the client accepts it."""
+        status, headers, body = response
+        mimetype = headers.get('Content-Type', '').split(';')[0]
+        if (request is not None and status == 200 and mimetype in COMPRESSIBLE_TYPES
+                and 'Content-Encoding' not in headers):
+            headers['Vary'] = 'Accept-Encoding'
+            encoding, body = self.compressor.encode(body, request.headers.get('accept-encoding'))
+            if encoding is not None:
+                headers['Content-Encoding'] = encoding
+                etag = headers.get('ETag')
+                if etag and not etag.startswith('W/'):
+                    headers['ETag'] = f'W/{etag}'
+
+        if request is not None and request.method == 'HEAD':
+            headers['Content-Length'] = str(len(body))
+            body = b''
+        else:
+            headers['Content-Length'] = str(len(body))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}"]
+        head += [f"{name}: {value}" for name, value in headers.items()]
+        return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+    async def _dispatch(self, request: Request) -> Response:
+        """Route a request to its handler."""
+        path = request.path
+        if request.method == 'POST':
+            for suffix, seen in (('/read', True), ('/unread', False)):
+                if path.startswith('/to/') and path.endswith(suffix) and len(path) > 4 + len(suffix):
+                    return await self._mark_read(request, path[4:-len(suffix)], seen)
+            return _error("Method not allowed", 405)
+        if request.method not in ('GET', 'HEAD'):
+            return _error("Method not allowed", 405)
+
+        try:
+            if path == '/':
+                return self._index(request)
+            if path == '/all':
+                return await self._mailbox(request, None, None)
+            if path == '/messages':
+                return await self._search(request)
+            if path == '/stats':
+                return await self._stats(request)
+            if path == '/changes':
+                return await self._changes(request)
+            # Both read the database; they run on its thread, not the loop
+            if path == '/health':
+                storage = await self.data.run(self.data.data_store.storage_status)
+                return _json({"status": "healthy", "service": "aemail", "storage": storage})
+            if path == '/metrics':
+                return _json(await self.data.run(self.metrics.collect))
+            if path.startswith('/from/') and len(path) > 6:
+                return await self._mailbox(request, 'sender', path[6:])
+            if path.startswith('/header/'):
+                name, _, value = path[8:].partition('/')
+                if not name or not value:
+                    return _error("Not found", 404)
+                return await self._header(request, name, value)
+            if path.startswith('/message/'):
+                if not path[9:].isdigit():
+                    return _error("Not found", 404)
+                return await self._message(request, int(path[9:]))
+            if path.startswith('/to/') and len(path) > 4:
+                recipient = path[4:]
+                for suffix, handler in (('/latest-code', self._latest_code),
+                                        ('/links', self._links), ('/wait', self._wait)):
+                    if recipient.endswith(suffix) and len(recipient) > len(suffix):
+                        return await handler(request, recipient[:-len(suffix)])
+                return await self._mailbox(request, 'recipient', recipient)
+        except ValueError:
+            return _error("Invalid parameter", 400)
+        except Exception as e:
+            logger.error(f"Error handling {path}: {e}")
+            return _error("Failed to retrieve messages", 500)
+        return _error("Not found", 404)
+
+    def _index(self, request: Request) -> Response:
+        """Serve the main page."""
+        if self.index_page is None:
+            return 404, {'Content-Type': 'text/plain'}, b'Not found'
+        encoding, body = self.index_page.variant(request.headers.get('accept-encoding'))
+        etag = f'"{self.index_page.etag}-{encoding}"' if encoding else f'"{self.index_page.etag}"'
+        headers = {
+            'Content-Type': f'{self.index_page.mimetype}; charset=utf-8',
+            'Cache-Control': f'public, max-age={self.index_page.max_age}',
+            'Vary': 'Accept-Encoding',
+            'ETag': etag,
+        }
+        if request.headers.get('if-none-match') == etag:
+            return 304, headers, b''
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return 200, headers, body
+
+    def _read_store(self, request: Request) -> Tuple[Any, Dict[str, Any]]:
+        """
+        Lookups a request reads from.
+
+        Returns:
+            The live lookups, or those of the snapshot for ?consistency=snapshot
+            (None while there is none), and the fields to add to the response
+        """
+        if request.args.get('consistency') != 'snapshot':
+            return self.data, {}
+        if self.snapshot is None or self.snapshot.data is None:
+            return None, {}
+        return self.snapshot_data, {"snapshot": self.snapshot.describe()}
+
+    async def _mailbox(self, request: Request, kind: Optional[str],
+                       address: Optional[str]) -> Response:
+        """Serve a page of /all, /from/<address> or /to/<address>."""
+        limit, offset, summary = _page_args(request)
+        extra: Dict[str, Any] = {}
+        if kind == 'sender':
+            messages = await self.data.get_messages_from(address, limit=limit, offset=offset, summary=summary)
+            total_count = await self.data.get_message_count(sender=address)
+        elif kind == 'recipient':
+            unread = request.args.get('unread') in ('1', 'true')
+            messages = await self.data.get_messages_to(
+                address, limit=limit, offset=offset, summary=summary, unread=unread
+            )
+            unread_count = await self.data.get_unread_count(address)
+            total_count = unread_count if unread else \
+                await self.data.get_message_count(recipient=address)
+        else:
+            store, extra = self._read_store(request)
+            if store is None:
+                return _error("No snapshot available", 503)
+            messages = await store.get_all_messages(limit=limit, offset=offset, summary=summary)
+            total_count = await store.get_message_count()
+
+        pagination = {
+            "limit": limit,
+            "offset": offset,
+            "total": total_count,
+            "has_more": offset + limit < total_count
+        }
+        if kind == 'recipient':
+            pagination["unread"] = unread_count
+        return _json({"messages": messages, "pagination": pagination, **extra})
+
+    async def _search(self, request: Request) -> Response:
+        """Get the messages matching every given filter (from, to, domain, subject, since, until)."""
+        limit, offset, summary = _page_args(request)
+        try:
+            since, until = (
+                parse_timestamp(request.args[name]) if request.args.get(name) else None
+                for name in ('since', 'until')
+            )
+        except ValueError:
+            return _error("limit and offset must be numbers, since and until "
+                          "epoch seconds or ISO 8601 times", 400)
+
+        store, extra = self._read_store(request)
+        if store is None:
+            return _error("No snapshot available", 503)
+        # One extra row tells whether there is another page
+        messages = await store.search_messages(
+            sender=request.args.get('from'), recipient=request.args.get('to'),
+            domain=request.args.get('domain'), subject=request.args.get('subject'),
+            since=since, until=until, limit=limit + 1, offset=offset, summary=summary
+        )
+        return _json({
+            "messages": messages[:limit],
+            "pagination": {
+                "limit": limit,
+                "offset": offset,
+                "has_more": len(messages) > limit
+            },
+            **extra
+        })
+
+    async def _header(self, request: Request, name: str, value: str) -> Response:
+        """Get the messages carrying an indexed header value."""
+        limit, offset, summary = _page_args(request)
+        # One extra row tells whether there is another page
+        messages = await self.data.get_messages_by_header(
+            name, value, limit=limit + 1, offset=offset, summary=summary
+        )
+        return _json({
+            "messages": messages[:limit],
+            "pagination": {
+                "limit": limit,
+                "offset": offset,
+                "has_more": len(messages) > limit
+            }
+        })
+
+    async def _stats(self, request: Request) -> Response:
+        """Message counts and bytes per recipient domain, sender, hour or mailbox."""
+        try:
+            limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
+            since, until = (
+                parse_timestamp(request.args[name]) if request.args.get(name) else None
+                for name in ('since', 'until')
+            )
+            by = request.args.get('by', 'domain')
+            store, extra = self._read_store(request)
+            if store is None:
+                return _error("No snapshot available", 503)
+            stats = await store.get_stats(
+                by=by, since=since, until=until, sender=request.args.get('from'),
+                domain=request.args.get('domain'), limit=limit
+            )
+        except ValueError:
+            return _error("by must be domain, sender, hour or mailbox, limit a number, "
+                          "since and until epoch seconds or ISO 8601 times", 400)
+        return _json({"by": by, "stats": stats, **extra})
+
+    async def _changes(self, request: Request) -> Response:
+        """Messages stored and deleted after ?after=<seq>, in order, for incremental sync."""
+        try:
+            after = int(request.args.get('after', 0))
+            limit = min(int(request.args.get('limit', 100)), 1000)  # Max 1000 per request
+            if after < 0 or limit < 1:
+                raise ValueError(after)
+        except ValueError:
+            return _error("after must be a sequence number, limit a positive number", 400)
+        # One extra row tells whether there is another page
+        changes = await self.data.get_changes(
+            after, limit=limit + 1, summary=request.args.get('view') == 'summary'
+        )
+        changes, has_more = changes[:limit], len(changes) > limit
+        return _json({
+            "changes": changes,
+            "next": changes[-1]["seq"] if changes else after,
+            "has_more": has_more
+        })
+
+    async def _mark_read(self, request: Request, recipient: str, seen: bool) -> Response:
+        """Mark one message (?id=) or the whole mailbox of a recipient read or unread."""
+        msg_id = request.args.get('id')
+        try:
+            msg_id = int(msg_id) if msg_id is not None else None
+        except ValueError:
+            return _error("id must be a message id", 400)
+        try:
+            updated = await self.data.mark_read(recipient, msg_id, seen=seen)
+            unread = await self.data.get_unread_count(recipient)
+        except Exception as e:
+            logger.error(f"Error marking messages to {recipient}: {e}")
+            return _error("Failed to update messages", 500)
+        return _json({"updated": updated, "unread": unread})
+
+    async def _latest_code(self, request: Request, recipient: str) -> Response:
+        """Get the code of the newest message to a recipient that has one (?kind= for custom tokens)."""
+        kind = request.args.get('kind', 'code')
+        token = await self.data.get_latest_token(recipient, kind)
+        if token is None:
+            return _error(f"No {kind} found", 404)
+        return _json(dict(token, kind=kind))
+
+    async def _links(self, request: Request, recipient: str) -> Response:
+        """Get the links of the newest messages to a recipient."""
+        limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
+        links = await self.data.get_tokens(recipient, 'link', limit=limit)
+        return _json({"links": links})
+
+    async def _wait(self, request: Request, recipient: str) -> Response:
+        """
+        Long-poll for mail to a recipient.
+
+        Returns the messages newer than ?after=<id> (default: the newest
+        message at the time of the request) as soon as there are any, or
+        an empty list after ?timeout= seconds (default 30).
+        """
+        timeout = min(float(request.args.get('timeout', 30)), MAX_WAIT)
+        summary = request.args.get('view') == 'summary'
+        after = request.args.get('after')
+        if after is None:
+            newest = await self.data.get_messages_to(recipient, limit=1, summary=True)
+            after = newest[0]['id'] if newest else 0
+        after = int(after)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            # Listening before looking, so mail stored in between is not missed
+            with self.data.listening(recipient) as waiter:
+                messages = await self.data.get_messages_to(recipient, limit=100, summary=summary)
+                messages = [m for m in messages if m['id'] > after]
+                if messages or self._closing or time.monotonic() >= deadline:
+                    return _json({"messages": messages[::-1], "after": after})
+                if not await self.data.arrival(waiter, max(0.0, deadline - time.monotonic())):
+                    return _json({"messages": [], "after": after})
+
+    async def _message(self, request: Request, msg_id: int) -> Response:
+        """Get a message, or one of its renditions with ?part=text|html."""
+        part = request.args.get('part')
+        if part is not None and part not in MESSAGE_PARTS:
+            return _error(f"part must be one of: {', '.join(MESSAGE_PARTS)}", 400)
+
+        if part is None:
+            summary = request.args.get('view') == 'summary'
+            message = await self.data.get_message(msg_id, summary=summary)
+            if message is None:
+                return _error("Message not found", 404)
+            if not summary:
+                message["parts"] = await self.data.get_message_parts(msg_id) or ["text"]
+            return _json(message)
+
+        body = await self.data.get_message_part(msg_id, part)
+        if body is None:
+            return _error("Message not found", 404)
+
+        data = body.encode('utf-8')
+        etag = f'"{hashlib.sha1(data).hexdigest()}"'
+        headers = {
+            'Content-Type': f"{'text/html' if part == 'html' else 'text/plain'}; charset=utf-8",
+            # Stored renditions never change, let clients reuse them
+            'Cache-Control': 'private, max-age=86400',
+            'ETag': etag,
+        }
+        if part == 'html':
+            # Already sanitized; the CSP keeps direct views inert as well
+            headers['Content-Security-Policy'] = (
+                "sandbox; default-src 'none'; img-src * data:; style-src 'unsafe-inline'"
+            )
+        if request.headers.get('if-none-match') == etag:
+            return 304, headers, b''
+        return 200, headers, data
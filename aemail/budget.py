@@ -0,0 +1,94 @@
+"""
+Memory budget of the in-memory database.
+"""
+
+import threading
+from typing import Any, Dict, Optional
+
+from .config import Config
+
+
+# What happens to the oldest mail once the budget is exceeded
+OVERFLOW_POLICIES = ("evict", "spill")
+
+
+class MemoryBudget:
+    """
+    Bound on the pages an in-memory database may use.
+
+    EmailData checks the database size after every store. With 'evict',
+    the oldest messages are deleted until the database is back under
+    low_water of the budget; with 'spill', the whole database moves to a
+    temporary file once, after which SQLite keeps only a page cache of
+    the budget's size in memory and everything stays queryable.
+    """
+
+    def __init__(self, max_bytes: int, overflow: str = "evict",
+                 spill_dir: Optional[str] = None, low_water: float = 0.9):
+        """
+        Initialize the budget.
+
+        Args:
+            max_bytes: Most bytes of database pages kept in memory
+            overflow: 'evict' or 'spill'
+            spill_dir: Directory of the spill file (default: the system temporary directory)
+            low_water: Fraction of max_bytes eviction brings the database down to
+
+        Raises:
+            ValueError: If overflow is not a known policy
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown memory overflow policy {overflow!r}; "
+                             f"use one of {', '.join(OVERFLOW_POLICIES)}")
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        self.counters = {
+            "evictions": 0,
+            "evicted": 0,
+            "spills": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config: Config) -> Optional['MemoryBudget']:
+        """Create a budget from the [memory] section, or None if memory is unbounded."""
+        section = config.config
+        max_mb = section.getfloat('memory', 'max_mb', fallback=0.0)
+        if max_mb <= 0:
+            return None
+        return cls(
+            int(max_mb * 1024 * 1024),
+            overflow=section.get('memory', 'overflow', fallback='evict').strip().lower(),
+            spill_dir=section.get('memory', 'spill_dir', fallback='').strip() or None,
+        )
+
+    @property
+    def target_bytes(self) -> int:
+        """Size eviction brings the database down to."""
+        return int(self.max_bytes * self.low_water)
+
+    def record_eviction(self, messages: int):
+        """Count one eviction pass and the messages it deleted."""
+        with self._lock:
+            self.counters["evictions"] += 1
+            self.counters["evicted"] += messages
+
+    def record_spill(self):
+        """Count a move of the database to its spill file."""
+        with self._lock:
+            self.counters["spills"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of the budget and its counters.
+
+        Returns:
+            Dictionary with max_bytes, overflow and the counters
+        """
+        with self._lock:
+            stats: Dict[str, Any] = dict(self.counters)
+        stats["max_bytes"] = self.max_bytes
+        stats["overflow"] = self.overflow
+        return stats
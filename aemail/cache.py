@@ -0,0 +1,265 @@
+"""
+In-process cache of the newest messages per mailbox.
+"""
+
+import threading
+from bisect import insort
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from .config import Config
+
+
+# Rough per-message overhead of the cached dictionaries, in bytes
+MESSAGE_OVERHEAD = 400
+
+
+class _Mailbox:
+    """The newest messages of one mailbox, newest first, and its total count."""
+
+    __slots__ = ("items", "total", "nbytes")
+
+    def __init__(self, total: int):
+        # (-created_at, -id, message, size) tuples, so sorting puts the newest first
+        self.items: List[Tuple[int, int, Dict[str, Any], int]] = []
+        self.total = total
+        self.nbytes = 0
+
+    @property
+    def complete(self) -> bool:
+        """Whether every message of the mailbox is cached."""
+        return len(self.items) >= self.total
+
+
+def _message_bytes(message: Dict[str, Any]) -> int:
+    """Estimate the memory held by a cached message."""
+    text = (message.get("content") or "", message.get("subject") or "",
+            message.get("from") or "", message.get("to0") or "")
+    return MESSAGE_OVERHEAD + sum(len(s) for s in text) + sum(len(a) for a in message.get("to") or ())
+
+
+class MessageCache:
+    """
+    Newest N messages per recipient and per sender, with LRU eviction.
+
+    A mailbox is cached as the top of its newest-first order plus its total
+    message count, so first pages and counts are served without a query.
+    Mailboxes are filled on the first read, or when their first message
+    is stored, and kept current write-through by store_message. Least
+    recently used mailboxes are evicted once the mailbox count or the
+    estimated memory use exceeds its bound.
+
+    Writes that bypass EmailData (another process on the same database
+    file) are not seen; the cache is meant for a single server process.
+    """
+
+    def __init__(self, max_mailboxes: int = 1024, per_mailbox: int = 20,
+                 max_bytes: int = 64 * 1024 * 1024):
+        """
+        Initialize the cache.
+
+        Args:
+            max_mailboxes: Mailboxes kept (recipients and senders together)
+            per_mailbox: Newest messages kept per mailbox
+            max_bytes: Estimated memory bound for the cached messages
+        """
+        self.max_mailboxes = max_mailboxes
+        self.per_mailbox = per_mailbox
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._mailboxes: "OrderedDict[Tuple[str, str], _Mailbox]" = OrderedDict()
+        self._nbytes = 0
+        # Message id -> [message, size, number of mailboxes holding it]
+        self._by_id: Dict[int, list] = {}
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "id_hits": 0,
+            "id_misses": 0,
+            "evictions": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config: Config) -> Optional['MessageCache']:
+        """Create a cache from the [cache] section, or None if it is disabled."""
+        section = config.config
+        max_mailboxes = section.getint('cache', 'mailboxes', fallback=1024)
+        per_mailbox = section.getint('cache', 'per_mailbox', fallback=20)
+        max_mb = section.getfloat('cache', 'max_mb', fallback=64.0)
+        if max_mailboxes <= 0 or per_mailbox <= 0 or max_mb <= 0:
+            return None
+        return cls(max_mailboxes, per_mailbox, int(max_mb * 1024 * 1024))
+
+    def _add_item(self, mailbox: _Mailbox, message: Dict[str, Any], created_at: int, size: int):
+        """Insert a message into a mailbox in newest-first order."""
+        # Ids are unique, so tuples never get as far as comparing the dicts
+        insort(mailbox.items, (-(created_at or 0), -message["id"], message, size))
+        nbytes = _message_bytes(message)
+        mailbox.nbytes += nbytes
+        self._nbytes += nbytes
+        entry = self._by_id.setdefault(message["id"], [message, size, 0])
+        entry[2] += 1
+        while len(mailbox.items) > self.per_mailbox:
+            self._drop_item(mailbox, mailbox.items.pop())
+
+    def _drop_item(self, mailbox: _Mailbox, item: tuple):
+        """Account for a message leaving a mailbox."""
+        nbytes = _message_bytes(item[2])
+        mailbox.nbytes -= nbytes
+        self._nbytes -= nbytes
+        entry = self._by_id.get(-item[1])
+        if entry is not None:
+            entry[2] -= 1
+            if entry[2] <= 0:
+                del self._by_id[-item[1]]
+
+    def _remove(self, key: Tuple[str, str]):
+        """Drop a mailbox."""
+        mailbox = self._mailboxes.pop(key, None)
+        if mailbox is not None:
+            for item in mailbox.items:
+                self._drop_item(mailbox, item)
+
+    def _evict(self):
+        """Drop least recently used mailboxes until within the bounds."""
+        while self._mailboxes and (len(self._mailboxes) > self.max_mailboxes
+                                   or self._nbytes > self.max_bytes):
+            self._remove(next(iter(self._mailboxes)))
+            self.counters["evictions"] += 1
+
+    def fill(self, key: Tuple[str, str], rows: List[Tuple[Dict[str, Any], int, int]], total: int):
+        """
+        Cache the newest messages of a mailbox read from the database.
+
+        Args:
+            key: ('to' or 'from', canonical address)
+            rows: (message, created_at, size) of the newest messages, newest first
+            total: Number of messages in the mailbox
+        """
+        with self._lock:
+            self._remove(key)
+            mailbox = _Mailbox(total)
+            for message, created_at, size in rows[:self.per_mailbox]:
+                self._add_item(mailbox, message, created_at, size)
+            self._mailboxes[key] = mailbox
+            self._evict()
+
+    def add(self, key: Tuple[str, str], message: Dict[str, Any], created_at: int,
+            size: int, new_mailbox: bool = False):
+        """
+        Record a newly stored message.
+
+        Args:
+            key: ('to' or 'from', canonical address)
+            message: Message dictionary including its id
+            created_at: Epoch timestamp of the message
+            size: Message size in bytes
+            new_mailbox: The message is the first of its mailbox, so an
+                         uncached mailbox can be cached complete
+        """
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            if mailbox is None:
+                if not new_mailbox:
+                    return
+                mailbox = self._mailboxes[key] = _Mailbox(0)
+            elif any(item[1] == -message["id"] for item in mailbox.items):
+                # Filled by a read that already saw the committed message
+                return
+
+            mailbox.total += 1
+            self._mailboxes.move_to_end(key)
+            order = (-(created_at or 0), -message["id"])
+            if (len(mailbox.items) < mailbox.total - 1 and mailbox.items
+                    and order > mailbox.items[-1][:2]):
+                # Older than everything cached of a partially cached mailbox
+                return
+            self._add_item(mailbox, message, created_at, size)
+            self._evict()
+
+    def invalidate(self, key: Tuple[str, str]):
+        """Forget a mailbox."""
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """Forget everything."""
+        with self._lock:
+            self._mailboxes.clear()
+            self._by_id.clear()
+            self._nbytes = 0
+
+    def page(self, key: Tuple[str, str], limit: int, offset: int,
+             summary: bool) -> Optional[List[Dict[str, Any]]]:
+        """
+        Serve a page of a mailbox from the cache.
+
+        Args:
+            key: ('to' or 'from', canonical address)
+            limit: Page size
+            offset: Messages to skip
+            summary: Return summaries (with size, without content)
+
+        Returns:
+            Copies of the cached messages, or None on a miss
+        """
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            if mailbox is None or (offset + limit > len(mailbox.items) and not mailbox.complete):
+                self.counters["misses"] += 1
+                return None
+            self._mailboxes.move_to_end(key)
+            self.counters["hits"] += 1
+            items = mailbox.items[offset:offset + limit]
+        return [self._copy(message, size, summary) for _, _, message, size in items]
+
+    def count(self, key: Tuple[str, str]) -> Optional[int]:
+        """Total messages of a cached mailbox, or None if it is not cached."""
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            return mailbox.total if mailbox is not None else None
+
+    def get(self, msg_id: int, summary: bool) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached message by id.
+
+        Args:
+            msg_id: Message id
+            summary: Return the summary (with size, without content)
+
+        Returns:
+            Copy of the message, or None on a miss
+        """
+        with self._lock:
+            entry = self._by_id.get(msg_id)
+            if entry is None:
+                self.counters["id_misses"] += 1
+                return None
+            self.counters["id_hits"] += 1
+        return self._copy(entry[0], entry[1], summary)
+
+    @staticmethod
+    def _copy(message: Dict[str, Any], size: int, summary: bool) -> Dict[str, Any]:
+        """Copy a cached message so callers cannot modify the cache."""
+        copy = dict(message)
+        copy["to"] = list(message["to"])
+        if summary:
+            del copy["content"]
+            copy["size"] = size
+        return copy
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of the cache counters and occupancy.
+
+        Returns:
+            Dictionary of counters, hit ratio, mailboxes and estimated bytes
+        """
+        with self._lock:
+            stats: Dict[str, Any] = dict(self.counters)
+            stats["mailboxes"] = len(self._mailboxes)
+            stats["messages"] = len(self._by_id)
+            stats["bytes"] = self._nbytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else None
+        return stats
@@ -9,7 +9,13 @@ from pathlib import Path
 from typing import Optional
 
 from .config import Config
+from .data import EmailData
+from .email_handler import BUILTIN_STAGES, DEFAULT_STAGES
+from .handoff import inherited_fds, wait_for_predecessor
+from .importer import MailImporter
+from .pipeline import Pipeline
 from .server import EmailServer
+from .utils import AddressNormalizer
 
 
 def create_parser() -> argparse.ArgumentParser:
@@ -35,6 +41,12 @@ Examples:
   # Start server with debug logging
   aemail-server --verbose
 
+  # Restart without dropping connections (drains, then hands over the sockets)
+  kill -USR2 <pid>
+
+  # Bulk import an mbox, a Maildir or a directory of .eml files
+  aemail-server import --db-file /path/to/emails.db corpus.mbox maildir/ eml/
+
 Environment Variables:
   SMTP_HOST     - SMTP server host (default: :: - all interfaces)
   SMTP_PORT     - SMTP server port (default: 25)
@@ -83,6 +95,53 @@ Environment Variables:
         action="version",
         version="%(prog)s 0.1.0"
     )
+
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+
+    import_parser = subparsers.add_parser(
+        "import",
+        help="Bulk import mbox, Maildir or .eml corpora into the database"
+    )
+
+    import_parser.add_argument(
+        "paths",
+        nargs="+",
+        help="mbox files, Maildir directories, .eml files or directories of .eml files"
+    )
+
+    import_parser.add_argument(
+        "--db-file",
+        type=str,
+        default=argparse.SUPPRESS,
+        help="SQLite database file path to import into"
+    )
+
+    import_parser.add_argument(
+        "--format",
+        choices=["auto", "mbox", "maildir", "eml"],
+        default="auto",
+        help="Corpus format (default: detect from each path)"
+    )
+
+    import_parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Parser processes (default: one per CPU, 1 parses in-process)"
+    )
+
+    import_parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="Messages per insert transaction (default: 1000)"
+    )
+
+    import_parser.add_argument(
+        "--keep-indexes",
+        action="store_true",
+        help="Keep indexes during the load instead of rebuilding them at the end"
+    )
     
     return parser
 
@@ -138,10 +197,36 @@ def create_config(args) -> Config:
     return config
 
 
+def run_import(args, config: Config) -> None:
+    """Run the bulk import subcommand."""
+    if not args.db_file:
+        raise ValueError("import requires --db-file")
+
+    data_store = EmailData(
+        args.db_file,
+        normalizer=AddressNormalizer(config.strip_plus_domains, config.fold_dot_domains)
+    )
+    # Imported mail goes through the same [pipeline] stages as received mail
+    pipeline = Pipeline.from_config(config, BUILTIN_STAGES, DEFAULT_STAGES)
+    try:
+        importer = MailImporter(
+            data_store,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            defer_indexes=not args.keep_indexes,
+            pipeline=pipeline
+        )
+        importer.run(args.paths, fmt=args.format)
+    finally:
+        pipeline.close()
+        data_store.close()
+
+
 def main():
     """Main entry point for the command line interface."""
     parser = create_parser()
     args = parser.parse_args()
+    logger = logging.getLogger(__name__)
     
     try:
         # Setup logging
@@ -149,12 +234,15 @@ def main():
         
         # Validate arguments
         validate_args(args)
-        
+
         # Create configuration
         config = create_config(args)
+
+        if args.command == "import":
+            run_import(args, config)
+            return
         
         # Print startup information
-        logger = logging.getLogger(__name__)
         logger.info("Starting AEmail Server")
         logger.info(f"SMTP: {config.smtp_host}:{config.smtp_port}")
 
@@ -172,8 +260,13 @@ def main():
         else:
             logger.info("Database: in-memory")
         
+        # Started by a restart: the old process holds the database until it
+        # has drained, and hands over its listening sockets
+        listen_fds = inherited_fds()
+        wait_for_predecessor()
+
         # Create and start server
-        with EmailServer(config=config, db_path=args.db_file) as server:
+        with EmailServer(config=config, db_path=args.db_file, listen_fds=listen_fds) as server:
             server.start()
             
     except KeyboardInterrupt:
@@ -0,0 +1,271 @@
+"""
+Negotiated response compression and precompressed static assets.
+"""
+
+import gzip
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from flask import Flask, Request, Response, request
+
+from .config import Config
+
+try:
+    import brotli
+except ImportError:  # Optional dependency; gzip is always available
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+# Content types worth compressing; images and archives are already compressed
+COMPRESSIBLE_TYPES = frozenset({
+    'application/json', 'application/javascript', 'image/svg+xml',
+    'text/css', 'text/html', 'text/javascript', 'text/plain', 'text/xml',
+})
+
+
+def _accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into encoding -> quality."""
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Pick the response encoding for an Accept-Encoding header.
+
+    Brotli is preferred when installed, then gzip.
+
+    Args:
+        accept_encoding: Accept-Encoding request header
+
+    Returns:
+        'br', 'gzip', or None to send the response uncompressed
+    """
+    if not accept_encoding:
+        return None
+    accepted = _accepted_encodings(accept_encoding)
+    wildcard = accepted.get('*', 0.0)
+    candidates = ('br', 'gzip') if brotli is not None else ('gzip',)
+    best, best_quality = None, 0.0
+    for encoding in candidates:
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """
+    Compress a response body.
+
+    Args:
+        data: Uncompressed body
+        encoding: 'br' or 'gzip'
+        level: Brotli quality (0-11) or gzip level (1-9)
+
+    Returns:
+        Compressed body
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+class ResponseCompressor:
+    """Compresses API responses according to the client's Accept-Encoding."""
+
+    def __init__(self, min_size: int = 1024, level: int = 6, brotli_quality: int = 4):
+        """
+        Initialize the compressor.
+
+        Args:
+            min_size: Smallest body in bytes worth compressing; 0 disables compression
+            level: gzip compression level (1-9)
+            brotli_quality: Brotli quality (0-11), used when brotli is installed
+        """
+        self.min_size = min_size
+        self.levels = {
+            'gzip': min(9, max(1, level)),
+            'br': min(11, max(0, brotli_quality)),
+        }
+        self.counters = {
+            'responses_compressed': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'ResponseCompressor':
+        """Create a compressor from the [compression] section of the configuration."""
+        section = config.config
+        return cls(
+            min_size=section.getint('compression', 'min_size', fallback=1024),
+            level=section.getint('compression', 'level', fallback=6),
+            brotli_quality=section.getint('compression', 'brotli_quality', fallback=4),
+        )
+
+    def init_app(self, app: Flask):
+        """Compress the responses of a Flask application."""
+        app.after_request(self.process_response)
+
+    def process_response(self, response: Response) -> Response:
+        """
+        Compress a response if the client accepts it and it is worth it.
+
+        Args:
+            response: Outgoing response
+
+        Returns:
+            The response, compressed in place when applicable
+        """
+        if not self.min_size or response.status_code != 200:
+            return response
+        if response.direct_passthrough or response.is_streamed:
+            return response
+        if 'Content-Encoding' in response.headers:
+            return response
+        if response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding, body = self.encode(response.get_data(), request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+
+        # The encoded body differs byte-wise, so a strong validator becomes weak
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def encode(self, data: bytes, accept_encoding: Optional[str]) -> Tuple[Optional[str], bytes]:
+        """
+        Compress a response body if the client accepts it and it is worth it.
+
+        The caller decides whether the response is eligible (status, type).
+
+        Args:
+            data: Uncompressed body
+            accept_encoding: Accept-Encoding request header
+
+        Returns:
+            Tuple of (encoding, body); encoding is None if the body is unchanged
+        """
+        if not self.min_size or len(data) < self.min_size:
+            return None, data
+        encoding = negotiate_encoding(accept_encoding)
+        if encoding is None:
+            return None, data
+
+        body = compress(data, encoding, self.levels[encoding])
+        self.counters['responses_compressed'] += 1
+        self.counters['bytes_in'] += len(data)
+        self.counters['bytes_out'] += len(body)
+        return encoding, body
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of the compression counters.
+
+        Returns:
+            Dictionary of counters and the overall compression ratio
+        """
+        stats: Dict[str, Any] = dict(self.counters)
+        stats['brotli'] = brotli is not None
+        stats['ratio'] = (
+            round(self.counters['bytes_in'] / self.counters['bytes_out'], 2)
+            if self.counters['bytes_out'] else None
+        )
+        return stats
+
+
+class StaticAsset:
+    """A static file loaded once and kept in memory with its compressed variants."""
+
+    def __init__(self, data: bytes, mimetype: str, max_age: int = 86400):
+        """
+        Initialize the asset.
+
+        Args:
+            data: File contents
+            mimetype: Content type to serve it as
+            max_age: Cache-Control max-age in seconds
+        """
+        self.mimetype = mimetype
+        self.max_age = max_age
+        self.etag = hashlib.sha256(data).hexdigest()[:32]
+        self.variants: Dict[Optional[str], bytes] = {None: data}
+
+        # Compress once at the highest levels; every request reuses the result
+        self.variants['gzip'] = compress(data, 'gzip', 9)
+        if brotli is not None:
+            self.variants['br'] = compress(data, 'br', 11)
+
+    @classmethod
+    def load(cls, path: Path, mimetype: str = 'text/html',
+             max_age: int = 86400) -> Optional['StaticAsset']:
+        """
+        Load a static file.
+
+        Args:
+            path: File to load
+            mimetype: Content type to serve it as
+            max_age: Cache-Control max-age in seconds
+
+        Returns:
+            The asset, or None if the file does not exist
+        """
+        try:
+            return cls(path.read_bytes(), mimetype, max_age)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.error(f"Error loading static file {path}: {e}")
+            return None
+
+    def variant(self, accept_encoding: Optional[str]) -> Tuple[Optional[str], bytes]:
+        """Pick the stored variant matching an Accept-Encoding header."""
+        encoding = negotiate_encoding(accept_encoding)
+        if encoding not in self.variants:
+            encoding = None
+        return encoding, self.variants[encoding]
+
+    def response(self, request: Request) -> Response:
+        """
+        Build the response for a request, honouring conditional headers.
+
+        Args:
+            request: Incoming request
+
+        Returns:
+            200 response with the negotiated variant, or 304 if unchanged
+        """
+        encoding, body = self.variant(request.headers.get('Accept-Encoding'))
+        response = Response(body, mimetype=self.mimetype)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = f'public, max-age={self.max_age}'
+        # One validator per variant keeps shared caches from mixing encodings
+        response.set_etag(f'{self.etag}-{encoding}' if encoding else self.etag)
+        return response.make_conditional(request)
@@ -6,7 +6,7 @@ import configparser
 import os
 import socket
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterable, List, Optional
 
 
 class Config:
@@ -27,6 +27,9 @@ class Config:
         # Load from file if exists
         if config_file is None:
             config_file = "cfg.ini"
+
+        self.config_file = config_file
+        self._mtime = self._file_mtime()
         
         if os.path.exists(config_file):
             self.config.read(config_file)
@@ -45,6 +48,17 @@ class Config:
 
         self.config.add_section('rest')
         self.config.set('rest', 'port', '14000')
+
+        self.config.add_section('addresses')
+        self.config.set('addresses', 'strip_plus_tags', '')
+        self.config.set('addresses', 'fold_dots', '')
+
+        self.config.add_section('routing')
+        self.config.set('routing', 'default', 'accept')
+        self.config.set('routing', 'reload_interval', '5')
+
+        # Recipient rules: pattern = accept | reject | discard
+        self.config.add_section('routes')
     
     def _load_from_env(self):
         """Load configuration from environment variables."""
@@ -78,6 +92,87 @@ class Config:
         """Get REST API port."""
         return self.config.getint('rest', 'port')
     
+    @property
+    def strip_plus_domains(self) -> List[str]:
+        """Get domains whose plus-tags are ignored in address lookups."""
+        return self._get_list('addresses', 'strip_plus_tags')
+
+    @property
+    def fold_dot_domains(self) -> List[str]:
+        """Get domains whose local-part dots are ignored in address lookups."""
+        return self._get_list('addresses', 'fold_dots')
+
+    @property
+    def routing_default_action(self) -> str:
+        """Get the routing action for recipients no rule matches."""
+        return self.config.get('routing', 'default', fallback='accept').strip().lower()
+
+    @property
+    def routing_reload_interval(self) -> float:
+        """Get seconds between checks of the config file for routing changes."""
+        return self.config.getfloat('routing', 'reload_interval', fallback=5.0)
+
+    @property
+    def profile_queries(self) -> bool:
+        """Get whether per-statement database timings are collected."""
+        return self.config.getboolean('database', 'profile_queries', fallback=False)
+
+    @property
+    def routing_rules(self) -> Dict[str, str]:
+        """Get recipient routing rules as a pattern to action mapping."""
+        return dict(self.config.items('routes'))
+
+    @property
+    def extractors(self) -> Dict[str, str]:
+        """Get token extractor settings: 'code'/'link' switches and custom kind patterns."""
+        if not self.config.has_section('extractors'):
+            return {}
+        # Raw, so that patterns may contain '%'
+        return dict(self.config.items('extractors', raw=True))
+
+    def _file_mtime(self) -> Optional[float]:
+        """Get the modification time of the config file, if it exists."""
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def refresh(self, sections: Iterable[str]) -> bool:
+        """
+        Re-read sections from the config file if it changed on disk.
+
+        Only the given sections are replaced, so command line and
+        environment overrides of other sections are kept. Options the
+        file no longer sets fall back to their defaults.
+
+        Args:
+            sections: Names of the sections to reload
+
+        Returns:
+            True if the file changed and the sections were reloaded
+        """
+        mtime = self._file_mtime()
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+
+        fresh = configparser.ConfigParser()
+        if mtime is not None:
+            fresh.read(self.config_file)
+
+        for section in sections:
+            self.config.remove_section(section)
+            self.config.add_section(section)
+            if fresh.has_section(section):
+                for option, value in fresh.items(section):
+                    self.config.set(section, option, value)
+        return True
+
+    def _get_list(self, section: str, option: str) -> List[str]:
+        """Get a comma-separated option as a list of non-empty values."""
+        value = self.config.get(section, option, fallback='')
+        return [item.strip() for item in value.split(',') if item.strip()]
+    
     def save(self, config_file: str = "cfg.ini"):
         """
         Save current configuration to file.
@@ -4,82 +4,688 @@ Data access layer for email storage and retrieval.
 
 import datetime
 import json
+import logging
+import math
+import os
 import sqlite3
-from typing import Dict, List, Any, Optional
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Any, Optional, Tuple
 from pathlib import Path
 
+from .budget import MemoryBudget
+from .cache import MessageCache
+from .migrations import (
+    INDEXES,
+    TRIGGER_INDEXES,
+    Migrator,
+    mailbox_addresses,
+    token_rows,
+)
+from .queries import QueryProfile, StatementCatalog
+from .rendering import HTML_CONTENT_MARKER, split_content
+from .utils import AddressNormalizer, header_values
+
+
+logger = logging.getLogger(__name__)
+
+
+MSG_COLUMNS = (
+    "frm, to0, tos, subject, content, created_at, frm_canon, to0_canon, "
+    "text_body, html_body, size"
+)
+INSERT_MSG = f"INSERT INTO msg ({MSG_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# Columns returned by message lookups; the renditions are served separately.
+# rowid is the message id (an alias of the id primary key once migrated).
+SELECT_COLUMNS = "rowid, frm, to0, tos, subject, content, created_at"
+
+# Columns returned by summary lookups, which leave out every body
+SUMMARY_COLUMNS = "rowid, frm, to0, tos, subject, created_at, size"
+
+# Newest first; the id orders messages stored within the same second
+NEWEST_FIRST = "ORDER BY created_at DESC, rowid DESC"
+
+# Recipient lookups walk the mailbox entries of an address newest first
+# and fetch each message by id
+MAILBOX_JOIN = "FROM mailbox AS b JOIN msg AS m ON m.rowid = b.msg_id WHERE b.address = ?"
+MAILBOX_NEWEST_FIRST = "ORDER BY b.created_at DESC, b.msg_id DESC"
+
+# Messages carrying a header value, newest stored first
+HEADER_JOIN = (
+    "FROM msg_header AS h JOIN msg AS m ON m.rowid = h.msg_id "
+    "WHERE h.name = ? AND h.value = ? ORDER BY h.msg_id DESC"
+)
+
+
+def _qualified(columns: str, alias: str) -> str:
+    """Prefix every column of a column list with a table alias."""
+    return ", ".join(f"{alias}.{column.strip()}" for column in columns.split(","))
+
+
+SELECT_TO = f"SELECT {_qualified(SELECT_COLUMNS, 'm')} {MAILBOX_JOIN}"
+SUMMARY_TO = f"SELECT {_qualified(SUMMARY_COLUMNS, 'm')} {MAILBOX_JOIN}"
+
+# Recipient domain of a mailbox entry, as indexed by idx_mailbox_domain
+def _domain_of(alias: str) -> str:
+    return f"substr({alias}.address, instr({alias}.address, '@') + 1)"
+
+
+# Filters of search_messages, and the ways a search can walk the messages:
+# the mailbox of a recipient, the mail of a sender, the mailbox entries of
+# a recipient domain, or every message, each newest first within the time
+# range. The SQL of a walk, and of each filter applied on top of it.
+SEARCH_FILTERS = ("to", "from", "domain", "subject")
+SEARCH_WALKS = {
+    "to": (
+        "FROM mailbox AS b JOIN msg AS m ON m.rowid = b.msg_id "
+        "WHERE b.address = ? AND b.created_at >= ? AND b.created_at < ?",
+        MAILBOX_NEWEST_FIRST,
+    ),
+    "from": (
+        "FROM msg AS m WHERE m.frm_canon = ? AND m.created_at >= ? AND m.created_at < ?",
+        "ORDER BY m.created_at DESC, m.rowid DESC",
+    ),
+    "domain": (
+        "FROM mailbox AS b JOIN msg AS m ON m.rowid = b.msg_id "
+        f"WHERE {_domain_of('b')} = ? AND b.created_at >= ? AND b.created_at < ? "
+        # A message to several addresses of the domain is listed once
+        "AND NOT EXISTS (SELECT 1 FROM mailbox AS d WHERE d.msg_id = b.msg_id "
+        f"AND d.address < b.address AND {_domain_of('d')} = {_domain_of('b')})",
+        "ORDER BY b.created_at DESC, b.msg_id DESC",
+    ),
+    "all": (
+        "FROM msg AS m WHERE m.created_at >= ? AND m.created_at < ?",
+        "ORDER BY m.created_at DESC, m.rowid DESC",
+    ),
+}
+SEARCH_PREDICATES = {
+    # The unary + keeps the sender index from competing with the chosen walk
+    "from": "+m.frm_canon = ?",
+    "to": "EXISTS (SELECT 1 FROM mailbox AS r WHERE r.msg_id = m.rowid AND r.address = ?)",
+    "domain": (
+        "EXISTS (SELECT 1 FROM mailbox AS r WHERE r.msg_id = m.rowid "
+        f"AND {_domain_of('r')} = ?)"
+    ),
+    "subject": "m.subject LIKE ? ESCAPE '\\'",
+}
+
+# Bounded counts of the messages each walk would visit, used to pick the shortest
+SEARCH_ESTIMATES = {
+    "to": "SELECT COUNT(*) FROM (SELECT 1 FROM mailbox "
+          "WHERE address = ? AND created_at >= ? AND created_at < ? LIMIT ?)",
+    "from": "SELECT COUNT(*) FROM (SELECT 1 FROM msg "
+            "WHERE frm_canon = ? AND created_at >= ? AND created_at < ? LIMIT ?)",
+    "domain": "SELECT COUNT(*) FROM (SELECT 1 FROM mailbox AS b "
+              f"WHERE {_domain_of('b')} = ? AND created_at >= ? AND created_at < ? LIMIT ?)",
+    "all": "SELECT COUNT(*) FROM (SELECT 1 FROM msg WHERE created_at >= ? AND created_at < ? LIMIT ?)",
+}
+
+# Walks are only compared up to this many messages; beyond it they are all slow
+SEARCH_PROBE_LIMIT = 10000
+
+# Open ends of a time range
+MIN_TIME, MAX_TIME = -2 ** 62, 2 ** 62
+
+# Groupings of get_stats: the rollup kind each one reads
+STATS_GROUPS = {"domain": "domain", "sender": "sender", "hour": "all", "mailbox": None}
+
+# Message renditions served by get_message_part
+MESSAGE_PARTS = ("text", "html")
+
+# Every statement the hot paths issue, by name. The SQL text is fixed, so
+# each one is compiled once per connection and then served from the
+# statement cache.
+STATEMENTS = {
+    "insert": INSERT_MSG,
+    "insert_mailbox": "INSERT OR IGNORE INTO mailbox (address, created_at, msg_id) VALUES (?, ?, ?)",
+    "messages_to": f"{SELECT_TO} {MAILBOX_NEWEST_FIRST} LIMIT ? OFFSET ?",
+    "summaries_to": f"{SUMMARY_TO} {MAILBOX_NEWEST_FIRST} LIMIT ? OFFSET ?",
+    "unread_messages_to": f"{SELECT_TO} AND b.seen = 0 {MAILBOX_NEWEST_FIRST} LIMIT ? OFFSET ?",
+    "unread_summaries_to": f"{SUMMARY_TO} AND b.seen = 0 {MAILBOX_NEWEST_FIRST} LIMIT ? OFFSET ?",
+    "messages_from": f"SELECT {SELECT_COLUMNS} FROM msg WHERE frm_canon = ? {NEWEST_FIRST} LIMIT ? OFFSET ?",
+    "summaries_from": f"SELECT {SUMMARY_COLUMNS} FROM msg WHERE frm_canon = ? {NEWEST_FIRST} LIMIT ? OFFSET ?",
+    "messages_all": f"SELECT {SELECT_COLUMNS} FROM msg {NEWEST_FIRST} LIMIT ? OFFSET ?",
+    "summaries_all": f"SELECT {SUMMARY_COLUMNS} FROM msg {NEWEST_FIRST} LIMIT ? OFFSET ?",
+    # No row for a mailbox that never received mail
+    "count_to": "SELECT total FROM mailbox_stats WHERE address = ?",
+    "count_unread_to": "SELECT unread FROM mailbox_stats WHERE address = ?",
+    "set_seen": "UPDATE mailbox SET seen = ? WHERE address = ? AND seen != ?",
+    "set_seen_message": "UPDATE mailbox SET seen = ? WHERE msg_id = ? AND address = ? AND seen != ?",
+    "count_from": "SELECT COUNT(*) FROM msg WHERE frm_canon = ?",
+    "count_all": "SELECT total FROM msg_count WHERE id = 0",
+    "count_all_scan": "SELECT COUNT(*) FROM msg",
+    "message": f"SELECT {SELECT_COLUMNS} FROM msg WHERE rowid = ?",
+    "summary": f"SELECT {SUMMARY_COLUMNS} FROM msg WHERE rowid = ?",
+    "text_part": "SELECT text_body, content FROM msg WHERE rowid = ?",
+    "html_part": "SELECT html_body, content FROM msg WHERE rowid = ?",
+    # Whether a message has an HTML rendition, without reading it (messages not
+    # split yet have it when their content carries the HTML marker)
+    "has_html": (
+        "SELECT CASE WHEN html_body IS NULL THEN instr(content, ?) > 0 "
+        "ELSE html_body != '' END FROM msg WHERE rowid = ?"
+    ),
+    "recent_to": f"SELECT {_qualified(SELECT_COLUMNS, 'm')}, m.size {MAILBOX_JOIN} {MAILBOX_NEWEST_FIRST} LIMIT ?",
+    "recent_from": f"SELECT {SELECT_COLUMNS}, size FROM msg WHERE frm_canon = ? {NEWEST_FIRST} LIMIT ?",
+    # The recipients (a JSON array) a stored message is the first message of
+    "first_to": (
+        "SELECT address FROM mailbox_stats "
+        "WHERE address IN (SELECT value FROM json_each(?)) AND total = 1"
+    ),
+    # Counts up to 2, for the same purpose
+    "first_from": "SELECT COUNT(*) FROM (SELECT 1 FROM msg WHERE frm_canon = ? LIMIT 2)",
+    "insert_token": "INSERT INTO msg_token (msg_id, kind, position, value) VALUES (?, ?, ?, ?)",
+    # The change feed after a sequence number; messages deleted since are gone
+    "changes": (
+        f"SELECT c.seq, c.op, c.msg_id, {_qualified(SELECT_COLUMNS, 'm')} FROM msg_change AS c "
+        "LEFT JOIN msg AS m ON m.rowid = c.msg_id AND c.op = 'insert' WHERE c.seq > ? ORDER BY c.seq LIMIT ?"
+    ),
+    "change_summaries": (
+        f"SELECT c.seq, c.op, c.msg_id, {_qualified(SUMMARY_COLUMNS, 'm')} FROM msg_change AS c "
+        "LEFT JOIN msg AS m ON m.rowid = c.msg_id AND c.op = 'insert' WHERE c.seq > ? ORDER BY c.seq LIMIT ?"
+    ),
+    "insert_header": "INSERT OR IGNORE INTO msg_header (name, value, msg_id) VALUES (?, ?, ?)",
+    "messages_by_header": f"SELECT {_qualified(SELECT_COLUMNS, 'm')} {HEADER_JOIN} LIMIT ? OFFSET ?",
+    "summaries_by_header": f"SELECT {_qualified(SUMMARY_COLUMNS, 'm')} {HEADER_JOIN} LIMIT ? OFFSET ?",
+    # Walks the recipient's messages newest first, probing each for tokens
+    "tokens_to": (
+        "SELECT t.value, m.rowid, m.subject, m.created_at FROM mailbox AS b "
+        "JOIN msg_token AS t ON t.msg_id = b.msg_id JOIN msg AS m ON m.rowid = b.msg_id "
+        "WHERE b.address = ? AND t.kind = ? "
+        f"{MAILBOX_NEWEST_FIRST}, t.position LIMIT ?"
+    ),
+    **{f"estimate_{walk}": sql for walk, sql in SEARCH_ESTIMATES.items()},
+    # Busiest keys of a time range, and the hourly series of one key, from the rollups
+    "stats_top": (
+        "SELECT key, SUM(messages) AS total, SUM(bytes) FROM msg_rollup "
+        "WHERE kind = ? AND hour >= ? AND hour < ? GROUP BY key HAVING total > 0 "
+        "ORDER BY total DESC, key LIMIT ?"
+    ),
+    "stats_hours": (
+        "SELECT hour, messages, bytes FROM msg_rollup "
+        "WHERE kind = ? AND key = ? AND hour >= ? AND hour < ? AND messages > 0 "
+        "ORDER BY hour DESC LIMIT ?"
+    ),
+    "stats_mailboxes": (
+        "SELECT address, total, unread FROM mailbox_stats WHERE total > 0 "
+        "ORDER BY total DESC, address LIMIT ?"
+    ),
+    "inbox_position": "SELECT segment, position FROM inbox_checkpoint WHERE id = 0",
+    "set_inbox_position": (
+        "INSERT OR REPLACE INTO inbox_checkpoint (id, segment, position) VALUES (0, ?, ?)"
+    ),
+    "page_count": "PRAGMA page_count",
+    "freelist_count": "PRAGMA freelist_count",
+    "page_size": "PRAGMA page_size",
+    # Eviction: the newest of the oldest messages, the mailboxes they are in, and
+    # the bookkeeping rows they leave behind once deleted
+    "evict_bound": "SELECT MAX(rowid) FROM (SELECT rowid FROM msg ORDER BY rowid LIMIT ?)",
+    "evict_senders": "SELECT DISTINCT frm_canon FROM msg WHERE rowid <= ? AND frm_canon IS NOT NULL",
+    "evict_recipients": "SELECT DISTINCT address FROM mailbox WHERE msg_id <= ?",
+    "evict_oldest": "DELETE FROM msg WHERE rowid <= ?",
+    "latest_change": "SELECT COALESCE(MAX(seq), 0) FROM msg_change",
+    "oldest_webhook_cursor": "SELECT MIN(seq) FROM webhook_cursor",
+    "prune_changes": "DELETE FROM msg_change WHERE seq <= ? AND msg_id <= ?",
+    "prune_mailbox_stats": (
+        "DELETE FROM mailbox_stats WHERE address IN (SELECT value FROM json_each(?)) AND total = 0"
+    ),
+    "prune_rollups": "DELETE FROM msg_rollup WHERE messages <= 0",
+}
+
+# Seconds the connection a database spilled from stays open for lookups still running on it
+SPILL_GRACE = 5.0
+
+# Room in the statement cache for migration and maintenance statements
+STATEMENT_CACHE_SIZE = len(STATEMENTS) + 64
+
 
 class EmailData:
     """Data access object for email storage and retrieval."""
     
-    def __init__(self, db_path: Optional[str] = None):
+    def __init__(self, db_path: Optional[str] = None,
+                 normalizer: Optional[AddressNormalizer] = None,
+                 background_migrations: bool = False,
+                 profile: Optional[QueryProfile] = None,
+                 cache: Optional[MessageCache] = None,
+                 read_only: bool = False,
+                 budget: Optional[MemoryBudget] = None):
         """
         Initialize the data access layer.
         
         Args:
             db_path: Path to SQLite database file. If None, uses in-memory database.
+            normalizer: Address normalizer for the canonical lookup columns.
+                        If None, addresses are only lowercased.
+            background_migrations: Run migration backfills on a background
+                                   thread instead of before returning
+            profile: Record per-statement call counts and timings (optional)
+            cache: Cache of the newest messages per mailbox (optional)
+            read_only: Open an existing database file for lookups only,
+                       as it is: no migrations run (see SnapshotReplica)
+            budget: Memory bound of the in-memory database (optional);
+                    ignored with a database file
         """
+        self.normalizer = normalizer or AddressNormalizer()
+        self.db_path = db_path
+        self.background_migrations = background_migrations
+        self.migration_thread: Optional[threading.Thread] = None
+        self.cache = cache
+        # Called with the canonical recipients of every committed write
+        self.listeners: List[Callable[[List[str]], None]] = []
+        if budget is not None and db_path is not None:
+            logger.warning("The memory budget only applies to the in-memory database; ignored")
+            budget = None
+        self.budget = budget
+        # Temporary file an over-budget in-memory database was moved to
+        self.spill_path: Optional[str] = None
+        # Connection the database was spilled from, and when
+        self._spilled_from: Optional[Tuple[sqlite3.Connection, float]] = None
+        # Held by the thread enforcing the budget; other stores skip the check meanwhile
+        self._budget_lock = threading.Lock()
+        # Set once eviction gave up short of the budget, so the warning is logged once
+        self._budget_exhausted = False
+
         if db_path is None:
-            self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+            self.conn = sqlite3.connect(
+                ":memory:", check_same_thread=False,
+                cached_statements=STATEMENT_CACHE_SIZE
+            )
+        elif read_only:
+            self.conn = sqlite3.connect(
+                f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True,
+                check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE
+            )
         else:
             # Ensure directory exists
             db_file = Path(db_path)
             db_file.parent.mkdir(parents=True, exist_ok=True)
-            self.conn = sqlite3.connect(str(db_file), check_same_thread=False)
+            self.conn = sqlite3.connect(
+                str(db_file), check_same_thread=False,
+                cached_statements=STATEMENT_CACHE_SIZE
+            )
         
-        self._init_database()
+        if not read_only:
+            self._init_database()
+        self.queries = StatementCatalog(self.conn, STATEMENTS, profile)
     
     def _init_database(self):
-        """Initialize database schema."""
-        cursor = self.conn.cursor()
-        
-        # Create messages table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS msg (
-                frm TEXT,
-                to0 TEXT,
-                tos TEXT,
-                subject TEXT,
-                content TEXT,
-                createDate timestamp
+        """Bring the database schema to the current version."""
+        migrator = Migrator(self.conn, self.normalizer)
+        migrator.upgrade()
+
+        if not migrator.pending_backfills():
+            # Restores indexes left dropped by an interrupted bulk load
+            self.create_indexes()
+            return
+        if self.background_migrations and self.db_path is not None:
+            self.migration_thread = threading.Thread(
+                target=self._run_backfills, name="aemail-migrations", daemon=True
             )
-        """)
-        
-        # Create indexes for better query performance
-        cursor.execute("CREATE INDEX IF NOT EXISTS index_frm ON msg (frm)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS index_to0 ON msg (to0)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS index_date ON msg (createDate)")
-        
-        self.conn.commit()
-    
-    def store_message(self, message: Dict[str, Any]) -> None:
+            self.migration_thread.start()
+        else:
+            migrator.run_backfills()
+
+    def _run_backfills(self, batch_size: int = 1000, pause: float = 0.01):
         """
-        Store an email message.
-        
+        Run pending migration backfills on a connection of their own.
+
         Args:
-            message: Dictionary containing email data with keys:
-                    'from', 'to', 'subject', 'content'
+            batch_size: Rows per batch
+            pause: Seconds between batches, so that mail can be stored meanwhile
         """
+        conn = sqlite3.connect(str(self.db_path), timeout=30)
+        try:
+            batches = Migrator(conn, self.normalizer).run_backfills(batch_size, pause)
+            logger.info(f"Schema backfills complete ({batches} batches)")
+        except Exception as e:
+            # Progress is kept; the backfill resumes on the next start
+            logger.error(f"Schema backfill failed: {e}")
+        finally:
+            conn.close()
+
+    def schema_status(self) -> Dict[str, Any]:
+        """
+        Schema version and migration backfill progress.
+
+        Returns:
+            Dictionary with 'version', 'latest' and 'pending_backfills'
+        """
+        return Migrator(self.conn, self.normalizer).status()
+
+    def create_indexes(self):
+        """Create (or rebuild) the secondary indexes of the msg and mailbox tables."""
         cursor = self.conn.cursor()
-        
+        for statement in INDEXES.values():
+            cursor.execute(statement)
+        self.conn.commit()
+
+    def drop_indexes(self):
+        """
+        Drop the secondary indexes of the msg table.
+
+        Used by bulk loads, which are much faster when the indexes are
+        rebuilt once at the end instead of being updated row by row. The
+        mailbox indexes the triggers depend on are kept.
+        """
+        cursor = self.conn.cursor()
+        for name in INDEXES:
+            if name not in TRIGGER_INDEXES:
+                cursor.execute(f"DROP INDEX IF EXISTS {name}")
+        self.conn.commit()
+
+    def _mailbox_rows(self, msg_id: int, message: Dict[str, Any], row: tuple) -> List[tuple]:
+        """
+        Build the mailbox entries of a stored message, one per distinct recipient.
+
+        Args:
+            msg_id: Message id
+            message: Dictionary containing email data
+            row: Its msg table row (see _message_row)
+
+        Returns:
+            (address, created_at, msg_id) tuples
+        """
+        addresses = mailbox_addresses(message.get('to') or [], self.normalizer)
+        return [(address, row[5], msg_id) for address in addresses]
+
+    def _message_row(self, message: Dict[str, Any]) -> tuple:
+        """
+        Build the msg table row for a message dictionary.
+
+        Args:
+            message: Dictionary containing email data
+
+        Returns:
+            Tuple of column values in table order
+        """
         # Extract first recipient for indexing
         to_list = message.get('to', [])
         first_to = to_list[0] if to_list else ''
-        
-        cursor.execute(
-            "INSERT INTO msg VALUES (?, ?, ?, ?, ?, ?)",
-            (
-                message.get('from', ''),
-                first_to,
-                json.dumps(to_list),
-                message.get('subject', ''),
-                message.get('content', ''),
-                datetime.datetime.now()
-            )
+
+        # Imported messages carry their original date, live mail is stamped now
+        created = message.get('date')
+        created_at = int(created.timestamp()) if created else int(time.time())
+
+        sender = message.get('from', '')
+        content = message.get('content', '')
+        canonicalize = self.normalizer.canonicalize
+
+        # Messages from the SMTP and import pipelines come with renditions.
+        # Combined content is split here; plain content is its own text
+        # rendition and is not stored twice
+        text, html = message.get('text'), message.get('html')
+        if text is None and HTML_CONTENT_MARKER in content:
+            text, html = split_content(content)
+
+        # Size of the raw message when known, else of the stored content
+        size = message.get('size')
+        if size is None:
+            size = len(content.encode('utf-8', errors='ignore'))
+
+        return (
+            sender,
+            first_to,
+            json.dumps(to_list),
+            message.get('subject', ''),
+            content,
+            created_at,
+            canonicalize(sender),
+            canonicalize(first_to),
+            text,
+            html,
+            size
         )
-        self.conn.commit()
+
+    def store_message(self, message: Dict[str, Any]) -> None:
+        """
+        Store an email message.
+        
+        Args:
+            message: Dictionary containing email data with keys:
+                    'from', 'to', 'subject', 'content' and optionally
+                    'date' (datetime, defaults to now), 'text' and 'html'
+                    renditions, 'size' (raw message bytes), 'tokens'
+                    ((kind, value) pairs extracted at ingest) and
+                    'headers' ((name, value) pairs to index, see
+                    HeaderExtractor)
+        """
+        row = self._message_row(message)
+        tokens = message.get('tokens')
+        headers = message.get('headers')
+        with self.queries.transaction():
+            msg_id = self.queries.insert("insert", row)
+            entries = self._mailbox_rows(msg_id, message, row)
+            self.queries.execute_many("insert_mailbox", entries)
+            if tokens:
+                self.queries.execute_many("insert_token", token_rows(msg_id, tokens))
+            if headers:
+                self.queries.execute_many(
+                    "insert_header", [(name, value, msg_id) for name, value in headers]
+                )
+        recipients = [entry[0] for entry in entries]
+        if self.cache is not None:
+            self._cache_stored(msg_id, row, recipients)
+        self._notify(recipients)
+        if self.budget is not None:
+            self._enforce_budget()
+
+    def store_messages(self, messages: Iterable[Dict[str, Any]],
+                       inbox_position: Optional[Tuple[int, int]] = None) -> int:
+        """
+        Store many email messages in a single transaction.
+
+        Args:
+            messages: Iterable of message dictionaries (see store_message)
+            inbox_position: (segment, position) of the durable inbox the
+                            messages were indexed up to, recorded in the
+                            same transaction (optional)
+
+        Returns:
+            Number of messages stored
+        """
+        messages = list(messages)
+        rows = [self._message_row(message) for message in messages]
+        if not rows:
+            if inbox_position is not None:
+                self.queries.execute("set_inbox_position", inbox_position)
+            return 0
+
+        # Mailbox entries, token and header rows need the message ids, so
+        # messages go in one by one, and the rows of the batch in one go each
+        entries: List[tuple] = []
+        tokens: List[tuple] = []
+        headers: List[tuple] = []
+        with self.queries.transaction():
+            if inbox_position is not None:
+                self.queries.execute("set_inbox_position", inbox_position)
+            for message, row in zip(messages, rows):
+                msg_id = self.queries.insert("insert", row)
+                entries += self._mailbox_rows(msg_id, message, row)
+                if message.get('tokens'):
+                    tokens += token_rows(msg_id, message['tokens'])
+                headers += [(name, value, msg_id) for name, value in message.get('headers') or ()]
+            self.queries.execute_many("insert_mailbox", entries)
+            if tokens:
+                self.queries.execute_many("insert_token", tokens)
+            if headers:
+                self.queries.execute_many("insert_header", headers)
+        recipients = list({entry[0]: None for entry in entries})
+        if self.cache is not None:
+            # Bulk loads are not tracked one by one; affected mailboxes reload
+            for row in rows:
+                self.cache.invalidate(("from", row[6]))
+            for recipient in recipients:
+                self.cache.invalidate(("to", recipient))
+        self._notify(recipients)
+        if self.budget is not None:
+            self._enforce_budget()
+        return len(rows)
+
+    def database_bytes(self) -> int:
+        """Bytes of database pages in use (free pages left by deletes are reused)."""
+        pages = self.queries.fetch_one("page_count")[0] - self.queries.fetch_one("freelist_count")[0]
+        return pages * self.queries.fetch_one("page_size")[0]
+
+    def _enforce_budget(self):
+        """Evict or spill once the in-memory database outgrows its budget."""
+        if not self._budget_lock.acquire(blocking=False):
+            return
+        try:
+            self._check_budget()
+        finally:
+            self._budget_lock.release()
+
+    def _check_budget(self):
+        """Enforce the budget (called with _budget_lock held)."""
+        if self._spilled_from is not None and time.monotonic() - self._spilled_from[1] > SPILL_GRACE:
+            self._spilled_from[0].close()
+            self._spilled_from = None
+        if self.spill_path is not None or self.database_bytes() <= self.budget.max_bytes:
+            return
+        if self.budget.overflow == "spill":
+            self._spill()
+        else:
+            self._evict()
+
+    def _evict(self):
+        """
+        Delete the oldest messages until the database is back under the budget's low water mark.
+
+        Along with the messages go the rows only they kept alive: their
+        change feed entries that no webhook target still has to read, the
+        counts of mailboxes they emptied and the rollup hours they emptied.
+        The delete entries of this pass stay on the feed for its readers.
+        How much a message frees is measured as eviction goes; once the
+        oldest messages cannot free enough without emptying the table,
+        eviction gives up rather than handing out ids again.
+        """
+        cursor = self.queries.fetch_one("oldest_webhook_cursor")[0]
+        latest = self.queries.fetch_one("latest_change")[0]
+        changes_bound = latest if cursor is None else min(cursor, latest)
+        evicted = reclaimed = 0
+        used = self.database_bytes()
+        while used > self.budget.target_bytes:
+            total = self.queries.fetch_one("count_all")[0]
+            # Bytes a message frees, measured once eviction freed any, the average before
+            per_message = reclaimed / evicted if reclaimed > 0 else used / max(total, 1)
+            batch = math.ceil((used - self.budget.target_bytes) / per_message)
+            if batch >= total:
+                if not self._budget_exhausted:
+                    logger.warning(
+                        f"Evicting cannot bring the in-memory database under {self.budget.target_bytes} "
+                        f"bytes without deleting all {total} messages; keeping them at {used} bytes"
+                    )
+                self._budget_exhausted = True
+                break
+            with self.queries.transaction():
+                newest = self.queries.fetch_one("evict_bound", (batch,))[0]
+                senders = [row[0] for row in self.queries.fetch("evict_senders", (newest,))]
+                recipients = [row[0] for row in self.queries.fetch("evict_recipients", (newest,))]
+                evicted += self.queries.execute("evict_oldest", (newest,))
+                self.queries.execute("prune_changes", (changes_bound, newest))
+                self.queries.execute("prune_mailbox_stats", (json.dumps(recipients),))
+                self.queries.execute("prune_rollups")
+            if self.cache is not None:
+                for sender in senders:
+                    self.cache.invalidate(("from", sender))
+                for recipient in recipients:
+                    self.cache.invalidate(("to", recipient))
+            now = self.database_bytes()
+            reclaimed += used - now
+            used = now
+        else:
+            self._budget_exhausted = False
+        if evicted:
+            self.budget.record_eviction(evicted)
+            logger.info(f"Evicted the {evicted} oldest messages to stay within the memory budget")
+
+    def _spill(self):
+        """Move the in-memory database to a temporary file, keeping a budget-sized page cache."""
+        fd, path = tempfile.mkstemp(prefix="aemail-spill-", suffix=".db", dir=self.budget.spill_dir)
+        os.close(fd)
+        conn = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        # The database was never durable; spilling it should not make writes slower
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute(f"PRAGMA cache_size = -{max(self.budget.max_bytes // 1024, 1)}")
+        with self.queries.write_lock:
+            self.conn.backup(conn)
+            self._spilled_from = (self.conn, time.monotonic())
+            self.conn = conn
+            self.queries.rebind(conn)
+            self.spill_path = path
+        self.budget.record_spill()
+        logger.warning(f"In-memory database exceeded its memory budget; spilled to {path}")
+
+    def storage_status(self) -> Dict[str, Any]:
+        """
+        Where the database lives and how large it is.
+
+        Returns:
+            Dictionary with 'mode' ('file', 'memory' or 'spilled'), page_size,
+            page_count, freelist_count, 'bytes' in use, and the memory
+            budget's counters under 'budget' if there is one
+        """
+        page_size = self.queries.fetch_one("page_size")[0]
+        page_count = self.queries.fetch_one("page_count")[0]
+        freelist_count = self.queries.fetch_one("freelist_count")[0]
+        if self.spill_path is not None:
+            mode = "spilled"
+        else:
+            mode = "memory" if self.db_path is None else "file"
+        status: Dict[str, Any] = {
+            "mode": mode,
+            "page_size": page_size,
+            "page_count": page_count,
+            "freelist_count": freelist_count,
+            "bytes": (page_count - freelist_count) * page_size,
+        }
+        if self.budget is not None:
+            status["budget"] = self.budget.stats()
+        return status
+
+    def _notify(self, recipients: List[str]):
+        """Tell the listeners which mailboxes just received mail."""
+        for listener in self.listeners:
+            try:
+                listener(recipients)
+            except Exception as e:
+                logger.error(f"Error in store listener: {e}")
+
+    def inbox_position(self) -> Optional[Tuple[int, int]]:
+        """
+        Position up to which the durable inbox has been indexed.
+
+        Returns:
+            (segment, position), or None if nothing has been indexed yet
+        """
+        row = self.queries.fetch_one("inbox_position")
+        return tuple(row) if row is not None else None
+
+    def _cache_stored(self, msg_id: int, row: tuple, recipients: List[str]):
+        """
+        Add a stored message to the cached mailboxes of its sender and recipients.
+
+        A mailbox that is not cached yet is started when this message is its
+        first, which is the usual case for a fresh test address.
+        """
+        message = self._transform_rows([(msg_id,) + row[:6]])[0]
+        created_at, frm_canon, size = row[5], row[6], row[10]
+        # Only mailboxes not cached yet need a look at the database, all
+        # recipients in one query however many there are
+        uncached = [address for address in recipients if self.cache.count(("to", address)) is None]
+        first = set()
+        if uncached:
+            first = {address for address, in self.queries.fetch("first_to", (json.dumps(uncached),))}
+        for recipient in recipients:
+            self.cache.add(("to", recipient), message, created_at, size,
+                           new_mailbox=recipient in first)
+        key = ("from", frm_canon)
+        new_mailbox = self.cache.count(key) is None and self._count("first_from", frm_canon) == 1
+        self.cache.add(key, message, created_at, size, new_mailbox=new_mailbox)
     
-    def get_messages_from(self, sender: str, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    def get_messages_from(self, sender: str, limit: int = 20, offset: int = 0,
+                          summary: bool = False) -> List[Dict[str, Any]]:
         """
         Get messages from a specific sender with pagination.
 
@@ -87,19 +693,26 @@ class EmailData:
             sender: Email address of the sender
             limit: Maximum number of messages to return (default: 20)
             offset: Number of messages to skip (default: 0)
+            summary: Return summaries without content (see _transform_summaries)
 
         Returns:
             List of message dictionaries
         """
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM msg WHERE frm = ? ORDER BY createDate DESC LIMIT ? OFFSET ?",
-            (sender, limit, offset)
+        address = self.normalizer.canonicalize(sender)
+        if self.cache is not None:
+            cached = self._cached_page(("from", address), limit, offset, summary)
+            if cached is not None:
+                return cached
+        if summary:
+            return self._transform_summaries(
+                self.queries.fetch("summaries_from", (address, limit, offset), limit)
+            )
+        return self._transform_rows(
+            self.queries.fetch("messages_from", (address, limit, offset), limit)
         )
-        rows = cursor.fetchall()
-        return self._transform_rows(rows)
 
-    def get_messages_to(self, recipient: str, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    def get_messages_to(self, recipient: str, limit: int = 20, offset: int = 0,
+                          summary: bool = False, unread: bool = False) -> List[Dict[str, Any]]:
         """
         Get messages to a specific recipient with pagination.
 
@@ -107,36 +720,294 @@ class EmailData:
             recipient: Email address of the recipient
             limit: Maximum number of messages to return (default: 20)
             offset: Number of messages to skip (default: 0)
+            summary: Return summaries without content (see _transform_summaries)
+            unread: Only return messages not yet marked read in this mailbox
 
         Returns:
             List of message dictionaries
         """
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM msg WHERE to0 = ? ORDER BY createDate DESC LIMIT ? OFFSET ?",
-            (recipient, limit, offset)
+        address = self.normalizer.canonicalize(recipient)
+        if unread:
+            if summary:
+                return self._transform_summaries(
+                    self.queries.fetch("unread_summaries_to", (address, limit, offset), limit)
+                )
+            return self._transform_rows(
+                self.queries.fetch("unread_messages_to", (address, limit, offset), limit)
+            )
+        if self.cache is not None:
+            cached = self._cached_page(("to", address), limit, offset, summary)
+            if cached is not None:
+                return cached
+        if summary:
+            return self._transform_summaries(
+                self.queries.fetch("summaries_to", (address, limit, offset), limit)
+            )
+        return self._transform_rows(
+            self.queries.fetch("messages_to", (address, limit, offset), limit)
         )
-        rows = cursor.fetchall()
-        return self._transform_rows(rows)
 
-    def get_all_messages(self, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    def get_messages_by_header(self, name: str, value: str, limit: int = 20, offset: int = 0,
+                               summary: bool = False) -> List[Dict[str, Any]]:
+        """
+        Get the messages carrying an indexed header value, newest stored first.
+
+        The header name is matched case-insensitively and the value exactly,
+        after the normalization applied at ingest (message ids with or
+        without angle brackets). Only headers configured in the [headers]
+        section when a message was stored can be looked up.
+
+        Args:
+            name: Header name, e.g. 'Message-ID' or 'X-Test-Run-Id'
+            value: Header value
+            limit: Maximum number of messages to return (default: 20)
+            offset: Number of messages to skip (default: 0)
+            summary: Return summaries without content (see _transform_summaries)
+
+        Returns:
+            List of message dictionaries
+        """
+        name = name.strip().lower()
+        values = header_values(name, value)
+        if not values:
+            return []
+        params = (name, values[0], limit, offset)
+        if summary:
+            return self._transform_summaries(self.queries.fetch("summaries_by_header", params, limit))
+        return self._transform_rows(self.queries.fetch("messages_by_header", params, limit))
+
+    def get_changes(self, after: int = 0, limit: int = 100,
+                    summary: bool = False) -> List[Dict[str, Any]]:
+        """
+        Get the messages stored and deleted after a point of the change feed.
+
+        Every stored message gets the next sequence number of the feed in
+        the transaction that stores it, and so does every deleted one, so a
+        consumer that passes the last sequence number it has seen gets each
+        change exactly once, in commit order, at the cost of the new
+        entries only.
+
+        Args:
+            after: Sequence number to continue after (0 for the beginning)
+            limit: Maximum number of changes to return (default: 100)
+            summary: Return summaries without content (see _transform_summaries)
+
+        Returns:
+            Change dictionaries with 'seq', 'op' ('insert' or 'delete'), the
+            message 'id' and, for inserts, the 'message' (None if it has
+            been deleted since)
+        """
+        name = "change_summaries" if summary else "changes"
+        rows = self.queries.fetch(name, (after, limit), limit)
+        messages = (self._transform_summaries if summary else self._transform_rows)(
+            [row[3:] for row in rows if row[3] is not None]
+        )
+        found = {message["id"]: message for message in messages}
+        return [
+            {"seq": seq, "op": op, "id": msg_id, "message": found.get(msg_id) if op == 'insert' else None}
+            for seq, op, msg_id, *_ in rows
+        ]
+
+    def _cached_page(self, key: tuple, limit: int, offset: int,
+                     summary: bool) -> Optional[List[Dict[str, Any]]]:
+        """
+        Serve a mailbox page from the cache, loading the mailbox on a first-page miss.
+
+        Args:
+            key: ('to' or 'from', canonical address)
+            limit: Page size
+            offset: Messages to skip
+            summary: Return summaries
+
+        Returns:
+            The page, or None if it has to come from the database
+        """
+        page = self.cache.page(key, limit, offset, summary)
+        if page is not None or offset or limit > self.cache.per_mailbox:
+            return page
+
+        # Deeper pages are rare; only the newest messages are worth keeping.
+        # No store may commit between the read and the fill: its write-through
+        # add skips the mailbox while it is not cached, so the fill would keep
+        # a page and count without it.
+        with self.queries.write_lock:
+            rows = self.queries.fetch(f"recent_{key[0]}", (key[1], self.cache.per_mailbox))
+            total = self._count(f"count_{key[0]}", key[1])
+            messages = self._transform_rows([row[:7] for row in rows])
+            self.cache.fill(
+                key, [(m, row[6], row[7]) for m, row in zip(messages, rows)], total
+            )
+        return self.cache.page(key, limit, offset, summary)
+
+    def get_all_messages(self, limit: int = 20, offset: int = 0,
+                         summary: bool = False) -> List[Dict[str, Any]]:
         """
         Get all messages with pagination.
 
         Args:
             limit: Maximum number of messages to return (default: 20)
             offset: Number of messages to skip (default: 0)
+            summary: Return summaries without content (see _transform_summaries)
 
         Returns:
             List of message dictionaries
         """
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT * FROM msg ORDER BY createDate DESC LIMIT ? OFFSET ?",
-            (limit, offset)
+        if summary:
+            return self._transform_summaries(self.queries.fetch("summaries_all", (limit, offset), limit))
+        return self._transform_rows(self.queries.fetch("messages_all", (limit, offset), limit))
+
+    def plan_search(self, filters: Dict[str, str], since: Optional[int] = None,
+                    until: Optional[int] = None) -> str:
+        """
+        Pick the walk of a search that visits the fewest messages.
+
+        Each candidate walk (the recipient's mailbox, the sender's mail, the
+        recipient domain's entries, or the time range of all mail) is sized
+        with a count that stops one past the best candidate so far, so
+        sizing never costs more than the cheapest walk.
+
+        Args:
+            filters: Canonical filter values by name (see search_messages)
+            since: Earliest epoch timestamp (inclusive), optional
+            until: Latest epoch timestamp (exclusive), optional
+
+        Returns:
+            'to', 'from', 'domain' or 'all'
+        """
+        time_range = (MIN_TIME if since is None else since, MAX_TIME if until is None else until)
+        candidates = [walk for walk in ("to", "from", "domain") if walk in filters]
+        if not candidates:
+            return "all"
+        if since is not None or until is not None:
+            candidates.append("all")
+
+        best, best_rows = candidates[0], SEARCH_PROBE_LIMIT
+        for walk in candidates:
+            params = (filters[walk],) if walk != "all" else ()
+            rows = self.queries.fetch_one(
+                f"estimate_{walk}", params + time_range + (best_rows + 1,)
+            )[0]
+            if rows < best_rows or walk == candidates[0]:
+                best, best_rows = walk, rows
+        return best
+
+    def search_messages(self, sender: Optional[str] = None, recipient: Optional[str] = None,
+                        domain: Optional[str] = None, subject: Optional[str] = None,
+                        since: Optional[int] = None, until: Optional[int] = None,
+                        limit: int = 20, offset: int = 0,
+                        summary: bool = False) -> List[Dict[str, Any]]:
+        """
+        Get the messages matching every given filter, newest first.
+
+        The walk over the messages is picked by plan_search; every other
+        filter is applied in the same statement.
+
+        Args:
+            sender: Email address of the sender
+            recipient: Email address of any recipient
+            domain: Domain of any recipient
+            subject: Subject prefix (case-insensitive for ASCII letters)
+            since: Earliest epoch timestamp (inclusive)
+            until: Latest epoch timestamp (exclusive)
+            limit: Maximum number of messages to return (default: 20)
+            offset: Number of messages to skip (default: 0)
+            summary: Return summaries without content (see _transform_summaries)
+
+        Returns:
+            List of message dictionaries
+        """
+        filters = {}
+        if recipient:
+            filters["to"] = self.normalizer.canonicalize(recipient)
+        if sender:
+            filters["from"] = self.normalizer.canonicalize(sender)
+        if domain:
+            filters["domain"] = self._canonical_domain(domain)
+        if subject:
+            escaped = subject.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            filters["subject"] = escaped + '%'
+
+        walk = self.plan_search(filters, since, until)
+        predicates = [name for name in SEARCH_FILTERS if name in filters and name != walk]
+        name = self.queries.define(
+            f"search_{walk}_{'_'.join(predicates) or 'only'}_{'summaries' if summary else 'messages'}",
+            self._search_sql(walk, predicates, summary)
         )
-        rows = cursor.fetchall()
-        return self._transform_rows(rows)
+        params = ((filters[walk],) if walk != "all" else ()) + (
+            MIN_TIME if since is None else since, MAX_TIME if until is None else until
+        ) + tuple(filters[predicate] for predicate in predicates) + (limit, offset)
+
+        rows = self.queries.fetch(name, params, limit)
+        return self._transform_summaries(rows) if summary else self._transform_rows(rows)
+
+    @staticmethod
+    def _canonical_domain(domain: str) -> str:
+        """Domain as the recipient domain of mailbox entries reads ('@' and case dropped)."""
+        return domain.strip().lstrip('@').lower()
+
+    @staticmethod
+    def _search_sql(walk: str, predicates: List[str], summary: bool) -> str:
+        """SQL of a search walking the messages one way, with further filters."""
+        source, order = SEARCH_WALKS[walk]
+        columns = _qualified(SUMMARY_COLUMNS if summary else SELECT_COLUMNS, "m")
+        where = "".join(f" AND {SEARCH_PREDICATES[predicate]}" for predicate in predicates)
+        return f"SELECT {columns} {source}{where} {order} LIMIT ? OFFSET ?"
+
+    def get_stats(self, by: str = "domain", since: Optional[int] = None,
+                  until: Optional[int] = None, sender: Optional[str] = None,
+                  domain: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Get message counts and bytes from the hourly rollups.
+
+        Counts come from tables the store triggers keep up to date, so
+        they never scan the messages. The time range selects whole hours:
+        those starting at or after since (rounded down to its hour) and
+        before until.
+
+        Args:
+            by: 'domain' or 'sender' for the busiest recipient domains or
+                senders of the range, 'hour' for hourly totals newest first
+                (of one sender or domain if given), or 'mailbox' for the
+                fullest mailboxes of all time, with their unread counts
+            since: Earliest epoch timestamp, optional
+            until: Latest epoch timestamp (exclusive), optional
+            sender: Sender whose hourly totals to return (by='hour' only)
+            domain: Recipient domain whose hourly totals to return (by='hour' only)
+            limit: Maximum number of rows to return (default: 20)
+
+        Returns:
+            List of dictionaries with the key ('domain', 'sender', 'hour'
+            or 'address'), 'messages' and 'bytes' ('unread' for mailboxes)
+
+        Raises:
+            ValueError: If by is not a known grouping
+        """
+        if by not in STATS_GROUPS:
+            raise ValueError(f"Unknown statistics grouping: {by}")
+        if by == "mailbox":
+            return [
+                {"address": address, "messages": total, "unread": unread}
+                for address, total, unread in self.queries.fetch("stats_mailboxes", (limit,), limit)
+            ]
+
+        time_range = (
+            MIN_TIME if since is None else since // 3600 * 3600,
+            MAX_TIME if until is None else until,
+        )
+        if by != "hour":
+            rows = self.queries.fetch("stats_top", (by,) + time_range + (limit,), limit)
+            return [{by: key, "messages": messages, "bytes": size} for key, messages, size in rows]
+
+        kind, key = STATS_GROUPS[by], ""
+        if sender:
+            kind, key = "sender", self.normalizer.canonicalize(sender)
+        elif domain:
+            kind, key = "domain", self._canonical_domain(domain)
+        rows = self.queries.fetch("stats_hours", (kind, key) + time_range + (limit,), limit)
+        return [
+            {"hour": self._format_time(hour), "messages": messages, "bytes": size}
+            for hour, messages, size in rows
+        ]
 
     def get_message_count(self, sender: str = None, recipient: str = None) -> int:
         """
@@ -149,17 +1020,172 @@ class EmailData:
         Returns:
             Total number of messages
         """
-        cursor = self.conn.cursor()
+        if sender or recipient:
+            key = ("from", self.normalizer.canonicalize(sender)) if sender else \
+                ("to", self.normalizer.canonicalize(recipient))
+            if self.cache is not None:
+                count = self.cache.count(key)
+                if count is not None:
+                    return count
+            return self._count(f"count_{key[0]}", key[1])
 
-        if sender:
-            cursor.execute("SELECT COUNT(*) FROM msg WHERE frm = ?", (sender,))
-        elif recipient:
-            cursor.execute("SELECT COUNT(*) FROM msg WHERE to0 = ?", (recipient,))
+        # Maintained by triggers; missing only while a migration is pending
+        row = self.queries.fetch_one("count_all")
+        if row is None:
+            row = self.queries.fetch_one("count_all_scan")
+        return row[0]
+
+    def _count(self, name: str, address: str) -> int:
+        """Run a count statement for an address; no row counts as 0."""
+        row = self.queries.fetch_one(name, (address,))
+        return row[0] if row is not None else 0
+
+    def get_unread_count(self, recipient: str) -> int:
+        """
+        Get the number of messages of a recipient not yet marked read.
+
+        Args:
+            recipient: Email address of the recipient
+
+        Returns:
+            Number of unread messages
+        """
+        return self._count("count_unread_to", self.normalizer.canonicalize(recipient))
+
+    def mark_read(self, recipient: str, msg_id: Optional[int] = None,
+                  seen: bool = True) -> int:
+        """
+        Mark messages of a recipient's mailbox read or unread.
+
+        Read state is kept per mailbox: marking a message read for one
+        recipient leaves it unread for the others.
+
+        Args:
+            recipient: Email address of the recipient
+            msg_id: Message to mark; None marks the whole mailbox
+            seen: True marks read, False unread
+
+        Returns:
+            Number of messages whose state changed
+        """
+        address = self.normalizer.canonicalize(recipient)
+        seen = int(seen)
+        if msg_id is None:
+            return self.queries.execute("set_seen", (seen, address, seen))
+        return self.queries.execute("set_seen_message", (seen, msg_id, address, seen))
+
+    def get_message(self, msg_id: int, summary: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Get a single message by id.
+
+        Args:
+            msg_id: Message id
+            summary: Return the summary without the content
+
+        Returns:
+            Message dictionary, or None if there is no such message
+        """
+        if self.cache is not None:
+            cached = self.cache.get(msg_id, summary)
+            if cached is not None:
+                return cached
+        if summary:
+            rows = self._transform_summaries(self.queries.fetch("summary", (msg_id,), 1))
         else:
-            cursor.execute("SELECT COUNT(*) FROM msg")
+            rows = self._transform_rows(self.queries.fetch("message", (msg_id,), 1))
+        return rows[0] if rows else None
+
+    def get_tokens(self, recipient: str, kind: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """
+        Get the tokens of one kind extracted from the mail of a recipient.
+
+        Args:
+            recipient: Email address of the recipient
+            kind: Token kind ('code', 'link' or a configured custom kind)
+            limit: Maximum number of tokens to return
+
+        Returns:
+            Token dictionaries with the value and the id, subject and time
+            of their message, newest message first and in extraction order
+            within a message
+        """
+        address = self.normalizer.canonicalize(recipient)
+        rows = self.queries.fetch("tokens_to", (address, kind, limit), limit)
+        return [
+            {
+                "value": value,
+                "id": msg_id,
+                "subject": subject,
+                "time": self._format_time(created_at),
+            }
+            for value, msg_id, subject, created_at in rows
+        ]
+
+    def get_latest_token(self, recipient: str, kind: str = 'code') -> Optional[Dict[str, Any]]:
+        """
+        Get the most likely token of a kind from the newest message that has one.
+
+        Args:
+            recipient: Email address of the recipient
+            kind: Token kind (default: 'code')
+
+        Returns:
+            Token dictionary (see get_tokens), or None if there is none
+        """
+        tokens = self.get_tokens(recipient, kind, limit=1)
+        return tokens[0] if tokens else None
+
+    def get_message_part(self, msg_id: int, part: str) -> Optional[str]:
+        """
+        Get the plain-text or sanitized HTML rendition of a message.
+
+        Renditions are computed at ingest. Messages stored before that get
+        theirs from the backfill of schema version 13; until it reaches
+        them, and for messages stored with plain content only, the
+        rendition is derived from the content on read, without writing.
+
+        Args:
+            msg_id: Message id
+            part: 'text' or 'html'
+
+        Returns:
+            The rendition ('' for a message without HTML), or None if there
+            is no such message
+        """
+        if part not in MESSAGE_PARTS:
+            raise ValueError(f"Unknown message part: {part}")
+
+        row = self.queries.fetch_one(f"{part}_part", (msg_id,))
+        if row is None:
+            return None
+        if row[0] is not None:
+            return row[0]
+
+        text, html = split_content(row[1] or '')
+        return text if part == "text" else html
+
+    def get_message_parts(self, msg_id: int) -> Optional[List[str]]:
+        """
+        Get the renditions a message has, without loading them.
+
+        Args:
+            msg_id: Message id
+
+        Returns:
+            ['text'] or ['text', 'html'], or None if there is no such message
+        """
+        row = self.queries.fetch_one("has_html", (HTML_CONTENT_MARKER, msg_id))
+        if row is None:
+            return None
+        return list(MESSAGE_PARTS) if row[0] else ["text"]
+
+    @staticmethod
+    def _format_time(created_at: Optional[int]) -> Optional[str]:
+        """Format an epoch timestamp as local time for the API."""
+        if created_at is None:
+            return None
+        return datetime.datetime.fromtimestamp(created_at).isoformat(sep=' ')
 
-        return cursor.fetchone()[0]
-    
     def _transform_rows(self, rows: List[tuple]) -> List[Dict[str, Any]]:
         """
         Transform database rows to dictionaries.
@@ -173,17 +1199,49 @@ class EmailData:
         messages = []
         for row in rows:
             message = {
-                "from": row[0],
-                "to0": row[1],
-                "to": json.loads(row[2]) if row[2] else [],
-                "subject": row[3],
-                "content": row[4],
-                "time": row[5],
+                "id": row[0],
+                "from": row[1],
+                "to0": row[2],
+                "to": json.loads(row[3]) if row[3] else [],
+                "subject": row[4],
+                "content": row[5],
+                "time": self._format_time(row[6]),
             }
             messages.append(message)
         return messages
     
+    def _transform_summaries(self, rows: List[tuple]) -> List[Dict[str, Any]]:
+        """
+        Transform summary rows to dictionaries.
+
+        Summaries carry everything a message list shows, plus the message
+        size, but no content; bodies are fetched per message.
+
+        Args:
+            rows: List of summary row tuples
+
+        Returns:
+            List of message summary dictionaries
+        """
+        return [
+            {
+                "id": row[0],
+                "from": row[1],
+                "to0": row[2],
+                "to": json.loads(row[3]) if row[3] else [],
+                "subject": row[4],
+                "time": self._format_time(row[5]),
+                "size": row[6],
+            }
+            for row in rows
+        ]
+
     def close(self):
-        """Close database connection."""
+        """Close database connection, and remove the spill file if there is one."""
+        if self._spilled_from is not None:
+            self._spilled_from[0].close()
+            self._spilled_from = None
         if self.conn:
             self.conn.close()
+        if self.spill_path is not None:
+            Path(self.spill_path).unlink(missing_ok=True)
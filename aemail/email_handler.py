@@ -2,17 +2,31 @@
 Email processing and SMTP handler.
 """
 
+import asyncio
 import email
 import logging
-from email.header import decode_header
-from typing import Dict, Any
+from email.header import decode_header, make_header
+from typing import BinaryIO, Dict, Any, List, Optional, Tuple, Union
 
+from .config import Config
 from .data import EmailData
+from .extractors import HeaderExtractor, TokenExtractor
+from .inbox import DurableInbox
+from .limits import ClientLimits
+from .pipeline import MessageContext, Pipeline, Stage
+from .rendering import html_to_text, sanitize_html
+from .routing import DISCARD, REJECT, Router
+from .utils import normalize_domain
 
 
 logger = logging.getLogger(__name__)
 
 
+# Built-in extractors, used when no configured set is given
+DEFAULT_EXTRACTOR = TokenExtractor()
+DEFAULT_HEADER_EXTRACTOR = HeaderExtractor()
+
+
 class EmailProcessor:
     """Email content processor."""
     
@@ -20,6 +34,9 @@ class EmailProcessor:
     def decode_header_value(header_value: str) -> str:
         """
         Decode email header value.
+
+        Every RFC 2047 encoded word is decoded and joined with the plain
+        text around it. Words in an unknown charset are decoded as UTF-8.
         
         Args:
             header_value: Raw header value
@@ -31,15 +48,13 @@ class EmailProcessor:
             return ""
         
         try:
-            decoded_parts = decode_header(header_value)
-            value, charset = decoded_parts[0]
-            
-            if charset and isinstance(value, bytes):
-                return value.decode(charset)
-            elif isinstance(value, bytes):
-                return value.decode('utf-8', errors='ignore')
-            else:
-                return str(value)
+            parts = decode_header(str(header_value))
+            try:
+                return str(make_header(parts))
+            except LookupError:
+                parts = [(value, None) if isinstance(value, str) else
+                         (value.decode('utf-8', errors='replace'), None) for value, _ in parts]
+                return str(make_header(parts))
         except Exception as e:
             logger.warning(f"Failed to decode header '{header_value}': {e}")
             return str(header_value)
@@ -124,59 +139,359 @@ class EmailProcessor:
         
         return '\n'.join(filter(None, content_parts))
 
+    @classmethod
+    def extract_renditions(cls, message) -> Tuple[str, str]:
+        """
+        Extract separate plain-text and sanitized HTML renditions.
+
+        Attachments are skipped. Without a text/plain part, the text
+        rendition is derived from the HTML.
+
+        Args:
+            message: Email message object
+
+        Returns:
+            Tuple of (text, html); html is empty if the message has no HTML part
+        """
+        text_parts = []
+        html_parts = []
+
+        for part in message.walk():
+            if part.is_multipart() or part.get_content_disposition() == 'attachment':
+                continue
+
+            content_type = part.get_content_type()
+            if content_type not in ('text/plain', 'text/html'):
+                continue
+
+            try:
+                payload = part.get_payload(decode=True)
+                if isinstance(payload, bytes):
+                    payload = payload.decode(cls.guess_charset(part), errors='ignore')
+            except Exception as e:
+                logger.warning(f"Failed to extract content from {content_type}: {e}")
+                continue
+
+            if content_type == 'text/html':
+                html_parts.append(str(payload))
+            else:
+                text_parts.append(str(payload))
+
+        html = sanitize_html('\n'.join(html_parts))
+        text = '\n'.join(text_parts) if text_parts else html_to_text(html)
+        return text, html
+
+
+class ParseStage(Stage):
+    """Parses the raw message and records its size."""
+
+    name = "parse"
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        if isinstance(context.raw, bytes):
+            context.message = email.message_from_bytes(context.raw)
+            context.data['size'] = len(context.raw)
+        else:
+            context.message = email.message_from_binary_file(context.raw)
+            context.data['size'] = context.raw.tell()
+        return None
+
+
+class SpamFlagStage(Stage):
+    """Drops messages an upstream filter flagged as spam (X-Spam-Flag: YES)."""
+
+    name = "spam"
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        if str(context.message.get('X-Spam-Flag', '')).strip().upper() == 'YES':
+            logger.info(f"Dropping message flagged as spam from {context.mail_from}")
+            return '250 Message accepted for delivery'
+        return None
+
+
+class SubjectStage(Stage):
+    """Decodes the subject header."""
+
+    name = "subject"
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        context.data['subject'] = EmailProcessor.decode_header_value(context.message.get('Subject', ''))
+        return None
+
+
+class HeaderStage(Stage):
+    """Decodes and selects the headers stored in the header index."""
+
+    name = "headers"
+
+    def __init__(self, extractor: Optional[HeaderExtractor] = None):
+        """
+        Initialize the stage.
+
+        Args:
+            extractor: Headers to index (defaults to the built-in ones)
+        """
+        self.extractor = extractor or DEFAULT_HEADER_EXTRACTOR
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'HeaderStage':
+        return cls(HeaderExtractor.from_config(config))
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        context.data['headers'] = self.extractor.extract(
+            context.message.items(), EmailProcessor.decode_header_value
+        )
+        return None
+
+
+class ContentStage(Stage):
+    """Extracts the combined content and the plain-text and HTML renditions."""
+
+    name = "content"
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        context.data['content'] = EmailProcessor.process_message_content(context.message)
+        context.data['text'], context.data['html'] = EmailProcessor.extract_renditions(context.message)
+        return None
+
+
+class TokenStage(Stage):
+    """Extracts codes, links and custom tokens from the subject and renditions."""
+
+    name = "tokens"
+
+    def __init__(self, extractor: Optional[TokenExtractor] = None):
+        """
+        Initialize the stage.
+
+        Args:
+            extractor: Extractors to run (defaults to the built-in ones)
+        """
+        self.extractor = extractor or DEFAULT_EXTRACTOR
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'TokenStage':
+        return cls(TokenExtractor.from_config(config))
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        data = context.data
+        data['tokens'] = self.extractor.extract(
+            data.get('subject', ''), data.get('text', ''), data.get('html', '')
+        )
+        return None
+
+
+# Stages available by name in the [pipeline] section, and the default order
+BUILTIN_STAGES = {
+    stage.name: stage.from_config
+    for stage in (ParseStage, SpamFlagStage, SubjectStage, HeaderStage, ContentStage, TokenStage)
+}
+DEFAULT_STAGES = ["parse", "subject", "headers", "content", "tokens"]
+
+
+def default_pipeline(extractor: Optional[TokenExtractor] = None) -> Pipeline:
+    """
+    The pipeline of the default stages, run inline.
+
+    Args:
+        extractor: Token extractors to run (defaults to the built-in ones)
+
+    Returns:
+        The pipeline
+    """
+    return Pipeline([ParseStage(), SubjectStage(), HeaderStage(), ContentStage(), TokenStage(extractor)])
+
 
 class SMTPHandler:
     """SMTP server handler for receiving emails."""
     
-    def __init__(self, data_store: EmailData):
+    def __init__(self, data_store: EmailData, router: Optional[Router] = None,
+                 limits: Optional[ClientLimits] = None,
+                 extractor: Optional[TokenExtractor] = None,
+                 inbox: Optional[DurableInbox] = None,
+                 pipeline: Optional[Pipeline] = None):
         """
         Initialize SMTP handler.
         
         Args:
             data_store: EmailData instance for storing messages
+            router: Recipient routing table. If None, all recipients are accepted.
+            limits: Per-client connection and rate limits. If None, unlimited.
+            extractor: Code, link and custom token extractors run at ingest.
+                       If None, the built-in ones are used.
+            inbox: Durable journal that accepted mail is written to before it
+                   is acknowledged; an InboxIndexer stores it afterwards.
+                   If None, mail is stored before it is acknowledged.
+            pipeline: Stages turning raw mail into stored messages. If None,
+                      the default stages run inline with the given extractor.
         """
         self.data_store = data_store
+        self.router = router
+        self.limits = limits
+        self.extractor = extractor
+        self.inbox = inbox
         self.processor = EmailProcessor()
+        self.pipeline = pipeline or default_pipeline(extractor)
+
+    def parse_message(self, raw: Union[bytes, BinaryIO], mail_from: str,
+                      rcpt_tos: List[str]) -> Optional[Dict[str, Any]]:
+        """
+        Run a raw message through the pipeline, on the calling thread.
+
+        Args:
+            raw: Raw message, as bytes or a binary file positioned at its start
+            mail_from: Envelope sender
+            rcpt_tos: Envelope recipients
+
+        Returns:
+            Message dictionary accepted by EmailData.store_message, including
+            the raw size, or None if a stage dropped the message
+        """
+        context = MessageContext(raw, mail_from, rcpt_tos)
+        if self.pipeline.process(context) is not None:
+            return None
+        return context.data
+
+    @staticmethod
+    def _ip(peer) -> str:
+        """Get the IP of a peer address."""
+        if isinstance(peer, (tuple, list)) and peer:
+            return str(peer[0])
+        return str(peer or '')
+
+    @classmethod
+    def _peer_ip(cls, session) -> str:
+        """Get the source IP of a session."""
+        return cls._ip(getattr(session, 'peer', None))
+
+    def handle_CONNECT(self, server, peer) -> Optional[str]:
+        """
+        Handle a new connection before the greeting.
+
+        Args:
+            server: SMTP protocol instance
+            peer: Peer address of the connection
+
+        Returns:
+            Rejection reply if the session limits are exceeded, else None
+        """
+        if self.limits is None:
+            return None
+        return self.limits.open_session(self._ip(peer))
+
+    def handle_DISCONNECT(self, server, session):
+        """Handle the end of a connection admitted by handle_CONNECT."""
+        if self.limits is not None:
+            self.limits.close_session(self._peer_ip(session))
+
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        """
+        Handle MAIL FROM command.
+
+        Enforces the per-IP message rate and the per-session message limit,
+        which counts the messages delivered so far (see _delivered).
+        """
+        if self.limits is not None:
+            status = self.limits.check_message(
+                self._peer_ip(session), getattr(session, 'message_count', 0)
+            )
+            if status is not None:
+                return status
+
+        envelope.mail_from = address
+        envelope.mail_options.extend(mail_options)
+        return '250 OK'
     
     async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
         """
         Handle RCPT TO command.
         
-        Accept all recipients (wildcard email server).
+        Recipients are accepted, rejected or discarded by the routing table
+        (all are accepted without one). The domain is lowercased here; the
+        canonical lookup form is derived at storage.
         """
+        address = normalize_domain(address)
+
+        action = self.router.route(address) if self.router else None
+        if action == REJECT:
+            logger.info(f"Rejecting recipient: {address}")
+            return '550 5.7.1 Recipient address rejected'
+
+        if self.limits is not None:
+            status = self.limits.check_recipient(address.rpartition('@')[2])
+            if status is not None:
+                return status
+
         envelope.rcpt_tos.append(address)
-        logger.info(f"Accepting recipient: {address}")
+        if action == DISCARD:
+            # Accepted on the wire, but never stored
+            if not hasattr(envelope, 'discarded_rcpts'):
+                envelope.discarded_rcpts = set()
+            envelope.discarded_rcpts.add(address)
+            logger.debug(f"Discarding recipient: {address}")
+        else:
+            logger.info(f"Accepting recipient: {address}")
         return '250 OK'
     
+    @staticmethod
+    def _delivered(session, reply: str = '250 Message accepted for delivery') -> str:
+        """
+        Count a message accepted in a session and return its reply.
+
+        Transactions reset or rejected before this point do not count
+        towards the per-session message limit.
+        """
+        if session is not None:
+            session.message_count = getattr(session, 'message_count', 0) + 1
+        return reply
+
     async def handle_DATA(self, server, session, envelope):
         """
         Handle DATA command - process the email content.
         """
+        discarded = getattr(envelope, 'discarded_rcpts', None)
+        rcpt_tos = envelope.rcpt_tos
+        if discarded:
+            rcpt_tos = [address for address in rcpt_tos if address not in discarded]
+            if not rcpt_tos:
+                logger.debug(f"Discarded message from {envelope.mail_from}")
+                return self._delivered(session)
+
+        # Large bodies are read from their spool file
+        spool = getattr(envelope, 'spool', None)
+        raw = spool.reader() if spool is not None else envelope.content
+
+        if self.inbox is not None:
+            try:
+                # Acknowledged once journaled; parsing and storing come later
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.inbox.deliver, envelope.mail_from, rcpt_tos, raw
+                )
+            except Exception as e:
+                logger.error(f"Error journaling email: {e}")
+                return '451 Requested action aborted: error in processing'
+            logger.info(f"Journaled message: {envelope.mail_from} -> {rcpt_tos}")
+            return self._delivered(session)
+
         try:
-            # Parse email message
-            message = email.message_from_bytes(envelope.content)
-            
-            # Extract message components
-            mail_from = envelope.mail_from
-            rcpt_tos = envelope.rcpt_tos
-            subject = self.processor.decode_header_value(message.get('Subject', ''))
-            content = self.processor.process_message_content(message)
-            
-            # Create message object
-            email_data = {
-                "from": mail_from,
-                "to": rcpt_tos,
-                "subject": subject,
-                "content": content
-            }
-            
+            context = MessageContext(raw, envelope.mail_from, rcpt_tos)
+            reply = await self.pipeline.process_async(context)
+            if reply is not None:
+                logger.info(f"Message from {envelope.mail_from} stopped by the pipeline: {reply}")
+                # A stage that drops mail silently still accepts it on the wire
+                return self._delivered(session, reply) if reply.startswith('2') else reply
+            email_data = context.data
+
             # Store message
-            self.data_store.store_message(email_data)
-            
-            logger.info(f"Stored message: {mail_from} -> {rcpt_tos} | {subject}")
-            
-            return '250 Message accepted for delivery'
-            
+            with self.pipeline.timed('store'):
+                self.data_store.store_message(email_data)
         except Exception as e:
             logger.error(f"Error processing email: {e}")
             return '451 Requested action aborted: error in processing'
+
+        # Stored: nothing from here on may turn the reply into a retry
+        logger.info(
+            f"Stored message: {email_data.get('from')} -> {email_data.get('to')} "
+            f"| {email_data.get('subject', '')}"
+        )
+        return self._delivered(session)
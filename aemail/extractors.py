@@ -0,0 +1,219 @@
+"""
+Extraction of verification codes, links, custom tokens and indexed headers from messages.
+"""
+
+import html
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Pattern, Tuple
+
+from .config import Config
+from .utils import header_values
+
+
+# Words that announce a verification code, in English and Chinese
+CODE_KEYWORDS = re.compile(
+    r'\b(?:code|otp|pin|passcode|password|verification|verify|one[- ]time|token)\b'
+    r'|验证码|校验码|动态码|確認碼|验证',
+    re.IGNORECASE
+)
+CODE_PATTERN = re.compile(r'(?<![\w.,/:-])(\d{4,8})(?![\w/:-]|[.,]\d)')
+URL_PATTERN = re.compile(r'https?://[^\s<>"\'`{}|\\^\[\]]+', re.IGNORECASE)
+HREF_PATTERN = re.compile(r'\bhref\s*=\s*(["\'])(.*?)\1', re.IGNORECASE | re.DOTALL)
+
+# Characters that end a sentence rather than a URL
+URL_TRAILING = '.,;:!?)\'"'
+
+# How far before a number a keyword makes it a code
+KEYWORD_WINDOW = 80
+
+# Values that switch a built-in extractor off
+OFF = ('off', 'false', 'no', '0')
+
+MAX_TOKENS_PER_KIND = 50
+MAX_TOKEN_LENGTH = 2048
+
+# Headers indexed when none are configured
+DEFAULT_HEADERS = ('message-id', 'date', 'in-reply-to')
+
+
+class TokenExtractor:
+    """
+    Precompiled extractors run once per message at ingest.
+
+    Built-in kinds are 'code' (numeric one-time codes) and 'link' (http and
+    https URLs). Custom kinds map a name to a regular expression; the first
+    group is extracted if the pattern has one, else the whole match.
+    """
+
+    def __init__(self, patterns: Optional[Dict[str, str]] = None,
+                 codes: bool = True, links: bool = True):
+        """
+        Initialize the extractor.
+
+        Args:
+            patterns: Custom token kinds, name to regular expression
+            codes: Extract numeric verification codes
+            links: Extract links
+        """
+        self.codes = codes
+        self.links = links
+        self.patterns: Dict[str, Pattern] = {
+            kind: re.compile(pattern) for kind, pattern in (patterns or {}).items()
+        }
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'TokenExtractor':
+        """
+        Create an extractor from the [extractors] section of the configuration.
+
+        'code' and 'link' can be set to off; every other option is a custom
+        kind and its pattern.
+        """
+        options = config.extractors
+        codes = options.pop('code', 'on').strip().lower() not in OFF
+        links = options.pop('link', 'on').strip().lower() not in OFF
+        return cls(options, codes=codes, links=links)
+
+    @property
+    def kinds(self) -> List[str]:
+        """Token kinds this extractor produces."""
+        kinds = (['code'] if self.codes else []) + (['link'] if self.links else [])
+        return kinds + list(self.patterns)
+
+    @staticmethod
+    def _unique(values: List[str]) -> List[str]:
+        """Drop duplicates and oversized values, keeping the first occurrence."""
+        seen = set()
+        unique = []
+        for value in values:
+            if value and value not in seen and len(value) <= MAX_TOKEN_LENGTH:
+                seen.add(value)
+                unique.append(value)
+        return unique[:MAX_TOKENS_PER_KIND]
+
+    @staticmethod
+    def extract_links(text: str, markup: str) -> List[str]:
+        """
+        Extract http(s) links, HTML hrefs first.
+
+        Args:
+            text: Plain-text rendition
+            markup: HTML rendition
+
+        Returns:
+            Unique links in order of appearance
+        """
+        links = []
+        for _, href in HREF_PATTERN.findall(markup or ''):
+            href = html.unescape(href).strip()
+            if href.lower().startswith(('http://', 'https://')):
+                links.append(href)
+        for url in URL_PATTERN.findall(text or ''):
+            links.append(url.rstrip(URL_TRAILING))
+        return links
+
+    @staticmethod
+    def extract_codes(subject: str, text: str) -> List[str]:
+        """
+        Extract numeric verification codes.
+
+        Each code keyword claims the first number of 4 to 8 digits that
+        follows it closely. A message without any such number still yields
+        its 6 to 8 digit numbers, which covers codes announced in another
+        language.
+
+        Args:
+            subject: Message subject
+            text: Plain-text rendition
+
+        Returns:
+            Candidate codes, most likely first
+        """
+        haystack = URL_PATTERN.sub(' ', f"{subject or ''}\n{text or ''}")
+        numbers = [(m.start(), m.group(1)) for m in CODE_PATTERN.finditer(haystack)]
+
+        near = []
+        for keyword in CODE_KEYWORDS.finditer(haystack):
+            for start, number in numbers:
+                if start >= keyword.end():
+                    if start - keyword.end() <= KEYWORD_WINDOW:
+                        near.append((start, number))
+                    break
+        if near:
+            return [number for _, number in sorted(set(near))]
+        return [number for _, number in numbers if len(number) >= 6]
+
+    def extract(self, subject: str, text: str, markup: str = '') -> List[Tuple[str, str]]:
+        """
+        Run every extractor over a message.
+
+        Args:
+            subject: Message subject
+            text: Plain-text rendition
+            markup: HTML rendition
+
+        Returns:
+            (kind, value) pairs, in order of likelihood within each kind
+        """
+        tokens = []
+        if self.codes:
+            tokens += [('code', v) for v in self._unique(self.extract_codes(subject, text))]
+        if self.links:
+            tokens += [('link', v) for v in self._unique(self.extract_links(text, markup))]
+        for kind, pattern in self.patterns.items():
+            values = []
+            for source in (subject or '', text or ''):
+                for match in pattern.finditer(source):
+                    values.append(match.group(1) if pattern.groups else match.group(0))
+            tokens += [(kind, v) for v in self._unique(values)]
+        return tokens
+
+
+class HeaderExtractor:
+    """
+    Selects the headers stored in the header index at ingest.
+
+    Names are matched case-insensitively; a name ending in '*' matches
+    every header it is a prefix of, e.g. 'x-*' indexes all X- headers.
+    """
+
+    def __init__(self, names: Iterable[str] = DEFAULT_HEADERS):
+        """
+        Initialize the extractor.
+
+        Args:
+            names: Header names and name prefixes to index
+        """
+        names = [name.strip().lower() for name in names if name.strip()]
+        self.names = frozenset(name for name in names if not name.endswith('*'))
+        self.prefixes = tuple(name[:-1] for name in names if name.endswith('*'))
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'HeaderExtractor':
+        """Create an extractor from 'index' in the [headers] section of the configuration."""
+        names = config.config.get('headers', 'index', fallback=', '.join(DEFAULT_HEADERS))
+        return cls(names.split(','))
+
+    def wants(self, name: str) -> bool:
+        """Whether a (lowercase) header name is indexed."""
+        return name in self.names or (bool(self.prefixes) and name.startswith(self.prefixes))
+
+    def extract(self, headers: Iterable[Tuple[str, str]],
+                decode: Callable[[str], str]) -> List[Tuple[str, str]]:
+        """
+        Select and normalize the indexed headers of a message.
+
+        Args:
+            headers: (name, raw value) pairs, as returned by Message.items()
+            decode: Decodes a raw (RFC 2047 encoded) header value
+
+        Returns:
+            Distinct (lowercase name, normalized value) pairs, in header order
+        """
+        rows: Dict[Tuple[str, str], None] = {}
+        for name, value in headers:
+            name = name.strip().lower()
+            if self.wants(name):
+                for normalized in header_values(name, decode(value)):
+                    rows[(name, normalized)] = None
+        return list(rows)
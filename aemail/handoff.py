@@ -0,0 +1,116 @@
+"""
+Listening socket handoff for zero-downtime restarts.
+
+On a restart the running server starts its successor with the SMTP and
+REST listening sockets inherited, then drains and exits. The successor
+waits until its predecessor has released the database before it starts
+accepting. The sockets stay open throughout, so connections that arrive
+in between wait in the listen backlog instead of being refused.
+"""
+
+import logging
+import os
+import select
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Inherited listening sockets, as "name=fd" pairs separated by commas
+LISTEN_FDS_ENV = 'AEMAIL_LISTEN_FDS'
+
+# Read end of a pipe the predecessor closes once it has shut down
+HANDOFF_FD_ENV = 'AEMAIL_HANDOFF_FD'
+
+
+def inherited_fds() -> Dict[str, int]:
+    """
+    Take the listening sockets passed down by a predecessor.
+
+    The variable is removed, so that processes started later do not
+    claim the same descriptors.
+
+    Returns:
+        Dictionary of socket name ('smtp', 'rest') to file descriptor
+    """
+    value = os.environ.pop(LISTEN_FDS_ENV, '')
+    fds = {}
+    for item in value.split(','):
+        name, _, fd = item.partition('=')
+        if name.strip() and fd.strip().isdigit():
+            fds[name.strip()] = int(fd)
+    return fds
+
+
+def wait_for_predecessor(timeout: float = 120.0) -> bool:
+    """
+    Block until the process that started this one has shut down.
+
+    Args:
+        timeout: Seconds to wait at most
+
+    Returns:
+        True if there was a predecessor to wait for
+    """
+    value = os.environ.pop(HANDOFF_FD_ENV, '')
+    if not value.isdigit():
+        return False
+
+    fd = int(value)
+    logger.info("Waiting for the previous server process to shut down")
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning("Previous server process did not shut down in time, starting anyway")
+                break
+            readable, _, _ = select.select([fd], [], [], remaining)
+            # The pipe is never written to; readable means closed
+            if readable and not os.read(fd, 1):
+                break
+    finally:
+        os.close(fd)
+    return True
+
+
+def successor_command() -> List[str]:
+    """Command line that starts another server with the same arguments."""
+    return [sys.executable, '-m', 'aemail.cli'] + sys.argv[1:]
+
+
+class Successor:
+    """A replacement server process started with this one's listening sockets."""
+
+    def __init__(self, fds: Dict[str, int], command: Optional[List[str]] = None):
+        """
+        Start the successor.
+
+        Args:
+            fds: Socket name to listening file descriptor
+            command: Command line (default: successor_command())
+        """
+        read_fd, self._release_fd = os.pipe()
+        env = dict(os.environ)
+        env[LISTEN_FDS_ENV] = ','.join(f'{name}={fd}' for name, fd in fds.items())
+        env[HANDOFF_FD_ENV] = str(read_fd)
+        try:
+            self.process = subprocess.Popen(
+                command or successor_command(), env=env,
+                pass_fds=tuple(fds.values()) + (read_fd,)
+            )
+        except Exception:
+            os.close(self._release_fd)
+            raise
+        finally:
+            os.close(read_fd)
+        logger.info(f"Started successor process {self.process.pid}")
+
+    def release(self):
+        """Let the successor start serving; call once the database is closed."""
+        if self._release_fd is not None:
+            os.close(self._release_fd)
+            self._release_fd = None
@@ -0,0 +1,282 @@
+"""
+Bulk import of mbox, Maildir and .eml corpora into the email store.
+"""
+
+import logging
+import mailbox
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses, parseaddr, parsedate_to_datetime
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from .data import EmailData
+from .email_handler import default_pipeline
+from .pipeline import MessageContext, Pipeline, Stage, StageMetrics
+
+
+logger = logging.getLogger(__name__)
+
+# Recipient headers used to rebuild the envelope of an imported message
+RECIPIENT_HEADERS = ('To', 'Cc', 'Bcc', 'Delivered-To', 'X-Original-To')
+
+
+def detect_format(path: Path) -> str:
+    """
+    Detect the corpus format of a path.
+
+    Args:
+        path: File or directory to import
+
+    Returns:
+        One of 'maildir', 'eml' or 'mbox'
+    """
+    if path.is_dir():
+        if all((path / sub).is_dir() for sub in ('cur', 'new', 'tmp')):
+            return 'maildir'
+        return 'eml'
+    if path.suffix.lower() == '.eml':
+        return 'eml'
+    return 'mbox'
+
+
+def iter_raw_messages(path: Path, fmt: str = 'auto') -> Iterator[bytes]:
+    """
+    Yield the raw bytes of every message in a corpus.
+
+    Args:
+        path: mbox file, Maildir directory, .eml file or directory of .eml files
+        fmt: Corpus format, or 'auto' to detect it from the path
+
+    Yields:
+        Raw RFC 5322 message bytes
+    """
+    if fmt == 'auto':
+        fmt = detect_format(path)
+
+    if fmt == 'mbox':
+        box = mailbox.mbox(str(path), create=False)
+        try:
+            for key in box.iterkeys():
+                yield box.get_bytes(key)
+        finally:
+            box.close()
+    elif fmt == 'maildir':
+        box = mailbox.Maildir(str(path), create=False)
+        for key in sorted(box.iterkeys()):
+            yield box.get_bytes(key)
+    elif fmt == 'eml':
+        files = [path] if path.is_file() else sorted(path.rglob('*.eml'))
+        for eml_file in files:
+            yield eml_file.read_bytes()
+    else:
+        raise ValueError(f"Unknown import format: {fmt}")
+
+
+def _process(raw: bytes, pipeline: Pipeline) -> Tuple[Optional[Dict[str, Any]], bool]:
+    """
+    Run a raw message through the pipeline.
+
+    Returns:
+        (message dictionary, dropped): the dictionary is None if the
+        message cannot be parsed or a stage stopped it, which dropped tells
+    """
+    try:
+        headers = BytesHeaderParser().parsebytes(raw)
+
+        mail_from = parseaddr(headers.get('Return-Path') or headers.get('From', ''))[1]
+        rcpt_tos: List[str] = []
+        for header in RECIPIENT_HEADERS:
+            for _, address in getaddresses(headers.get_all(header, [])):
+                if address and address not in rcpt_tos:
+                    rcpt_tos.append(address)
+
+        context = MessageContext(raw, mail_from, rcpt_tos)
+        if pipeline.process(context) is not None:
+            return None, True
+        email_data = context.data
+
+        date_header = headers.get('Date')
+        if date_header:
+            try:
+                email_data['date'] = parsedate_to_datetime(date_header)
+            except (TypeError, ValueError):
+                pass
+
+        return email_data, False
+    except Exception as e:
+        logger.warning(f"Failed to parse message: {e}")
+        return None, False
+
+
+def parse_raw_message(raw: bytes, pipeline: Optional[Pipeline] = None) -> Optional[Dict[str, Any]]:
+    """
+    Parse a raw message into a storable message dictionary.
+
+    The envelope is rebuilt from the headers, since imported mail has no
+    SMTP session; the message then goes through the same stages as mail
+    received over SMTP.
+
+    Args:
+        raw: Raw message bytes
+        pipeline: Stages to run (defaults to the default stages)
+
+    Returns:
+        Message dictionary, or None if the message cannot be parsed or a
+        stage dropped it
+    """
+    return _process(raw, pipeline or default_pipeline())[0]
+
+
+class MailImporter:
+    """Bulk loader that parses messages in parallel and stores them in batches."""
+
+    def __init__(self, data_store: EmailData, workers: Optional[int] = None,
+                 batch_size: int = 1000, defer_indexes: bool = True,
+                 progress_interval: float = 5.0,
+                 pipeline: Optional[Pipeline] = None):
+        """
+        Initialize the importer.
+
+        Args:
+            data_store: EmailData instance to load messages into
+            workers: Parser processes; 0 or 1 parses in-process,
+                     None uses one per CPU
+            batch_size: Messages per parse batch and insert transaction
+            defer_indexes: Drop indexes during the load and rebuild them at the end
+            progress_interval: Seconds between progress log lines
+            pipeline: Stages every message goes through (defaults to the
+                      default stages). Parser processes run copies of its
+                      stages; their timings are added to it.
+        """
+        self.data_store = data_store
+        self.workers = workers
+        self.batch_size = max(1, batch_size)
+        self.defer_indexes = defer_indexes
+        self.progress_interval = progress_interval
+        self.pipeline = pipeline or default_pipeline()
+
+    def _batches(self, paths: List[Path], fmt: str) -> Iterator[List[bytes]]:
+        """Group the raw messages of all paths into batches."""
+        batch = []
+        for path in paths:
+            for raw in iter_raw_messages(path, fmt):
+                batch.append(raw)
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def run(self, paths: List[str], fmt: str = 'auto') -> Dict[str, Any]:
+        """
+        Import all messages found in the given paths.
+
+        Args:
+            paths: Corpus paths (see iter_raw_messages)
+            fmt: Corpus format, or 'auto' to detect per path
+
+        Returns:
+            Dictionary with 'imported', 'failed', 'dropped' (stopped by a
+            stage), 'elapsed' and 'rate' keys
+        """
+        corpus = [Path(p) for p in paths]
+        for path in corpus:
+            if not path.exists():
+                raise FileNotFoundError(f"Import source not found: {path}")
+
+        stats = {'imported': 0, 'failed': 0, 'dropped': 0, 'elapsed': 0.0, 'rate': 0.0}
+        start = last_report = time.monotonic()
+
+        pool = None
+        depth = 1
+        if self.workers is None or self.workers > 1:
+            pool = ProcessPoolExecutor(max_workers=self.workers)
+            depth = self.workers or os.cpu_count() or 1
+
+        if self.defer_indexes:
+            self.data_store.drop_indexes()
+
+        try:
+            # Every worker parses a batch while the oldest one is stored;
+            # batches are stored in the order they were read
+            pending: Deque[Future] = deque()
+            for batch in self._batches(corpus, fmt):
+                if pool is not None:
+                    future = pool.submit(_parse_batch, batch, self.pipeline.stages)
+                else:
+                    future = Future()
+                    future.set_result(_parse_batch(batch, pipeline=self.pipeline))
+                pending.append(future)
+
+                while len(pending) > depth:
+                    self._store(pending.popleft().result(), stats)
+
+                now = time.monotonic()
+                if now - last_report >= self.progress_interval:
+                    last_report = now
+                    self._report(stats, now - start)
+
+            while pending:
+                self._store(pending.popleft().result(), stats)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            if self.defer_indexes:
+                logger.info("Rebuilding indexes...")
+                self.data_store.create_indexes()
+
+        stats['elapsed'] = time.monotonic() - start
+        stats['rate'] = stats['imported'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        self._report(stats, stats['elapsed'])
+        return stats
+
+    def _store(self, parsed: Tuple[List[Dict[str, Any]], int, int, Optional[Dict[str, StageMetrics]]],
+               stats: Dict[str, Any]):
+        """Store one parsed batch and update the counters."""
+        messages, failed, dropped, metrics = parsed
+        if metrics is not None:
+            self.pipeline.merge(metrics)
+        stats['failed'] += failed
+        stats['dropped'] += dropped
+        with self.pipeline.timed('store'):
+            stats['imported'] += self.data_store.store_messages(messages)
+
+    @staticmethod
+    def _report(stats: Dict[str, Any], elapsed: float):
+        """Log import progress."""
+        rate = stats['imported'] / elapsed if elapsed else 0.0
+        logger.info(
+            f"Imported {stats['imported']} messages "
+            f"({stats['failed']} failed, {stats['dropped']} dropped) - {rate:.0f} msg/s"
+        )
+
+
+def _parse_batch(batch: List[bytes], stages: Optional[List[Stage]] = None,
+                 pipeline: Optional[Pipeline] = None
+                 ) -> Tuple[List[Dict[str, Any]], int, int, Optional[Dict[str, StageMetrics]]]:
+    """
+    Parse a batch of raw messages (process pool entry point).
+
+    Args:
+        batch: Raw messages
+        stages: Stages to run in a pipeline of this process, whose timings are returned
+        pipeline: Pipeline to run instead, in-process
+
+    Returns:
+        (messages, failed, dropped, stage metrics of the process's pipeline or None)
+    """
+    worker = pipeline if pipeline is not None else Pipeline(stages)
+    messages, failed, dropped = [], 0, 0
+    for raw in batch:
+        email_data, was_dropped = _process(raw, worker)
+        if email_data is not None:
+            messages.append(email_data)
+        elif was_dropped:
+            dropped += 1
+        else:
+            failed += 1
+    return messages, failed, dropped, (worker.metrics if pipeline is None else None)
@@ -0,0 +1,506 @@
+"""
+Durable inbox: an append-only journal of accepted mail and its indexer.
+"""
+
+import datetime
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple, Union
+
+from .config import Config
+from .data import EmailData
+
+
+logger = logging.getLogger(__name__)
+
+# Record framing: magic, metadata length and body length up front, CRC-32
+# of the metadata and body at the end
+RECORD_HEADER = struct.Struct('>4sII')
+RECORD_TRAILER = struct.Struct('>I')
+RECORD_MAGIC = b'AEIB'
+
+SEGMENT_SUFFIX = '.inbox'
+
+# Bytes copied per step when a spooled body is appended from its file
+COPY_SIZE = 64 * 1024
+
+# (segment number, byte offset within the segment)
+Position = Tuple[int, int]
+
+# A journaled message: its envelope metadata and raw bytes
+Record = Tuple[Dict[str, Any], bytes]
+
+
+def _read_record(f: BinaryIO) -> Optional[Record]:
+    """
+    Read the record at the current file position.
+
+    Returns:
+        The record, or None at the end of the file or at a torn or
+        corrupt record
+    """
+    header = f.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+        return None
+    magic, meta_len, body_len = RECORD_HEADER.unpack(header)
+    if magic != RECORD_MAGIC:
+        return None
+    meta = f.read(meta_len)
+    body = f.read(body_len)
+    trailer = f.read(RECORD_TRAILER.size)
+    if len(meta) < meta_len or len(body) < body_len or len(trailer) < RECORD_TRAILER.size:
+        return None
+    if RECORD_TRAILER.unpack(trailer)[0] != zlib.crc32(body, zlib.crc32(meta)):
+        return None
+    return json.loads(meta), body
+
+
+class DurableInbox:
+    """
+    Append-only journal of accepted messages, split into numbered segment files.
+
+    handle_DATA appends each message (envelope plus raw bytes) as a single
+    record and waits for sync before replying 250, so acknowledged mail is
+    on disk before it is parsed or indexed. Concurrent waiters share one
+    fsync: the first to arrive syncs everything written so far, and those
+    that arrive meanwhile are covered by it or by the next one (group
+    commit).
+
+    A record torn by a crash fails its checksum and is cut off when the
+    inbox is reopened; it was never acknowledged. Only synced records are
+    handed to readers.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024,
+                 fsync: bool = True):
+        """
+        Initialize the inbox, recovering the segments left by a previous run.
+
+        Args:
+            directory: Directory holding the segment files
+            segment_size: Bytes after which appends move to a new segment
+            fsync: Sync appended records to disk before acknowledging them.
+                   Without it records are only flushed to the OS, which
+                   survives a process crash but not a power loss.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.available = threading.Event()
+        self.counters = {
+            'appended': 0,
+            'appended_bytes': 0,
+            'syncs': 0,
+            'truncated_bytes': 0,
+            'corrupt_records': 0,
+        }
+
+        self._write_lock = threading.Lock()
+        self._sync_cond = threading.Condition()
+        self._syncing = False
+        # Sequence numbers of the last appended and the last synced record
+        self._written = 0
+        self._synced = 0
+
+        segments = self.segments()
+        self._segment = segments[-1] if segments else 1
+        self._offset = self._recover(self._segment) if segments else 0
+        self._file = open(self._path(self._segment), 'ab')
+        self._durable: Position = (self._segment, self._offset)
+
+    @classmethod
+    def from_config(cls, config: Config) -> Optional['DurableInbox']:
+        """Create an inbox from the [inbox] section, or None if it is disabled."""
+        section = config.config
+        directory = section.get('inbox', 'dir', fallback='').strip()
+        if not directory:
+            return None
+        return cls(
+            directory,
+            segment_size=int(section.getfloat('inbox', 'segment_mb', fallback=64.0) * 1024 * 1024),
+            fsync=section.getboolean('inbox', 'fsync', fallback=True),
+        )
+
+    def _path(self, segment: int) -> Path:
+        """Path of a segment file."""
+        return self.directory / f"{segment:08d}{SEGMENT_SUFFIX}"
+
+    def segments(self) -> List[int]:
+        """Numbers of the segment files on disk, oldest first."""
+        return sorted(
+            int(path.stem) for path in self.directory.glob(f"*{SEGMENT_SUFFIX}")
+            if path.stem.isdigit()
+        )
+
+    def _recover(self, segment: int) -> int:
+        """
+        Cut a torn record off the end of a segment.
+
+        Returns:
+            Offset of the end of the last intact record
+        """
+        path = self._path(segment)
+        with open(path, 'r+b') as f:
+            end = 0
+            while _read_record(f) is not None:
+                end = f.tell()
+            size = f.seek(0, os.SEEK_END)
+            if size > end:
+                logger.warning(f"Truncating {size - end} bytes of torn records from {path}")
+                self.counters['truncated_bytes'] += size - end
+                f.truncate(end)
+        return end
+
+    def _roll(self):
+        """Close the current segment and start the next one (write lock held)."""
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._segment += 1
+        self._offset = 0
+        self._file = open(self._path(self._segment), 'ab')
+
+    def append(self, mail_from: str, rcpt_tos: List[str],
+               body: Union[bytes, BinaryIO]) -> int:
+        """
+        Append a message to the journal.
+
+        The record is buffered; it is durable once sync returns for it.
+
+        Args:
+            mail_from: Envelope sender
+            rcpt_tos: Envelope recipients
+            body: Raw message, as bytes or a binary file positioned at its start
+
+        Returns:
+            Sequence number of the record, to pass to sync
+        """
+        meta = json.dumps({'from': mail_from, 'to': rcpt_tos, 'received': time.time()}).encode()
+        with self._write_lock:
+            if self._offset >= self.segment_size:
+                self._roll()
+            start = self._offset
+            try:
+                if isinstance(body, bytes):
+                    crc = zlib.crc32(body, zlib.crc32(meta))
+                    self._file.write(b''.join((
+                        RECORD_HEADER.pack(RECORD_MAGIC, len(meta), len(body)),
+                        meta, body, RECORD_TRAILER.pack(crc),
+                    )))
+                    body_len = len(body)
+                else:
+                    body_len = self._append_file(meta, body)
+            except Exception:
+                self._discard_partial(start)
+                raise
+            size = RECORD_HEADER.size + len(meta) + body_len + RECORD_TRAILER.size
+            self._offset += size
+            self._written += 1
+            self.counters['appended'] += 1
+            self.counters['appended_bytes'] += size
+            return self._written
+
+    def _discard_partial(self, start: int):
+        """Cut a partly written record off the current segment (write lock held)."""
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        os.truncate(self._path(self._segment), start)
+        self._file = open(self._path(self._segment), 'ab')
+
+    def _append_file(self, meta: bytes, body: BinaryIO) -> int:
+        """Write a record whose body is copied from a file (write lock held)."""
+        body_len = body.seek(0, os.SEEK_END)
+        body.seek(0)
+        self._file.write(RECORD_HEADER.pack(RECORD_MAGIC, len(meta), body_len))
+        self._file.write(meta)
+        crc = zlib.crc32(meta)
+        copied = 0
+        while copied < body_len:
+            chunk = body.read(min(COPY_SIZE, body_len - copied))
+            if not chunk:
+                raise IOError("Message body shorter than its file")
+            self._file.write(chunk)
+            crc = zlib.crc32(chunk, crc)
+            copied += len(chunk)
+        self._file.write(RECORD_TRAILER.pack(crc))
+        return body_len
+
+    def sync(self, sequence: int):
+        """
+        Block until the record with the given sequence number is on disk.
+
+        Args:
+            sequence: Sequence number returned by append
+        """
+        with self._sync_cond:
+            while self._synced < sequence:
+                if not self._syncing:
+                    self._syncing = True
+                    break
+                self._sync_cond.wait()
+            else:
+                return
+
+        synced = None
+        try:
+            with self._write_lock:
+                self._file.flush()
+                target, end = self._written, (self._segment, self._offset)
+                # Synced outside the lock so that appends carry on meanwhile;
+                # the duplicate stays valid if the segment rolls over
+                fd = os.dup(self._file.fileno()) if self.fsync else None
+            if fd is not None:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            synced = target
+        finally:
+            with self._sync_cond:
+                self._syncing = False
+                if synced is not None:
+                    self._synced = max(self._synced, synced)
+                    self._durable = max(self._durable, end)
+                    self.counters['syncs'] += 1
+                self._sync_cond.notify_all()
+        self.available.set()
+
+    def deliver(self, mail_from: str, rcpt_tos: List[str],
+                body: Union[bytes, BinaryIO]) -> None:
+        """Append a message and wait until it is durable."""
+        self.sync(self.append(mail_from, rcpt_tos, body))
+
+    @property
+    def durable_position(self) -> Position:
+        """Position of the end of the last synced record."""
+        return self._durable
+
+    def read(self, position: Position, limit: int) -> Tuple[List[Record], Position]:
+        """
+        Read synced records from a position onwards.
+
+        Args:
+            position: Where to start reading
+            limit: Maximum number of records
+
+        Returns:
+            Tuple of (records, position after the last record returned)
+        """
+        segment, offset = position
+        durable_segment, durable_offset = self._durable
+        records: List[Record] = []
+        while len(records) < limit and (segment, offset) < (durable_segment, durable_offset):
+            last = segment == durable_segment
+            path = self._path(segment)
+            if not path.exists():
+                if last:
+                    break
+                segment, offset = segment + 1, 0
+                continue
+
+            with open(path, 'rb') as f:
+                end = durable_offset if last else f.seek(0, os.SEEK_END)
+                f.seek(offset)
+                while len(records) < limit and offset < end:
+                    record = _read_record(f)
+                    if record is None:
+                        logger.error(f"Corrupt record in {path} at offset {offset}, "
+                                     f"skipping the rest of the segment")
+                        self.counters['corrupt_records'] += 1
+                        offset = end
+                        break
+                    records.append(record)
+                    offset = f.tell()
+            if offset >= end and not last:
+                segment, offset = segment + 1, 0
+        return records, (segment, offset)
+
+    def remove_before(self, segment: int) -> int:
+        """
+        Delete the segments older than the given one.
+
+        Returns:
+            Number of segment files deleted
+        """
+        removed = 0
+        for number in self.segments():
+            if number >= min(segment, self._segment):
+                break
+            self._path(number).unlink()
+            removed += 1
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of the journal counters.
+
+        Returns:
+            Dictionary of counters, the segment count and the current segment
+        """
+        stats: Dict[str, Any] = dict(self.counters)
+        stats['segments'] = len(self.segments())
+        stats['segment'] = self._segment
+        return stats
+
+    def close(self):
+        """Sync and close the current segment."""
+        with self._write_lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+
+
+class InboxIndexer:
+    """
+    Loads journaled messages into EmailData on a background thread.
+
+    The indexer starts from the checkpoint stored in the database, so on
+    startup it replays whatever was acknowledged but not yet indexed.
+    Each batch is stored in one transaction together with its new
+    checkpoint, so a replay never stores a message twice. Segments
+    behind the checkpoint are deleted.
+    """
+
+    def __init__(self, inbox: DurableInbox, data_store: EmailData,
+                 parse: Callable[[bytes, str, List[str]], Dict[str, Any]],
+                 batch_size: int = 500, retry_interval: float = 1.0):
+        """
+        Initialize the indexer.
+
+        Args:
+            inbox: Journal to index
+            data_store: EmailData instance to store the messages in
+            parse: Builds the storable message dictionary from the raw
+                   bytes, sender and recipients, or returns None to drop it
+            batch_size: Messages per transaction
+            retry_interval: Seconds to wait after a failed batch
+        """
+        self.inbox = inbox
+        self.data_store = data_store
+        self.parse = parse
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.position = self._start_position()
+        self.counters = {
+            'indexed': 0,
+            'parse_errors': 0,
+            'dropped': 0,
+            'store_errors': 0,
+            'segments_removed': 0,
+        }
+        self.thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def _start_position(self) -> Position:
+        """The checkpoint, or the oldest segment if there is none or it is stale."""
+        segments = self.inbox.segments()
+        first: Position = (segments[0] if segments else 1, 0)
+        position = self.data_store.inbox_position()
+        if position is None:
+            return first
+        if position > self.inbox.durable_position:
+            logger.warning(f"Inbox checkpoint {position} is past the end of the journal, "
+                           f"indexing from the start")
+            return first
+        return max(position, first)
+
+    def _parse(self, record: Record) -> Optional[Dict[str, Any]]:
+        """Build the message of a record, or None if it cannot be parsed or is dropped."""
+        meta, body = record
+        try:
+            message = self.parse(body, meta['from'], meta['to'])
+        except Exception as e:
+            logger.error(f"Dropping unparseable journaled message from {meta.get('from')}: {e}")
+            self.counters['parse_errors'] += 1
+            return None
+        if message is None:
+            self.counters['dropped'] += 1
+            return None
+        # Stamped with the time it was accepted, not the time it is indexed
+        message['date'] = datetime.datetime.fromtimestamp(meta['received'])
+        return message
+
+    def index_pending(self) -> int:
+        """
+        Index one batch of synced records.
+
+        Returns:
+            Number of records consumed
+        """
+        records, position = self.inbox.read(self.position, self.batch_size)
+        if position == self.position:
+            return 0
+
+        messages = [m for m in map(self._parse, records) if m is not None]
+        self.data_store.store_messages(messages, inbox_position=position)
+        self.position = position
+        self.counters['indexed'] += len(messages)
+
+        removed = self.inbox.remove_before(position[0])
+        self.counters['segments_removed'] += removed
+        # Moving past a finished segment counts as progress too
+        return max(len(records), 1)
+
+    def run(self):
+        """Index until stopped, then drain what is left."""
+        while True:
+            self.inbox.available.clear()
+            try:
+                indexed = self.index_pending()
+            except Exception as e:
+                logger.error(f"Error indexing journaled mail: {e}")
+                self.counters['store_errors'] += 1
+                if self._stopping.wait(self.retry_interval):
+                    break
+                continue
+            if indexed:
+                continue
+            if self._stopping.is_set():
+                break
+            self.inbox.available.wait(1.0)
+
+    def start(self):
+        """Start indexing on a background thread."""
+        self.thread = threading.Thread(target=self.run, name="aemail-inbox", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Index the remaining records and stop.
+
+        Args:
+            timeout: Seconds to wait for the backlog to drain
+        """
+        self._stopping.set()
+        self.inbox.available.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                logger.warning("Inbox indexer did not drain in time; "
+                               "the rest is replayed on the next start")
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of the journal and indexing counters.
+
+        Returns:
+            Dictionary of counters and the indexed and durable positions
+        """
+        stats = self.inbox.stats()
+        stats.update(self.counters)
+        stats['position'] = list(self.position)
+        stats['durable_position'] = list(self.inbox.durable_position)
+        return stats
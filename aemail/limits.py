@@ -0,0 +1,244 @@
+"""
+Per-client connection and rate limits for SMTP ingestion.
+"""
+
+import time
+from typing import Any, Dict, Optional
+
+from .config import Config
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at a fixed rate."""
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> bool:
+        """
+        Take one token if available.
+
+        Args:
+            rate: Tokens added per second
+            burst: Bucket capacity
+            now: Current monotonic time
+
+        Returns:
+            True if a token was taken
+        """
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class KeyedRateLimiter:
+    """
+    Token buckets per key (source IP, recipient domain, ...).
+
+    Buckets idle for longer than the TTL are dropped by a sweep that runs
+    at most once per TTL, so memory stays proportional to active keys.
+    An idle bucket would have refilled to full anyway, so dropping it
+    does not change any decision.
+    """
+
+    def __init__(self, rate: float, burst: float, idle_ttl: float = 300.0):
+        """
+        Initialize the limiter.
+
+        Args:
+            rate: Sustained events per second per key (0 disables the limit)
+            burst: Events allowed at once per key
+            idle_ttl: Seconds after which an unused bucket is dropped
+        """
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.idle_ttl = idle_ttl
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._next_sweep = time.monotonic() + idle_ttl
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the limit is enforced."""
+        return self.rate > 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, key: str, now: Optional[float] = None) -> bool:
+        """
+        Check and consume one event for a key.
+
+        Args:
+            key: Bucket key
+            now: Current monotonic time (defaults to time.monotonic())
+
+        Returns:
+            True if the event is within the limit
+        """
+        if not self.enabled:
+            return True
+
+        if now is None:
+            now = time.monotonic()
+        if now >= self._next_sweep:
+            self.sweep(now)
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+        return bucket.take(self.rate, self.burst, now)
+
+    def sweep(self, now: Optional[float] = None):
+        """Drop buckets that have been idle for longer than the TTL."""
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.idle_ttl
+        for key in [k for k, b in self._buckets.items() if b.updated < cutoff]:
+            del self._buckets[key]
+        self._next_sweep = now + self.idle_ttl
+
+
+class ClientLimits:
+    """
+    Connection, session and rate limits enforced from the SMTP handler hooks.
+
+    A limit of 0 disables it. Everything is in-memory and accessed only
+    from the SMTP event loop.
+    """
+
+    # Replies; 421 closes the connection, 452 asks the client to retry later
+    TOO_MANY_SESSIONS = '421 4.7.0 Too many connections, try again later'
+    IP_RATE_EXCEEDED = '452 4.7.1 Message rate limit exceeded, try again later'
+    SESSION_MESSAGES_EXCEEDED = '452 4.5.3 Too many messages in this session'
+    DOMAIN_RATE_EXCEEDED = '452 4.7.1 Recipient domain rate limit exceeded, try again later'
+
+    def __init__(self, max_sessions: int = 0, max_sessions_per_ip: int = 0,
+                 max_messages_per_session: int = 0, ip_rate: float = 0.0,
+                 ip_burst: float = 10.0, domain_rate: float = 0.0,
+                 domain_burst: float = 10.0, idle_ttl: float = 300.0):
+        """
+        Initialize the limits.
+
+        Args:
+            max_sessions: Concurrent SMTP sessions in total
+            max_sessions_per_ip: Concurrent SMTP sessions per source IP
+            max_messages_per_session: Messages accepted per session
+            ip_rate: Sustained messages per second per source IP
+            ip_burst: Message burst per source IP
+            domain_rate: Sustained recipients per second per recipient domain
+            domain_burst: Recipient burst per recipient domain
+            idle_ttl: Seconds after which idle per-key state is dropped
+        """
+        self.max_sessions = max_sessions
+        self.max_sessions_per_ip = max_sessions_per_ip
+        self.max_messages_per_session = max_messages_per_session
+        self.ip_limiter = KeyedRateLimiter(ip_rate, ip_burst, idle_ttl)
+        self.domain_limiter = KeyedRateLimiter(domain_rate, domain_burst, idle_ttl)
+
+        self.active_sessions = 0
+        self._sessions_per_ip: Dict[str, int] = {}
+        self.counters = {
+            'sessions_accepted': 0,
+            'sessions_rejected': 0,
+            'messages_rejected_ip_rate': 0,
+            'messages_rejected_session_limit': 0,
+            'recipients_rejected_domain_rate': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'ClientLimits':
+        """Create limits from the [limits] section of the configuration."""
+        section = config.config
+        return cls(
+            max_sessions=section.getint('limits', 'max_sessions', fallback=0),
+            max_sessions_per_ip=section.getint('limits', 'max_sessions_per_ip', fallback=0),
+            max_messages_per_session=section.getint('limits', 'max_messages_per_session', fallback=0),
+            ip_rate=section.getfloat('limits', 'ip_rate', fallback=0.0),
+            ip_burst=section.getfloat('limits', 'ip_burst', fallback=10.0),
+            domain_rate=section.getfloat('limits', 'domain_rate', fallback=0.0),
+            domain_burst=section.getfloat('limits', 'domain_burst', fallback=10.0),
+            idle_ttl=section.getfloat('limits', 'idle_ttl', fallback=300.0),
+        )
+
+    def open_session(self, ip: str) -> Optional[str]:
+        """
+        Register a new session.
+
+        Args:
+            ip: Source IP of the client
+
+        Returns:
+            Rejection reply, or None if the session is admitted
+        """
+        per_ip = self._sessions_per_ip.get(ip, 0)
+        if ((self.max_sessions and self.active_sessions >= self.max_sessions) or
+                (self.max_sessions_per_ip and per_ip >= self.max_sessions_per_ip)):
+            self.counters['sessions_rejected'] += 1
+            return self.TOO_MANY_SESSIONS
+
+        self.active_sessions += 1
+        self._sessions_per_ip[ip] = per_ip + 1
+        self.counters['sessions_accepted'] += 1
+        return None
+
+    def close_session(self, ip: str):
+        """Unregister a session admitted by open_session."""
+        self.active_sessions -= 1
+        remaining = self._sessions_per_ip.get(ip, 1) - 1
+        if remaining > 0:
+            self._sessions_per_ip[ip] = remaining
+        else:
+            self._sessions_per_ip.pop(ip, None)
+
+    def check_message(self, ip: str, session_messages: int) -> Optional[str]:
+        """
+        Check whether a new message (MAIL FROM) may start.
+
+        Args:
+            ip: Source IP of the client
+            session_messages: Messages already delivered in this session
+
+        Returns:
+            Rejection reply, or None if the message is allowed
+        """
+        if self.max_messages_per_session and session_messages >= self.max_messages_per_session:
+            self.counters['messages_rejected_session_limit'] += 1
+            return self.SESSION_MESSAGES_EXCEEDED
+        if not self.ip_limiter.allow(ip):
+            self.counters['messages_rejected_ip_rate'] += 1
+            return self.IP_RATE_EXCEEDED
+        return None
+
+    def check_recipient(self, domain: str) -> Optional[str]:
+        """
+        Check whether a recipient domain is within its rate.
+
+        Args:
+            domain: Lowercased recipient domain
+
+        Returns:
+            Rejection reply, or None if the recipient is allowed
+        """
+        if not self.domain_limiter.allow(domain):
+            self.counters['recipients_rejected_domain_rate'] += 1
+            return self.DOMAIN_RATE_EXCEEDED
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        """Get limit settings, current usage and rejection counters."""
+        return {
+            'active_sessions': self.active_sessions,
+            'tracked_ips': len(self._sessions_per_ip),
+            'ip_buckets': len(self.ip_limiter),
+            'domain_buckets': len(self.domain_limiter),
+            'max_sessions': self.max_sessions,
+            'max_sessions_per_ip': self.max_sessions_per_ip,
+            'max_messages_per_session': self.max_messages_per_session,
+            **self.counters,
+        }
@@ -0,0 +1,43 @@
+"""
+Metrics registry for the /metrics endpoint.
+"""
+
+import logging
+from typing import Any, Callable, Dict
+
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsRegistry:
+    """Collects named metric snapshots from the server components."""
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def register(self, name: str, provider: Callable[[], Dict[str, Any]]):
+        """
+        Register a metrics provider.
+
+        Args:
+            name: Key of the provider's section in the collected metrics
+            provider: Callable returning a JSON-serializable dictionary
+        """
+        self._providers[name] = provider
+
+    def collect(self) -> Dict[str, Any]:
+        """
+        Collect a snapshot from every provider.
+
+        Returns:
+            Dictionary of provider name to its metrics
+        """
+        snapshot = {}
+        for name, provider in self._providers.items():
+            try:
+                snapshot[name] = provider()
+            except Exception as e:
+                logger.error(f"Error collecting {name} metrics: {e}")
+                snapshot[name] = {"error": str(e)}
+        return snapshot
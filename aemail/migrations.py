@@ -0,0 +1,1063 @@
+"""
+Versioned schema migrations for the msg table.
+
+The schema version lives in ``PRAGMA user_version``. Each migration has a
+quick DDL step, applied when the database is opened, and optionally a
+backfill that walks the table in small resumable batches. Backfills can
+run on their own connection while the server keeps storing mail: their
+progress is recorded in the schema_backfill table, so an interrupted
+backfill continues where it stopped the next time the database is opened.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .extractors import TokenExtractor
+from .rendering import split_content
+from .utils import AddressNormalizer
+
+
+logger = logging.getLogger(__name__)
+
+# Current layout, created as-is for new databases
+MSG_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        frm TEXT,
+        to0 TEXT,
+        tos TEXT,
+        subject TEXT,
+        content TEXT,
+        created_at INTEGER,
+        frm_canon TEXT,
+        to0_canon TEXT,
+        text_body TEXT,
+        html_body TEXT,
+        size INTEGER
+    )
+"""
+
+# Secondary indexes of the current layout, keyed by name so they can be
+# dropped and rebuilt around bulk loads. The msg indexes each serve one
+# lookup (by sender, everything) in newest-first order: the key columns
+# match the WHERE and ORDER BY of the query, and the trailing columns hold
+# everything a summary returns, so message lists never touch the table.
+# Address lookups go through the canonical columns so that differently-cased
+# spellings hit the same entries. Recipient lookups go through the mailbox
+# table, whose entries idx_mailbox_msg finds by message and
+# idx_mailbox_domain by recipient domain, newest first.
+SUMMARY_INDEX_COLUMNS = "id, frm, to0, tos, subject, size"
+INDEXES = {
+    "idx_msg_frm_created": (
+        "CREATE INDEX IF NOT EXISTS idx_msg_frm_created ON msg "
+        f"(frm_canon, created_at, {SUMMARY_INDEX_COLUMNS})"
+    ),
+    "idx_msg_created": (
+        "CREATE INDEX IF NOT EXISTS idx_msg_created ON msg "
+        f"(created_at, {SUMMARY_INDEX_COLUMNS})"
+    ),
+    "idx_mailbox_msg": "CREATE INDEX IF NOT EXISTS idx_mailbox_msg ON mailbox (msg_id)",
+    "idx_mailbox_domain": (
+        "CREATE INDEX IF NOT EXISTS idx_mailbox_domain ON mailbox "
+        "(substr(address, instr(address, '@') + 1), created_at, msg_id)"
+    ),
+}
+
+# Indexes the mailbox triggers look entries up by (a message's entries on
+# delete, its other recipients in a domain for the rollups). Without them
+# every stored message would scan the mailbox table, so they stay during
+# bulk loads.
+TRIGGER_INDEXES = frozenset({"idx_mailbox_msg", "idx_mailbox_domain"})
+
+# The msg indexes of schema versions 3 to 6, built by those migrations.
+# The first one served recipient lookups until the mailbox table replaced it.
+INDEXES_V4 = {
+    "idx_msg_to0_created": (
+        "CREATE INDEX IF NOT EXISTS idx_msg_to0_created ON msg "
+        f"(to0_canon, created_at, {SUMMARY_INDEX_COLUMNS})"
+    ),
+    "idx_msg_frm_created": INDEXES["idx_msg_frm_created"],
+    "idx_msg_created": INDEXES["idx_msg_created"],
+}
+
+# Row count kept up to date by triggers, so totals need no table scan
+MSG_COUNT_TABLE = """
+    CREATE TABLE IF NOT EXISTS msg_count (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        total INTEGER NOT NULL
+    )
+"""
+TRIGGERS = {
+    "msg_count_insert": (
+        "CREATE TRIGGER IF NOT EXISTS msg_count_insert AFTER INSERT ON msg "
+        "BEGIN UPDATE msg_count SET total = total + 1 WHERE id = 0; END"
+    ),
+    "msg_count_delete": (
+        "CREATE TRIGGER IF NOT EXISTS msg_count_delete AFTER DELETE ON msg "
+        "BEGIN UPDATE msg_count SET total = total - 1 WHERE id = 0; END"
+    ),
+}
+
+# Codes, links and custom tokens extracted from each message at ingest.
+# Rows are keyed by message, then kind, in extraction order, so the first
+# token of a kind is the leading entry of its (msg_id, kind) range.
+MSG_TOKEN_TABLE = """
+    CREATE TABLE IF NOT EXISTS msg_token (
+        msg_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        value TEXT NOT NULL
+    )
+"""
+MSG_TOKEN_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idx_msg_token ON msg_token (msg_id, kind, position, value)"
+)
+MSG_TOKEN_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS msg_token_delete AFTER DELETE ON msg "
+    "BEGIN DELETE FROM msg_token WHERE msg_id = old.id; END"
+)
+
+# Values of the indexed headers (see HeaderExtractor), keyed for exact
+# lookups by name and value, newest message first
+MSG_HEADER_TABLE = """
+    CREATE TABLE IF NOT EXISTS msg_header (
+        name TEXT NOT NULL,
+        value TEXT NOT NULL,
+        msg_id INTEGER NOT NULL,
+        PRIMARY KEY (name, value, msg_id)
+    ) WITHOUT ROWID
+"""
+MSG_HEADER_INDEX = "CREATE INDEX IF NOT EXISTS idx_msg_header_msg ON msg_header (msg_id)"
+MSG_HEADER_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS msg_header_delete AFTER DELETE ON msg "
+    "BEGIN DELETE FROM msg_header WHERE msg_id = old.id; END"
+)
+
+# Change feed: every message stored or deleted, in commit order. AUTOINCREMENT
+# keeps sequence numbers from being reused, so a consumer can always resume
+# after the last one it has seen.
+MSG_CHANGE_TABLE = """
+    CREATE TABLE IF NOT EXISTS msg_change (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        op TEXT NOT NULL,
+        msg_id INTEGER NOT NULL
+    )
+"""
+CHANGE_TRIGGERS = {
+    "msg_change_insert": (
+        "CREATE TRIGGER IF NOT EXISTS msg_change_insert AFTER INSERT ON msg "
+        "BEGIN INSERT INTO msg_change (op, msg_id) VALUES ('insert', new.id); END"
+    ),
+    "msg_change_delete": (
+        "CREATE TRIGGER IF NOT EXISTS msg_change_delete AFTER DELETE ON msg "
+        "BEGIN INSERT INTO msg_change (op, msg_id) VALUES ('delete', old.id); END"
+    ),
+}
+
+# Outbound webhooks: how far each target has read the change feed, and the
+# batches waiting to be delivered, due first
+WEBHOOK_CURSOR_TABLE = """
+    CREATE TABLE IF NOT EXISTS webhook_cursor (
+        target TEXT PRIMARY KEY,
+        seq INTEGER NOT NULL
+    )
+"""
+WEBHOOK_QUEUE_TABLE = """
+    CREATE TABLE IF NOT EXISTS webhook_queue (
+        id INTEGER PRIMARY KEY,
+        target TEXT NOT NULL,
+        msg_ids TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt INTEGER NOT NULL,
+        last_error TEXT
+    )
+"""
+WEBHOOK_QUEUE_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idx_webhook_queue_due ON webhook_queue (target, next_attempt, id)"
+)
+
+# Position up to which the durable inbox has been indexed. Written in the
+# same transaction as the messages, so a replay never stores one twice.
+INBOX_CHECKPOINT_TABLE = """
+    CREATE TABLE IF NOT EXISTS inbox_checkpoint (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        segment INTEGER NOT NULL,
+        position INTEGER NOT NULL
+    )
+"""
+
+# One entry per recipient of a message, so a message to 500 recipients is
+# stored once and listed in 500 mailboxes. The primary key orders each
+# mailbox newest first, and seen is the per-mailbox read state.
+MAILBOX_TABLE = """
+    CREATE TABLE IF NOT EXISTS mailbox (
+        address TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        msg_id INTEGER NOT NULL,
+        seen INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (address, created_at, msg_id)
+    ) WITHOUT ROWID
+"""
+
+# Message and unread counts per mailbox, kept up to date by triggers
+MAILBOX_STATS_TABLE = """
+    CREATE TABLE IF NOT EXISTS mailbox_stats (
+        address TEXT PRIMARY KEY,
+        total INTEGER NOT NULL,
+        unread INTEGER NOT NULL
+    ) WITHOUT ROWID
+"""
+MAILBOX_TRIGGERS = {
+    "mailbox_insert": (
+        "CREATE TRIGGER IF NOT EXISTS mailbox_insert AFTER INSERT ON mailbox "
+        "BEGIN INSERT INTO mailbox_stats (address, total, unread) "
+        "VALUES (new.address, 1, 1 - new.seen) ON CONFLICT (address) DO UPDATE "
+        "SET total = total + 1, unread = unread + 1 - new.seen; END"
+    ),
+    "mailbox_seen": (
+        "CREATE TRIGGER IF NOT EXISTS mailbox_seen AFTER UPDATE OF seen ON mailbox "
+        "WHEN old.seen != new.seen BEGIN UPDATE mailbox_stats "
+        "SET unread = unread + old.seen - new.seen WHERE address = new.address; END"
+    ),
+    "mailbox_delete": (
+        "CREATE TRIGGER IF NOT EXISTS mailbox_delete AFTER DELETE ON mailbox "
+        "BEGIN UPDATE mailbox_stats SET total = total - 1, unread = unread - 1 + old.seen "
+        "WHERE address = old.address; END"
+    ),
+}
+MAILBOX_MSG_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS msg_mailbox_delete AFTER DELETE ON msg "
+    "BEGIN DELETE FROM mailbox WHERE msg_id = old.id; END"
+)
+
+# Message counts and bytes per hour, kept up to date by triggers so that
+# statistics never scan msg. kind is 'all' (key ''), 'sender' (canonical
+# sender) or 'domain' (recipient domain, counted once per message however
+# many of its recipients share the domain). The primary key serves the
+# busiest keys of a time range, the index the hourly series of one key.
+HOUR = "/ 3600 * 3600"
+MSG_ROLLUP_TABLE = """
+    CREATE TABLE IF NOT EXISTS msg_rollup (
+        kind TEXT NOT NULL,
+        hour INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        messages INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        PRIMARY KEY (kind, hour, key)
+    ) WITHOUT ROWID
+"""
+MSG_ROLLUP_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idx_msg_rollup_key ON msg_rollup (kind, key, hour, messages, bytes)"
+)
+ROLLUP_UPSERT = (
+    "ON CONFLICT (kind, hour, key) DO UPDATE SET "
+    "messages = messages + excluded.messages, bytes = bytes + excluded.bytes"
+)
+MAILBOX_DOMAIN = "substr({0}address, instr({0}address, '@') + 1)"
+ROLLUP_TRIGGERS = {
+    "msg_rollup_insert": (
+        "CREATE TRIGGER IF NOT EXISTS msg_rollup_insert AFTER INSERT ON msg "
+        "BEGIN INSERT INTO msg_rollup (kind, hour, key, messages, bytes) VALUES "
+        f"('all', coalesce(new.created_at, 0) {HOUR}, '', 1, coalesce(new.size, 0)), "
+        f"('sender', coalesce(new.created_at, 0) {HOUR}, coalesce(new.frm_canon, ''), 1, "
+        f"coalesce(new.size, 0)) {ROLLUP_UPSERT}; END"
+    ),
+    # The first entry of a message in each domain counts the message there;
+    # idx_mailbox_domain finds the message's other entries in the domain
+    "mailbox_rollup_insert": (
+        "CREATE TRIGGER IF NOT EXISTS mailbox_rollup_insert AFTER INSERT ON mailbox "
+        f"WHEN NOT EXISTS (SELECT 1 FROM mailbox WHERE {MAILBOX_DOMAIN.format('')} = "
+        f"{MAILBOX_DOMAIN.format('new.')} AND created_at = new.created_at "
+        "AND msg_id = new.msg_id AND address != new.address) "
+        "BEGIN INSERT INTO msg_rollup (kind, hour, key, messages, bytes) VALUES "
+        f"('domain', new.created_at {HOUR}, {MAILBOX_DOMAIN.format('new.')}, 1, "
+        f"coalesce((SELECT size FROM msg WHERE rowid = new.msg_id), 0)) {ROLLUP_UPSERT}; END"
+    ),
+    # Before the delete, while the message's mailbox entries still name its domains
+    "msg_rollup_delete": (
+        "CREATE TRIGGER IF NOT EXISTS msg_rollup_delete BEFORE DELETE ON msg "
+        "BEGIN UPDATE msg_rollup SET messages = messages - 1, bytes = bytes - coalesce(old.size, 0) "
+        f"WHERE hour = coalesce(old.created_at, 0) {HOUR} AND ("
+        "(kind = 'all' AND key = '') OR (kind = 'sender' AND key = coalesce(old.frm_canon, '')) "
+        f"OR (kind = 'domain' AND key IN (SELECT {MAILBOX_DOMAIN.format('')} FROM mailbox "
+        "WHERE msg_id = old.id))); END"
+    ),
+}
+
+BACKFILL_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_backfill (
+        version INTEGER PRIMARY KEY,
+        position INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+# Local-time timestamp strings of the createDate column as epoch seconds
+EPOCH_FROM_CREATE_DATE = "CAST(strftime('%s', createDate, 'utc') AS INTEGER)"
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    """Column names of a table."""
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    """Check whether a table exists."""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+def _batch_end(conn: sqlite3.Connection, table: str, position: int,
+               batch_size: int) -> Optional[int]:
+    """Last rowid of the next batch after position, or None past the end."""
+    return conn.execute(
+        f"SELECT MAX(rowid) FROM (SELECT rowid FROM {table} "
+        "WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+        (position, batch_size)
+    ).fetchone()[0]
+
+
+class Migration:
+    """A schema change from version - 1 to version."""
+
+    version = 0
+    description = ""
+    has_backfill = False
+
+    def upgrade(self, conn: sqlite3.Connection):
+        """
+        Apply the schema change.
+
+        Runs inside a transaction when the database is opened, so it must
+        only contain quick DDL; anything proportional to the table size
+        belongs in backfill.
+        """
+
+    def backfill(self, conn: sqlite3.Connection, position: int, batch_size: int,
+                 normalizer: AddressNormalizer) -> Optional[int]:
+        """
+        Process the next batch of rows.
+
+        Runs inside its own transaction.
+
+        Args:
+            conn: Database connection
+            position: Position reached by the previous batch (0 at the start)
+            batch_size: Rows to process
+            normalizer: Address normalizer of the data store
+
+        Returns:
+            The new position, or None once the backfill is complete
+        """
+        return None
+
+
+class AddCanonicalColumns(Migration):
+    """Canonical address columns, stored renditions and message size."""
+
+    version = 1
+    description = "canonical address columns, renditions and size"
+    has_backfill = True
+
+    COLUMNS = {
+        "frm_canon": "TEXT",
+        "to0_canon": "TEXT",
+        "text_body": "TEXT",
+        "html_body": "TEXT",
+        "size": "INTEGER",
+    }
+
+    def upgrade(self, conn: sqlite3.Connection):
+        columns = _columns(conn, "msg")
+        for column, column_type in self.COLUMNS.items():
+            if column not in columns:
+                conn.execute(f"ALTER TABLE msg ADD COLUMN {column} {column_type}")
+        # Lookups on the raw address columns are replaced by the canonical ones
+        conn.execute("DROP INDEX IF EXISTS index_frm")
+        conn.execute("DROP INDEX IF EXISTS index_to0")
+        conn.execute("CREATE INDEX IF NOT EXISTS index_frm_canon ON msg (frm_canon)")
+        conn.execute("CREATE INDEX IF NOT EXISTS index_to0_canon ON msg (to0_canon)")
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        rows = conn.execute(
+            "SELECT rowid, frm, to0, to0_canon FROM msg "
+            "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (position, batch_size)
+        ).fetchall()
+        if not rows:
+            return None
+
+        canonicalize = normalizer.canonicalize
+        conn.executemany(
+            "UPDATE msg SET frm_canon = ?, to0_canon = ? WHERE rowid = ?",
+            [(canonicalize(frm or ''), canonicalize(to0 or ''), rowid)
+             for rowid, frm, to0, to0_canon in rows if to0_canon is None]
+        )
+        # The raw size is unknown; like _message_row, fall back to the stored content
+        conn.execute(
+            "UPDATE msg SET size = COALESCE(length(CAST(content AS BLOB)), 0) "
+            "WHERE rowid > ? AND rowid <= ? AND size IS NULL",
+            (position, rows[-1][0])
+        )
+        return rows[-1][0]
+
+
+class AddEpochTimestamps(Migration):
+    """Integer epoch timestamps in place of timestamp strings."""
+
+    version = 2
+    description = "created_at epoch seconds"
+    has_backfill = True
+
+    def upgrade(self, conn: sqlite3.Connection):
+        if "created_at" not in _columns(conn, "msg"):
+            conn.execute("ALTER TABLE msg ADD COLUMN created_at INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS index_created_at ON msg (created_at)")
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        end = _batch_end(conn, "msg", position, batch_size)
+        if end is None:
+            return None
+        conn.execute(
+            f"UPDATE msg SET created_at = {EPOCH_FROM_CREATE_DATE} "
+            "WHERE rowid > ? AND rowid <= ? AND created_at IS NULL",
+            (position, end)
+        )
+        return end
+
+
+class AddPrimaryKey(Migration):
+    """
+    Rebuild msg with an INTEGER PRIMARY KEY message id.
+
+    SQLite cannot add a primary key in place, so rows are copied into
+    msg_rebuild in rowid order, keeping their rowid as the id. Mail keeps
+    going to the old table meanwhile; the rows that arrive during the copy
+    are carried over in the same transaction that swaps the tables. The
+    old table is then emptied in batches before it is dropped, so no
+    single step holds the write lock for long. Renditions that are lazily
+    written back to already-copied rows during the copy are recomputed on
+    their next access.
+    """
+
+    version = 3
+    description = "id INTEGER PRIMARY KEY"
+    has_backfill = True
+
+    COPY_COLUMNS = (
+        "frm, to0, tos, subject, content, frm_canon, to0_canon, "
+        "text_body, html_body, size"
+    )
+
+    def upgrade(self, conn: sqlite3.Connection):
+        conn.execute(MSG_TABLE.format(name="msg_rebuild"))
+        # Built empty so the copy maintains them batch by batch
+        for statement in INDEXES_V4.values():
+            conn.execute(statement.replace(" ON msg ", " ON msg_rebuild "))
+
+    def _copy(self, conn: sqlite3.Connection, position: int,
+              end: Optional[int] = None) -> None:
+        """Copy the rows after position (up to end) into msg_rebuild."""
+        has_create_date = "createDate" in _columns(conn, "msg")
+        created_at = (
+            f"COALESCE(created_at, {EPOCH_FROM_CREATE_DATE})"
+            if has_create_date else "created_at"
+        )
+        where = "rowid > ?" + (" AND rowid <= ?" if end is not None else "")
+        params = (position,) + ((end,) if end is not None else ())
+        conn.execute(
+            f"INSERT INTO msg_rebuild (id, {self.COPY_COLUMNS}, created_at) "
+            f"SELECT rowid, {self.COPY_COLUMNS}, {created_at} FROM msg "
+            f"WHERE {where} ORDER BY rowid",
+            params
+        )
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        if _table_exists(conn, "msg_retired"):
+            # Swapped already; empty the old table
+            end = _batch_end(conn, "msg_retired", 0, batch_size)
+            if end is not None:
+                conn.execute("DELETE FROM msg_retired WHERE rowid <= ?", (end,))
+                return position
+            conn.execute("DROP TABLE msg_retired")
+            return None
+
+        end = _batch_end(conn, "msg", position, batch_size)
+        if end is not None:
+            self._copy(conn, position, end)
+            return end
+
+        # Caught up: carry over late arrivals and swap the tables
+        self._copy(conn, position)
+        conn.execute("ALTER TABLE msg RENAME TO msg_retired")
+        conn.execute("ALTER TABLE msg_rebuild RENAME TO msg")
+        for statement in INDEXES_V4.values():
+            conn.execute(statement)
+        return position
+
+
+class AddCoveringIndexes(Migration):
+    """
+    Composite covering indexes and a maintained row count.
+
+    Building an index holds the write lock for the whole build, so each
+    index is built in a backfill step of its own (on the background
+    connection) rather than at startup; the single-column indexes they
+    replace keep serving lookups until the last one is done.
+    """
+
+    version = 4
+    description = "composite covering indexes and msg_count"
+    has_backfill = True
+
+    # The single-column indexes of versions 1 and 2
+    REPLACED_INDEXES = ("index_frm_canon", "index_to0_canon", "index_created_at")
+
+    def upgrade(self, conn: sqlite3.Connection):
+        conn.execute(MSG_COUNT_TABLE)
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        if position == 0:
+            # Counted in the same transaction the triggers start counting in
+            conn.execute(
+                "INSERT OR REPLACE INTO msg_count (id, total) "
+                "SELECT 0, COUNT(*) FROM msg"
+            )
+            for statement in TRIGGERS.values():
+                conn.execute(statement)
+            return 1
+
+        statements = list(INDEXES_V4.values())
+        if position <= len(statements):
+            conn.execute(statements[position - 1])
+            return position + 1
+
+        for name in self.REPLACED_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+        return None
+
+
+class AddMessageTokens(Migration):
+    """
+    The msg_token table of extracted codes and links.
+
+    The backfill runs the built-in extractors over the messages stored
+    before it; custom patterns only apply to mail that arrives after they
+    are configured. The cleanup trigger fires on deletes from msg, so it is
+    created by the backfill, once the primary key rebuild (whose retired
+    table keeps the same ids) has finished.
+    """
+
+    version = 5
+    description = "msg_token table of extracted codes and links"
+    has_backfill = True
+
+    def upgrade(self, conn: sqlite3.Connection):
+        conn.execute(MSG_TOKEN_TABLE)
+        conn.execute(MSG_TOKEN_INDEX)
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        if position == 0:
+            conn.execute(MSG_TOKEN_TRIGGER)
+        rows = conn.execute(
+            "SELECT rowid, subject, COALESCE(text_body, content), html_body FROM msg "
+            "WHERE rowid > ? AND NOT EXISTS "
+            "(SELECT 1 FROM msg_token WHERE msg_id = msg.rowid) "
+            "ORDER BY rowid LIMIT ?",
+            (position, batch_size)
+        ).fetchall()
+        if not rows:
+            return None
+
+        extractor = TokenExtractor()
+        conn.executemany(
+            "INSERT INTO msg_token (msg_id, kind, position, value) VALUES (?, ?, ?, ?)",
+            [token for rowid, subject, text, html in rows
+             for token in token_rows(rowid, extractor.extract(subject, text, html or ''))]
+        )
+        return rows[-1][0]
+
+
+class AddInboxCheckpoint(Migration):
+    """The inbox_checkpoint table of the durable inbox indexer."""
+
+    version = 6
+    description = "inbox_checkpoint table"
+
+    def upgrade(self, conn: sqlite3.Connection):
+        conn.execute(INBOX_CHECKPOINT_TABLE)
+
+
+class AddMailboxes(Migration):
+    """
+    Per-recipient mailbox entries with read state, and their counts.
+
+    The backfill files every stored message under all of its recipients;
+    until then, recipient lookups only find mail stored since the upgrade
+    and the recipients the backfill has reached. Mail stored meanwhile is
+    filed by store_message, and entries the backfill finds already present
+    are left alone. The cleanup trigger is created by the backfill, for the
+    same reason as the one of msg_token, and the recipient index of msg
+    is dropped once the backfill is complete.
+    """
+
+    version = 7
+    description = "mailbox entries per recipient"
+    has_backfill = True
+
+    def upgrade(self, conn: sqlite3.Connection):
+        conn.execute(MAILBOX_TABLE)
+        conn.execute(MAILBOX_STATS_TABLE)
+        for statement in MAILBOX_TRIGGERS.values():
+            conn.execute(statement)
+        conn.execute(INDEXES["idx_mailbox_msg"])
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        if position == 0:
+            conn.execute(MAILBOX_MSG_TRIGGER)
+        rows = conn.execute(
+            "SELECT rowid, to0, tos, created_at FROM msg "
+            "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (position, batch_size)
+        ).fetchall()
+        if not rows:
+            # Recipient lookups go through the mailbox table from now on
+            conn.execute("DROP INDEX IF EXISTS idx_msg_to0_created")
+            return None
+
+        entries = []
+        for rowid, to0, tos, created_at in rows:
+            try:
+                recipients = json.loads(tos) if tos else []
+            except ValueError:
+                recipients = []
+            for address in mailbox_addresses([to0 or ''] + list(recipients), normalizer):
+                entries.append((address, created_at or 0, rowid))
+        conn.executemany(
+            "INSERT OR IGNORE INTO mailbox (address, created_at, msg_id) VALUES (?, ?, ?)",
+            entries
+        )
+        return rows[-1][0]
+
+
+class AddDomainIndex(Migration):
+    """
+    Index of mailbox entries by recipient domain.
+
+    Built in a backfill step, on the background connection, for the same
+    reason as the covering indexes of version 4.
+    """
+
+    version = 8
+    description = "mailbox entries by recipient domain"
+    has_backfill = True
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        conn.execute(INDEXES["idx_mailbox_domain"])
+        return None
+
+
+class AddRollups(Migration):
+    """
+    Hourly message counts and bytes per sender and recipient domain.
+
+    The backfill creates the triggers in its first step and notes the
+    newest message id at that moment; mail stored from then on is counted
+    by the triggers, and the backfill counts the messages before it,
+    newest first, so the position shrinks towards the first message.
+    """
+
+    version = 9
+    description = "hourly rollups per sender and recipient domain"
+    has_backfill = True
+
+    def upgrade(self, conn: sqlite3.Connection):
+        conn.execute(MSG_ROLLUP_TABLE)
+        conn.execute(MSG_ROLLUP_INDEX)
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        if position == 0:
+            for statement in ROLLUP_TRIGGERS.values():
+                conn.execute(statement)
+            newest = conn.execute("SELECT MAX(rowid) FROM msg").fetchone()[0]
+            return newest + 1 if newest is not None else None
+
+        start = conn.execute(
+            "SELECT MIN(rowid) FROM (SELECT rowid FROM msg "
+            "WHERE rowid < ? ORDER BY rowid DESC LIMIT ?)",
+            (position, batch_size)
+        ).fetchone()[0]
+        if start is None:
+            return None
+
+        hour = f"coalesce(m.created_at, 0) {HOUR}"
+        conn.execute(
+            "INSERT INTO msg_rollup (kind, hour, key, messages, bytes) "
+            f"SELECT 'all', {hour}, '', COUNT(*), SUM(coalesce(m.size, 0)) FROM msg AS m "
+            f"WHERE m.rowid >= ? AND m.rowid < ? GROUP BY 2 {ROLLUP_UPSERT}",
+            (start, position)
+        )
+        conn.execute(
+            "INSERT INTO msg_rollup (kind, hour, key, messages, bytes) "
+            f"SELECT 'sender', {hour}, coalesce(m.frm_canon, ''), COUNT(*), SUM(coalesce(m.size, 0)) "
+            f"FROM msg AS m WHERE m.rowid >= ? AND m.rowid < ? GROUP BY 2, 3 {ROLLUP_UPSERT}",
+            (start, position)
+        )
+        conn.execute(
+            "INSERT INTO msg_rollup (kind, hour, key, messages, bytes) "
+            f"SELECT 'domain', {hour}, d.domain, COUNT(*), SUM(coalesce(m.size, 0)) "
+            f"FROM (SELECT DISTINCT msg_id, {MAILBOX_DOMAIN.format('')} AS domain FROM mailbox "
+            "WHERE msg_id >= ? AND msg_id < ?) AS d JOIN msg AS m ON m.rowid = d.msg_id "
+            f"WHERE true GROUP BY 2, 3 {ROLLUP_UPSERT}",
+            (start, position)
+        )
+        return start
+
+
+class AddHeaderIndex(Migration):
+    """
+    The msg_header table of indexed header values.
+
+    Raw headers were never stored, so there is nothing to backfill: only
+    mail stored after the upgrade can be looked up by header. The backfill
+    step only creates the cleanup trigger, for the same reason as that of
+    version 5.
+    """
+
+    version = 10
+    description = "msg_header table of indexed header values"
+    has_backfill = True
+
+    def upgrade(self, conn: sqlite3.Connection):
+        conn.execute(MSG_HEADER_TABLE)
+        conn.execute(MSG_HEADER_INDEX)
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        conn.execute(MSG_HEADER_TRIGGER)
+        return None
+
+
+class AddChangeLog(Migration):
+    """
+    The msg_change table of the change feed.
+
+    The backfill logs the messages stored before it oldest first, so the
+    feed lists them in id order, then creates the insert trigger in the
+    step that finds nothing left to log; the write lock of the step keeps
+    mail from being stored in between. Deletes are logged from the first
+    step on, so a message that is deleted after being logged is never
+    left in a consumer's mirror.
+    """
+
+    version = 11
+    description = "msg_change table of the change feed"
+    has_backfill = True
+
+    def upgrade(self, conn: sqlite3.Connection):
+        conn.execute(MSG_CHANGE_TABLE)
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        if position == 0:
+            conn.execute(CHANGE_TRIGGERS["msg_change_delete"])
+        end = _batch_end(conn, "msg", position, batch_size)
+        if end is None:
+            conn.execute(CHANGE_TRIGGERS["msg_change_insert"])
+            return None
+        conn.execute(
+            "INSERT INTO msg_change (op, msg_id) "
+            "SELECT 'insert', rowid FROM msg WHERE rowid > ? AND rowid <= ? ORDER BY rowid",
+            (position, end)
+        )
+        return end
+
+
+class AddWebhookQueue(Migration):
+    """The webhook_cursor and webhook_queue tables of the webhook dispatcher."""
+
+    version = 12
+    description = "webhook cursors and delivery queue"
+
+    def upgrade(self, conn: sqlite3.Connection):
+        conn.execute(WEBHOOK_CURSOR_TABLE)
+        conn.execute(WEBHOOK_QUEUE_TABLE)
+        conn.execute(WEBHOOK_QUEUE_INDEX)
+
+
+class SplitRenditions(Migration):
+    """
+    Renditions of the messages stored with combined content only.
+
+    Messages stored before renditions were computed at ingest have no
+    text_body or html_body; the backfill splits their content and
+    sanitizes the HTML part, oldest first. Reads of messages it has not
+    reached yet split them on the fly without writing anything back.
+    """
+
+    version = 13
+    description = "renditions of messages stored with combined content"
+    has_backfill = True
+
+    def backfill(self, conn, position, batch_size, normalizer):
+        end = _batch_end(conn, "msg", position, batch_size)
+        if end is None:
+            return None
+        rows = conn.execute(
+            "SELECT rowid, content FROM msg WHERE rowid > ? AND rowid <= ? AND text_body IS NULL",
+            (position, end)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE msg SET text_body = ?, html_body = ? WHERE rowid = ?",
+            [split_content(content or '') + (rowid,) for rowid, content in rows]
+        )
+        return end
+
+
+def mailbox_addresses(recipients: List[str], normalizer: AddressNormalizer) -> List[str]:
+    """
+    Canonical mailbox addresses of a message's recipients.
+
+    Args:
+        recipients: Recipient addresses as given
+        normalizer: Address normalizer of the data store
+
+    Returns:
+        Distinct non-empty canonical addresses, in order
+    """
+    addresses = {}
+    for recipient in recipients:
+        address = normalizer.canonicalize(recipient or '')
+        if address:
+            addresses[address] = None
+    return list(addresses)
+
+
+def token_rows(msg_id: int, tokens: List[Tuple[str, str]]) -> List[tuple]:
+    """
+    Build the msg_token rows of a message.
+
+    Args:
+        msg_id: Message id
+        tokens: (kind, value) pairs, in order within each kind
+
+    Returns:
+        (msg_id, kind, position, value) tuples
+    """
+    positions: Dict[str, int] = {}
+    rows = []
+    for kind, value in tokens:
+        position = positions.get(kind, 0)
+        positions[kind] = position + 1
+        rows.append((msg_id, kind, position, value))
+    return rows
+
+
+MIGRATIONS: List[Migration] = [
+    AddCanonicalColumns(),
+    AddEpochTimestamps(),
+    AddPrimaryKey(),
+    AddCoveringIndexes(),
+    AddMessageTokens(),
+    AddInboxCheckpoint(),
+    AddMailboxes(),
+    AddDomainIndex(),
+    AddRollups(),
+    AddHeaderIndex(),
+    AddChangeLog(),
+    AddWebhookQueue(),
+    SplitRenditions(),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+class Migrator:
+    """Brings a database to the current schema version."""
+
+    def __init__(self, conn: sqlite3.Connection,
+                 normalizer: Optional[AddressNormalizer] = None,
+                 migrations: Optional[List[Migration]] = None):
+        """
+        Initialize the migrator.
+
+        Args:
+            conn: Database connection
+            normalizer: Address normalizer for backfilling canonical columns
+            migrations: Migrations in version order (defaults to MIGRATIONS)
+        """
+        self.conn = conn
+        self.normalizer = normalizer or AddressNormalizer()
+        self.migrations = migrations if migrations is not None else MIGRATIONS
+        self._by_version = {m.version: m for m in self.migrations}
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """Run a block in an immediate (write-locked) transaction."""
+        self.conn.commit()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+
+    @property
+    def version(self) -> int:
+        """Schema version of the database."""
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def upgrade(self) -> List[int]:
+        """
+        Apply the DDL of every migration newer than the database.
+
+        New databases get the current layout directly. Backfills of the
+        applied migrations are only queued; see run_backfills.
+
+        Returns:
+            Versions that were applied
+        """
+        latest = self.migrations[-1].version if self.migrations else 0
+        current = self.version
+        if current > latest:
+            raise RuntimeError(
+                f"Database schema version {current} is newer than this "
+                f"version of aemail supports ({latest})"
+            )
+
+        with self._transaction():
+            self.conn.execute(BACKFILL_TABLE)
+            if not _table_exists(self.conn, "msg"):
+                self.conn.execute(MSG_TABLE.format(name="msg"))
+                self.conn.execute(MAILBOX_TABLE)
+                self.conn.execute(MAILBOX_STATS_TABLE)
+                for statement in MAILBOX_TRIGGERS.values():
+                    self.conn.execute(statement)
+                self.conn.execute(MAILBOX_MSG_TRIGGER)
+                self.conn.execute(MSG_COUNT_TABLE)
+                self.conn.execute("INSERT INTO msg_count (id, total) VALUES (0, 0)")
+                for statement in TRIGGERS.values():
+                    self.conn.execute(statement)
+                self.conn.execute(MSG_TOKEN_TABLE)
+                self.conn.execute(MSG_TOKEN_INDEX)
+                self.conn.execute(MSG_TOKEN_TRIGGER)
+                self.conn.execute(INBOX_CHECKPOINT_TABLE)
+                self.conn.execute(MSG_HEADER_TABLE)
+                self.conn.execute(MSG_HEADER_INDEX)
+                self.conn.execute(MSG_HEADER_TRIGGER)
+                self.conn.execute(MSG_CHANGE_TABLE)
+                for statement in CHANGE_TRIGGERS.values():
+                    self.conn.execute(statement)
+                self.conn.execute(WEBHOOK_CURSOR_TABLE)
+                self.conn.execute(WEBHOOK_QUEUE_TABLE)
+                self.conn.execute(WEBHOOK_QUEUE_INDEX)
+                self.conn.execute(MSG_ROLLUP_TABLE)
+                self.conn.execute(MSG_ROLLUP_INDEX)
+                for statement in ROLLUP_TRIGGERS.values():
+                    self.conn.execute(statement)
+                for statement in INDEXES.values():
+                    self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version = {latest}")
+                return []
+
+        applied = []
+        for migration in self.migrations:
+            if migration.version <= current:
+                continue
+            with self._transaction():
+                migration.upgrade(self.conn)
+                if migration.has_backfill:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO schema_backfill (version, position) "
+                        "VALUES (?, 0)",
+                        (migration.version,)
+                    )
+                self.conn.execute(f"PRAGMA user_version = {migration.version}")
+            logger.info(f"Migrated database to schema version {migration.version} "
+                        f"({migration.description})")
+            applied.append(migration.version)
+        return applied
+
+    def pending_backfills(self) -> Dict[int, int]:
+        """
+        Backfills still to run.
+
+        Returns:
+            Dictionary of migration version to the position reached
+        """
+        return dict(self.conn.execute(
+            "SELECT version, position FROM schema_backfill ORDER BY version"
+        ).fetchall())
+
+    def backfill_step(self, batch_size: int = 1000) -> bool:
+        """
+        Run one batch of the oldest pending backfill.
+
+        Backfills run strictly in version order, since later ones may
+        depend on columns filled in by earlier ones.
+
+        Args:
+            batch_size: Rows to process
+
+        Returns:
+            True if a batch ran, False if nothing is pending
+        """
+        with self._transaction():
+            row = self.conn.execute(
+                "SELECT version, position FROM schema_backfill ORDER BY version LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return False
+
+            version, position = row
+            migration = self._by_version.get(version)
+            new_position = None
+            if migration is not None:
+                new_position = migration.backfill(
+                    self.conn, position, batch_size, self.normalizer
+                )
+
+            if new_position is None:
+                self.conn.execute("DELETE FROM schema_backfill WHERE version = ?", (version,))
+                logger.info(f"Backfill for schema version {version} complete")
+            else:
+                self.conn.execute(
+                    "UPDATE schema_backfill SET position = ? WHERE version = ?",
+                    (new_position, version)
+                )
+        return True
+
+    def run_backfills(self, batch_size: int = 1000, pause: float = 0.0) -> int:
+        """
+        Run all pending backfills to completion.
+
+        Args:
+            batch_size: Rows per batch (and per transaction)
+            pause: Seconds to sleep between batches, giving writers
+                   on other connections a turn at the write lock
+
+        Returns:
+            Number of batches run
+        """
+        batches = 0
+        while self.backfill_step(batch_size):
+            batches += 1
+            if pause:
+                time.sleep(pause)
+        return batches
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Schema version and backfill progress.
+
+        Returns:
+            Dictionary with 'version', 'latest' and 'pending_backfills'
+        """
+        return {
+            "version": self.version,
+            "latest": self.migrations[-1].version if self.migrations else 0,
+            "pending_backfills": self.pending_backfills(),
+        }
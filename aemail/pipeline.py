@@ -0,0 +1,329 @@
+"""
+Message-processing pipeline with per-stage timing.
+"""
+
+import asyncio
+import importlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Union,
+)
+
+from .config import Config
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the stage latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1.0, 5.0, 10.0, 50.0, 100.0, 500.0, 1000.0)
+
+
+class StageMetrics:
+    """Call, error and drop counters and a latency histogram of one stage."""
+
+    def __init__(self):
+        """Initialize empty counters."""
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.stopped = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, seconds: float, error: bool = False, stopped: bool = False):
+        """
+        Record one run of the stage.
+
+        Args:
+            seconds: Time the stage took
+            error: The stage raised
+            stopped: The stage stopped the pipeline
+        """
+        ms = seconds * 1000
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if ms <= bound),
+                      len(LATENCY_BUCKETS_MS))
+        with self._lock:
+            self.calls += 1
+            self.errors += error
+            self.stopped += stopped
+            self.seconds += seconds
+            self.buckets[bucket] += 1
+
+    def merge(self, other: 'StageMetrics'):
+        """Add the runs recorded by another instance, such as one from a worker process."""
+        with self._lock:
+            self.calls += other.calls
+            self.errors += other.errors
+            self.stopped += other.stopped
+            self.seconds += other.seconds
+            self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of the counters.
+
+        Returns:
+            Dictionary with calls, errors, stopped, total_ms, avg_ms and
+            'histogram', run counts keyed by bucket upper bound in ms
+        """
+        with self._lock:
+            labels = [f"{bound:g}" for bound in LATENCY_BUCKETS_MS] + ["+Inf"]
+            return {
+                "calls": self.calls,
+                "errors": self.errors,
+                "stopped": self.stopped,
+                "total_ms": round(self.seconds * 1000, 3),
+                "avg_ms": round(self.seconds * 1000 / self.calls, 4) if self.calls else 0.0,
+                "histogram": dict(zip(labels, self.buckets)),
+            }
+
+
+class MessageContext:
+    """A message on its way through the pipeline."""
+
+    __slots__ = ('raw', 'mail_from', 'rcpt_tos', 'message', 'data')
+
+    def __init__(self, raw: Union[bytes, BinaryIO], mail_from: str, rcpt_tos: List[str]):
+        """
+        Initialize the context.
+
+        Args:
+            raw: Raw message, as bytes or a binary file positioned at its start
+            mail_from: Envelope sender
+            rcpt_tos: Envelope recipients
+        """
+        self.raw = raw
+        self.mail_from = mail_from
+        self.rcpt_tos = rcpt_tos
+        # Parsed email.message.Message, set by the parse stage
+        self.message: Any = None
+        # Message dictionary for EmailData.store_message, filled in by the stages
+        self.data: Dict[str, Any] = {"from": mail_from, "to": rcpt_tos}
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    Subclasses set name and implement process. A stage that returns an
+    SMTP reply stops the pipeline: the message is not stored, and the
+    reply is sent to the client if it has not been acknowledged yet
+    ('250 ...' drops the message silently, '550 ...' rejects it).
+    """
+
+    name = ""
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'Stage':
+        """Create the stage; override to read settings from the configuration."""
+        return cls()
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        """
+        Process a message.
+
+        Args:
+            context: The message and what earlier stages made of it
+
+        Returns:
+            None to continue, or an SMTP reply to stop the pipeline
+        """
+        return None
+
+
+def load_stage(path: str, config: Config) -> Stage:
+    """
+    Create a custom stage from its 'module:Class' path.
+
+    Args:
+        path: Module and class name of a Stage subclass
+        config: Configuration handed to its from_config
+
+    Returns:
+        The stage
+    """
+    module_name, _, class_name = path.partition(':')
+    stage_class = getattr(importlib.import_module(module_name), class_name)
+    return stage_class.from_config(config)
+
+
+class Pipeline:
+    """
+    Ordered stages that turn a raw message into a storable dictionary.
+
+    Every stage run is timed and counted per stage. Stages named in
+    offload run in a worker pool when the pipeline runs on the event loop
+    (process_async), so slow stages do not hold up other SMTP sessions;
+    called from a thread (process), every stage runs inline.
+    """
+
+    def __init__(self, stages: List[Stage], offload: Optional[List[str]] = None,
+                 workers: int = 2):
+        """
+        Initialize the pipeline.
+
+        Args:
+            stages: Stages in order
+            offload: Names of the stages to run in the worker pool
+            workers: Threads of the worker pool
+        """
+        self.stages = stages
+        self.offload = set(offload or ())
+        self.metrics: Dict[str, StageMetrics] = {stage.name: StageMetrics() for stage in stages}
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if self.offload:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='aemail-stage')
+
+    @classmethod
+    def from_config(cls, config: Config, builtins: Mapping[str, Callable[[Config], Stage]],
+                    default: List[str]) -> 'Pipeline':
+        """
+        Create a pipeline from the [pipeline] section.
+
+        Args:
+            config: Configuration
+            builtins: Built-in stage factories by name; any other entry of
+                      'stages' is a 'module:Class' path
+            default: Stage names used when none are configured
+
+        Returns:
+            The pipeline
+
+        Raises:
+            ValueError: If a stage name is unknown, or the parse stage,
+                        which every other stage reads from, is not first
+        """
+        section = config.config
+        names = [name.strip() for name in
+                 section.get('pipeline', 'stages', fallback=', '.join(default)).split(',')
+                 if name.strip()]
+        stages = []
+        for name in names:
+            if name in builtins:
+                stages.append(builtins[name](config))
+            elif ':' in name:
+                stages.append(load_stage(name, config))
+            else:
+                raise ValueError(f"Unknown pipeline stage {name!r}")
+        if not stages or stages[0].name != 'parse':
+            raise ValueError("The parse stage must come first in the pipeline")
+        offload = [name.strip() for name in
+                   section.get('pipeline', 'offload', fallback='').split(',') if name.strip()]
+        unknown = set(offload) - {stage.name for stage in stages}
+        if unknown:
+            raise ValueError(f"Cannot offload stages not in the pipeline: {', '.join(sorted(unknown))}")
+        return cls(stages, offload, workers=section.getint('pipeline', 'workers', fallback=2))
+
+    def _run(self, stage: Stage, context: MessageContext) -> Optional[str]:
+        """Run one stage, timing and counting it."""
+        start = time.perf_counter()
+        try:
+            reply = stage.process(context)
+        except Exception as e:
+            self.metrics[stage.name].record(time.perf_counter() - start, error=True)
+            logger.error(f"Error in pipeline stage {stage.name}: {e}")
+            raise
+        self.metrics[stage.name].record(time.perf_counter() - start, stopped=reply is not None)
+        return reply
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        """
+        Run every stage in order, on the calling thread.
+
+        Args:
+            context: Message to process
+
+        Returns:
+            None if every stage passed it on, else the reply of the stage
+            that stopped it
+        """
+        for stage in self.stages:
+            reply = self._run(stage, context)
+            if reply is not None:
+                return reply
+        return None
+
+    async def process_async(self, context: MessageContext) -> Optional[str]:
+        """
+        Run every stage in order, offloaded stages in the worker pool.
+
+        Args:
+            context: Message to process
+
+        Returns:
+            None if every stage passed it on, else the reply of the stage
+            that stopped it
+        """
+        loop = asyncio.get_running_loop()
+        for stage in self.stages:
+            if stage.name in self.offload:
+                reply = await loop.run_in_executor(self.executor, self._run, stage, context)
+            else:
+                reply = self._run(stage, context)
+            if reply is not None:
+                return reply
+        return None
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        """
+        Time and count a step that is not a stage, such as storing, with the stages.
+
+        Args:
+            name: Name the step is reported under
+        """
+        metrics = self.metrics.get(name)
+        if metrics is None:
+            metrics = self.metrics.setdefault(name, StageMetrics())
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            metrics.record(time.perf_counter() - start, error=True)
+            raise
+        metrics.record(time.perf_counter() - start)
+
+    def merge(self, metrics: Mapping[str, StageMetrics]):
+        """
+        Add the stage runs of another pipeline with the same stages.
+
+        Args:
+            metrics: Its metrics, by stage name
+        """
+        for name, other in metrics.items():
+            self.metrics.setdefault(name, StageMetrics()).merge(other)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of every stage's counters, in pipeline order.
+
+        Returns:
+            Dictionary of stage name to its counters and histogram
+        """
+        return {name: metrics.stats() for name, metrics in list(self.metrics.items())}
+
+    def close(self):
+        """Stop the worker pool."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
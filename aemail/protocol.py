@@ -0,0 +1,524 @@
+"""
+SMTP protocol customizations on top of aiosmtpd.
+"""
+
+import asyncio
+import logging
+import socket
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Set
+
+import aiosmtpd
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import MISSING, SMTP, syntax
+
+from .config import Config
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from the socket per step of a BDAT chunk
+BDAT_READ_SIZE = 64 * 1024
+
+LINE_TOO_LONG = '500 Line too long (see RFC5321 4.5.3.1.6)'
+TOO_MUCH_DATA = '552 Error: Too much mail data'
+SHUTTING_DOWN = '421 4.3.2 Service shutting down, try again later'
+
+# The aiosmtpd release SMTPProtocol and SMTPController are tested with (pinned
+# in pyproject.toml), and the private members of it they override or call
+AIOSMTPD_VERSION = '1.4.6'
+SMTP_PRIVATE_METHODS = (
+    '_call_handler_hook', '_cb_client_connected', '_reset_timeout', '_set_post_data_state',
+)
+# Set by SMTP.__init__, and _reader/_writer by _cb_client_connected
+SMTP_PRIVATE_ATTRIBUTES = ('_auth_required', '_ehlo_hook_ver', '_handle_hooks', '_reader', '_writer')
+CONTROLLER_PRIVATE_METHODS = ('_create_server', '_factory_invoker')
+CONTROLLER_PRIVATE_ATTRIBUTES = ('_thread',)
+
+
+def check_aiosmtpd():
+    """
+    Fail fast if the installed aiosmtpd lacks a private member this module relies on.
+
+    PIPELINING, BDAT and spooling are built on aiosmtpd internals, which
+    any release may rename; a missing one would otherwise only show up
+    as broken sessions.
+
+    Raises:
+        RuntimeError: Naming the missing members
+    """
+    missing = [f"SMTP.{name}" for name in SMTP_PRIVATE_METHODS
+               if not callable(getattr(SMTP, name, None))]
+    missing += [f"Controller.{name}" for name in CONTROLLER_PRIVATE_METHODS
+                if not callable(getattr(Controller, name, None))]
+    if not missing:
+        loop = asyncio.new_event_loop()
+        try:
+            session = SMTP(None, loop=loop)
+            session._cb_client_connected(asyncio.StreamReader(loop=loop), None)
+            missing += [f"SMTP.{name}" for name in SMTP_PRIVATE_ATTRIBUTES if not hasattr(session, name)]
+            controller = Controller(None)
+            controller.loop.close()
+            missing += [f"Controller.{name}" for name in CONTROLLER_PRIVATE_ATTRIBUTES
+                        if not hasattr(controller, name)]
+        finally:
+            loop.close()
+    if missing:
+        installed = getattr(aiosmtpd, '__version__', 'unknown')
+        raise RuntimeError(
+            f"aiosmtpd {installed} lacks {', '.join(missing)}; "
+            f"aemail's SMTP server requires aiosmtpd {AIOSMTPD_VERSION}"
+        )
+
+
+class SMTPProfile:
+    """
+    Session limits and buffering of the SMTP server, plus transfer counters.
+
+    Message bodies (DATA or BDAT) are written to a spool that stays in
+    memory up to spool_threshold bytes and moves to a temporary file
+    beyond, so a large message costs one file rather than several copies
+    of itself in RAM.
+
+    The profile also tracks the open sessions, so that a drain can close
+    the idle ones and wait for those in the middle of a transaction.
+    """
+
+    def __init__(self, data_size_limit: int = 32 * 1024 * 1024,
+                 idle_timeout: float = 60.0, data_timeout: float = 600.0,
+                 line_length_limit: int = 1001, spool_threshold: int = 1024 * 1024,
+                 spool_dir: Optional[str] = None, drain_timeout: float = 30.0):
+        """
+        Initialize the profile.
+
+        Args:
+            data_size_limit: Largest message accepted, in bytes (0 for no limit)
+            idle_timeout: Seconds a session may wait between commands
+            data_timeout: Seconds a single DATA or BDAT transfer may take
+            line_length_limit: Longest DATA or command line accepted, CRLF included
+            spool_threshold: Message size in bytes above which the body is
+                             spooled to a temporary file
+            spool_dir: Directory for spool files (default: system temp dir)
+            drain_timeout: Seconds open transactions get to finish when
+                           the server shuts down
+        """
+        self.data_size_limit = data_size_limit
+        self.idle_timeout = idle_timeout
+        self.data_timeout = data_timeout
+        self.line_length_limit = line_length_limit
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.drain_timeout = drain_timeout
+        self.sessions: Set['SMTPProtocol'] = set()
+        self.draining = False
+        self.counters = {
+            'messages_data': 0,
+            'messages_bdat': 0,
+            'bdat_chunks': 0,
+            'spooled_to_disk': 0,
+            'bytes_received': 0,
+            'rejected_too_large': 0,
+            'rejected_line_too_long': 0,
+            'closed_by_drain': 0,
+        }
+
+    @classmethod
+    def from_config(cls, config: Config) -> 'SMTPProfile':
+        """Create a profile from the [smtpd] section of the configuration."""
+        section = config.config
+        return cls(
+            data_size_limit=section.getint('smtpd', 'data_size_limit', fallback=32 * 1024 * 1024),
+            idle_timeout=section.getfloat('smtpd', 'idle_timeout', fallback=60.0),
+            data_timeout=section.getfloat('smtpd', 'data_timeout', fallback=600.0),
+            line_length_limit=section.getint('smtpd', 'line_length_limit', fallback=1001),
+            spool_threshold=section.getint('smtpd', 'spool_threshold', fallback=1024 * 1024),
+            spool_dir=section.get('smtpd', 'spool_dir', fallback=None) or None,
+            drain_timeout=section.getfloat('smtpd', 'drain_timeout', fallback=30.0),
+        )
+
+    def spool(self) -> 'MessageSpool':
+        """Open a spool for one message body."""
+        return MessageSpool(self.spool_threshold, self.spool_dir)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot of the settings and transfer counters.
+
+        Returns:
+            Dictionary of counters and the effective limits
+        """
+        stats: Dict[str, Any] = dict(self.counters)
+        stats['data_size_limit'] = self.data_size_limit
+        stats['spool_threshold'] = self.spool_threshold
+        stats['active_sessions'] = len(self.sessions)
+        stats['draining'] = self.draining
+        return stats
+
+    def begin_drain(self):
+        """
+        Refuse new transactions and close the sessions that are not in one.
+
+        Must be called on the event loop of the sessions.
+        """
+        self.draining = True
+        for session in list(self.sessions):
+            if not session.in_transaction:
+                session.close_for_drain()
+
+
+class MessageSpool:
+    """A message body being received, in memory until it outgrows the threshold."""
+
+    def __init__(self, threshold: int, directory: Optional[str] = None):
+        """
+        Initialize the spool.
+
+        Args:
+            threshold: Bytes kept in memory before rolling over to a file
+            directory: Directory for the temporary file
+        """
+        self.file = tempfile.SpooledTemporaryFile(max_size=threshold, dir=directory)
+        self.size = 0
+
+    @property
+    def on_disk(self) -> bool:
+        """Whether the body has been rolled over to a temporary file."""
+        return bool(getattr(self.file, '_rolled', False))
+
+    def write(self, data: bytes):
+        """Append to the body."""
+        self.file.write(data)
+        self.size += len(data)
+
+    def reader(self):
+        """The body as a binary file positioned at its start."""
+        self.file.seek(0)
+        return self.file
+
+    def getvalue(self) -> bytes:
+        """The whole body as bytes."""
+        return self.reader().read()
+
+    def close(self):
+        """Release the buffer or delete the temporary file."""
+        self.file.close()
+
+
+class SMTPProtocol(SMTP):
+    """
+    aiosmtpd SMTP session with connection-level handler hooks and a tuned profile.
+
+    When a connection is made, ``handle_CONNECT(server, peer)`` is called
+    synchronously, before aiosmtpd sets up the session; a returned reply
+    (e.g. a 421) is sent instead of the greeting and the connection is
+    closed. When an admitted connection goes away,
+    ``handle_DISCONNECT(server, session)`` is called synchronously.
+
+    PIPELINING and CHUNKING (BDAT) are advertised. DATA and BDAT bodies
+    are written to a MessageSpool, available to ``handle_DATA`` as
+    ``envelope.spool``; ``envelope.content`` is only filled in for bodies
+    small enough to have stayed in memory. Bodies are always delivered as
+    bytes.
+    """
+
+    def __init__(self, handler: Any, profile: Optional[SMTPProfile] = None, **kwargs):
+        """
+        Initialize the session.
+
+        Args:
+            handler: aiosmtpd handler
+            profile: Limits and spooling settings (defaults to SMTPProfile())
+            **kwargs: Further aiosmtpd SMTP options; data_size_limit and
+                      timeout default to the profile's
+        """
+        self.profile = profile or SMTPProfile()
+        kwargs.setdefault('data_size_limit', self.profile.data_size_limit or None)
+        kwargs.setdefault('timeout', self.profile.idle_timeout)
+        # Read by aiosmtpd to size the stream reader's line buffer
+        self.line_length_limit = self.profile.line_length_limit
+        # Set when handle_CONNECT turned the connection away
+        self.refused = False
+        super().__init__(handler, **kwargs)
+
+        # Advertise the extensions in front of whatever the handler's EHLO adds
+        if self._ehlo_hook_ver in (None, 'new'):
+            self._handler_ehlo = self._handle_hooks.get('EHLO')
+            self._handle_hooks['EHLO'] = self._extend_ehlo
+            self._ehlo_hook_ver = 'new'
+
+    async def _extend_ehlo(self, server, session, envelope, hostname: str,
+                           responses: List[str]) -> List[str]:
+        """Add PIPELINING and CHUNKING to the EHLO reply."""
+        responses = responses[:-1] + ['250-PIPELINING', '250-CHUNKING'] + responses[-1:]
+        if self._handler_ehlo is not None:
+            return await self._handler_ehlo(server, session, envelope, hostname, responses)
+        session.host_name = hostname
+        return responses
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        hook = getattr(self.event_handler, 'handle_CONNECT', None)
+        # Not again for the TLS transport STARTTLS hands over
+        if hook is not None and self.transport is None:
+            peer = transport.get_extra_info('peername')
+            status: Optional[str] = hook(self, peer)
+            if status is not None:
+                logger.info(f"Refusing connection from {peer}: {status}")
+                self.refused = True
+                transport.write(f'{status}\r\n'.encode('ascii'))
+                transport.close()
+                return
+        super().connection_made(transport)
+        self.profile.sessions.add(self)
+
+    def connection_lost(self, error: Optional[Exception]) -> None:
+        if self.refused:
+            # Never handed to aiosmtpd
+            return
+        self.profile.sessions.discard(self)
+        hook = getattr(self.event_handler, 'handle_DISCONNECT', None)
+        if hook is not None and self.session is not None:
+            try:
+                hook(self, self.session)
+            except Exception as e:
+                logger.error(f"Error in disconnect hook: {e}")
+        self._close_spool()
+        super().connection_lost(error)
+
+    @property
+    def in_transaction(self) -> bool:
+        """Whether a MAIL FROM has been accepted and its message not yet delivered."""
+        return self.envelope is not None and self.envelope.mail_from is not None
+
+    def close_for_drain(self):
+        """Tell the client the server is going away and close the connection."""
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.profile.counters['closed_by_drain'] += 1
+        self.transport.write(f'{SHUTTING_DOWN}\r\n'.encode('ascii'))
+        self.transport.close()
+
+    @syntax('MAIL FROM: <address>', extended=' [SP <mail-parameters>]')
+    async def smtp_MAIL(self, arg: Optional[str]) -> None:
+        if self.profile.draining:
+            self.close_for_drain()
+            return
+        await super().smtp_MAIL(arg)
+
+    def _close_spool(self):
+        """Discard the body of an unfinished transaction."""
+        spool = getattr(self.envelope, 'spool', None)
+        if spool is not None:
+            spool.close()
+            self.envelope.spool = None
+
+    def _set_post_data_state(self):
+        self._close_spool()
+        super()._set_post_data_state()
+
+    def _transaction_error(self, command: str) -> Optional[str]:
+        """Reply refusing a DATA or BDAT command outside a valid transaction."""
+        if not self.session.host_name:
+            return '503 Error: send HELO first'
+        if self._auth_required and not self.session.authenticated:
+            return '530 5.7.0 Authentication required'
+        if not self.envelope.rcpt_tos:
+            return '503 Error: need RCPT command'
+        if command == 'DATA' and getattr(self.envelope, 'spool', None) is not None:
+            return '503 Error: BDAT transfer in progress'
+        return None
+
+    @syntax('DATA')
+    async def smtp_DATA(self, arg: str) -> None:
+        status = self._transaction_error('DATA')
+        if status is not None:
+            await self.push(status)
+            return
+        if arg:
+            await self.push('501 Syntax: DATA')
+            return
+
+        await self.push('354 End data with <CR><LF>.<CR><LF>')
+        self._reset_timeout(self.profile.data_timeout)
+        spool = self.envelope.spool = self.profile.spool()
+        limit = self.data_size_limit
+        error: Optional[str] = None
+        line_start = True
+        while self.transport is not None:
+            try:
+                line = await self._reader.readuntil(b'\r\n')
+            except asyncio.LimitOverrunError as e:
+                # Keep draining the line, the reply waits for the end of data
+                line = await self._reader.read(e.consumed)
+                error = error or LINE_TOO_LONG
+            except asyncio.CancelledError:
+                logger.info('Connection lost during DATA')
+                self._writer.close()
+                raise
+
+            if line_start and line == b'.\r\n':
+                break
+            if error is None:
+                # Undo the transparency dot (RFC 5321 4.5.2)
+                body = line[1:] if line_start and line.startswith(b'.') else line
+                if limit and spool.size + len(body) > limit:
+                    error = TOO_MUCH_DATA
+                else:
+                    spool.write(body)
+            line_start = line.endswith(b'\r\n')
+        self._reset_timeout()
+
+        if error is not None:
+            self._reject(error)
+            self._set_post_data_state()
+            await self.push(error)
+            return
+        self.profile.counters['messages_data'] += 1
+        await self._deliver(spool)
+
+    @syntax('BDAT size [LAST]')
+    async def smtp_BDAT(self, arg: str) -> None:
+        parts = (arg or '').split()
+        if (not 1 <= len(parts) <= 2 or not parts[0].isdigit()
+                or (len(parts) == 2 and parts[1].upper() != 'LAST')):
+            await self.push('501 Syntax: BDAT size [LAST]')
+            return
+        size, last = int(parts[0]), len(parts) == 2
+
+        # The chunk follows the command unconditionally, so it is read even
+        # when the command is refused
+        status = self._transaction_error('BDAT')
+        spool = None
+        if status is None:
+            spool = getattr(self.envelope, 'spool', None)
+            if spool is None:
+                spool = self.envelope.spool = self.profile.spool()
+        self._reset_timeout(self.profile.data_timeout)
+        limit = self.data_size_limit
+        remaining = size
+        while remaining and self.transport is not None:
+            chunk = await self._reader.read(min(remaining, BDAT_READ_SIZE))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            if status is None:
+                if limit and spool.size + len(chunk) > limit:
+                    status = TOO_MUCH_DATA
+                    self._reject(status)
+                else:
+                    spool.write(chunk)
+        self._reset_timeout()
+        self.profile.counters['bdat_chunks'] += 1
+
+        if status is not None:
+            # A failed chunk fails the whole transaction (RFC 3030 2)
+            if spool is not None:
+                self._set_post_data_state()
+            await self.push(status)
+            return
+        if not last:
+            await self.push(f'250 2.0.0 {size} octets received')
+            return
+        self.profile.counters['messages_bdat'] += 1
+        await self._deliver(spool)
+
+    def _reject(self, status: str):
+        """Count a refused message body."""
+        key = 'rejected_too_large' if status == TOO_MUCH_DATA else 'rejected_line_too_long'
+        self.profile.counters[key] += 1
+
+    async def _deliver(self, spool: MessageSpool) -> None:
+        """Hand a complete message body to the DATA hook and reply."""
+        self.profile.counters['bytes_received'] += spool.size
+        if spool.on_disk:
+            self.profile.counters['spooled_to_disk'] += 1
+        else:
+            self.envelope.content = self.envelope.original_content = spool.getvalue()
+
+        if 'DATA' in self._handle_hooks:
+            status = await self._call_handler_hook('DATA')
+        else:
+            status = MISSING
+        self._set_post_data_state()
+        await self.push('250 OK' if status is MISSING else status)
+        if self.profile.draining:
+            self.close_for_drain()
+
+
+class SMTPController(Controller):
+    """
+    Threaded aiosmtpd controller serving SMTPProtocol sessions.
+
+    It can listen on an already bound socket (one inherited from the
+    process being replaced, see handoff.py) and shuts down by draining:
+    the listener is closed first, then open transactions get the
+    profile's drain_timeout to finish before the rest is cut off.
+    """
+
+    def __init__(self, handler: Any, profile: SMTPProfile, hostname: Optional[str] = None,
+                 port: int = 8025, sock: Optional[socket.socket] = None, **kwargs):
+        """
+        Initialize the controller.
+
+        Args:
+            handler: aiosmtpd handler
+            profile: Limits, spooling and drain settings shared by all sessions
+            hostname: Address to listen on
+            port: Port to listen on
+            sock: Listening socket to use instead of binding hostname:port
+            **kwargs: Further SMTP options for each session
+
+        Raises:
+            RuntimeError: If the installed aiosmtpd is not one the sessions work with
+        """
+        check_aiosmtpd()
+        super().__init__(handler, hostname=hostname, port=port, **kwargs)
+        self.profile = profile
+        self.sock = sock
+
+    def factory(self):
+        return SMTPProtocol(self.handler, profile=self.profile, **self.SMTP_kwargs)
+
+    def _create_server(self):
+        if self.sock is None:
+            return super()._create_server()
+        return self.loop.create_server(self._factory_invoker, sock=self.sock, ssl=self.ssl_context)
+
+    def listening_socket(self) -> Optional[socket.socket]:
+        """The socket the server accepts connections on, while it runs."""
+        if self.server is None or not self.server.sockets:
+            return None
+        return self.server.sockets[0]
+
+    def drain(self, timeout: Optional[float] = None, stop: bool = True) -> int:
+        """
+        Stop accepting connections, let open transactions finish, then stop.
+
+        Args:
+            timeout: Seconds to wait for open sessions (default: the
+                     profile's drain_timeout)
+            stop: Stop the event loop afterwards; False keeps it running for
+                  other servers sharing it (call stop() later)
+
+        Returns:
+            Number of sessions that were still open at the deadline
+        """
+        if self._thread is None:
+            return 0
+        timeout = self.profile.drain_timeout if timeout is None else timeout
+
+        def begin():
+            if self.server is not None:
+                self.server.close()
+            self.profile.begin_drain()
+
+        self.loop.call_soon_threadsafe(begin)
+        deadline = time.monotonic() + timeout
+        while self.profile.sessions and time.monotonic() < deadline:
+            time.sleep(0.05)
+        remaining = len(self.profile.sessions)
+        if remaining:
+            logger.warning(f"Cutting off {remaining} SMTP sessions still open after the drain")
+        if stop:
+            self.stop()
+        return remaining
@@ -0,0 +1,230 @@
+"""
+Named statement catalog with per-thread cursors and query profiling.
+"""
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence
+
+
+class QueryProfile:
+    """Per-statement call counts and cumulative execution time."""
+
+    def __init__(self):
+        """Initialize an empty profile."""
+        self._lock = threading.Lock()
+        self._calls: Dict[str, int] = {}
+        self._seconds: Dict[str, float] = {}
+
+    def record(self, name: str, seconds: float):
+        """
+        Record one execution of a statement.
+
+        Args:
+            name: Statement name
+            seconds: Time spent executing and fetching
+        """
+        with self._lock:
+            self._calls[name] = self._calls.get(name, 0) + 1
+            self._seconds[name] = self._seconds.get(name, 0.0) + seconds
+
+    def reset(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._calls.clear()
+            self._seconds.clear()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Snapshot of the profile, most expensive statement first.
+
+        Returns:
+            Dictionary of statement name to calls, total_ms and avg_ms
+        """
+        with self._lock:
+            names = sorted(self._seconds, key=self._seconds.get, reverse=True)
+            return {
+                name: {
+                    "calls": self._calls[name],
+                    "total_ms": round(self._seconds[name] * 1000, 3),
+                    "avg_ms": round(self._seconds[name] * 1000 / self._calls[name], 4),
+                }
+                for name in names
+            }
+
+
+class StatementCatalog:
+    """
+    Executes a fixed set of named SQL statements on one connection.
+
+    sqlite3 keeps prepared statements in a per-connection cache keyed by
+    the SQL text. Issuing only the catalog's constant strings, with a cache
+    sized to hold all of them, means each statement is compiled once and
+    reused for the life of the connection. Each thread gets its own cursor,
+    created once, so threads sharing the connection never step on each
+    other's result sets.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, statements: Mapping[str, str],
+                 profile: Optional[QueryProfile] = None):
+        """
+        Initialize the catalog.
+
+        Args:
+            conn: Database connection, opened with a statement cache of at
+                  least len(statements) entries
+            statements: Statement name to SQL text
+            profile: Profile to record every execution in (optional)
+        """
+        self.conn = conn
+        self.statements = dict(statements)
+        self.profile = profile
+        # Held by the outermost transaction of any thread
+        self.write_lock = threading.Lock()
+        self._local = threading.local()
+
+    def define(self, name: str, sql: str) -> str:
+        """
+        Add a generated statement to the catalog, unless it is there already.
+
+        For statements built from a fixed set of parts (see
+        EmailData.search_messages): the name must identify the SQL text.
+
+        Args:
+            name: Statement name
+            sql: SQL text
+
+        Returns:
+            The name
+        """
+        self.statements.setdefault(name, sql)
+        return name
+
+    def cursor(self) -> sqlite3.Cursor:
+        """The calling thread's cursor."""
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None or cursor.connection is not self.conn:
+            cursor = self._local.cursor = self.conn.cursor()
+        return cursor
+
+    def rebind(self, conn: sqlite3.Connection):
+        """
+        Move the catalog to another connection holding the same database.
+
+        Call with write_lock held. Every thread gets a new cursor on its
+        next statement; the old connection is left open for statements
+        still running on it.
+
+        Args:
+            conn: Database connection, opened like the current one
+        """
+        self.conn = conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Group the writes of a block into one transaction.
+
+        Writes issued inside the block join it instead of committing on
+        their own; nested blocks join the outermost one. The outermost
+        block holds write_lock, so threads sharing the connection take
+        turns rather than writing into each other's transactions.
+        """
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            if depth:
+                yield
+            else:
+                with self.write_lock, self.conn:
+                    yield
+        finally:
+            self._local.depth = depth
+
+    def _run(self, name: str, params: Sequence[Any], size: Optional[int]) -> List[tuple]:
+        """Execute a statement and fetch its rows, size rows per batch."""
+        cursor = self.cursor()
+        start = time.perf_counter() if self.profile is not None else 0.0
+        cursor.execute(self.statements[name], params)
+        rows = cursor.fetchmany(size) if size else []
+        # A statement that is not run to completion keeps its read lock,
+        # so whatever the batch did not cover is drained as well
+        rows += cursor.fetchall()
+        if self.profile is not None:
+            self.profile.record(name, time.perf_counter() - start)
+        return rows
+
+    def fetch(self, name: str, params: Sequence[Any] = (), size: Optional[int] = None) -> List[tuple]:
+        """
+        Run a query and return its rows.
+
+        Args:
+            name: Statement name
+            params: Statement parameters
+            size: Expected number of rows (the page limit), fetched as a
+                  single batch; None fetches everything
+
+        Returns:
+            List of row tuples
+        """
+        return self._run(name, params, size)
+
+    def fetch_one(self, name: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        """
+        Run a query and return its first row.
+
+        Args:
+            name: Statement name
+            params: Statement parameters
+
+        Returns:
+            First row, or None if there is none
+        """
+        rows = self._run(name, params, 1)
+        return rows[0] if rows else None
+
+    def execute(self, name: str, params: Sequence[Any] = ()) -> int:
+        """
+        Run a write statement in its own transaction (or the enclosing one).
+
+        Args:
+            name: Statement name
+            params: Statement parameters
+
+        Returns:
+            Number of rows changed
+        """
+        with self.transaction():
+            self._run(name, params, None)
+            return self.cursor().rowcount
+
+    def insert(self, name: str, params: Sequence[Any] = ()) -> int:
+        """
+        Run an insert statement in its own transaction (or the enclosing one).
+
+        Args:
+            name: Statement name
+            params: Statement parameters
+
+        Returns:
+            Rowid of the inserted row
+        """
+        with self.transaction():
+            self._run(name, params, None)
+            return self.cursor().lastrowid
+
+    def execute_many(self, name: str, rows: Iterable[Sequence[Any]]) -> None:
+        """
+        Run a write statement for many parameter rows in one transaction.
+
+        Args:
+            name: Statement name
+            rows: Parameter rows
+        """
+        start = time.perf_counter() if self.profile is not None else 0.0
+        with self.transaction():
+            self.cursor().executemany(self.statements[name], rows)
+        if self.profile is not None:
+            self.profile.record(name, time.perf_counter() - start)
@@ -0,0 +1,212 @@
+"""
+HTML sanitization and HTML-to-text conversion for message renditions.
+"""
+
+import html
+from html.parser import HTMLParser
+from typing import List, Optional, Tuple
+
+
+# Elements removed together with everything inside them
+DROP_CONTENT_TAGS = frozenset({
+    'script', 'iframe', 'frame', 'frameset', 'object', 'embed', 'applet', 'noscript',
+})
+# Elements removed but whose content is kept. SVG animations can set any
+# attribute of their parent (attributeName="href" to="javascript:..."),
+# past the attribute checks below.
+DROP_TAGS = frozenset({
+    'base', 'link', 'meta', 'form', 'input', 'button', 'textarea', 'select',
+    'animate', 'animatemotion', 'animatetransform', 'set',
+})
+VOID_TAGS = frozenset({
+    'area', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param',
+    'source', 'track', 'wbr', 'base',
+})
+URL_ATTRIBUTES = frozenset({'href', 'src', 'action', 'formaction', 'background', 'xlink:href', 'poster'})
+SAFE_URL_SCHEMES = ('http:', 'https:', 'mailto:', 'cid:', 'tel:', 'data:image/')
+
+# Elements that start a new line in the text rendition
+BLOCK_TAGS = frozenset({
+    'address', 'article', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'footer',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre',
+    'section', 'table', 'tr', 'ul',
+})
+HIDDEN_TAGS = frozenset({'head', 'script', 'style', 'title', 'noscript'})
+
+# Marker the combined content field puts in front of HTML parts
+HTML_CONTENT_MARKER = "<!-- HTML_CONTENT -->\n"
+
+
+def _is_safe_url(value: str) -> bool:
+    """Check whether a URL attribute value uses an allowed scheme."""
+    compact = ''.join(value.split()).lower()
+    if ':' not in compact.split('/', 1)[0]:
+        # Relative URL or fragment
+        return True
+    return compact.startswith(SAFE_URL_SCHEMES)
+
+
+class _Sanitizer(HTMLParser):
+    """Rebuilds HTML without active content."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.out: List[str] = []
+        self._skip_depth = 0
+
+    def _render_attrs(self, attrs: List[Tuple[str, Optional[str]]]) -> str:
+        parts = []
+        for name, value in attrs:
+            name = name.lower()
+            if name.startswith('on') or name in ('srcdoc', 'formaction'):
+                continue
+            if value is None:
+                parts.append(f' {name}')
+                continue
+            if name in URL_ATTRIBUTES and not _is_safe_url(value):
+                continue
+            if name == 'style' and ('expression(' in value.lower() or 'javascript:' in value.lower()):
+                continue
+            parts.append(f' {name}="{html.escape(value, quote=True)}"')
+        return ''.join(parts)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROP_CONTENT_TAGS:
+            if tag not in VOID_TAGS:
+                self._skip_depth += 1
+            return
+        if self._skip_depth or tag in DROP_TAGS:
+            return
+        self.out.append(f'<{tag}{self._render_attrs(attrs)}>')
+
+    def handle_startendtag(self, tag, attrs):
+        if self._skip_depth or tag in DROP_CONTENT_TAGS or tag in DROP_TAGS:
+            return
+        self.out.append(f'<{tag}{self._render_attrs(attrs)} />')
+
+    def handle_endtag(self, tag):
+        if tag in DROP_CONTENT_TAGS:
+            if self._skip_depth and tag not in VOID_TAGS:
+                self._skip_depth -= 1
+            return
+        if self._skip_depth or tag in DROP_TAGS or tag in VOID_TAGS:
+            return
+        self.out.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.out.append(html.escape(data, quote=False))
+
+    def handle_entityref(self, name):
+        if not self._skip_depth:
+            self.out.append(f'&{name};')
+
+    def handle_charref(self, name):
+        if not self._skip_depth:
+            self.out.append(f'&#{name};')
+
+    def handle_comment(self, data):
+        # Conditional comments can smuggle markup; drop all comments
+        pass
+
+    def handle_decl(self, decl):
+        if not self._skip_depth:
+            self.out.append(f'<!{decl}>')
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML document."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out: List[str] = []
+        self._hidden_depth = 0
+        self._links: List[Optional[str]] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HIDDEN_TAGS:
+            self._hidden_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.out.append('\n')
+        if tag == 'a':
+            self._links.append(dict(attrs).get('href'))
+        elif tag == 'li':
+            self.out.append('- ')
+
+    def handle_endtag(self, tag):
+        if tag in HIDDEN_TAGS:
+            self._hidden_depth = max(0, self._hidden_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self.out.append('\n')
+        elif tag == 'a' and self._links:
+            href = self._links.pop()
+            if href and not href.startswith(('#', 'mailto:')):
+                self.out.append(f' ({href})')
+        elif tag in ('td', 'th'):
+            self.out.append('\t')
+
+    def handle_data(self, data):
+        if not self._hidden_depth:
+            self.out.append(data.replace('\n', ' '))
+
+
+def sanitize_html(markup: str) -> str:
+    """
+    Remove scripts, embedded frames, event handlers and unsafe URLs from HTML.
+
+    Args:
+        markup: HTML as received
+
+    Returns:
+        HTML safe to render in a browser
+    """
+    if not markup:
+        return ''
+    parser = _Sanitizer()
+    parser.feed(markup)
+    parser.close()
+    return ''.join(parser.out)
+
+
+def html_to_text(markup: str) -> str:
+    """
+    Convert HTML to readable plain text.
+
+    Args:
+        markup: HTML document or fragment
+
+    Returns:
+        Visible text with block elements on separate lines
+    """
+    if not markup:
+        return ''
+    parser = _TextExtractor()
+    parser.feed(markup)
+    parser.close()
+
+    lines = [' '.join(line.split()) for line in ''.join(parser.out).splitlines()]
+    text = '\n'.join(lines)
+    while '\n\n\n' in text:
+        text = text.replace('\n\n\n', '\n\n')
+    return text.strip()
+
+
+def split_content(content: str) -> Tuple[str, str]:
+    """
+    Derive the renditions of a combined content field.
+
+    Everything after the first HTML marker is taken as HTML, which
+    matches the text-then-HTML order of multipart/alternative mail.
+
+    Args:
+        content: Combined content, as stored before renditions were
+
+    Returns:
+        (text, sanitized HTML); the HTML is '' without an HTML part
+    """
+    text, marker, markup = content.partition(HTML_CONTENT_MARKER)
+    markup = sanitize_html(markup.replace(HTML_CONTENT_MARKER, '')) if marker else ''
+    text = text.rstrip('\n')
+    if not text and markup:
+        text = html_to_text(markup)
+    return text, markup
@@ -0,0 +1,235 @@
+"""
+Recipient routing table: accept, reject or discard mail per address and domain.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from .config import Config
+
+
+logger = logging.getLogger(__name__)
+
+ACCEPT = 'accept'
+REJECT = 'reject'
+DISCARD = 'discard'
+ACTIONS = (ACCEPT, REJECT, DISCARD)
+
+# Pattern reported for recipients no rule matches
+DEFAULT_RULE = '*'
+
+
+class _DomainNode:
+    """Trie node for one domain label, walked from the TLD down."""
+
+    __slots__ = ('children', 'suffix')
+
+    def __init__(self):
+        self.children: Dict[str, '_DomainNode'] = {}
+        # (pattern, action) applying to every domain below this node
+        self.suffix: Optional[Tuple[str, str]] = None
+
+
+class RoutingTable:
+    """
+    Maps recipients to an action.
+
+    Rule patterns, from most to least specific:
+
+    - ``user@example.com``: exact address
+    - ``example.com``: exact domain
+    - ``*.example.com``: any subdomain of example.com (not example.com itself)
+    - ``.example.com``: example.com and any subdomain
+
+    Exact addresses and domains live in hash maps. Wildcard and suffix
+    rules live in a trie keyed by reversed domain labels, so a lookup costs
+    one dictionary probe per label regardless of the number of rules. The
+    deepest matching wildcard or suffix rule wins.
+    """
+
+    def __init__(self, rules: Optional[Dict[str, str]] = None, default_action: str = ACCEPT):
+        """
+        Initialize the routing table.
+
+        Args:
+            rules: Mapping of pattern to action
+            default_action: Action for recipients no rule matches
+        """
+        if default_action not in ACTIONS:
+            raise ValueError(f"Invalid default routing action: {default_action}")
+
+        self.default_action = default_action
+        self._addresses: Dict[str, str] = {}
+        self._domains: Dict[str, str] = {}
+        self._root = _DomainNode()
+        self.counters: Dict[str, int] = {DEFAULT_RULE: 0}
+
+        for pattern, action in (rules or {}).items():
+            self.add_rule(pattern, action)
+
+    def __len__(self) -> int:
+        """Number of rules, not counting the default."""
+        return len(self.counters) - 1
+
+    def add_rule(self, pattern: str, action: str):
+        """
+        Add a routing rule.
+
+        Args:
+            pattern: Address, domain, ``*.domain`` or ``.domain`` pattern
+            action: One of accept, reject or discard
+        """
+        pattern = pattern.strip().lower()
+        action = action.strip().lower()
+        if action not in ACTIONS:
+            raise ValueError(f"Invalid routing action for {pattern}: {action}")
+        if not pattern or pattern == DEFAULT_RULE:
+            raise ValueError(f"Invalid routing pattern: {pattern!r}")
+
+        if '@' in pattern:
+            self._addresses[pattern] = action
+        elif pattern.startswith('*.') or pattern.startswith('.'):
+            node = self._root
+            for label in reversed(pattern.lstrip('*').strip('.').split('.')):
+                node = node.children.setdefault(label, _DomainNode())
+            if pattern.startswith('*.'):
+                # Subdomains only: hang the rule one level down, under any label
+                node = node.children.setdefault('*', _DomainNode())
+            node.suffix = (pattern, action)
+        else:
+            self._domains[pattern] = action
+
+        self.counters.setdefault(pattern, 0)
+
+    def lookup(self, address: str) -> Tuple[str, str]:
+        """
+        Find the rule for a recipient without counting it.
+
+        Args:
+            address: Recipient address
+
+        Returns:
+            Tuple of (action, matching pattern)
+        """
+        address = address.strip().strip('<>').lower()
+
+        action = self._addresses.get(address)
+        if action is not None:
+            return action, address
+
+        domain = address.rpartition('@')[2]
+        action = self._domains.get(domain)
+        if action is not None:
+            return action, domain
+
+        best = None
+        node = self._root
+        for label in reversed(domain.split('.')):
+            wildcard = node.children.get('*')
+            node = node.children.get(label)
+            if wildcard is not None and wildcard.suffix is not None:
+                best = wildcard.suffix
+            if node is None:
+                break
+            if node.suffix is not None:
+                best = node.suffix
+
+        if best is not None:
+            return best[1], best[0]
+        return self.default_action, DEFAULT_RULE
+
+    def route(self, address: str) -> str:
+        """
+        Find the action for a recipient and count the matching rule.
+
+        Args:
+            address: Recipient address
+
+        Returns:
+            One of accept, reject or discard
+        """
+        action, pattern = self.lookup(address)
+        self.counters[pattern] += 1
+        return action
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get per-rule match counters.
+
+        Returns:
+            Dictionary with the default action, rule count and per-pattern matches
+        """
+        return {
+            'default_action': self.default_action,
+            'rules': len(self),
+            'matches': dict(self.counters),
+        }
+
+
+class Router:
+    """
+    Routing table that hot-reloads its rules from the configuration file.
+
+    The file's modification time is checked at most once per reload
+    interval, so routing stays a plain table lookup between checks.
+    Counters of rules that survive a reload are kept.
+    """
+
+    def __init__(self, config: Config):
+        """
+        Initialize the router.
+
+        Args:
+            config: Configuration providing the [routing] and [routes] sections
+        """
+        self.config = config
+        self.reload_interval = config.routing_reload_interval
+        self._lock = threading.Lock()
+        self._next_check = time.monotonic() + self.reload_interval
+        self.table = self._build()
+
+    def _build(self) -> RoutingTable:
+        """Build a routing table from the current configuration."""
+        table = RoutingTable(self.config.routing_rules, self.config.routing_default_action)
+        logger.info(
+            f"Loaded {len(table)} routing rules (default: {table.default_action})"
+        )
+        return table
+
+    def reload_if_changed(self):
+        """Rebuild the table if the configuration file changed on disk."""
+        with self._lock:
+            self._next_check = time.monotonic() + self.reload_interval
+            if not self.config.refresh(('routing', 'routes')):
+                return
+
+            try:
+                table = self._build()
+            except ValueError as e:
+                logger.error(f"Keeping previous routing table, reload failed: {e}")
+                return
+
+            for pattern, count in self.table.counters.items():
+                if pattern in table.counters:
+                    table.counters[pattern] = count
+            self.table = table
+
+    def route(self, address: str) -> str:
+        """
+        Find the action for a recipient and count the matching rule.
+
+        Args:
+            address: Recipient address
+
+        Returns:
+            One of accept, reject or discard
+        """
+        if self.reload_interval > 0 and time.monotonic() >= self._next_check:
+            self.reload_if_changed()
+        return self.table.route(address)
+
+    def stats(self) -> Dict[str, Any]:
+        """Get per-rule match counters of the current table."""
+        return self.table.stats()
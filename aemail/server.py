@@ -2,19 +2,33 @@
 Main email server implementation.
 """
 
+import asyncio
 import logging
 import signal
+import socket
 import sys
 import threading
-from typing import Optional
-
-from aiosmtpd.controller import Controller
-from aiosmtpd.smtp import SMTP
+from typing import Dict, Optional
 
+from .async_api import AsyncEmailAPI
+from .budget import MemoryBudget
+from .cache import MessageCache
+from .compression import ResponseCompressor
 from .config import Config
 from .data import EmailData
-from .email_handler import SMTPHandler
+from .email_handler import BUILTIN_STAGES, DEFAULT_STAGES, SMTPHandler
+from .handoff import Successor
+from .inbox import DurableInbox, InboxIndexer
+from .limits import ClientLimits
+from .metrics import MetricsRegistry
+from .pipeline import Pipeline
+from .protocol import SMTPController, SMTPProfile
+from .queries import QueryProfile
+from .routing import Router
+from .snapshot import SnapshotReplica
+from .utils import AddressNormalizer
 from .web_api import EmailAPI
+from .webhooks import WebhookDispatcher
 
 
 logger = logging.getLogger(__name__)
@@ -23,18 +37,94 @@ logger = logging.getLogger(__name__)
 class EmailServer:
     """Main email server that combines SMTP and REST API functionality."""
     
-    def __init__(self, config: Optional[Config] = None, db_path: Optional[str] = None):
+    def __init__(self, config: Optional[Config] = None, db_path: Optional[str] = None,
+                 listen_fds: Optional[Dict[str, int]] = None):
         """
         Initialize the email server.
         
         Args:
             config: Configuration object. If None, creates default config.
             db_path: Path to SQLite database. If None, uses in-memory database.
+            listen_fds: Already bound 'smtp' and 'rest' listening sockets,
+                        inherited from the process being replaced (optional)
         """
         self.config = config or Config()
-        self.data_store = EmailData(db_path)
-        self.smtp_handler = SMTPHandler(self.data_store)
-        self.web_api = EmailAPI(self.data_store)
+        self.listen_fds = listen_fds or {}
+        self.query_profile = QueryProfile() if self.config.profile_queries else None
+        self.data_store = EmailData(
+            db_path,
+            normalizer=AddressNormalizer(
+                self.config.strip_plus_domains,
+                self.config.fold_dot_domains
+            ),
+            # Large databases keep accepting mail while they are migrated
+            background_migrations=True,
+            profile=self.query_profile,
+            cache=MessageCache.from_config(self.config),
+            # Long-running in-memory instances evict or spill instead of growing unbounded
+            budget=MemoryBudget.from_config(self.config)
+        )
+        self.router = Router(self.config)
+        self.limits = ClientLimits.from_config(self.config)
+
+        self.inbox = DurableInbox.from_config(self.config)
+        if self.inbox is not None and db_path is None:
+            # Indexed mail would be gone on restart while its segments are not
+            logger.warning("The durable inbox needs a database file; disabled")
+            self.inbox.close()
+            self.inbox = None
+
+        self.pipeline = Pipeline.from_config(self.config, BUILTIN_STAGES, DEFAULT_STAGES)
+        self.smtp_handler = SMTPHandler(
+            self.data_store, router=self.router, limits=self.limits,
+            inbox=self.inbox, pipeline=self.pipeline
+        )
+        self.inbox_indexer = None
+        if self.inbox is not None:
+            self.inbox_indexer = InboxIndexer(
+                self.inbox, self.data_store, self.smtp_handler.parse_message,
+                batch_size=self.config.config.getint('inbox', 'batch_size', fallback=500)
+            )
+
+        self.smtp_profile = SMTPProfile.from_config(self.config)
+
+        self.metrics = MetricsRegistry()
+        self.metrics.register('smtp', self.smtp_profile.stats)
+        self.metrics.register('routing', self.router.stats)
+        self.metrics.register('limits', self.limits.stats)
+        self.metrics.register('pipeline', self.pipeline.stats)
+        self.metrics.register('schema', self.data_store.schema_status)
+        self.metrics.register('storage', self.data_store.storage_status)
+        if self.query_profile is not None:
+            self.metrics.register('queries', self.query_profile.stats)
+        if self.data_store.cache is not None:
+            self.metrics.register('cache', self.data_store.cache.stats)
+        if self.inbox_indexer is not None:
+            self.metrics.register('inbox', self.inbox_indexer.stats)
+
+        self.compressor = ResponseCompressor.from_config(self.config)
+        self.metrics.register('compression', self.compressor.stats)
+
+        # Read-only copy serving ?consistency=snapshot reads
+        self.snapshot = SnapshotReplica.from_config(self.config, self.data_store)
+        if self.snapshot is not None:
+            self.metrics.register('snapshot', self.snapshot.stats)
+
+        # Stored mail pushed to the [webhook:<name>] targets
+        self.webhooks = WebhookDispatcher.from_config(self.config, self.data_store)
+        if self.webhooks is not None:
+            self.metrics.register('webhooks', self.webhooks.stats)
+
+        # 'async' serves the API on the SMTP event loop instead of a thread per request
+        self.frontend = self.config.config.get('rest', 'frontend', fallback='flask')
+        if self.frontend not in ('flask', 'async'):
+            logger.warning(f"Unknown REST frontend {self.frontend!r}, using flask")
+            self.frontend = 'flask'
+        api_class = AsyncEmailAPI if self.frontend == 'async' else EmailAPI
+        self.web_api = api_class(
+            self.data_store, metrics=self.metrics, compressor=self.compressor,
+            snapshot=self.snapshot
+        )
         
         # SMTP controller
         self.smtp_controller = None
@@ -42,6 +132,10 @@ class EmailServer:
         # Web server thread
         self.web_thread = None
         self._shutdown_event = threading.Event()
+        self._stopped = False
+
+        # Process started by restart(), released once this one has stopped
+        self.successor: Optional[Successor] = None
         
         # Setup logging
         self._setup_logging()
@@ -60,23 +154,34 @@ class EmailServer:
         )
     
     def _setup_signal_handlers(self):
-        """Setup signal handlers for graceful shutdown."""
+        """
+        Setup signal handlers for graceful shutdown.
+
+        SIGINT and SIGTERM drain and stop the server; SIGUSR2 hands the
+        listening sockets to a new process first (see restart). The
+        handlers only flag the request, the main thread does the rest.
+        """
         def signal_handler(signum, frame):
             logger.info(f"Received signal {signum}, shutting down...")
-            self.stop()
-            sys.exit(0)
-        
+            self._shutdown_event.set()
+
+        def restart_handler(signum, frame):
+            logger.info(f"Received signal {signum}, restarting...")
+            self._restart_requested = True
+            self._shutdown_event.set()
+
+        self._restart_requested = False
+        if threading.current_thread() is not threading.main_thread():
+            return
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2, restart_handler)
     
     def _run_web_server(self):
         """Run the web server in a separate thread."""
         try:
-            self.web_api.run(
-                host=self.config.rest_host,
-                port=self.config.rest_port,
-                debug=False
-            )
+            self.web_api.server.serve_forever()
         except Exception as e:
             logger.error(f"Web server error: {e}")
             self._shutdown_event.set()
@@ -90,21 +195,45 @@ class EmailServer:
             logger.info(f"IPv4 support: {'✓' if bind_info['supports_ipv4'] else '✗'}")
             logger.info(f"IPv6 support: {'✓' if bind_info['supports_ipv6'] else '✗'}")
 
+            # Replays mail journaled but not yet indexed by a previous run
+            if self.inbox_indexer is not None:
+                self.inbox_indexer.start()
+            if self.snapshot is not None:
+                self.snapshot.start()
+            if self.webhooks is not None:
+                self.webhooks.start()
+
             # Start SMTP server
             logger.info(f"Starting SMTP server on {self.config.smtp_host}:{self.config.smtp_port}")
-            self.smtp_controller = Controller(
+            smtp_fd = self.listen_fds.get('smtp')
+            # Enable UTF8 support, the connection-level limit hooks and the
+            # size, timeout, spooling and drain profile
+            self.smtp_controller = SMTPController(
                 self.smtp_handler,
+                self.smtp_profile,
                 hostname=self.config.smtp_host,
-                port=self.config.smtp_port
+                port=self.config.smtp_port,
+                sock=socket.socket(fileno=smtp_fd) if smtp_fd is not None else None,
+                enable_SMTPUTF8=True
             )
-            # Enable UTF8 support
-            self.smtp_controller.factory = lambda: SMTP(self.smtp_handler, enable_SMTPUTF8=True)
             self.smtp_controller.start()
 
-            # Start web server in a separate thread
             logger.info(f"Starting web API on {self.config.rest_host}:{self.config.rest_port}")
-            self.web_thread = threading.Thread(target=self._run_web_server, daemon=True)
-            self.web_thread.start()
+            rest_fd = self.listen_fds.get('rest')
+            if self.frontend == 'async':
+                # Served by the event loop of the SMTP server
+                asyncio.run_coroutine_threadsafe(
+                    self.web_api.start(
+                        self.config.rest_host, self.config.rest_port,
+                        sock=socket.socket(fileno=rest_fd) if rest_fd is not None else None
+                    ),
+                    self.smtp_controller.loop
+                ).result()
+            else:
+                # Start web server in a separate thread
+                self.web_api.bind(self.config.rest_host, self.config.rest_port, fd=rest_fd)
+                self.web_thread = threading.Thread(target=self._run_web_server, daemon=True)
+                self.web_thread.start()
             
             logger.info("Email server started successfully")
             logger.info(f"SMTP: {self.config.smtp_host}:{self.config.smtp_port}")
@@ -125,6 +254,11 @@ class EmailServer:
             logger.error(f"Failed to start server: {e}")
             self.stop()
             raise
+
+        if self._restart_requested:
+            self.restart()
+        else:
+            self.stop()
     
     def _wait_for_shutdown(self):
         """Wait for shutdown signal or web server error."""
@@ -137,21 +271,99 @@ class EmailServer:
         except KeyboardInterrupt:
             logger.info("Received keyboard interrupt")
     
+    def restart(self):
+        """
+        Replace this process without refusing a connection.
+
+        A new server process is started with the listening sockets, and
+        this one drains and stops. The successor begins accepting once
+        the database is closed; connections arriving in between wait in
+        the listen backlog.
+        """
+        fds = {}
+        smtp_socket = self.smtp_controller.listening_socket() if self.smtp_controller else None
+        if smtp_socket is not None:
+            fds['smtp'] = smtp_socket.fileno()
+        rest_socket = self.web_api.listening_socket()
+        if rest_socket is not None:
+            fds['rest'] = rest_socket.fileno()
+        try:
+            self.successor = Successor(fds)
+        except Exception as e:
+            logger.error(f"Failed to start successor process, stopping without handoff: {e}")
+        self.stop()
+
     def stop(self):
-        """Stop both servers and cleanup resources."""
+        """
+        Drain both servers and cleanup resources.
+
+        New SMTP connections are refused and open transactions get the
+        drain timeout to finish. Journaled mail is then indexed, the web
+        API stops once its requests in progress are answered, and the
+        database is closed last.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
         logger.info("Stopping email server...")
         
         # Signal shutdown
         self._shutdown_event.set()
         
-        # Stop SMTP server
+        # Drain SMTP server; the async web API still needs its event loop
+        shared_loop = self.frontend == 'async'
         if self.smtp_controller:
+            try:
+                self.smtp_controller.drain(stop=not shared_loop)
+                logger.info("SMTP server drained" if shared_loop else "SMTP server stopped")
+            except Exception as e:
+                logger.error(f"Error stopping SMTP server: {e}")
+
+        # Index what is left in the journal, then close it
+        if self.inbox_indexer is not None:
+            try:
+                self.inbox_indexer.stop(timeout=30)
+                self.inbox.close()
+                logger.info("Durable inbox closed")
+            except Exception as e:
+                logger.error(f"Error closing durable inbox: {e}")
+
+        # Stop the web API, which has served reads of the drained mail meanwhile
+        drain_timeout = self.config.config.getfloat('rest', 'drain_timeout', fallback=10.0)
+        try:
+            if not shared_loop:
+                self.web_api.shutdown(drain_timeout)
+            elif self.smtp_controller and self.web_api.server is not None:
+                asyncio.run_coroutine_threadsafe(
+                    self.web_api.shutdown(drain_timeout), self.smtp_controller.loop
+                ).result(drain_timeout + 5)
+        except Exception as e:
+            logger.error(f"Error stopping web API: {e}")
+
+        if shared_loop and self.smtp_controller:
             try:
                 self.smtp_controller.stop()
                 logger.info("SMTP server stopped")
             except Exception as e:
                 logger.error(f"Error stopping SMTP server: {e}")
-        
+
+        self.pipeline.close()
+
+        # Undelivered batches stay queued in the database for the next start
+        if self.webhooks is not None:
+            try:
+                self.webhooks.stop(timeout=30)
+                logger.info("Webhook dispatcher stopped")
+            except Exception as e:
+                logger.error(f"Error stopping webhook dispatcher: {e}")
+
+        if self.snapshot is not None:
+            try:
+                self.snapshot.stop(timeout=30)
+                logger.info("Database snapshot closed")
+            except Exception as e:
+                logger.error(f"Error closing database snapshot: {e}")
+
         # Close database connection
         if self.data_store:
             try:
@@ -159,6 +371,10 @@ class EmailServer:
                 logger.info("Database connection closed")
             except Exception as e:
                 logger.error(f"Error closing database: {e}")
+
+        if self.successor is not None:
+            self.successor.release()
+            logger.info(f"Handed over to process {self.successor.process.pid}")
         
         logger.info("Email server stopped")
     
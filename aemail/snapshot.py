@@ -0,0 +1,202 @@
+"""
+Periodically refreshed read-only snapshot of the database.
+"""
+
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from .config import Config
+from .data import EmailData
+
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotReplica:
+    """
+    A copy of the database for heavy reads, refreshed on a background thread.
+
+    Each refresh copies the live database with the SQLite backup API, a
+    few pages per step. Every step waits for the write lock of the live
+    connection, so a step never lands in the middle of a transaction, and
+    releases it in between, so mail keeps being stored while the copy is
+    made. Writes made between steps are carried into the copy by SQLite;
+    should mail arrive faster than it is copied, the last steps keep the
+    lock until the copy is complete.
+
+    The copy is then opened read-only on a connection of its own, so
+    queries against it never wait for the ingest connection. Two files
+    take turns: the newest copy is served while the next one is written
+    over the copy before it, which by then has been out of service for
+    one refresh interval.
+    """
+
+    def __init__(self, data_store: EmailData, directory: Optional[str] = None,
+                 interval: float = 300.0, pages_per_step: int = 1024,
+                 step_pause: float = 0.001):
+        """
+        Initialize the replica; the first snapshot is taken by refresh or start.
+
+        Args:
+            data_store: EmailData instance to copy
+            directory: Directory for the snapshot files (default: a new
+                       temporary directory)
+            interval: Seconds between refreshes
+            pages_per_step: Database pages copied per step
+            step_pause: Seconds the write lock is left free between steps
+        """
+        self.data_store = data_store
+        self.directory = Path(directory or tempfile.mkdtemp(prefix='aemail-snapshot-'))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.interval = interval
+        self.pages_per_step = pages_per_step
+        self.step_pause = step_pause
+
+        # The snapshot being served, and the one served before it
+        self.data: Optional[EmailData] = None
+        self.taken_at: Optional[float] = None
+        self._retired: Optional[EmailData] = None
+        self._next = 0
+        self.counters = {
+            'refreshes': 0,
+            'errors': 0,
+            'pages': 0,
+            'last_duration_ms': 0.0,
+        }
+        self.thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    @classmethod
+    def from_config(cls, config: Config, data_store: EmailData) -> Optional['SnapshotReplica']:
+        """Create a replica from the [snapshot] section, or None if it is disabled."""
+        section = config.config
+        interval = section.getfloat('snapshot', 'interval', fallback=0.0)
+        if interval <= 0:
+            return None
+        return cls(
+            data_store,
+            directory=section.get('snapshot', 'dir', fallback='').strip() or None,
+            interval=interval,
+            pages_per_step=section.getint('snapshot', 'pages_per_step', fallback=1024),
+            step_pause=section.getfloat('snapshot', 'step_pause_ms', fallback=1.0) / 1000,
+        )
+
+    def _path(self, index: int) -> Path:
+        """Path of one of the two snapshot files."""
+        return self.directory / f"snapshot-{index}.db"
+
+    def age(self) -> Optional[float]:
+        """Seconds since the snapshot being served was taken, or None before the first."""
+        if self.taken_at is None:
+            return None
+        return time.time() - self.taken_at
+
+    def describe(self) -> Dict[str, Any]:
+        """
+        Time and age of the snapshot being served, for responses read from it.
+
+        Returns:
+            Dictionary with 'time' (local ISO time) and 'age_seconds'
+        """
+        age = self.age()
+        return {
+            "time": EmailData._format_time(int(self.taken_at)) if self.taken_at is not None else None,
+            "age_seconds": round(age, 1) if age is not None else None,
+        }
+
+    def refresh(self):
+        """Take a new snapshot and serve it."""
+        start = time.perf_counter()
+        path = self._path(self._next)
+        if self._retired is not None:
+            self._retired.close()
+            self._retired = None
+
+        write_lock = self.data_store.queries.write_lock
+        budget = None
+
+        def between_steps(status: int, remaining: int, total: int):
+            nonlocal budget
+            # Mail stored faster than it is copied would keep the copy from
+            # ever finishing; after twice the starting size, writers wait
+            if budget is None:
+                budget = 2 * total
+            budget -= self.pages_per_step
+            if budget <= 0:
+                return
+            write_lock.release()
+            time.sleep(self.step_pause)
+            write_lock.acquire()
+
+        taken_at = time.time()
+        target = sqlite3.connect(str(path))
+        try:
+            with write_lock:
+                self.data_store.conn.backup(
+                    target, pages=self.pages_per_step, progress=between_steps
+                )
+            pages = target.execute("PRAGMA page_count").fetchone()[0]
+        finally:
+            target.close()
+
+        snapshot = EmailData(str(path), normalizer=self.data_store.normalizer, read_only=True)
+        self._retired, self.data = self.data, snapshot
+        self.taken_at = taken_at
+        self._next = 1 - self._next
+        self.counters['refreshes'] += 1
+        self.counters['pages'] = pages
+        self.counters['last_duration_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    def run(self):
+        """Refresh every interval until stopped."""
+        while not self._stopping.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error taking database snapshot: {e}")
+                self.counters['errors'] += 1
+            self._stopping.wait(self.interval)
+
+    def start(self):
+        """Start refreshing on a background thread."""
+        self.thread = threading.Thread(target=self.run, name="aemail-snapshot", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Stop refreshing and close the snapshots.
+
+        Args:
+            timeout: Seconds to wait for a refresh in progress
+        """
+        self._stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        for snapshot in (self._retired, self.data):
+            if snapshot is not None:
+                snapshot.close()
+        self._retired = self.data = None
+        for index in (0, 1):
+            try:
+                os.remove(self._path(index))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Snapshot age and refresh counters.
+
+        Returns:
+            Dictionary of counters, 'age_seconds' and 'interval'
+        """
+        stats: Dict[str, Any] = dict(self.counters)
+        age = self.age()
+        stats['age_seconds'] = round(age, 1) if age is not None else None
+        stats['interval'] = self.interval
+        return stats
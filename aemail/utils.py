@@ -2,8 +2,22 @@
 Utility functions for the email server.
 """
 
+import datetime
 import re
-from typing import List, Optional
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+
+# Compiled once at import instead of on every call
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+INVALID_FILENAME_CHARS = re.compile(r'[<>:"/\\|?*]')
+MESSAGE_ID_PATTERN = re.compile(r'<([^<>\s]+)>')
+
+# Headers holding message ids, indexed and looked up without angle brackets
+MESSAGE_ID_HEADERS = frozenset({'message-id', 'in-reply-to', 'references'})
+
+# Longest header value kept in the header index
+MAX_HEADER_VALUE = 998
 
 
 def validate_email(email: str) -> bool:
@@ -19,9 +33,7 @@ def validate_email(email: str) -> bool:
     if not email or not isinstance(email, str):
         return False
     
-    # Basic email regex pattern
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email.strip()))
+    return EMAIL_PATTERN.match(email.strip()) is not None
 
 
 def extract_domain(email: str) -> Optional[str]:
@@ -56,6 +68,153 @@ def normalize_email(email: str) -> str:
     return email.strip().lower()
 
 
+def normalize_domain(address: str) -> str:
+    """
+    Strip whitespace and angle brackets and lowercase the domain part.
+
+    The local part is left untouched, since only the domain is
+    case-insensitive by definition.
+
+    Args:
+        address: Email address
+
+    Returns:
+        Address with a lowercased domain
+    """
+    if not address:
+        return ""
+
+    address = address.strip().strip('<>')
+    local, at, domain = address.rpartition('@')
+    if not at:
+        return address
+    return f"{local}@{domain.lower()}"
+
+
+def parse_timestamp(value: str) -> int:
+    """
+    Parse a query-string time into epoch seconds.
+
+    Args:
+        value: Epoch seconds, or an ISO 8601 date or date and time (local
+               time unless it carries an offset, like the times the API returns)
+
+    Returns:
+        Epoch seconds
+
+    Raises:
+        ValueError: If the value is neither
+    """
+    value = value.strip()
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    return int(datetime.datetime.fromisoformat(value).timestamp())
+
+
+def header_values(name: str, value: str) -> List[str]:
+    """
+    Normalize a decoded header value for the header index.
+
+    Whitespace runs, including folding, become single spaces. Message-id
+    headers yield each id without its angle brackets, so they are found
+    with or without them.
+
+    Args:
+        name: Lowercase header name
+        value: Decoded header value
+
+    Returns:
+        Values to index (empty for a blank header)
+    """
+    value = ' '.join(str(value).split())
+    if name in MESSAGE_ID_HEADERS:
+        ids = MESSAGE_ID_PATTERN.findall(value)
+        values = ids or [value.strip('<>')]
+    else:
+        values = [value]
+    return [v[:MAX_HEADER_VALUE] for v in values if v]
+
+
+class AddressNormalizer:
+    """
+    Computes the canonical form of email addresses for indexed lookups.
+
+    Every address is lowercased. Per-domain policy additionally strips
+    plus-tags (``user+tag@`` -> ``user@``) and folds dots in the local part
+    (``first.last@`` -> ``firstlast@``). A policy entry applies to the
+    domain and its subdomains; ``*`` applies to every domain. Policies are
+    resolved once per domain and memoized, and canonicalization itself uses
+    plain string operations.
+    """
+
+    def __init__(self, strip_plus_domains: Iterable[str] = (),
+                 fold_dot_domains: Iterable[str] = (), cache_size: int = 4096):
+        """
+        Initialize the normalizer.
+
+        Args:
+            strip_plus_domains: Domains whose plus-tags are stripped
+            fold_dot_domains: Domains whose local-part dots are folded
+            cache_size: Number of per-domain policies to memoize
+        """
+        self.strip_plus_domains = frozenset(d.strip().lower() for d in strip_plus_domains if d.strip())
+        self.fold_dot_domains = frozenset(d.strip().lower() for d in fold_dot_domains if d.strip())
+        self.policy_for = lru_cache(maxsize=cache_size)(self._resolve_policy)
+
+    @staticmethod
+    def _matches(domain: str, domains: frozenset) -> bool:
+        """Check whether a domain or one of its parents is in a policy set."""
+        if not domains:
+            return False
+        if '*' in domains:
+            return True
+        while True:
+            if domain in domains:
+                return True
+            _, dot, domain = domain.partition('.')
+            if not dot:
+                return False
+
+    def _resolve_policy(self, domain: str) -> Tuple[bool, bool]:
+        """
+        Resolve the policy of a (lowercased) domain.
+
+        Returns:
+            Tuple of (strip_plus, fold_dots)
+        """
+        return (
+            self._matches(domain, self.strip_plus_domains),
+            self._matches(domain, self.fold_dot_domains),
+        )
+
+    def canonicalize(self, address: str) -> str:
+        """
+        Compute the canonical form of an address.
+
+        Args:
+            address: Email address as received
+
+        Returns:
+            Canonical address used for indexed lookups
+        """
+        if not address:
+            return ""
+
+        address = address.strip().strip('<>').lower()
+        local, at, domain = address.rpartition('@')
+        if not at:
+            return address
+
+        strip_plus, fold_dots = self.policy_for(domain)
+        if strip_plus:
+            local = local.partition('+')[0]
+        if fold_dots:
+            local = local.replace('.', '')
+        return f"{local}@{domain}"
+
+
 def filter_valid_emails(emails: List[str]) -> List[str]:
     """
     Filter list to only include valid email addresses.
@@ -100,8 +259,7 @@ def sanitize_filename(filename: str) -> str:
         return "unnamed"
     
     # Remove or replace invalid characters
-    invalid_chars = r'[<>:"/\\|?*]'
-    sanitized = re.sub(invalid_chars, '_', filename)
+    sanitized = INVALID_FILENAME_CHARS.sub('_', filename)
     
     # Remove leading/trailing dots and spaces
     sanitized = sanitized.strip('. ')
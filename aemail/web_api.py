@@ -5,11 +5,19 @@ REST API for accessing stored emails.
 import json
 import logging
 import os
-from flask import Flask, jsonify, send_file, request
+import socket
+import threading
+import time
+from flask import Flask, Response, jsonify, request
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, Optional, Tuple
+from werkzeug.serving import BaseWSGIServer, make_server
 
-from .data import EmailData
+from .compression import ResponseCompressor, StaticAsset
+from .data import MESSAGE_PARTS, EmailData
+from .metrics import MetricsRegistry
+from .snapshot import SnapshotReplica
+from .utils import parse_timestamp
 
 
 logger = logging.getLogger(__name__)
@@ -18,16 +26,26 @@ logger = logging.getLogger(__name__)
 class EmailAPI:
     """REST API for email access."""
     
-    def __init__(self, data_store: EmailData, static_dir: Optional[str] = None):
+    def __init__(self, data_store: EmailData, static_dir: Optional[str] = None,
+                 metrics: Optional[MetricsRegistry] = None,
+                 compressor: Optional[ResponseCompressor] = None,
+                 snapshot: Optional[SnapshotReplica] = None):
         """
         Initialize the email API.
 
         Args:
             data_store: EmailData instance for accessing stored emails
             static_dir: Directory containing static files (optional)
+            metrics: Registry served at /metrics (optional)
+            compressor: Response compression settings (optional)
+            snapshot: Replica serving ?consistency=snapshot reads (optional)
         """
         self.app = Flask(__name__)
         self.data_store = data_store
+        self.snapshot = snapshot
+        self.metrics = metrics or MetricsRegistry()
+        self.compressor = compressor or ResponseCompressor()
+        self.compressor.init_app(self.app)
 
         # Default to package's static directory
         if static_dir is None:
@@ -36,22 +54,53 @@ class EmailAPI:
         else:
             self.static_dir = static_dir
         
+        # The UI is read and compressed once instead of on every request
+        self.index_page = StaticAsset.load(Path(self.static_dir) / 'index.html')
+
         # Configure JSON serialization
         self.app.json.ensure_ascii = False
+
+        # Server created by bind, and the requests it is handling
+        self.server: Optional[BaseWSGIServer] = None
+        self._active_requests = 0
+        self._active_lock = threading.Lock()
         
         # Register routes
         self._register_routes()
     
+    def _read_store(self) -> Tuple[Optional[EmailData], Dict[str, Any]]:
+        """
+        Data store the current request reads from.
+
+        Returns:
+            The live store, or the snapshot for ?consistency=snapshot (None
+            while there is none), and the fields to add to the response
+        """
+        if request.args.get('consistency') != 'snapshot':
+            return self.data_store, {}
+        if self.snapshot is None or self.snapshot.data is None:
+            return None, {}
+        return self.snapshot.data, {"snapshot": self.snapshot.describe()}
+
     def _register_routes(self):
         """Register API routes."""
+
+        @self.app.before_request
+        def count_request():
+            with self._active_lock:
+                self._active_requests += 1
+
+        @self.app.teardown_request
+        def uncount_request(error):
+            with self._active_lock:
+                self._active_requests -= 1
         
         @self.app.route('/')
         def index():
             """Serve the main page."""
             try:
-                static_path = Path(self.static_dir) / 'index.html'
-                if static_path.exists():
-                    return send_file(str(static_path))
+                if self.index_page is not None:
+                    return self.index_page.response(request)
                 else:
                     return self._create_default_page()
             except Exception as e:
@@ -65,10 +114,15 @@ class EmailAPI:
                 # Get pagination parameters
                 limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
                 offset = max(int(request.args.get('offset', 0)), 0)
+                summary = request.args.get('view') == 'summary'
+
+                store, extra = self._read_store()
+                if store is None:
+                    return jsonify({"error": "No snapshot available"}), 503
 
                 # Get messages and total count
-                messages = self.data_store.get_all_messages(limit=limit, offset=offset)
-                total_count = self.data_store.get_message_count()
+                messages = store.get_all_messages(limit=limit, offset=offset, summary=summary)
+                total_count = store.get_message_count()
 
                 return jsonify({
                     "messages": messages,
@@ -77,12 +131,51 @@ class EmailAPI:
                         "offset": offset,
                         "total": total_count,
                         "has_more": offset + limit < total_count
-                    }
+                    },
+                    **extra
                 })
             except Exception as e:
                 logger.error(f"Error retrieving all messages: {e}")
                 return jsonify({"error": "Failed to retrieve messages"}), 500
 
+        @self.app.route('/messages')
+        def search_messages():
+            """Get the messages matching every given filter (from, to, domain, subject, since, until)."""
+            try:
+                limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
+                offset = max(int(request.args.get('offset', 0)), 0)
+                since, until = (
+                    parse_timestamp(request.args[name]) if request.args.get(name) else None
+                    for name in ('since', 'until')
+                )
+            except ValueError:
+                return jsonify({"error": "limit and offset must be numbers, since and until "
+                                         "epoch seconds or ISO 8601 times"}), 400
+
+            store, extra = self._read_store()
+            if store is None:
+                return jsonify({"error": "No snapshot available"}), 503
+            try:
+                # One extra row tells whether there is another page
+                messages = store.search_messages(
+                    sender=request.args.get('from'), recipient=request.args.get('to'),
+                    domain=request.args.get('domain'), subject=request.args.get('subject'),
+                    since=since, until=until, limit=limit + 1, offset=offset,
+                    summary=request.args.get('view') == 'summary'
+                )
+                return jsonify({
+                    "messages": messages[:limit],
+                    "pagination": {
+                        "limit": limit,
+                        "offset": offset,
+                        "has_more": len(messages) > limit
+                    },
+                    **extra
+                })
+            except Exception as e:
+                logger.error(f"Error searching messages: {e}")
+                return jsonify({"error": "Failed to retrieve messages"}), 500
+
         @self.app.route('/from/<path:sender>')
         def get_messages_from(sender: str):
             """Get messages from a specific sender with pagination support."""
@@ -90,9 +183,10 @@ class EmailAPI:
                 # Get pagination parameters
                 limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
                 offset = max(int(request.args.get('offset', 0)), 0)
+                summary = request.args.get('view') == 'summary'
 
                 # Get messages and total count
-                messages = self.data_store.get_messages_from(sender, limit=limit, offset=offset)
+                messages = self.data_store.get_messages_from(sender, limit=limit, offset=offset, summary=summary)
                 total_count = self.data_store.get_message_count(sender=sender)
 
                 return jsonify({
@@ -110,15 +204,21 @@ class EmailAPI:
 
         @self.app.route('/to/<path:recipient>')
         def get_messages_to(recipient: str):
-            """Get messages to a specific recipient with pagination support."""
+            """Get messages to a specific recipient with pagination support (?unread=1 for unread only)."""
             try:
                 # Get pagination parameters
                 limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
                 offset = max(int(request.args.get('offset', 0)), 0)
+                summary = request.args.get('view') == 'summary'
+                unread = request.args.get('unread') in ('1', 'true')
 
                 # Get messages and total count
-                messages = self.data_store.get_messages_to(recipient, limit=limit, offset=offset)
-                total_count = self.data_store.get_message_count(recipient=recipient)
+                messages = self.data_store.get_messages_to(
+                    recipient, limit=limit, offset=offset, summary=summary, unread=unread
+                )
+                unread_count = self.data_store.get_unread_count(recipient)
+                total_count = unread_count if unread else \
+                    self.data_store.get_message_count(recipient=recipient)
 
                 return jsonify({
                     "messages": messages,
@@ -126,17 +226,176 @@ class EmailAPI:
                         "limit": limit,
                         "offset": offset,
                         "total": total_count,
+                        "unread": unread_count,
                         "has_more": offset + limit < total_count
                     }
                 })
             except Exception as e:
                 logger.error(f"Error retrieving messages to {recipient}: {e}")
                 return jsonify({"error": "Failed to retrieve messages"}), 500
-        
+
+        @self.app.route('/to/<path:recipient>/read', methods=['POST'], defaults={'seen': True})
+        @self.app.route('/to/<path:recipient>/unread', methods=['POST'], defaults={'seen': False})
+        def mark_read(recipient: str, seen: bool):
+            """Mark one message (?id=) or the whole mailbox of a recipient read or unread."""
+            try:
+                msg_id = request.args.get('id')
+                msg_id = int(msg_id) if msg_id is not None else None
+                updated = self.data_store.mark_read(recipient, msg_id, seen=seen)
+                return jsonify({
+                    "updated": updated,
+                    "unread": self.data_store.get_unread_count(recipient)
+                })
+            except ValueError:
+                return jsonify({"error": "id must be a message id"}), 400
+            except Exception as e:
+                logger.error(f"Error marking messages to {recipient}: {e}")
+                return jsonify({"error": "Failed to update messages"}), 500
+
+        @self.app.route('/to/<path:recipient>/latest-code')
+        def get_latest_code(recipient: str):
+            """Get the code of the newest message to a recipient that has one (?kind= for custom tokens)."""
+            kind = request.args.get('kind', 'code')
+            try:
+                token = self.data_store.get_latest_token(recipient, kind)
+            except Exception as e:
+                logger.error(f"Error retrieving latest {kind} for {recipient}: {e}")
+                return jsonify({"error": "Failed to retrieve code"}), 500
+            if token is None:
+                return jsonify({"error": f"No {kind} found"}), 404
+            return jsonify(dict(token, kind=kind))
+
+        @self.app.route('/to/<path:recipient>/links')
+        def get_links(recipient: str):
+            """Get the links of the newest messages to a recipient."""
+            try:
+                limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
+                links = self.data_store.get_tokens(recipient, 'link', limit=limit)
+                return jsonify({"links": links})
+            except Exception as e:
+                logger.error(f"Error retrieving links for {recipient}: {e}")
+                return jsonify({"error": "Failed to retrieve links"}), 500
+
+        @self.app.route('/header/<name>/<path:value>')
+        def get_messages_by_header(name: str, value: str):
+            """Get the messages carrying an indexed header value (e.g. /header/Message-ID/<id>)."""
+            try:
+                limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
+                offset = max(int(request.args.get('offset', 0)), 0)
+                summary = request.args.get('view') == 'summary'
+
+                # One extra row tells whether there is another page
+                messages = self.data_store.get_messages_by_header(
+                    name, value, limit=limit + 1, offset=offset, summary=summary
+                )
+                return jsonify({
+                    "messages": messages[:limit],
+                    "pagination": {
+                        "limit": limit,
+                        "offset": offset,
+                        "has_more": len(messages) > limit
+                    }
+                })
+            except Exception as e:
+                logger.error(f"Error retrieving messages by header {name}: {e}")
+                return jsonify({"error": "Failed to retrieve messages"}), 500
+
+        @self.app.route('/message/<int:msg_id>')
+        def get_message(msg_id: int):
+            """Get a message, or one of its renditions with ?part=text|html."""
+            part = request.args.get('part')
+            if part is not None and part not in MESSAGE_PARTS:
+                return jsonify({"error": f"part must be one of: {', '.join(MESSAGE_PARTS)}"}), 400
+
+            try:
+                if part is None:
+                    summary = request.args.get('view') == 'summary'
+                    message = self.data_store.get_message(msg_id, summary=summary)
+                    if message is None:
+                        return jsonify({"error": "Message not found"}), 404
+                    if not summary:
+                        message["parts"] = self.data_store.get_message_parts(msg_id) or ["text"]
+                    return jsonify(message)
+
+                body = self.data_store.get_message_part(msg_id, part)
+                if body is None:
+                    return jsonify({"error": "Message not found"}), 404
+            except Exception as e:
+                logger.error(f"Error retrieving message {msg_id}: {e}")
+                return jsonify({"error": "Failed to retrieve message"}), 500
+
+            mimetype = 'text/html' if part == 'html' else 'text/plain'
+            response = Response(body, mimetype=mimetype)
+            if part == 'html':
+                # Already sanitized; the CSP keeps direct views inert as well
+                response.headers['Content-Security-Policy'] = (
+                    "sandbox; default-src 'none'; img-src * data:; style-src 'unsafe-inline'"
+                )
+            # Stored renditions never change, let clients reuse them
+            response.headers['Cache-Control'] = 'private, max-age=86400'
+            response.add_etag()
+            return response.make_conditional(request)
+
+        @self.app.route('/stats')
+        def get_stats():
+            """Message counts and bytes per recipient domain, sender, hour or mailbox."""
+            store, extra = self._read_store()
+            if store is None:
+                return jsonify({"error": "No snapshot available"}), 503
+            try:
+                limit = min(int(request.args.get('limit', 20)), 100)  # Max 100 per request
+                since, until = (
+                    parse_timestamp(request.args[name]) if request.args.get(name) else None
+                    for name in ('since', 'until')
+                )
+                stats = store.get_stats(
+                    by=request.args.get('by', 'domain'), since=since, until=until,
+                    sender=request.args.get('from'), domain=request.args.get('domain'),
+                    limit=limit
+                )
+            except ValueError:
+                return jsonify({"error": "by must be domain, sender, hour or mailbox, limit a "
+                                         "number, since and until epoch seconds or ISO 8601 times"}), 400
+            except Exception as e:
+                logger.error(f"Error retrieving statistics: {e}")
+                return jsonify({"error": "Failed to retrieve statistics"}), 500
+            return jsonify({"by": request.args.get('by', 'domain'), "stats": stats, **extra})
+
+        @self.app.route('/changes')
+        def get_changes():
+            """Messages stored and deleted after ?after=<seq>, in order, for incremental sync."""
+            try:
+                after = int(request.args.get('after', 0))
+                limit = min(int(request.args.get('limit', 100)), 1000)  # Max 1000 per request
+                if after < 0 or limit < 1:
+                    raise ValueError(after)
+            except ValueError:
+                return jsonify({"error": "after must be a sequence number, limit a positive number"}), 400
+            try:
+                # One extra row tells whether there is another page
+                changes = self.data_store.get_changes(
+                    after, limit=limit + 1, summary=request.args.get('view') == 'summary'
+                )
+            except Exception as e:
+                logger.error(f"Error retrieving changes: {e}")
+                return jsonify({"error": "Failed to retrieve changes"}), 500
+            changes, has_more = changes[:limit], len(changes) > limit
+            return jsonify({
+                "changes": changes,
+                "next": changes[-1]["seq"] if changes else after,
+                "has_more": has_more
+            })
+
         @self.app.route('/health')
         def health_check():
-            """Health check endpoint."""
-            return jsonify({"status": "healthy", "service": "aemail"})
+            """Health check endpoint, with the database size."""
+            return jsonify({"status": "healthy", "service": "aemail",
+                            "storage": self.data_store.storage_status()})
+
+        @self.app.route('/metrics')
+        def get_metrics():
+            """Server metrics: routing, limits and other component counters."""
+            return jsonify(self.metrics.collect())
     
     def _create_default_page(self) -> str:
         """Create a default HTML page when static files are not available."""
@@ -161,7 +420,8 @@ class EmailAPI:
                 
                 <div class="endpoint">
                     <strong>GET /all</strong><br>
-                    Get all stored messages (last 100)
+                    Get all stored messages (last 100)<br>
+                    Add <code>?view=summary</code> to any list to leave out the bodies
                 </div>
                 
                 <div class="endpoint">
@@ -176,10 +436,33 @@ class EmailAPI:
                     Example: <code>/to/user@example.com</code>
                 </div>
                 
+                <div class="endpoint">
+                    <strong>GET /messages?from=&amp;to=&amp;domain=&amp;subject=&amp;since=&amp;until=</strong><br>
+                    Get the messages matching every given filter<br>
+                    Example: <code>/messages?to=user@example.com&amp;subject=Verify&amp;since=2024-01-01</code>
+                </div>
+
+                <div class="endpoint">
+                    <strong>GET /stats?by=domain|sender|hour|mailbox&amp;since=&amp;until=</strong><br>
+                    Get message counts and bytes per recipient domain, sender, hour or mailbox<br>
+                    Example: <code>/stats?by=sender&amp;since=2024-01-01</code>
+                </div>
+
+                <div class="endpoint">
+                    <strong>GET /message/&lt;id&gt;?part=text|html</strong><br>
+                    Get one message, or its plain-text or sanitized HTML rendition<br>
+                    Example: <code>/message/42?part=text</code>
+                </div>
+
                 <div class="endpoint">
                     <strong>GET /health</strong><br>
                     Health check endpoint
                 </div>
+
+                <div class="endpoint">
+                    <strong>GET /metrics</strong><br>
+                    Server metrics (routing rule matches, connection and rate limits)
+                </div>
                 
                 <h2>Usage Example:</h2>
                 <p>Send an email to any address ending with your domain, then query:</p>
@@ -189,6 +472,45 @@ class EmailAPI:
         </html>
         """
     
+    def bind(self, host: str = '127.0.0.1', port: int = 14000,
+             fd: Optional[int] = None) -> BaseWSGIServer:
+        """
+        Create the threaded HTTP server, ready for serve_forever.
+
+        Args:
+            host: Host to bind to
+            port: Port to bind to
+            fd: Already bound listening socket to use instead (inherited
+                from the process being replaced)
+
+        Returns:
+            The server
+        """
+        self.server = make_server(host, port, self.app, threaded=True, fd=fd)
+        return self.server
+
+    def listening_socket(self) -> Optional[socket.socket]:
+        """The socket the server accepts connections on, while it runs."""
+        return self.server.socket if self.server is not None else None
+
+    def shutdown(self, timeout: float = 10.0):
+        """
+        Stop accepting requests, and give those in progress time to finish.
+
+        Args:
+            timeout: Seconds to wait for requests in progress
+        """
+        if self.server is None:
+            return
+        self.server.shutdown()
+        deadline = time.monotonic() + timeout
+        while self._active_requests > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self._active_requests > 0:
+            logger.warning(f"Closing web API with {self._active_requests} requests in progress")
+        self.server.server_close()
+        self.server = None
+
     def run(self, host: str = '127.0.0.1', port: int = 14000, debug: bool = False):
         """
         Run the Flask application.
@@ -0,0 +1,487 @@
+"""
+Outbound webhooks: stored mail pushed to HTTP endpoints in batches.
+"""
+
+import asyncio
+import json
+import logging
+import ssl
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from .config import Config
+from .data import EmailData
+
+
+logger = logging.getLogger(__name__)
+
+# Section prefix of a webhook target: [webhook:<name>]
+SECTION_PREFIX = 'webhook:'
+
+# Statements of the dispatcher, added to the data store's catalog
+STATEMENTS = {
+    "webhook_cursor": "SELECT seq FROM webhook_cursor WHERE target = ?",
+    "webhook_set_cursor": "INSERT OR REPLACE INTO webhook_cursor (target, seq) VALUES (?, ?)",
+    "webhook_latest_change": "SELECT COALESCE(MAX(seq), 0) FROM msg_change",
+    "webhook_changes": "SELECT seq, op, msg_id FROM msg_change WHERE seq > ? ORDER BY seq LIMIT ?",
+    "webhook_enqueue": (
+        "INSERT INTO webhook_queue (target, msg_ids, attempts, next_attempt) VALUES (?, ?, 0, ?)"
+    ),
+    "webhook_due": (
+        "SELECT id, msg_ids, attempts FROM webhook_queue "
+        "WHERE target = ? AND next_attempt <= ? ORDER BY next_attempt, id LIMIT ?"
+    ),
+    "webhook_next_due": "SELECT MIN(next_attempt) FROM webhook_queue WHERE target = ?",
+    "webhook_pending": "SELECT COUNT(*) FROM webhook_queue WHERE target = ?",
+    "webhook_delivered": "DELETE FROM webhook_queue WHERE id = ?",
+    "webhook_retry": (
+        "UPDATE webhook_queue SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?"
+    ),
+}
+
+
+class WebhookTarget:
+    """An endpoint that stored mail is POSTed to, and how to deliver to it."""
+
+    def __init__(self, name: str, url: str, batch_size: int = 50, concurrency: int = 2,
+                 timeout: float = 10.0, max_attempts: int = 10, backoff: float = 1.0,
+                 max_backoff: float = 300.0, authorization: Optional[str] = None):
+        """
+        Initialize the target.
+
+        Args:
+            name: Name of the target, keying its cursor and queue
+            url: http:// or https:// URL the batches are POSTed to
+            batch_size: Most messages per POST
+            concurrency: Most POSTs in flight (and pooled connections)
+            timeout: Seconds a POST may take
+            max_attempts: Attempts before a batch is dropped
+            backoff: Seconds before the first retry, doubled on each one
+            max_backoff: Longest wait between retries, in seconds
+            authorization: Authorization header value (optional)
+
+        Raises:
+            ValueError: If the URL is not http or https
+        """
+        if urlsplit(url).scheme not in ('http', 'https'):
+            raise ValueError(f"Webhook {name}: URL must be http or https, not {url!r}")
+        self.name = name
+        self.url = url
+        self.batch_size = max(batch_size, 1)
+        self.concurrency = max(concurrency, 1)
+        self.timeout = timeout
+        self.max_attempts = max(max_attempts, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.authorization = authorization
+
+    @classmethod
+    def from_config(cls, config: Config, section: str) -> 'WebhookTarget':
+        """Create a target from its [webhook:<name>] section."""
+        options = config.config
+        return cls(
+            section[len(SECTION_PREFIX):],
+            options.get(section, 'url'),
+            batch_size=options.getint(section, 'batch_size', fallback=50),
+            concurrency=options.getint(section, 'concurrency', fallback=2),
+            timeout=options.getfloat(section, 'timeout', fallback=10.0),
+            max_attempts=options.getint(section, 'max_attempts', fallback=10),
+            backoff=options.getfloat(section, 'backoff', fallback=1.0),
+            max_backoff=options.getfloat(section, 'max_backoff', fallback=300.0),
+            authorization=options.get(section, 'authorization', fallback='').strip() or None,
+        )
+
+    def retry_delay(self, attempts: int) -> float:
+        """Seconds to wait after the given number of failed attempts."""
+        return min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP/1.1 connections to one endpoint, for POSTs only.
+
+    Connections are reused as long as the server keeps them open; one
+    that turns out to have been closed while idle is dropped and the
+    request sent on the next.
+    """
+
+    def __init__(self, url: str, size: int, timeout: float):
+        """
+        Initialize the pool; connections are opened on demand.
+
+        Args:
+            url: Endpoint URL
+            size: Most idle connections kept
+            timeout: Seconds a request may take
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        self.host_header = parts.netloc
+        self.size = size
+        self.timeout = timeout
+        self.idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self.opened = 0
+
+    async def post(self, body: bytes, headers: Dict[str, str]) -> int:
+        """
+        POST a body.
+
+        Args:
+            body: Request body
+            headers: Extra request headers
+
+        Returns:
+            Response status code
+
+        Raises:
+            OSError, asyncio.TimeoutError or ValueError if there is no valid response
+        """
+        while self.idle:
+            connection = self.idle.pop()
+            try:
+                return await self._request(connection, body, headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # Closed by the server while idle
+                continue
+        connection = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout
+        )
+        self.opened += 1
+        return await self._request(connection, body, headers)
+
+    async def _request(self, connection: Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+                       body: bytes, headers: Dict[str, str]) -> int:
+        """Send one request on a connection and read the response."""
+        reader, writer = connection
+        try:
+            status, keep_alive = await asyncio.wait_for(
+                self._exchange(reader, writer, body, headers), self.timeout
+            )
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive and len(self.idle) < self.size:
+            self.idle.append(connection)
+        else:
+            writer.close()
+        return status
+
+    async def _exchange(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                        body: bytes, headers: Dict[str, str]) -> Tuple[int, bool]:
+        """Write the request, then read the status and skip the response body."""
+        head = [f"POST {self.path} HTTP/1.1", f"Host: {self.host_header}",
+                f"Content-Length: {len(body)}", "User-Agent: aemail"]
+        head += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed before the response")
+        version, status = status_line.decode('latin-1').split()[:2]
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and response_headers.get('connection', '').lower() != 'close'
+        if 'content-length' in response_headers:
+            await reader.readexactly(int(response_headers['content-length']))
+        elif response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await reader.read()
+            keep_alive = False
+        return int(status), keep_alive
+
+    def close(self):
+        """Close the idle connections."""
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+
+class WebhookDispatcher:
+    """
+    Pushes stored mail to webhook targets from a thread of its own.
+
+    Every target follows the change feed (see EmailData.get_changes) from
+    a cursor of its own. Stored messages are moved into the webhook_queue
+    table in batches, in the same transaction that advances the cursor,
+    and POSTed from there; a batch leaves the queue once the target
+    answered 2xx, and is otherwise retried with exponential backoff, also
+    after a restart. Delivery is therefore at least once: a batch sent
+    just before a crash is sent again.
+
+    Ingestion only wakes the dispatcher. Deliveries run on the
+    dispatcher's own event loop, at most 'concurrency' at a time per
+    target over pooled keep-alive connections, so a slow or failing
+    target never holds up the SMTP server or the other targets.
+    """
+
+    def __init__(self, data_store: EmailData, targets: List[WebhookTarget],
+                 linger: float = 0.05):
+        """
+        Initialize the dispatcher; deliveries begin with start.
+
+        Args:
+            data_store: EmailData instance whose mail is pushed
+            targets: Webhook targets
+            linger: Seconds to wait after mail is stored for more to batch with it
+        """
+        self.data_store = data_store
+        self.queries = data_store.queries
+        for name, sql in STATEMENTS.items():
+            self.queries.define(name, sql)
+        self.targets = {target.name: target for target in targets}
+        self.linger = linger
+        self.pools = {
+            target.name: ConnectionPool(target.url, target.concurrency, target.timeout)
+            for target in targets
+        }
+        self.counters = {
+            target.name: {
+                'batches': 0,
+                'messages': 0,
+                'failures': 0,
+                'dropped': 0,
+                'in_flight': 0,
+            }
+            for target in targets
+        }
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.thread: Optional[threading.Thread] = None
+        self._stored_event: Optional[asyncio.Event] = None
+        self._due: Dict[str, asyncio.Event] = {}
+        self._stopping: Optional[asyncio.Event] = None
+        self._started = threading.Event()
+
+    @classmethod
+    def from_config(cls, config: Config, data_store: EmailData) -> Optional['WebhookDispatcher']:
+        """Create a dispatcher for the [webhook:<name>] sections, or None if there are none."""
+        targets = [
+            WebhookTarget.from_config(config, section)
+            for section in config.config.sections() if section.startswith(SECTION_PREFIX)
+        ]
+        if not targets:
+            return None
+        linger = config.config.getfloat('webhooks', 'linger_ms', fallback=50.0) / 1000
+        return cls(data_store, targets, linger=linger)
+
+    def _stored(self, recipients: List[str]):
+        """Store listener: wake the dispatcher (called on the storing thread)."""
+        loop = self.loop
+        if loop is not None and self._stored_event is not None:
+            try:
+                loop.call_soon_threadsafe(self._stored_event.set)
+            except RuntimeError:
+                # The loop has stopped
+                pass
+
+    def _cursor(self, target: str) -> int:
+        """The target's position in the change feed; new targets start at its end."""
+        row = self.queries.fetch_one("webhook_cursor", (target,))
+        if row is not None:
+            return row[0]
+        seq = self.queries.fetch_one("webhook_latest_change")[0]
+        self.queries.execute("webhook_set_cursor", (target, seq))
+        return seq
+
+    def enqueue_pending(self) -> int:
+        """
+        Move the mail stored since each target's cursor into its queue.
+
+        Returns:
+            Number of batches queued
+        """
+        queued = 0
+        now = int(time.time())
+        for target in self.targets.values():
+            cursor = self._cursor(target.name)
+            batches = 0
+            while True:
+                rows = self.queries.fetch("webhook_changes", (cursor, target.batch_size), target.batch_size)
+                if not rows:
+                    break
+                msg_ids = [msg_id for _, op, msg_id in rows if op == 'insert']
+                cursor = rows[-1][0]
+                with self.queries.transaction():
+                    if msg_ids:
+                        self.queries.insert("webhook_enqueue", (target.name, json.dumps(msg_ids), now))
+                    self.queries.execute("webhook_set_cursor", (target.name, cursor))
+                if msg_ids:
+                    batches += 1
+            if batches and target.name in self._due:
+                self._due[target.name].set()
+            queued += batches
+        return queued
+
+    async def _follow(self):
+        """Queue new mail whenever some is stored."""
+        while not self._stopping.is_set():
+            self._stored_event.clear()
+            try:
+                self.enqueue_pending()
+            except Exception as e:
+                logger.error(f"Error queueing webhook batches: {e}")
+            waiter = asyncio.ensure_future(self._stored_event.wait())
+            stopper = asyncio.ensure_future(self._stopping.wait())
+            await asyncio.wait({waiter, stopper}, timeout=1.0, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            stopper.cancel()
+            # Mail stored right after tends to come in bursts; take it along
+            if self.linger and not self._stopping.is_set():
+                await asyncio.sleep(self.linger)
+
+    async def _deliver(self, target: WebhookTarget):
+        """Send the due batches of a target, at most 'concurrency' at a time."""
+        slots = asyncio.Semaphore(target.concurrency)
+        in_flight: Dict[int, asyncio.Task] = {}
+        due = self._due[target.name]
+        while not self._stopping.is_set():
+            due.clear()
+            try:
+                rows = self.queries.fetch(
+                    "webhook_due", (target.name, int(time.time()), target.concurrency * 2 + len(in_flight))
+                )
+            except Exception as e:
+                logger.error(f"Error reading the webhook queue of {target.name}: {e}")
+                rows = []
+            for batch_id, msg_ids, attempts in rows:
+                if batch_id in in_flight:
+                    continue
+                await slots.acquire()
+                if self._stopping.is_set():
+                    slots.release()
+                    break
+                task = asyncio.ensure_future(self._send(target, batch_id, json.loads(msg_ids), attempts))
+                in_flight[batch_id] = task
+                task.add_done_callback(lambda _, batch_id=batch_id: (
+                    in_flight.pop(batch_id, None), slots.release(), due.set()
+                ))
+
+            # Batches due now are in flight and wake the loop when done
+            try:
+                next_due = self.queries.fetch_one("webhook_next_due", (target.name,))[0]
+            except Exception:
+                next_due = None
+            now = time.time()
+            timeout = 1.0 if next_due is None or next_due <= now else min(next_due - now, 1.0)
+            waiter = asyncio.ensure_future(due.wait())
+            stopper = asyncio.ensure_future(self._stopping.wait())
+            await asyncio.wait({waiter, stopper}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            stopper.cancel()
+
+        if in_flight:
+            await asyncio.wait(list(in_flight.values()), timeout=target.timeout)
+
+    async def _send(self, target: WebhookTarget, batch_id: int, msg_ids: List[int], attempts: int):
+        """POST one batch, then remove it from the queue or schedule its retry."""
+        counters = self.counters[target.name]
+        counters['in_flight'] += 1
+        try:
+            messages = [m for m in map(self.data_store.get_message, msg_ids) if m is not None]
+            error = None
+            if messages:
+                body = json.dumps({"target": target.name, "batch": batch_id, "messages": messages},
+                                  ensure_ascii=False).encode('utf-8')
+                headers = {'Content-Type': 'application/json'}
+                if target.authorization:
+                    headers['Authorization'] = target.authorization
+                try:
+                    status = await self.pools[target.name].post(body, headers)
+                    if not 200 <= status < 300:
+                        error = f"HTTP {status}"
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+
+            if error is None:
+                self.queries.execute("webhook_delivered", (batch_id,))
+                counters['batches'] += 1
+                counters['messages'] += len(messages)
+                return
+
+            attempts += 1
+            counters['failures'] += 1
+            if attempts >= target.max_attempts:
+                logger.error(f"Dropping webhook batch {batch_id} for {target.name} "
+                             f"after {attempts} attempts: {error}")
+                self.queries.execute("webhook_delivered", (batch_id,))
+                counters['dropped'] += 1
+                return
+            logger.warning(f"Webhook batch {batch_id} for {target.name} failed ({error}), "
+                           f"retrying in {target.retry_delay(attempts):g}s")
+            self.queries.execute("webhook_retry", (
+                attempts, int(time.time() + target.retry_delay(attempts)), error, batch_id
+            ))
+        except Exception as e:
+            logger.error(f"Error delivering webhook batch {batch_id} for {target.name}: {e}")
+        finally:
+            counters['in_flight'] -= 1
+
+    async def _run(self):
+        """Follow the change feed and deliver until stopped."""
+        self._stored_event = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._due = {name: asyncio.Event() for name in self.targets}
+        self.loop = asyncio.get_running_loop()
+        self._started.set()
+        try:
+            await asyncio.gather(
+                self._follow(), *(self._deliver(target) for target in self.targets.values())
+            )
+        finally:
+            for pool in self.pools.values():
+                pool.close()
+
+    def start(self):
+        """Start delivering on a background thread."""
+        # Pin the cursors of new targets first, so mail stored from here on is sent
+        for name in self.targets:
+            self._cursor(name)
+        self.data_store.listeners.append(self._stored)
+        self.thread = threading.Thread(
+            target=asyncio.run, args=(self._run(),), name="aemail-webhooks", daemon=True
+        )
+        self.thread.start()
+        self._started.wait(5)
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Stop delivering; batches not yet delivered stay queued for the next start.
+
+        Args:
+            timeout: Seconds to wait for deliveries in progress
+        """
+        if self._stored in self.data_store.listeners:
+            self.data_store.listeners.remove(self._stored)
+        if self.loop is not None and self.thread is not None and self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self._stopping.set)
+            self.thread.join(timeout)
+        self.loop = None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Delivery counters and queue length per target.
+
+        Returns:
+            Dictionary of target name to its counters and 'queued' batches
+        """
+        stats = {}
+        for name, counters in self.counters.items():
+            stats[name] = dict(counters)
+            stats[name]['queued'] = self.queries.fetch_one("webhook_pending", (name,))[0]
+        return stats
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Benchmark the Flask and asyncio REST front ends side by side.
+
+Fills an in-memory database, starts each front end on a local port and
+drives it with concurrent keep-alive clients requesting mailbox pages.
+--idle first opens that many waiting connections: long polls on
+/to/<address>/wait for the asyncio front end, plain open connections for
+Flask (each holding a thread), which shows how many waiting clients each
+model carries while still answering. Prints requests per second and
+latency percentiles.
+
+Usage:
+    python benchmarks/bench_api.py --clients 50 --requests 200
+    python benchmarks/bench_api.py --clients 500 --idle 1000 --frontend async
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aemail.async_api import AsyncEmailAPI  # noqa: E402
+from aemail.data import EmailData  # noqa: E402
+from aemail.web_api import EmailAPI  # noqa: E402
+
+
+def free_port() -> int:
+    """Find a free local TCP port."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def fill(data: EmailData, count: int):
+    """Store count messages spread over 100 mailboxes."""
+    data.store_messages({
+        'from': 'bench@example.org',
+        'to': [f'user{i % 100}@example.com'],
+        'subject': f'Message {i}',
+        'content': f'Your code is {i:06d}.\n' + 'x' * 500,
+    } for i in range(count))
+
+
+async def get(reader, writer, path: str) -> tuple:
+    """Send one keep-alive GET and read the response; returns (status, keep_alive)."""
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length, keep_alive = 0, True
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+        elif name.lower() == 'connection':
+            keep_alive = value.strip().lower() == 'keep-alive'
+    await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def client(port: int, index: int, requests: int, latencies: list):
+    """Request mailbox pages, over one connection as long as the server keeps it open."""
+    writer = None
+    try:
+        for i in range(requests):
+            start = time.perf_counter()
+            if writer is None:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            status, keep_alive = await get(reader, writer, f'/to/user{(index + i) % 100}@example.com?limit=20')
+            if status != 200:
+                raise RuntimeError(f"status {status}")
+            if not keep_alive:
+                writer.close()
+                writer = None
+            latencies.append(time.perf_counter() - start)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def idle(port: int, frontend: str):
+    """Hold a connection open the way a waiting client would."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    if frontend == 'async':
+        writer.write(b"GET /to/nobody@example.com/wait?timeout=60 HTTP/1.1\r\nHost: bench\r\n\r\n")
+        await writer.drain()
+    # Flask has no long polling; an open connection already holds a thread
+    return writer
+
+
+def start_flask(data: EmailData, port: int):
+    """Start the Flask front end in a thread."""
+    api = EmailAPI(data)
+    server = api.bind('127.0.0.1', port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return lambda: api.shutdown(1)
+
+
+def start_async(data: EmailData, port: int):
+    """Start the asyncio front end on its own event loop thread."""
+    api = AsyncEmailAPI(data)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(api.start('127.0.0.1', port), loop).result()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(api.shutdown(1), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    return stop
+
+
+def run(frontend: str, data: EmailData, args) -> bool:
+    """Benchmark one front end and print its results."""
+    port = free_port()
+    stop = (start_async if frontend == 'async' else start_flask)(data, port)
+    latencies: list = []
+
+    async def load():
+        idlers = [await idle(port, frontend) for _ in range(args.idle)]
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            asyncio.wait_for(client(port, i, args.requests, latencies), args.timeout)
+            for i in range(args.clients)
+        ), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        for writer in idlers:
+            writer.close()
+        return elapsed, sum(isinstance(r, BaseException) for r in results)
+
+    try:
+        elapsed, failed = asyncio.run(load())
+    finally:
+        stop()
+
+    if latencies:
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        print(f"{frontend:5}: {len(latencies):,} requests by {args.clients} clients "
+              f"(+{args.idle} idle) in {elapsed:.2f}s = {len(latencies) / elapsed:,.0f} req/s, "
+              f"p50 {quantiles[49] * 1000:.1f} ms, p99 {quantiles[98] * 1000:.1f} ms, "
+              f"{failed} clients failed")
+    else:
+        print(f"{frontend:5}: no request completed, {failed} clients failed")
+    return failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--frontend', choices=('flask', 'async', 'both'), default='both')
+    parser.add_argument('--clients', type=int, default=50, help='concurrent keep-alive clients')
+    parser.add_argument('--requests', type=int, default=200, help='requests per client')
+    parser.add_argument('--idle', type=int, default=0, help='idle (waiting) connections held open')
+    parser.add_argument('--messages', type=int, default=10000, help='messages in the database')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds a client may take')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    data = EmailData()
+    fill(data, args.messages)
+    frontends = ('flask', 'async') if args.frontend == 'both' else (args.frontend,)
+    ok = all([run(frontend, data, args) for frontend in frontends])
+    data.close()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark the SMTP ingest path: handle_RCPT plus storage.
+
+Drives SMTPHandler directly (no sockets) so the numbers reflect recipient
+normalization, message processing and the SQLite insert only.
+
+Usage:
+    python benchmarks/bench_ingest.py --messages 20000 --recipients 3
+    python benchmarks/bench_ingest.py --db-file /tmp/bench.db
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aemail.data import EmailData  # noqa: E402
+from aemail.email_handler import SMTPHandler  # noqa: E402
+from aemail.utils import AddressNormalizer  # noqa: E402
+
+
+class Envelope:
+    """Minimal stand-in for aiosmtpd's Envelope."""
+
+    def __init__(self):
+        self.mail_from = 'Sender@Example.COM'
+        self.rcpt_tos = []
+        self.content = b''
+
+
+def build_payload() -> bytes:
+    """Build a representative multipart message."""
+    message = EmailMessage()
+    message['From'] = 'Sender@Example.COM'
+    message['To'] = 'User@Example.COM'
+    message['Subject'] = 'Your verification code'
+    message.set_content('Your code is 123456.\n' * 20)
+    message.add_alternative('<p>Your code is <b>123456</b>.</p>' * 20, subtype='html')
+    return message.as_bytes()
+
+
+async def run(handler: SMTPHandler, messages: int, recipients: int, payload: bytes):
+    """Run the ingest loop and return (rcpt_seconds, total_seconds)."""
+    rcpt_time = 0.0
+    start = time.perf_counter()
+    for i in range(messages):
+        envelope = Envelope()
+        envelope.content = payload
+
+        rcpt_start = time.perf_counter()
+        for r in range(recipients):
+            await handler.handle_RCPT(None, None, envelope, f'User.{i % 1000}+{r}@Example.COM', [])
+        rcpt_time += time.perf_counter() - rcpt_start
+
+        await handler.handle_DATA(None, None, envelope)
+    return rcpt_time, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--recipients', type=int, default=1)
+    parser.add_argument('--db-file', type=str, default=None,
+                        help='database file (default: temporary file)')
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_file = args.db_file or os.path.join(temp_dir, 'bench.db')
+        data = EmailData(db_file, normalizer=AddressNormalizer(['example.com'], ['example.com']))
+        handler = SMTPHandler(data)
+
+        rcpt_time, total = asyncio.run(run(handler, args.messages, args.recipients, build_payload()))
+        rcpts = args.messages * args.recipients
+
+        lookup_start = time.perf_counter()
+        for i in range(1000):
+            data.get_messages_to(f'USER.{i}@example.com', limit=1)
+        lookup_time = time.perf_counter() - lookup_start
+
+        print(f"messages:        {args.messages}")
+        print(f"handle_RCPT:     {rcpts / rcpt_time:,.0f} rcpt/s")
+        print(f"ingest (stored): {args.messages / total:,.0f} msg/s")
+        print(f"canonical /to:   {1000 / lookup_time:,.0f} lookups/s")
+        data.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Benchmark the EmailData lookups on a large synthetic mailbox.
+
+Fills a database with synthetic rows (1M by default), prints the query
+plan of every lookup and times it. Exits non-zero if any lookup scans the
+msg table or sorts in a temporary B-tree (see tests/test_query_plans.py),
+or if any lookup takes longer than --budget-ms on average.
+
+Usage:
+    python benchmarks/bench_queries.py --rows 1000000
+    python benchmarks/bench_queries.py --db-file /tmp/queries.db --repeat 500
+    python benchmarks/bench_queries.py --budget-ms 5
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aemail.data import INSERT_MSG, EmailData  # noqa: E402
+from tests.test_query_plans import offending_steps, query_plan  # noqa: E402
+
+
+def fill(data: EmailData, rows: int, mailboxes: int, senders: int):
+    """Insert synthetic messages spread over a year."""
+    now = int(time.time())
+    rng = random.Random(42)
+    batch = []
+    for i in range(rows):
+        to0 = f'user{rng.randrange(mailboxes)}@example.com'
+        frm = f'sender{rng.randrange(senders)}@example.org'
+        batch.append((
+            frm, to0, f'["{to0}"]', f'Your code {i}', f'Your code is {i:06d}.',
+            now - rng.randrange(365 * 86400), frm, to0, None, None, 64
+        ))
+        if len(batch) == 50000:
+            data.conn.executemany(INSERT_MSG, batch)
+            batch = []
+    if batch:
+        data.conn.executemany(INSERT_MSG, batch)
+    # One recipient per message, filed the way store_message files it
+    data.conn.execute(
+        "INSERT OR IGNORE INTO mailbox (address, created_at, msg_id) "
+        "SELECT to0_canon, created_at, id FROM msg"
+    )
+    # A Message-ID per message and a test run id per hundred
+    data.conn.execute(
+        "INSERT INTO msg_header (name, value, msg_id) "
+        "SELECT 'message-id', id || '@example.org', id FROM msg"
+    )
+    data.conn.execute(
+        "INSERT INTO msg_header (name, value, msg_id) "
+        "SELECT 'x-test-run-id', 'run' || (id / 100), id FROM msg"
+    )
+    data.conn.commit()
+    data.conn.execute("ANALYZE")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--mailboxes', type=int, default=10_000)
+    parser.add_argument('--senders', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='fail if a lookup averages more than this many milliseconds')
+    parser.add_argument('--db-file', type=str, default=None,
+                        help='database file (default: temporary file)')
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_file = args.db_file or os.path.join(temp_dir, 'queries.db')
+        data = EmailData(db_file)
+        if data.get_message_count() < args.rows:
+            start = time.perf_counter()
+            fill(data, args.rows - data.get_message_count(), args.mailboxes, args.senders)
+            print(f"filled {args.rows:,} rows in {time.perf_counter() - start:.1f}s")
+
+        now = int(time.time())
+        day_ago, week_ago = now - 86400, now - 7 * 86400
+        lookups = {
+            'to (summary)': lambda i: data.get_messages_to(f'user{i % args.mailboxes}@example.com', summary=True),
+            'to (full)': lambda i: data.get_messages_to(f'user{i % args.mailboxes}@example.com'),
+            'to page 3': lambda i: data.get_messages_to(f'user{i % args.mailboxes}@example.com', offset=40),
+            'from (summary)': lambda i: data.get_messages_from(f'sender{i % args.senders}@example.org', summary=True),
+            'all (summary)': lambda i: data.get_all_messages(offset=i % 100, summary=True),
+            'count': lambda i: data.get_message_count(),
+            'count to': lambda i: data.get_message_count(recipient=f'user{i % args.mailboxes}@example.com'),
+            'unread to': lambda i: data.get_messages_to(f'user{i % args.mailboxes}@example.com', unread=True),
+            'count from': lambda i: data.get_message_count(sender=f'sender{i % args.senders}@example.org'),
+            'message': lambda i: data.get_message(1 + i * 997 % args.rows),
+            'search to+from': lambda i: data.search_messages(
+                recipient=f'user{i % args.mailboxes}@example.com', sender=f'sender{i % args.senders}@example.org'),
+            'search from+subj': lambda i: data.search_messages(
+                sender=f'sender{i % args.senders}@example.org', subject='Your code 1', summary=True),
+            'search domain': lambda i: data.search_messages(domain='example.com', offset=i % 100, summary=True),
+            'search to+week': lambda i: data.search_messages(
+                recipient=f'user{i % args.mailboxes}@example.com', since=week_ago),
+            'search from+day': lambda i: data.search_messages(
+                sender=f'sender{i % args.senders}@example.org', since=day_ago, until=now),
+            'search day': lambda i: data.search_messages(since=day_ago - i * 60, until=now, summary=True),
+            'search subj': lambda i: data.search_messages(subject=f'Your code {i % 1000}', summary=True),
+            'header msgid': lambda i: data.get_messages_by_header('Message-ID', f'<{1 + i * 997 % args.rows}@example.org>'),
+            'changes': lambda i: data.get_changes(after=i * 997 % args.rows, summary=True),
+            'header run': lambda i: data.get_messages_by_header('X-Test-Run-Id', f'run{i % 1000}', summary=True),
+        }
+
+        failed = False
+        print(f"{'lookup':<16} {'ms/op':>8}  plan")
+        for name, lookup in lookups.items():
+            statements = []
+            data.conn.set_trace_callback(statements.append)
+            lookup(0)
+            data.conn.set_trace_callback(None)
+
+            start = time.perf_counter()
+            for i in range(args.repeat):
+                lookup(i)
+            elapsed = (time.perf_counter() - start) / args.repeat * 1000
+
+            plans = []
+            for sql in statements:
+                plan = query_plan(data, sql)
+                if offending_steps(sql, plan):
+                    failed = True
+                    plans.append('!! ' + '; '.join(plan))
+                else:
+                    plans.append('; '.join(plan))
+            over = args.budget_ms is not None and elapsed > args.budget_ms
+            failed = failed or over
+            print(f"{name:<16} {elapsed:>8.3f}{'!' if over else ' '} {' | '.join(plans)}")
+
+        data.close()
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
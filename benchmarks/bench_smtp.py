@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Benchmark SMTP ingestion with many messages per session.
+
+Starts the SMTP server on a local port and drives it with concurrent
+sessions, each delivering a run of messages, in one of three styles:
+lock-step DATA (one command per round trip, like smtplib), pipelined
+DATA (RFC 2920), or pipelined BDAT chunks (RFC 3030). Prints messages per
+second and the peak resident memory of the process, which includes the
+server. --stock runs the same load against aiosmtpd's own SMTP class
+for comparison.
+
+Usage:
+    python benchmarks/bench_smtp.py --mode pipelined --sessions 8 --messages 500
+    python benchmarks/bench_smtp.py --mode bdat --size 5000000 --messages 5
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aiosmtpd.controller import Controller  # noqa: E402
+from aiosmtpd.smtp import SMTP  # noqa: E402
+
+from aemail.data import EmailData  # noqa: E402
+from aemail.email_handler import SMTPHandler  # noqa: E402
+from aemail.protocol import SMTPProfile, SMTPProtocol  # noqa: E402
+
+
+def build_message(index: int, size: int) -> bytes:
+    """A message of roughly size bytes with CRLF lines of 76 characters."""
+    header = (
+        f"From: bench@example.org\r\nTo: user{index % 100}@example.com\r\n"
+        f"Subject: Message {index}\r\n\r\nYour code is {index:06d}.\r\n"
+    ).encode()
+    lines = max(0, size - len(header)) // 78
+    return header + (b'x' * 76 + b'\r\n') * lines
+
+
+async def read_replies(reader: asyncio.StreamReader, count: int):
+    """Read count replies and fail on any error code."""
+    for _ in range(count):
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError('connection closed')
+            if line[3:4] == b' ':
+                break
+        if line[:1] not in (b'2', b'3'):
+            raise RuntimeError(f"server replied {line!r}")
+
+
+async def session(port: int, mode: str, messages: int, size: int, chunk: int):
+    """Deliver messages over one SMTP session."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port, limit=2 ** 20)
+    await read_replies(reader, 1)
+    writer.write(b'EHLO bench\r\n')
+    await read_replies(reader, 1)
+
+    for i in range(messages):
+        body = build_message(i, size)
+        envelope = b'MAIL FROM:<bench@example.org>\r\nRCPT TO:<user%d@example.com>\r\n' % (i % 100)
+        if mode == 'lockstep':
+            for command in envelope.split(b'\r\n')[:2]:
+                writer.write(command + b'\r\n')
+                await read_replies(reader, 1)
+            writer.write(b'DATA\r\n')
+            await read_replies(reader, 1)
+            writer.write(body + b'.\r\n')
+            await read_replies(reader, 1)
+        elif mode == 'pipelined':
+            writer.write(envelope + b'DATA\r\n')
+            await read_replies(reader, 3)
+            writer.write(body + b'.\r\n')
+            await read_replies(reader, 1)
+        else:
+            writer.write(envelope)
+            chunks = [body[j:j + chunk] for j in range(0, len(body), chunk)] or [b'']
+            for j, part in enumerate(chunks):
+                last = b' LAST' if j == len(chunks) - 1 else b''
+                writer.write(b'BDAT %d%s\r\n' % (len(part), last) + part)
+            await read_replies(reader, 2 + len(chunks))
+
+    writer.write(b'QUIT\r\n')
+    await read_replies(reader, 1)
+    writer.close()
+
+
+def free_port() -> int:
+    """Find a free local TCP port."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--mode', choices=('lockstep', 'pipelined', 'bdat'), default='pipelined')
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=250, help='messages per session')
+    parser.add_argument('--size', type=int, default=4000, help='message size in bytes')
+    parser.add_argument('--chunk', type=int, default=256 * 1024, help='BDAT chunk size')
+    parser.add_argument('--spool-threshold', type=int, default=1024 * 1024)
+    parser.add_argument('--stock', action='store_true', help="use aiosmtpd's SMTP class")
+    args = parser.parse_args()
+
+    if args.stock and args.mode == 'bdat':
+        parser.error('aiosmtpd does not implement BDAT')
+    logging.disable(logging.INFO)
+
+    data = EmailData()
+    handler = SMTPHandler(data)
+    profile = SMTPProfile(data_size_limit=max(args.size * 2, 32 * 1024 * 1024),
+                          spool_threshold=args.spool_threshold)
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    if args.stock:
+        controller.factory = lambda: SMTP(handler, enable_SMTPUTF8=True,
+                                          data_size_limit=profile.data_size_limit)
+    else:
+        controller.factory = lambda: SMTPProtocol(handler, profile=profile, enable_SMTPUTF8=True)
+    controller.start()
+
+    async def run():
+        await asyncio.gather(*(
+            session(controller.port, args.mode, args.messages, args.size, args.chunk)
+            for _ in range(args.sessions)
+        ))
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    try:
+        asyncio.run(run())
+    finally:
+        elapsed = time.perf_counter() - start
+        controller.stop()
+
+    total = args.sessions * args.messages
+    stored = data.get_message_count()
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    server = 'aiosmtpd' if args.stock else 'aemail'
+    print(f"{server} {args.mode}: {stored}/{total} messages of {args.size:,} bytes "
+          f"in {elapsed:.2f}s = {total / elapsed:,.0f} msg/s")
+    print(f"peak RSS {rss_peak / 1024:.1f} MiB (+{(rss_peak - rss_before) / 1024:.1f} MiB)")
+    if not args.stock:
+        print(f"smtp counters: {profile.stats()}")
+    data.close()
+    sys.exit(0 if stored == total else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""
+Tests for the asyncio REST front end.
+"""
+
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from aemail.async_api import AsyncEmailAPI
+from aemail.compression import ResponseCompressor
+from aemail.data import EmailData
+
+
+def message(recipient: str, subject: str = 'Hello') -> dict:
+    return {
+        'from': 'sender@example.com',
+        'to': [recipient],
+        'subject': subject,
+        'content': f'{subject}\nYour code is 123456',
+    }
+
+
+@pytest.fixture
+async def api():
+    data = EmailData()
+    data.store_message(message('user@example.com', 'First'))
+    api = AsyncEmailAPI(data, compressor=ResponseCompressor(min_size=64))
+    await api.start('127.0.0.1', 0)
+    yield api
+    await api.shutdown(1)
+    data.close()
+
+
+async def request(api: AsyncEmailAPI, path: str, headers: str = '', connection=None,
+                  method: str = 'GET'):
+    """Send one request; returns (status, headers, body, connection)."""
+    if connection is None:
+        port = api.listening_socket().getsockname()[1]
+        connection = await asyncio.open_connection('127.0.0.1', port)
+    reader, writer = connection
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: test\r\n{headers}\r\n".encode())
+    status = int((await reader.readline()).split()[1])
+    response_headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode().partition(':')
+        response_headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(response_headers.get('content-length', 0)))
+    return status, response_headers, body, connection
+
+
+class TestAsyncEmailAPI:
+    """Test the routes match the Flask API."""
+
+    async def test_mailbox_routes(self, api):
+        """Test lists, messages and tokens over one keep-alive connection."""
+        status, _, body, connection = await request(api, '/to/USER@example.com?view=summary')
+        assert status == 200
+        page = json.loads(body)
+        assert page['pagination']['total'] == 1
+        assert page['messages'][0]['subject'] == 'First'
+
+        msg_id = page['messages'][0]['id']
+        status, _, body, _ = await request(api, f'/message/{msg_id}', connection=connection)
+        assert status == 200 and json.loads(body)['parts'] == ['text']
+
+        status, headers, body, _ = await request(api, f'/message/{msg_id}?part=text',
+                                                 connection=connection)
+        assert status == 200 and headers['content-type'].startswith('text/plain')
+        status, _, _, _ = await request(api, f'/message/{msg_id}?part=text',
+                                        f"If-None-Match: {headers['etag']}\r\n", connection)
+        assert status == 304
+
+        status, _, body, _ = await request(api, '/to/user@example.com/latest-code',
+                                           connection=connection)
+        assert status == 404  # No extractor configured
+        for path, expected in (('/message/999', 404), ('/message/x', 404), ('/nowhere', 404),
+                               ('/all?limit=x', 400), ('/health', 200), ('/from/sender@example.com', 200),
+                               ('/messages?since=yesterday', 400)):
+            status, _, _, _ = await request(api, path, connection=connection)
+            assert status == expected, path
+        connection[1].close()
+
+    async def test_search(self, api):
+        """Test the filtered message list and the statistics."""
+        status, _, body, connection = await request(
+            api, '/messages?from=sender@example.com&domain=EXAMPLE.com&since=2000-01-01T00:00:00&view=summary')
+        assert status == 200
+        page = json.loads(body)
+        assert [m['subject'] for m in page['messages']] == ['First']
+        assert page['pagination']['has_more'] is False
+        status, _, body, _ = await request(api, '/messages?subject=Second', connection=connection)
+        assert json.loads(body)['messages'] == []
+
+        status, _, body, _ = await request(api, '/stats?by=sender', connection=connection)
+        assert json.loads(body) == {
+            'by': 'sender', 'stats': [{'sender': 'sender@example.com', 'messages': 1, 'bytes': 25}]
+        }
+        status, _, _, _ = await request(api, '/stats?by=subject', connection=connection)
+        assert status == 400
+
+        status, _, body, _ = await request(api, '/header/Message-ID/%3Cnone@example.com%3E',
+                                           connection=connection)
+        assert status == 200 and json.loads(body)['messages'] == []
+        status, _, _, _ = await request(api, '/header/Message-ID', connection=connection)
+        assert status == 404
+
+        status, _, body, _ = await request(api, '/changes?after=0&view=summary', connection=connection)
+        page = json.loads(body)
+        assert [(c['seq'], c['op'], c['message']['subject']) for c in page['changes']] == [(1, 'insert', 'First')]
+        assert (page['next'], page['has_more']) == (1, False)
+        status, _, body, _ = await request(api, '/changes?after=1', connection=connection)
+        assert json.loads(body) == {'changes': [], 'next': 1, 'has_more': False}
+        status, _, _, _ = await request(api, '/changes?after=-1', connection=connection)
+        assert status == 400
+        connection[1].close()
+
+    async def test_read_state(self, api):
+        """Test marking a mailbox read and listing unread mail."""
+        status, _, body, connection = await request(api, '/to/user@example.com')
+        assert json.loads(body)['pagination']['unread'] == 1
+
+        status, _, body, _ = await request(api, '/to/user@example.com/read', connection=connection,
+                                           method='POST')
+        assert status == 200 and json.loads(body) == {'updated': 1, 'unread': 0}
+        status, _, body, _ = await request(api, '/to/user@example.com?unread=1', connection=connection)
+        page = json.loads(body)
+        assert page['messages'] == [] and page['pagination']['total'] == 0
+
+        status, _, body, _ = await request(api, '/to/user@example.com/unread?id=1', connection=connection,
+                                           method='POST')
+        assert json.loads(body) == {'updated': 1, 'unread': 1}
+        status, _, _, _ = await request(api, '/to/user@example.com/read?id=x', connection=connection,
+                                        method='POST')
+        assert status == 400
+        status, _, _, _ = await request(api, '/all', connection=connection, method='POST')
+        assert status == 405
+        connection[1].close()
+
+    async def test_compression(self, api):
+        """Test JSON responses are compressed like the Flask API's."""
+        status, headers, body, connection = await request(api, '/all', 'Accept-Encoding: gzip\r\n')
+        assert status == 200
+        assert headers['content-encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(body))['pagination']['total'] == 1
+        connection[1].close()
+
+    async def test_wait_for_mail(self, api):
+        """Test a long poll is answered as soon as mail to the mailbox is stored."""
+        waiting = asyncio.ensure_future(request(api, '/to/new@example.com/wait?timeout=10'))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+
+        # Mail to other mailboxes does not answer it
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, api.data.data_store.store_message, message('other@example.com'))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+
+        await loop.run_in_executor(None, api.data.data_store.store_message, message('New@example.com', 'Welcome'))
+        status, _, body, connection = await asyncio.wait_for(waiting, 5)
+        assert status == 200
+        assert [m['subject'] for m in json.loads(body)['messages']] == ['Welcome']
+        assert not api.data._waiters
+        connection[1].close()
+
+    async def test_wait_store_during_lookup(self, api):
+        """Test mail stored while a long poll looks the mailbox up still answers it."""
+        data_store = api.data.data_store
+        lookup = data_store.get_messages_to
+        stored = []
+
+        def lookup_then_store(recipient, **kwargs):
+            messages = lookup(recipient, **kwargs)
+            if kwargs.get('limit') == 100 and not stored:
+                # Lands after the lookup, before the long poll starts waiting
+                stored.append(data_store.store_message(message('late@example.com', 'Late')))
+            return messages
+
+        data_store.get_messages_to = lookup_then_store
+        status, _, body, connection = await asyncio.wait_for(
+            request(api, '/to/late@example.com/wait?after=0&timeout=10'), 2
+        )
+        assert status == 200
+        assert [m['subject'] for m in json.loads(body)['messages']] == ['Late']
+        connection[1].close()
+
+    async def test_wait_timeout(self, api):
+        """Test a long poll without mail returns an empty list."""
+        status, _, body, connection = await request(api, '/to/user@example.com/wait?timeout=0.1')
+        assert status == 200 and json.loads(body)['messages'] == []
+
+        # Earlier mail is returned right away with ?after=
+        status, _, body, _ = await request(api, '/to/user@example.com/wait?after=0',
+                                           connection=connection)
+        assert [m['subject'] for m in json.loads(body)['messages']] == ['First']
+        connection[1].close()
+
+    async def test_shutdown_answers_waiters(self, api):
+        """Test shutdown ends pending long polls instead of cutting them off."""
+        waiting = asyncio.ensure_future(request(api, '/to/new@example.com/wait?timeout=30'))
+        await asyncio.sleep(0.1)
+        await api.shutdown(5)
+        status, headers, body, connection = await asyncio.wait_for(waiting, 5)
+        assert status == 200 and json.loads(body)['messages'] == []
+        assert headers['connection'] == 'close'
+        connection[1].close()
@@ -0,0 +1,130 @@
+"""
+Tests for the memory budget of the in-memory database.
+"""
+
+import datetime
+import logging
+from pathlib import Path
+
+import pytest
+
+from aemail.budget import MemoryBudget
+from aemail.cache import MessageCache
+from aemail.config import Config
+from aemail.data import EmailData
+from aemail.web_api import EmailAPI
+
+
+BUDGET = 256 * 1024
+
+
+def message(i: int) -> dict:
+    return {'from': 'ci@example.org', 'to': [f'run{i % 4}@example.com'],
+            'subject': f'Build {i}', 'content': f'Build {i} log\n' + 'x' * 4000}
+
+
+class TestMemoryBudget:
+    """Test the in-memory database stays within its budget."""
+
+    def test_evict(self):
+        """Test the oldest messages are evicted once the budget is exceeded."""
+        data = EmailData(budget=MemoryBudget(BUDGET))
+        for i in range(200):
+            data.store_message(message(i))
+
+        status = data.storage_status()
+        assert status['mode'] == 'memory'
+        assert status['bytes'] <= BUDGET
+        assert status['bytes'] == (status['page_count'] - status['freelist_count']) * status['page_size']
+        evicted = status['budget']['evicted']
+        assert status['budget']['evictions'] >= 1 and evicted > 0
+
+        # The newest messages are kept, the oldest are gone, and counts agree
+        assert data.get_message_count() == 200 - evicted
+        assert data.get_message(1) is None
+        assert data.get_message(200)['subject'] == 'Build 199'
+        assert data.get_messages_to('run3@example.com', limit=1)[0]['subject'] == 'Build 199'
+        assert sum(data.get_message_count(recipient=f'run{i}@example.com') for i in range(4)) \
+            == 200 - evicted
+        # The feed keeps the last pass's deletions, not the history of evicted mail
+        changes = data.get_changes(limit=1000)
+        assert [c['id'] for c in changes if c['op'] == 'insert'] == list(range(evicted + 1, 201))
+        assert 0 < len([c for c in changes if c['op'] == 'delete']) < evicted
+        data.close()
+
+    def test_evict_many_addresses(self):
+        """Test mail to and from distinct addresses is evicted with its bookkeeping."""
+        data = EmailData(budget=MemoryBudget(BUDGET), cache=MessageCache())
+        for i in range(3000):
+            data.store_message({'from': f'sender{i}@example.org', 'to': [f'user{i}@example.com'],
+                                'subject': f'Welcome {i}', 'content': 'Your code is 123456',
+                                'date': datetime.datetime(2024, 1, 1) + datetime.timedelta(hours=i)})
+            if i == 100:
+                assert data.get_messages_to('user100@example.com')[0]['subject'] == 'Welcome 100'
+
+        status = data.storage_status()
+        assert status['bytes'] <= BUDGET
+        live = data.get_message_count()
+        assert live == 3000 - status['budget']['evicted'] and live > 100
+        # Emptied mailboxes, rollup hours and change entries go with the messages
+        conn = data.conn
+        assert conn.execute("SELECT COUNT(*) FROM mailbox_stats").fetchone()[0] == live
+        assert conn.execute("SELECT COUNT(*) FROM msg_rollup WHERE kind = 'sender'").fetchone()[0] == live
+        assert conn.execute("SELECT COUNT(*) FROM msg_change WHERE op = 'insert'").fetchone()[0] == live
+        # The cache forgot the evicted mailboxes only
+        assert data.get_messages_to('user100@example.com') == []
+        assert data.get_messages_to('user2999@example.com')[0]['subject'] == 'Welcome 2999'
+        data.close()
+
+    def test_evict_gives_up(self, caplog):
+        """Test a budget eviction cannot reach is reported rather than emptying the table."""
+        data = EmailData(budget=MemoryBudget(4096))
+        with caplog.at_level(logging.WARNING, logger='aemail.data'):
+            for i in range(5):
+                data.store_message(message(i))
+
+        assert data.get_message_count() >= 1
+        assert data.get_message(5)['subject'] == 'Build 4'
+        assert len([r for r in caplog.records if 'Evicting cannot' in r.getMessage()]) == 1
+        data.close()
+
+    def test_spill(self, tmp_path):
+        """Test an over-budget database moves to a temporary file and stays queryable."""
+        data = EmailData(budget=MemoryBudget(BUDGET, overflow='spill', spill_dir=str(tmp_path)))
+        for i in range(200):
+            data.store_message(message(i))
+
+        status = data.storage_status()
+        assert status['mode'] == 'spilled'
+        assert status['budget']['spills'] == 1 and status['budget']['evicted'] == 0
+        spill_path = Path(data.spill_path)
+        assert spill_path.parent == tmp_path and spill_path.stat().st_size > BUDGET
+
+        assert data.get_message_count() == 200
+        assert data.get_message(1)['subject'] == 'Build 0'
+        assert len(data.get_messages_to('run0@example.com', limit=100)) == 50
+        data.close()
+        assert not spill_path.exists()
+
+    def test_from_config(self):
+        """Test the [memory] section configures the budget, and a file database ignores it."""
+        config = Config('/nonexistent.ini')
+        assert MemoryBudget.from_config(config) is None
+
+        config.config.read_string("[memory]\nmax_mb = 1.5\noverflow = spill\n")
+        budget = MemoryBudget.from_config(config)
+        assert (budget.max_bytes, budget.overflow, budget.spill_dir) == (1572864, 'spill', None)
+        with pytest.raises(ValueError):
+            MemoryBudget(BUDGET, overflow='drop')
+
+    def test_health(self):
+        """Test /health reports the database size and the budget."""
+        data = EmailData(budget=MemoryBudget(BUDGET))
+        data.store_message(message(0))
+        client = EmailAPI(data).app.test_client()
+
+        storage = client.get('/health').get_json()['storage']
+        assert storage['mode'] == 'memory'
+        assert 0 < storage['bytes'] <= BUDGET
+        assert storage['budget']['max_bytes'] == BUDGET
+        data.close()
@@ -0,0 +1,157 @@
+"""
+Tests for the hot-message cache.
+"""
+
+import threading
+
+from aemail.cache import MessageCache
+from aemail.data import EmailData
+
+
+def message(to: str, subject: str, sender: str = 'noreply@example.com') -> dict:
+    """Build a message dictionary."""
+    return {'from': sender, 'to': [to], 'subject': subject, 'content': f'Body of {subject}'}
+
+
+class TestMessageCache:
+    """Test cached mailbox reads."""
+
+    def test_write_through_first_read(self):
+        """Test a message read right after it lands never touches the database."""
+        cache = MessageCache()
+        data = EmailData(cache=cache)
+        data.store_message(message('fresh@example.com', 'Code 1'))
+
+        issued = []
+        data.conn.set_trace_callback(issued.append)
+        messages = data.get_messages_to('Fresh@Example.com')
+        count = data.get_message_count(recipient='fresh@example.com')
+        single = data.get_message(messages[0]['id'], summary=True)
+        data.conn.set_trace_callback(None)
+
+        assert issued == []
+        assert [m['subject'] for m in messages] == ['Code 1']
+        assert count == 1
+        assert single['size'] > 0 and 'content' not in single
+        assert cache.stats()['hits'] == 1
+        data.close()
+
+    def test_matches_database(self):
+        """Test cached pages equal uncached ones as mail keeps arriving."""
+        cache = MessageCache(per_mailbox=5)
+        cached = EmailData(cache=cache)
+        plain = EmailData()
+
+        for i in range(12):
+            for data in (cached, plain):
+                data.store_message(message('busy@example.com', f'S{i}'))
+            for summary in (False, True):
+                for offset in (0, 3):
+                    assert (cached.get_messages_to('busy@example.com', limit=3, offset=offset, summary=summary)
+                            == plain.get_messages_to('busy@example.com', limit=3, offset=offset, summary=summary))
+            assert cached.get_message_count(sender='noreply@example.com') == i + 1
+
+        # Pages past the cached window come from the database
+        assert len(cached.get_messages_to('busy@example.com', limit=10)) == 10
+        assert cache.stats()['misses'] > 0
+        cached.close()
+        plain.close()
+
+    def test_fill_before_add(self):
+        """Test a message a concurrent read already cached is not added twice."""
+        data = EmailData(cache=MessageCache())
+        data.store_message(message('race@example.com', 'First'))
+        data.cache.invalidate(('to', 'race@example.com'))
+        data.get_messages_to('race@example.com')
+        stored = data.get_message(1)
+
+        data.cache.add(('to', 'race@example.com'), stored, 0, 10)
+        assert data.cache.count(('to', 'race@example.com')) == 1
+        assert len(data.get_messages_to('race@example.com')) == 1
+        data.close()
+
+    def test_store_during_fill(self):
+        """Test a message stored between a fill's read and the fill is not lost."""
+        data = EmailData(cache=MessageCache())
+        data.store_message(message('race@example.com', 'First'))
+        data.cache.invalidate(('to', 'race@example.com'))
+
+        count = data._count
+        writers = []
+
+        def count_then_store(name, address):
+            total = count(name, address)
+            if not writers:
+                writer = threading.Thread(
+                    target=data.store_message, args=(message('race@example.com', 'Second'),)
+                )
+                writers.append(writer)
+                writer.start()
+                # Gives the store every chance to land before the fill
+                writer.join(timeout=0.5)
+            return total
+
+        data._count = count_then_store
+        data.get_messages_to('race@example.com')
+        writers[0].join()
+        data._count = count
+
+        assert [m['subject'] for m in data.get_messages_to('race@example.com')] == ['Second', 'First']
+        assert data.get_message_count(recipient='race@example.com') == 2
+        data.close()
+
+    def test_many_recipients(self):
+        """Test storing to many uncached mailboxes looks them up in one query."""
+        data = EmailData(cache=MessageCache())
+        recipients = [f'user{i}@example.com' for i in range(200)]
+        data.store_message({'from': 'a@example.com', 'to': recipients[:100],
+                            'subject': 'Hi', 'content': 'x'})
+
+        issued = []
+        data.conn.set_trace_callback(issued.append)
+        data.store_message({'from': 'a@example.com', 'to': recipients,
+                            'subject': 'Hi again', 'content': 'x'})
+        data.conn.set_trace_callback(None)
+
+        assert len([sql for sql in issued if 'mailbox_stats' in sql and sql.startswith('SELECT')]) == 1
+        # The first hundred were cached by their first message, the others start with this one
+        assert data.cache.count(('to', 'user0@example.com')) == 2
+        assert data.cache.count(('to', 'user150@example.com')) == 1
+        data.close()
+
+    def test_returned_copies(self):
+        """Test callers cannot modify cached messages."""
+        data = EmailData(cache=MessageCache())
+        data.store_message(message('a@example.com', 'Original'))
+
+        first = data.get_messages_to('a@example.com')[0]
+        first['subject'] = 'Changed'
+        first['to'].append('x@example.com')
+
+        again = data.get_messages_to('a@example.com')[0]
+        assert again['subject'] == 'Original'
+        assert again['to'] == ['a@example.com']
+        data.close()
+
+    def test_eviction(self):
+        """Test mailbox and memory bounds evict the least recently used mailboxes."""
+        cache = MessageCache(max_mailboxes=4, per_mailbox=2)
+        data = EmailData(cache=cache)
+        for i in range(6):
+            data.store_message(message(f'user{i}@example.com', 'Hi', sender=f's{i}@example.com'))
+
+        stats = cache.stats()
+        assert stats['mailboxes'] == 4
+        assert stats['evictions'] == 8
+        assert cache.count(('to', 'user5@example.com')) == 1
+        assert cache.count(('to', 'user0@example.com')) is None
+
+        small = MessageCache(max_bytes=2000)
+        small.fill(('to', 'big@example.com'), [
+            ({'id': i, 'from': 'a', 'to0': 'b', 'to': ['b'], 'subject': 's',
+              'content': 'x' * 1000, 'time': None}, i, 1000)
+            for i in range(3, 0, -1)
+        ], 3)
+        assert small.stats()['mailboxes'] == 0
+        assert small.stats()['bytes'] == 0
+        data.close()
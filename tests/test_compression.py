@@ -0,0 +1,87 @@
+"""
+Tests for response compression.
+"""
+
+import gzip
+from pathlib import Path
+
+from aemail.compression import ResponseCompressor, StaticAsset, negotiate_encoding
+from aemail.data import EmailData
+from aemail.web_api import EmailAPI
+
+
+class TestNegotiation:
+    """Test Accept-Encoding negotiation."""
+
+    def test_negotiate_encoding(self):
+        """Test quality values and wildcards are honoured."""
+        assert negotiate_encoding(None) is None
+        assert negotiate_encoding('identity') is None
+        assert negotiate_encoding('gzip, deflate') == 'gzip'
+        assert negotiate_encoding('gzip;q=0') is None
+        assert negotiate_encoding('*') is not None
+
+
+class TestCompression:
+    """Test compressed API and UI responses."""
+
+    def _api(self, **kwargs) -> EmailAPI:
+        data = EmailData()
+        for i in range(30):
+            data.store_message({
+                'from': 'a@x.com',
+                'to': ['b@x.com'],
+                'subject': f'Message {i}',
+                'content': 'Your verification code is 123456. ' * 20
+            })
+        return EmailAPI(data, **kwargs)
+
+    def test_api_responses(self):
+        """Test large JSON is compressed and small or unaccepted responses are not."""
+        compressor = ResponseCompressor(min_size=1024, level=6)
+        client = self._api(compressor=compressor).app.test_client()
+
+        plain = client.get('/all')
+        assert 'Content-Encoding' not in plain.headers
+        assert 'Accept-Encoding' in plain.headers['Vary']
+
+        response = client.get('/all', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.data) == plain.data
+        assert len(response.data) < len(plain.data) / 5
+
+        small = client.get('/health', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in small.headers
+        assert compressor.stats()['responses_compressed'] == 1
+
+    def test_disabled(self):
+        """Test min_size 0 turns compression off."""
+        client = self._api(compressor=ResponseCompressor(min_size=0)).app.test_client()
+
+        response = client.get('/all', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+    def test_precompressed_index(self, tmp_path: Path):
+        """Test the UI is served from memory with per-encoding ETags."""
+        page = tmp_path / 'index.html'
+        page.write_text('<html>' + '<p>UI</p>' * 500 + '</html>')
+        client = self._api(static_dir=str(tmp_path)).app.test_client()
+
+        # Served from the copy loaded at startup
+        page.write_text('changed')
+
+        plain = client.get('/')
+        assert plain.data.startswith(b'<html>')
+        assert 'max-age' in plain.headers['Cache-Control']
+
+        compressed = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        assert compressed.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(compressed.data) == plain.data
+        assert compressed.headers['ETag'] != plain.headers['ETag']
+
+        cached = client.get('/', headers={
+            'Accept-Encoding': 'gzip',
+            'If-None-Match': compressed.headers['ETag']
+        })
+        assert cached.status_code == 304
+        assert StaticAsset.load(tmp_path / 'missing.html') is None
@@ -2,11 +2,15 @@
 Tests for data access layer.
 """
 
+import datetime
 import pytest
+import sqlite3
 import tempfile
 from pathlib import Path
 
 from aemail.data import EmailData
+from aemail.utils import AddressNormalizer
+from aemail.web_api import EmailAPI
 
 
 class TestEmailData:
@@ -149,3 +153,232 @@ class TestEmailData:
         assert len(limited_msgs) == 50
         
         data.close()
+
+    def test_case_insensitive_lookups(self):
+        """Test address lookups match differently-cased spellings."""
+        data = EmailData()
+
+        data.store_message({
+            'from': 'Alice@Example.COM',
+            'to': ['Foo@X.com'],
+            'subject': 'Case',
+            'content': 'Mixed case addresses'
+        })
+
+        assert len(data.get_messages_to('foo@x.com')) == 1
+        assert len(data.get_messages_to('FOO@X.COM')) == 1
+        assert len(data.get_messages_from('alice@example.com')) == 1
+        assert data.get_message_count(recipient='foo@X.com') == 1
+
+        # The original spelling is preserved for display
+        assert data.get_messages_to('foo@x.com')[0]['to0'] == 'Foo@X.com'
+
+        data.close()
+
+    def test_domain_policy_lookups(self):
+        """Test plus-tag and dot folding per domain policy."""
+        data = EmailData(normalizer=AddressNormalizer(['gmail.com'], ['gmail.com']))
+
+        data.store_message({
+            'from': 'sender@example.com',
+            'to': ['First.Last+signup@gmail.com'],
+            'subject': 'Policy',
+            'content': 'Tagged address'
+        })
+        data.store_message({
+            'from': 'sender@example.com',
+            'to': ['first.last+signup@other.com'],
+            'subject': 'No policy',
+            'content': 'Other domain'
+        })
+
+        assert data.get_message_count(recipient='firstlast@gmail.com') == 1
+        assert data.get_message_count(recipient='first.last@other.com') == 0
+        assert data.get_message_count(recipient='first.last+signup@other.com') == 1
+
+        data.close()
+
+    def test_canonical_backfill(self):
+        """Test rows from before canonical columns are backfilled on open."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = Path(temp_dir) / 'legacy.db'
+
+            conn = sqlite3.connect(str(db_path))
+            conn.execute(
+                "CREATE TABLE msg (frm TEXT, to0 TEXT, tos TEXT, subject TEXT, "
+                "content TEXT, createDate timestamp)"
+            )
+            conn.execute("CREATE INDEX index_to0 ON msg (to0)")
+            conn.execute(
+                "INSERT INTO msg VALUES ('a@b.com', 'Bob@Example.com', "
+                "'[\"Bob@Example.com\"]', 's', 'c', '2024-01-01 00:00:00')"
+            )
+            conn.commit()
+            conn.close()
+
+            data = EmailData(str(db_path))
+            assert data.get_message_count(recipient='bob@example.com') == 1
+            data.close()
+
+    def test_multi_recipient_fan_out(self):
+        """Test a message to many recipients is stored once and listed in each mailbox."""
+        data = EmailData()
+        recipients = [f'user{i}@example.com' for i in range(50)] + ['USER0@example.com']
+        data.store_message({
+            'from': 'notify@example.com',
+            'to': recipients,
+            'subject': 'Announcement',
+            'content': 'Hello everyone'
+        })
+
+        assert data.conn.execute("SELECT COUNT(*) FROM msg").fetchone()[0] == 1
+        for recipient in ('user0@example.com', 'user49@example.com'):
+            messages = data.get_messages_to(recipient)
+            assert [m['subject'] for m in messages] == ['Announcement']
+            assert messages[0]['to'] == recipients
+            assert data.get_message_count(recipient=recipient) == 1
+
+        # Repeated recipients get one entry; batches fan out the same way
+        data.store_messages([{'from': 'a@example.com', 'to': ['user1@example.com', 'x@example.com'],
+                              'subject': 'Batch', 'content': 'c'}])
+        assert data.get_message_count(recipient='user0@example.com') == 1
+        assert [m['subject'] for m in data.get_messages_to('user1@example.com')] == ['Batch', 'Announcement']
+        assert data.get_message_count(recipient='x@example.com') == 1
+
+        data.close()
+
+    def test_read_state_per_mailbox(self):
+        """Test read and unread state and counts are kept per recipient."""
+        data = EmailData()
+        for i in range(3):
+            data.store_message({'from': 'a@example.com', 'to': ['bob@example.com', 'carol@example.com'],
+                                'subject': f'Message {i}', 'content': 'c'})
+        assert data.get_unread_count('bob@example.com') == 3
+
+        assert data.mark_read('Bob@example.com', 2) == 1
+        assert data.mark_read('bob@example.com', 2) == 0
+        assert data.get_unread_count('bob@example.com') == 2
+        assert data.get_unread_count('carol@example.com') == 3
+        unread = data.get_messages_to('bob@example.com', unread=True, summary=True)
+        assert [m['id'] for m in unread] == [3, 1]
+
+        assert data.mark_read('bob@example.com') == 2
+        assert data.get_unread_count('bob@example.com') == 0
+        assert data.get_messages_to('bob@example.com', unread=True) == []
+        assert data.mark_read('bob@example.com', 3, seen=False) == 1
+        assert data.get_unread_count('bob@example.com') == 1
+        assert data.get_message_count(recipient='bob@example.com') == 3
+        assert data.get_unread_count('nobody@example.com') == 0
+
+        data.close()
+
+    def test_search_messages(self):
+        """Test combined filters and the walk the planner picks for them."""
+        data = EmailData()
+        base = datetime.datetime(2024, 1, 1)
+        data.store_messages([
+            {
+                'from': f'sender{i % 3}@example.org',
+                'to': [f'user{i % 4}@{"a" if i % 2 else "b"}.example.com', 'all@b.example.com'],
+                'subject': f'Code {i}' if i % 5 else f'Welcome_{i}',
+                'content': 'c',
+                'date': base + datetime.timedelta(hours=i),
+            }
+            for i in range(40)
+        ])
+
+        def subjects(**filters):
+            return [m['subject'] for m in data.search_messages(limit=100, summary=True, **filters)]
+
+        assert len(subjects(recipient='User1@a.example.com')) == 10
+        assert subjects(sender='sender0@example.org', subject='welcome_') == \
+            ['Welcome_30', 'Welcome_15', 'Welcome_0']
+        # Subject wildcards are literal
+        assert subjects(subject='Welcome%') == []
+
+        # A message to several addresses of a domain is listed once
+        assert len(subjects(domain='B.example.com')) == 40
+        assert len(subjects(domain='a.example.com')) == 20
+
+        since = int((base + datetime.timedelta(hours=10)).timestamp())
+        until = int((base + datetime.timedelta(hours=20)).timestamp())
+        assert subjects(since=since, until=until, domain='a.example.com', sender='sender1@example.org') == \
+            ['Code 19', 'Code 13']
+        assert len(data.search_messages(limit=5, offset=35)) == 5
+
+        # The smallest walk wins
+        assert data.plan_search({'to': 'all@b.example.com', 'from': 'sender1@example.org'}) == 'from'
+        assert data.plan_search({'to': 'user1@a.example.com', 'from': 'sender1@example.org'}) == 'to'
+        assert data.plan_search({'domain': 'b.example.com'}, since, until) == 'all'
+        assert data.plan_search({'subject': 'Code%'}) == 'all'
+
+        data.close()
+
+    def test_stats(self):
+        """Test the rollups count every message once per sender, domain and hour."""
+        data = EmailData()
+        base = datetime.datetime(2024, 1, 1, 10, 15)
+        data.store_message({'from': 'Shop@example.org', 'to': ['a@x.com', 'b@X.com', 'c@y.com'],
+                            'subject': 'S', 'content': 'c', 'size': 100, 'date': base})
+        data.store_messages([
+            {'from': 'news@example.org', 'to': ['a@x.com'], 'subject': 'N', 'content': 'c',
+             'size': 10, 'date': base + datetime.timedelta(minutes=30 * i)}
+            for i in range(4)
+        ])
+
+        assert data.get_stats('domain') == [
+            {'domain': 'x.com', 'messages': 5, 'bytes': 140},
+            {'domain': 'y.com', 'messages': 1, 'bytes': 100},
+        ]
+        assert data.get_stats('sender', limit=1) == [
+            {'sender': 'news@example.org', 'messages': 4, 'bytes': 40}
+        ]
+        hours = data.get_stats('hour')
+        assert [(row['hour'][11:16], row['messages'], row['bytes']) for row in hours] == [
+            ('11:00', 2, 20), ('10:00', 3, 120)
+        ]
+        since = int((base + datetime.timedelta(hours=1)).timestamp())
+        assert [row['messages'] for row in data.get_stats('hour', since=since, sender='NEWS@example.org')] == [2]
+        assert [row['messages'] for row in data.get_stats('domain', since=since)] == [2]
+        assert data.get_stats('hour', domain='@Y.com')[0]['messages'] == 1
+        assert data.get_stats('mailbox') == [
+            {'address': 'a@x.com', 'messages': 5, 'unread': 5},
+            {'address': 'b@x.com', 'messages': 1, 'unread': 1},
+            {'address': 'c@y.com', 'messages': 1, 'unread': 1},
+        ]
+        with pytest.raises(ValueError):
+            data.get_stats('subject')
+        data.close()
+
+    def test_change_feed(self):
+        """Test consumers resume after the last change they saw and see deletes."""
+        data = EmailData()
+        data.store_message({'from': 'a@b.com', 'to': ['x@y.com'], 'subject': 'One', 'content': 'c'})
+        data.store_messages(
+            {'from': 'a@b.com', 'to': ['x@y.com'], 'subject': f'Bulk {i}', 'content': 'c'}
+            for i in range(3)
+        )
+
+        changes = data.get_changes(limit=2)
+        assert [(c['seq'], c['op'], c['id']) for c in changes] == [(1, 'insert', 1), (2, 'insert', 2)]
+        assert changes[0]['message']['subject'] == 'One'
+        changes = data.get_changes(after=2, summary=True)
+        assert [c['message']['subject'] for c in changes] == ['Bulk 1', 'Bulk 2']
+        assert 'content' not in changes[0]['message']
+
+        data.conn.execute("DELETE FROM msg WHERE id = 3")
+        data.store_message({'from': 'a@b.com', 'to': ['x@y.com'], 'subject': 'Two', 'content': 'c'})
+        changes = data.get_changes(after=2)
+        assert [(c['seq'], c['op'], c['id']) for c in changes] == [
+            (3, 'insert', 3), (4, 'insert', 4), (5, 'delete', 3), (6, 'insert', 5)
+        ]
+        # Gone since it was stored
+        assert changes[0]['message'] is None and changes[2]['message'] is None
+        assert data.get_changes(after=6) == []
+
+        client = EmailAPI(data).app.test_client()
+        page = client.get('/changes?after=3&limit=2').get_json()
+        assert [c['seq'] for c in page['changes']] == [4, 5]
+        assert (page['next'], page['has_more']) == (5, True)
+        assert client.get('/changes?after=x').status_code == 400
+        data.close()
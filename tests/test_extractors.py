@@ -0,0 +1,173 @@
+"""
+Tests for code, link, custom token and header extraction.
+"""
+
+import email
+from email.message import EmailMessage
+
+from aemail.config import Config
+from aemail.data import EmailData
+from aemail.email_handler import EmailProcessor, default_pipeline
+from aemail.extractors import HeaderExtractor, TokenExtractor
+from aemail.importer import parse_raw_message
+from aemail.pipeline import MessageContext
+from aemail.web_api import EmailAPI
+
+
+def parse(message, mail_from: str, rcpt_tos: list) -> dict:
+    """Run a message through the default pipeline stages."""
+    context = MessageContext(message.as_bytes(), mail_from, rcpt_tos)
+    default_pipeline().process(context)
+    return context.data
+
+
+def verification_email(code: str, link: str) -> EmailMessage:
+    """Build a multipart verification email."""
+    message = EmailMessage()
+    message['From'] = 'noreply@service.com'
+    message['To'] = 'user@example.com'
+    message['Subject'] = 'Confirm your account'
+    message.set_content(f'Your verification code is {code}.\nOr open {link}.\n\n© 2024 Service')
+    message.add_alternative(
+        f'<p>Code: <b>{code}</b></p><a href="{link.replace("&", "&amp;")}">Confirm</a>',
+        subtype='html'
+    )
+    return message
+
+
+class TestTokenExtractor:
+    """Test the extractors themselves."""
+
+    def test_codes(self):
+        """Test keywords pick the code and footer numbers are left out."""
+        extractor = TokenExtractor()
+        assert extractor.extract_codes('Your code', 'Use 4821 to sign in.\n© 2024') == ['4821']
+        assert extractor.extract_codes('登录', '您的验证码：839201，5分钟内有效') == ['839201']
+        # Without a keyword only longer numbers qualify
+        assert extractor.extract_codes('Welcome', 'Call 555-1234, ref 77.') == []
+        assert extractor.extract_codes('Welcome', 'Enter 902113 to continue') == ['902113']
+        # Numbers inside links are not codes
+        assert extractor.extract_codes('Code', 'https://x.com/123456') == []
+
+    def test_links(self):
+        """Test hrefs are unescaped and trailing punctuation is dropped."""
+        tokens = TokenExtractor().extract(
+            'Hi', 'See https://a.com/x?y=1&z=2. Then (https://b.com/).',
+            '<a href="https://a.com/x?y=1&amp;z=2">go</a><a href="mailto:x@y.com">m</a>'
+        )
+        assert tokens == [('link', 'https://a.com/x?y=1&z=2'), ('link', 'https://b.com/')]
+
+    def test_custom_patterns(self):
+        """Test custom kinds from the [extractors] section."""
+        config = Config()
+        config.config.read_dict({'extractors': {'ticket': r'TICKET-(\d+)', 'link': 'off'}})
+        extractor = TokenExtractor.from_config(config)
+
+        assert extractor.kinds == ['code', 'ticket']
+        tokens = extractor.extract('Re: TICKET-42', 'Merged into TICKET-7, https://x.com')
+        assert tokens == [('ticket', '42'), ('ticket', '7')]
+
+
+class TestHeaderExtractor:
+    """Test header decoding and selection for the header index."""
+
+    def test_decode_encoded_words(self):
+        """Test every encoded word of a header is decoded."""
+        decode = EmailProcessor.decode_header_value
+        assert decode('=?utf-8?b?5L2g5aW9?= =?utf-8?q?_world?= tail') == '你好 world tail'
+        assert decode('Re: =?iso-8859-1?q?caf=E9?= ok') == 'Re: café ok'
+        assert decode('Plain subject') == 'Plain subject'
+
+    def test_select_and_normalize(self):
+        """Test configured names and prefixes are indexed, message ids without brackets."""
+        config = Config('/nonexistent.ini')
+        config.config.read_string("[headers]\nindex = Message-ID, In-Reply-To, X-Test-*\n")
+        extractor = HeaderExtractor.from_config(config)
+
+        message = email.message_from_bytes(
+            b'Message-ID:  <abc.123@service.com>\r\n'
+            b'In-Reply-To: <a@x.com>\r\n <b@x.com>\r\n'
+            b'X-Test-Run-Id: =?utf-8?q?run_42?=\r\n'
+            b'X-Mailer: mailer\r\n'
+            b'Subject: Hi\r\n\r\nBody\r\n'
+        )
+        rows = extractor.extract(message.items(), EmailProcessor.decode_header_value)
+        assert rows == [
+            ('message-id', 'abc.123@service.com'),
+            ('in-reply-to', 'a@x.com'), ('in-reply-to', 'b@x.com'),
+            ('x-test-run-id', 'run 42'),
+        ]
+
+
+class TestIngest:
+    """Test extraction at ingest and the token endpoints."""
+
+    def test_ingest_tokens(self):
+        """Test the default stages and the importer extract tokens."""
+        message = verification_email('482913', 'https://service.com/v?t=a&u=1')
+        tokens = parse(message, 'a@b.com', ['user@example.com'])['tokens']
+        assert tokens == [('code', '482913'), ('link', 'https://service.com/v?t=a&u=1')]
+
+        parsed = parse_raw_message(message.as_bytes(), default_pipeline(TokenExtractor(codes=False)))
+        assert parsed['tokens'] == [('link', 'https://service.com/v?t=a&u=1')]
+
+    def test_endpoints(self):
+        """Test /latest-code and /links serve the newest message's tokens."""
+        data = EmailData()
+        for i, code in enumerate(('111111', '222222')):
+            message = verification_email(code, f'https://service.com/v/{i}')
+            data.store_message(parse(
+                message, 'noreply@service.com', ['User@Example.com']
+            ))
+        data.store_message({'from': 'a@b.com', 'to': ['user@example.com'],
+                            'subject': 'Newsletter', 'content': 'No codes here'})
+        client = EmailAPI(data).app.test_client()
+
+        response = client.get('/to/user@example.com/latest-code')
+        assert response.status_code == 200
+        assert response.json['value'] == '222222'
+        assert response.json['id'] == 2
+        assert response.json['kind'] == 'code'
+
+        links = client.get('/to/user@example.com/links').json['links']
+        assert [link['value'] for link in links] == [
+            'https://service.com/v/1', 'https://service.com/v/0'
+        ]
+        assert len(client.get('/to/user@example.com/links?limit=1').json['links']) == 1
+
+        assert client.get('/to/nobody@example.com/latest-code').status_code == 404
+        assert client.get('/to/user@example.com/latest-code?kind=ticket').status_code == 404
+        # The mailbox itself is still served
+        assert client.get('/to/user@example.com').json['pagination']['total'] == 3
+        data.close()
+
+    def test_header_endpoint(self):
+        """Test /header/<name>/<value> finds messages by an indexed header."""
+        data = EmailData()
+        for i in range(3):
+            message = verification_email(f'11111{i}', 'https://service.com/v')
+            message['Message-ID'] = f'<m{i}@service.com>'
+            message['Date'] = 'Mon, 01 Jan 2024 00:00:00 +0000'
+            data.store_message(parse(message, 'a@b.com', ['user@example.com']))
+        client = EmailAPI(data).app.test_client()
+
+        page = client.get('/header/Message-ID/%3Cm1@service.com%3E').json
+        assert [m['id'] for m in page['messages']] == [2]
+        assert client.get('/header/message-id/m1@service.com').json['messages'][0]['id'] == 2
+        page = client.get('/header/Date/Mon, 01 Jan 2024 00:00:00 +0000?limit=2&view=summary').json
+        assert [m['id'] for m in page['messages']] == [3, 2]
+        assert page['pagination']['has_more'] is True
+        assert client.get('/header/X-Test-Run-Id/1').json['messages'] == []
+        data.close()
+
+    def test_store_messages(self):
+        """Test bulk stores keep tokens with their messages."""
+        data = EmailData()
+        data.store_messages([
+            {'from': 'a@b.com', 'to': ['x@y.com'], 'subject': 'One', 'content': 'c'},
+            {'from': 'a@b.com', 'to': ['x@y.com'], 'subject': 'Two', 'content': 'c',
+             'tokens': [('code', '5555'), ('code', '6666')]},
+        ])
+        token = data.get_latest_token('x@y.com')
+        assert (token['value'], token['subject']) == ('5555', 'Two')
+        data.close()
@@ -0,0 +1,66 @@
+"""
+Tests for listening socket handoff between server processes.
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+from aemail.handoff import (
+    HANDOFF_FD_ENV,
+    LISTEN_FDS_ENV,
+    Successor,
+    inherited_fds,
+    wait_for_predecessor,
+)
+
+
+class TestHandoff:
+    """Test passing listening sockets to a successor process."""
+
+    def test_inherited_fds(self, monkeypatch):
+        """Test the descriptors are parsed and the variable consumed."""
+        monkeypatch.setenv(LISTEN_FDS_ENV, 'smtp=5,rest=6')
+        assert inherited_fds() == {'smtp': 5, 'rest': 6}
+        assert LISTEN_FDS_ENV not in os.environ
+        assert inherited_fds() == {}
+
+    def test_wait_for_predecessor(self, monkeypatch):
+        """Test the successor waits until the handoff pipe is closed."""
+        assert not wait_for_predecessor()
+
+        read_fd, write_fd = os.pipe()
+        monkeypatch.setenv(HANDOFF_FD_ENV, str(read_fd))
+        closer = threading.Timer(0.2, os.close, (write_fd,))
+        closer.start()
+        start = time.monotonic()
+        assert wait_for_predecessor(timeout=5)
+        assert time.monotonic() - start >= 0.15
+
+    def test_successor_accepts_on_inherited_socket(self):
+        """Test a child process serves the listening socket once released."""
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+
+        script = (
+            "import socket\n"
+            "from aemail.handoff import inherited_fds, wait_for_predecessor\n"
+            "fds = inherited_fds()\n"
+            "wait_for_predecessor(10)\n"
+            "conn, _ = socket.socket(fileno=fds['smtp']).accept()\n"
+            "conn.sendall(b'hello')\n"
+            "conn.close()\n"
+        )
+        successor = Successor({'smtp': listener.fileno()}, [sys.executable, '-c', script])
+        listener.close()
+
+        # Queued in the backlog until the successor is released
+        client = socket.create_connection(('127.0.0.1', port), timeout=10)
+        successor.release()
+        assert client.recv(5) == b'hello'
+        client.close()
+        assert successor.process.wait(10) == 0
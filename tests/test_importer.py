@@ -0,0 +1,196 @@
+"""
+Tests for bulk import.
+"""
+
+import mailbox
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from email.message import EmailMessage
+from pathlib import Path
+
+import pytest
+
+from aemail import importer as importer_module
+from aemail.config import Config
+from aemail.data import EmailData
+from aemail.email_handler import BUILTIN_STAGES, DEFAULT_STAGES
+from aemail.importer import MailImporter, detect_format, parse_raw_message
+from aemail.pipeline import Pipeline
+
+
+def make_message(i: int) -> EmailMessage:
+    """Build a simple test message."""
+    message = EmailMessage()
+    message['From'] = f'sender{i}@example.com'
+    message['To'] = 'bob@example.com'
+    message['Cc'] = 'Carol <carol@example.com>'
+    message['Subject'] = f'Message {i}'
+    message['Date'] = 'Mon, 01 Jan 2024 12:00:00 +0000'
+    message.set_content(f'Body {i}')
+    return message
+
+
+class TestMailImporter:
+    """Test the bulk importer."""
+
+    def test_parse_raw_message(self):
+        """Test the envelope is rebuilt from the headers."""
+        parsed = parse_raw_message(make_message(1).as_bytes())
+
+        assert parsed['from'] == 'sender1@example.com'
+        assert parsed['to'] == ['bob@example.com', 'carol@example.com']
+        assert parsed['subject'] == 'Message 1'
+        assert 'Body 1' in parsed['content']
+        assert parsed['date'].year == 2024
+
+    def test_detect_format(self):
+        """Test corpus format detection."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            mailbox.Maildir(str(root / 'md'))
+
+            assert detect_format(root / 'md') == 'maildir'
+            assert detect_format(root) == 'eml'
+            assert detect_format(root / 'x.eml') == 'eml'
+            assert detect_format(root / 'box.mbox') == 'mbox'
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_import_all_formats(self, workers):
+        """Test importing mbox, Maildir and .eml sources together."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+
+            box = mailbox.mbox(str(root / 'box.mbox'))
+            for i in range(5):
+                box.add(make_message(i))
+            box.close()
+
+            maildir = mailbox.Maildir(str(root / 'md'))
+            for i in range(5, 8):
+                maildir.add(make_message(i))
+
+            (root / 'eml').mkdir()
+            for i in range(8, 10):
+                (root / 'eml' / f'{i}.eml').write_bytes(make_message(i).as_bytes())
+
+            data = EmailData(str(root / 'test.db'))
+            importer = MailImporter(data, workers=workers, batch_size=3)
+            stats = importer.run([str(root / 'box.mbox'), str(root / 'md'), str(root / 'eml')])
+
+            assert stats['imported'] == 10
+            assert stats['failed'] == 0
+            assert data.get_message_count() == 10
+            assert data.get_message_count(recipient='bob@example.com') == 10
+
+            # Indexes are rebuilt after the load
+            index_names = {
+                row[0] for row in data.conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index'"
+                )
+            }
+            assert {'idx_msg_frm_created', 'idx_mailbox_msg'} <= index_names
+
+            data.close()
+
+    def test_batches_in_flight(self, monkeypatch):
+        """Test every worker has a batch to parse while the oldest one is stored."""
+        submitted = []
+        in_flight = []
+
+        class RecordingPool(ProcessPoolExecutor):
+            def submit(self, *args, **kwargs):
+                submitted.append(args[1])
+                return super().submit(*args, **kwargs)
+
+        store = MailImporter._store
+
+        def recording_store(importer, parsed, stats):
+            in_flight.append(len(submitted) - len(in_flight))
+            store(importer, parsed, stats)
+
+        monkeypatch.setattr(importer_module, 'ProcessPoolExecutor', RecordingPool)
+        monkeypatch.setattr(MailImporter, '_store', recording_store)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            box = mailbox.mbox(str(root / 'box.mbox'))
+            for i in range(20):
+                box.add(make_message(i))
+            box.close()
+
+            data = EmailData(str(root / 'test.db'))
+            stats = MailImporter(data, workers=4, batch_size=2).run([str(root / 'box.mbox')])
+
+            assert stats['imported'] == 20 and len(submitted) == 10
+            assert in_flight[0] == 5 and max(in_flight) > 2
+            # Stored in the order they were read
+            assert [m['subject'] for m in data.get_all_messages(limit=3)] == \
+                ['Message 19', 'Message 18', 'Message 17']
+            data.close()
+
+    def test_batches_stay_flat(self):
+        """Test later batches store as fast as the first while the msg indexes are dropped."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            box = mailbox.mbox(str(root / 'box.mbox'))
+            for i in range(2000):
+                box.add(make_message(i))
+            box.close()
+
+            data = EmailData(str(root / 'test.db'))
+            store_messages = data.store_messages
+            timings = []
+            indexes = []
+
+            def timed_store(messages):
+                indexes.append({row[0] for row in data.conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index'"
+                )})
+                start = time.perf_counter()
+                stored = store_messages(messages)
+                timings.append(time.perf_counter() - start)
+                return stored
+
+            data.store_messages = timed_store
+            stats = MailImporter(data, workers=1, batch_size=400).run([str(root / 'box.mbox')])
+
+            assert stats['imported'] == 2000 and len(timings) == 5
+            # The triggers find mailbox entries through these, so they stay
+            assert all({'idx_mailbox_msg', 'idx_mailbox_domain'} <= names for names in indexes)
+            assert 'idx_msg_created' not in indexes[0]
+            assert max(timings[-2:]) < 3 * min(timings[:2]) + 0.05, timings
+            data.close()
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_configured_pipeline(self, workers):
+        """Test imported mail goes through the configured stages, which are timed."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            for i in range(3):
+                message = make_message(i)
+                message['Message-ID'] = f'<m{i}@example.com>'
+                if i == 1:
+                    message['X-Spam-Flag'] = 'YES'
+                (root / f'{i}.eml').write_bytes(message.as_bytes())
+
+            config = Config('/nonexistent.ini')
+            config.config.read_string("[pipeline]\nstages = parse, spam, subject, headers, content, tokens\n")
+            pipeline = Pipeline.from_config(config, BUILTIN_STAGES, DEFAULT_STAGES)
+            data = EmailData(str(root / 'test.db'))
+            stats = MailImporter(data, workers=workers, pipeline=pipeline).run([str(root)])
+
+            assert (stats['imported'], stats['failed'], stats['dropped']) == (2, 0, 1)
+            assert [m['subject'] for m in data.get_messages_by_header('message-id', 'm2@example.com')] \
+                == ['Message 2']
+            timings = pipeline.stats()
+            assert timings['parse']['calls'] == 3
+            assert timings['spam']['stopped'] == 1
+            assert timings['store']['calls'] == 1
+            data.close()
+
+    def test_missing_source(self):
+        """Test a missing path is reported before anything is loaded."""
+        data = EmailData()
+        with pytest.raises(FileNotFoundError):
+            MailImporter(data, workers=1).run(['/nonexistent/corpus.mbox'])
+        data.close()
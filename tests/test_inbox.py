@@ -0,0 +1,163 @@
+"""
+Tests for the durable inbox and its indexer.
+"""
+
+import io
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+from aiosmtpd.smtp import Envelope
+
+from aemail.data import EmailData
+from aemail.email_handler import SMTPHandler
+from aemail.inbox import DurableInbox, InboxIndexer
+
+
+MESSAGE = b"From: a@example.com\r\nTo: b@example.com\r\nSubject: Code 123456\r\n\r\nbody\r\n"
+
+
+@pytest.fixture
+def workdir():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        yield Path(temp_dir)
+
+
+def open_store(workdir: Path):
+    """Open the data store, journal, handler and indexer of one server run."""
+    data = EmailData(str(workdir / 'mail.db'))
+    inbox = DurableInbox(str(workdir / 'inbox'), segment_size=1024)
+    handler = SMTPHandler(data, inbox=inbox)
+    indexer = InboxIndexer(inbox, data, handler.parse_message, batch_size=4)
+    return data, inbox, handler, indexer
+
+
+class TestDurableInbox:
+    """Test journal appends, group commit and recovery."""
+
+    def test_append_and_read(self, workdir):
+        """Test records are read back only once synced."""
+        inbox = DurableInbox(str(workdir))
+        sequence = inbox.append('a@example.com', ['b@example.com'], MESSAGE)
+        assert inbox.read((1, 0), 10)[0] == []
+
+        inbox.sync(sequence)
+        records, position = inbox.read((1, 0), 10)
+        assert len(records) == 1
+        meta, body = records[0]
+        assert meta['from'] == 'a@example.com' and meta['to'] == ['b@example.com']
+        assert body == MESSAGE
+        assert position == inbox.durable_position
+
+        # File bodies are copied in chunks
+        inbox.deliver('c@example.com', ['d@example.com'], io.BytesIO(MESSAGE * 3))
+        records, _ = inbox.read(position, 10)
+        assert records[0][1] == MESSAGE * 3
+        inbox.close()
+
+    def test_group_commit(self, workdir):
+        """Test concurrent deliveries are all durable with fewer syncs."""
+        inbox = DurableInbox(str(workdir))
+        threads = [
+            threading.Thread(target=inbox.deliver, args=('a@example.com', [f'u{i}@example.com'], MESSAGE))
+            for i in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(inbox.read((1, 0), 100)[0]) == 20
+        assert 1 <= inbox.counters['syncs'] <= 20
+        inbox.close()
+
+    def test_torn_record_truncated(self, workdir):
+        """Test a partly written record is cut off when the journal is reopened."""
+        inbox = DurableInbox(str(workdir))
+        inbox.deliver('a@example.com', ['b@example.com'], MESSAGE)
+        end = inbox.durable_position[1]
+        inbox.close()
+
+        segment = workdir / '00000001.inbox'
+        data = segment.read_bytes()
+        segment.write_bytes(data + data[:len(data) // 2])
+
+        inbox = DurableInbox(str(workdir))
+        assert inbox.counters['truncated_bytes'] == len(data) // 2
+        assert segment.stat().st_size == end
+        inbox.deliver('a@example.com', ['b@example.com'], MESSAGE)
+        assert len(inbox.read((1, 0), 10)[0]) == 2
+        inbox.close()
+
+
+class TestInboxIndexer:
+    """Test indexing and crash recovery."""
+
+    async def test_handler_journals_then_indexes(self, workdir):
+        """Test handle_DATA acknowledges after journaling and the indexer stores."""
+        data, inbox, handler, indexer = open_store(workdir)
+        envelope = Envelope()
+        envelope.mail_from = 'a@example.com'
+        envelope.rcpt_tos = ['b@example.com']
+        envelope.content = MESSAGE
+
+        assert (await handler.handle_DATA(None, None, envelope)).startswith('250')
+        assert data.get_message_count() == 0
+
+        assert indexer.index_pending() == 1
+        message = data.get_messages_to('b@example.com', summary=True)[0]
+        assert message['subject'] == 'Code 123456'
+        assert message['size'] == len(MESSAGE)
+        assert data.get_latest_token('b@example.com')['value'] == '123456'
+        assert data.inbox_position() == inbox.durable_position
+        inbox.close()
+        data.close()
+
+    def test_replay_after_crash(self, workdir):
+        """Test unindexed mail is replayed once, and indexed segments removed."""
+        data, inbox, _, indexer = open_store(workdir)
+        for i in range(10):
+            inbox.deliver('a@example.com', [f'user{i}@example.com'], MESSAGE)
+        assert len(inbox.segments()) > 1
+
+        # One batch is indexed before the process dies
+        indexer.index_pending()
+        assert data.get_message_count() == 4
+        data.close()
+
+        data, inbox, _, indexer = open_store(workdir)
+        indexer.start()
+        indexer.stop(timeout=10)
+        assert data.get_message_count() == 10
+        assert len(data.get_messages_to('user9@example.com')) == 1
+        assert inbox.segments() == [inbox.durable_position[0]]
+        assert indexer.counters['segments_removed'] >= 1
+
+        # Nothing left to replay on the next start
+        inbox.close()
+        data.close()
+        data, inbox, _, indexer = open_store(workdir)
+        assert indexer.index_pending() == 0
+        assert data.get_message_count() == 10
+        inbox.close()
+        data.close()
+
+    def test_unparseable_message_skipped(self, workdir):
+        """Test a record that fails to parse does not stall indexing."""
+        data, inbox, handler, _ = open_store(workdir)
+
+        def parse(raw, mail_from, rcpt_tos):
+            if b'broken' in raw:
+                raise ValueError('bad message')
+            return handler.parse_message(raw, mail_from, rcpt_tos)
+
+        indexer = InboxIndexer(inbox, data, parse)
+        inbox.deliver('a@example.com', ['b@example.com'], b'broken')
+        inbox.deliver('a@example.com', ['b@example.com'], MESSAGE)
+        indexer.index_pending()
+
+        assert data.get_message_count() == 1
+        assert indexer.counters['parse_errors'] == 1
+        inbox.close()
+        data.close()
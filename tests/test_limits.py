@@ -0,0 +1,150 @@
+"""
+Tests for SMTP connection and rate limits.
+"""
+
+import smtplib
+import socket
+import time
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from aemail.data import EmailData
+from aemail.email_handler import SMTPHandler
+from aemail.limits import ClientLimits, KeyedRateLimiter, TokenBucket
+from aemail.metrics import MetricsRegistry
+from aemail.protocol import SMTPProtocol
+from aemail.web_api import EmailAPI
+
+
+def free_port() -> int:
+    """Find a free local TCP port."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestRateLimiting:
+    """Test token buckets and keyed limiters."""
+
+    def test_token_bucket(self):
+        """Test burst consumption and refill."""
+        bucket = TokenBucket(2, now=0.0)
+
+        assert bucket.take(1.0, 2, now=0.0)
+        assert bucket.take(1.0, 2, now=0.0)
+        assert not bucket.take(1.0, 2, now=0.0)
+        assert bucket.take(1.0, 2, now=1.0)
+
+    def test_idle_expiry(self):
+        """Test idle buckets are swept."""
+        limiter = KeyedRateLimiter(rate=1.0, burst=1, idle_ttl=10)
+
+        assert limiter.allow('a', now=0.0)
+        assert not limiter.allow('a', now=0.5)
+        assert limiter.allow('b', now=5.0)
+        assert len(limiter) == 2
+
+        limiter.sweep(now=12.0)
+        assert len(limiter) == 1
+
+    def test_disabled(self):
+        """Test a zero rate never limits or tracks keys."""
+        limiter = KeyedRateLimiter(rate=0, burst=1)
+
+        assert all(limiter.allow('a') for _ in range(100))
+        assert len(limiter) == 0
+
+
+class TestClientLimits:
+    """Test session and message limits."""
+
+    def test_sessions(self):
+        """Test total and per-IP session caps."""
+        limits = ClientLimits(max_sessions=3, max_sessions_per_ip=2)
+
+        assert limits.open_session('1.1.1.1') is None
+        assert limits.open_session('1.1.1.1') is None
+        assert limits.open_session('1.1.1.1').startswith('421')
+        assert limits.open_session('2.2.2.2') is None
+        assert limits.open_session('3.3.3.3').startswith('421')
+
+        limits.close_session('1.1.1.1')
+        assert limits.open_session('3.3.3.3') is None
+        assert limits.stats()['sessions_rejected'] == 2
+
+    def test_messages(self):
+        """Test messages per session and per-IP message rate."""
+        limits = ClientLimits(max_messages_per_session=2, ip_rate=0.001, ip_burst=3)
+
+        assert limits.check_message('1.1.1.1', 0) is None
+        assert limits.check_message('1.1.1.1', 2).startswith('452')
+        assert limits.check_message('1.1.1.1', 1) is None
+        assert limits.check_message('1.1.1.1', 0) is None
+        assert limits.check_message('1.1.1.1', 0).startswith('452')
+
+    def test_recipient_domains(self):
+        """Test the per-domain recipient rate."""
+        limits = ClientLimits(domain_rate=0.001, domain_burst=1)
+
+        assert limits.check_recipient('a.com') is None
+        assert limits.check_recipient('a.com').startswith('452')
+        assert limits.check_recipient('b.com') is None
+
+
+class TestSMTPLimits:
+    """Test limits enforced by a running SMTP server."""
+
+    def test_session_and_message_limits(self):
+        """Test 421 on too many sessions and 452 on too many messages."""
+        data = EmailData()
+        limits = ClientLimits(max_sessions=1, max_messages_per_session=1)
+        handler = SMTPHandler(data, limits=limits)
+
+        controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+        controller.factory = lambda: SMTPProtocol(handler, enable_SMTPUTF8=True)
+        controller.start()
+        try:
+            # Let the controller's startup probe connection unregister
+            deadline = time.monotonic() + 5
+            while limits.active_sessions and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            with smtplib.SMTP('127.0.0.1', controller.port) as client:
+                client.sendmail('a@example.com', ['b@example.com'], 'Subject: 1\r\n\r\nOne')
+
+                with pytest.raises(smtplib.SMTPSenderRefused) as refused:
+                    client.sendmail('a@example.com', ['b@example.com'], 'Subject: 2\r\n\r\nTwo')
+                assert refused.value.smtp_code == 452
+
+                with pytest.raises(smtplib.SMTPConnectError) as connect_error:
+                    smtplib.SMTP('127.0.0.1', controller.port)
+                assert connect_error.value.smtp_code == 421
+        finally:
+            controller.stop()
+
+        assert data.get_message_count() == 1
+        assert limits.active_sessions == 0
+
+        # Transactions that deliver nothing do not count towards the limit
+        handler = SMTPHandler(data, limits=ClientLimits(max_messages_per_session=1))
+        controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+        controller.factory = lambda: SMTPProtocol(handler)
+        controller.start()
+        try:
+            with smtplib.SMTP('127.0.0.1', controller.port) as client:
+                client.ehlo()
+                assert client.mail('a@example.com')[0] == 250
+                client.rset()
+                client.sendmail('a@example.com', ['b@example.com'], 'Subject: 3\r\n\r\nThree')
+                with pytest.raises(smtplib.SMTPSenderRefused):
+                    client.sendmail('a@example.com', ['b@example.com'], 'Subject: 4\r\n\r\nFour')
+        finally:
+            controller.stop()
+        assert data.get_message_count() == 2
+
+        metrics = MetricsRegistry()
+        metrics.register('limits', limits.stats)
+        response = EmailAPI(data, metrics=metrics).app.test_client().get('/metrics')
+        assert response.get_json()['limits']['sessions_rejected'] >= 1
+        data.close()
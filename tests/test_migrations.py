@@ -0,0 +1,312 @@
+"""
+Tests for schema migrations.
+"""
+
+import datetime
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from aemail.data import EmailData
+from aemail.migrations import INDEXES_V4, SCHEMA_VERSION, AddCoveringIndexes, Migrator
+
+
+def create_legacy_db(db_path: Path, rows: int) -> None:
+    """Create a database with the original, unversioned msg layout."""
+    conn = sqlite3.connect(str(db_path))
+    conn.execute(
+        "CREATE TABLE msg (frm TEXT, to0 TEXT, tos TEXT, subject TEXT, "
+        "content TEXT, createDate timestamp)"
+    )
+    conn.execute("CREATE INDEX index_to0 ON msg (to0)")
+    conn.executemany(
+        "INSERT INTO msg VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            ('a@b.com', 'Bob@Example.com', '["Bob@Example.com"]', f'Subject {i}',
+             'Body', f'2024-01-01 00:00:{i:02d}.250000')
+            for i in range(rows)
+        ]
+    )
+    conn.commit()
+    conn.close()
+
+
+class TestMigrations:
+    """Test versioned schema upgrades."""
+
+    def test_new_database(self):
+        """Test a new database gets the current layout without backfills."""
+        data = EmailData()
+
+        status = data.schema_status()
+        assert status['version'] == SCHEMA_VERSION
+        assert status['pending_backfills'] == {}
+
+        columns = {row[1]: row for row in data.conn.execute("PRAGMA table_info(msg)")}
+        assert columns['id'][5] == 1  # primary key
+        assert 'created_at' in columns and 'createDate' not in columns
+        data.close()
+
+    def test_legacy_database(self):
+        """Test the original layout is migrated with ids and dates preserved."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = Path(temp_dir) / 'legacy.db'
+            create_legacy_db(db_path, 5)
+
+            data = EmailData(str(db_path))
+            assert data.schema_status()['version'] == SCHEMA_VERSION
+            assert data.schema_status()['pending_backfills'] == {}
+
+            messages = data.get_messages_to('bob@example.com')
+            assert [m['subject'] for m in messages][:2] == ['Subject 4', 'Subject 3']
+            assert [m['id'] for m in messages] == [5, 4, 3, 2, 1]
+            assert messages[0]['time'] == '2024-01-01 00:00:04'
+            assert data.get_messages_to('bob@example.com', summary=True)[0]['size'] == len(b'Body')
+
+            expected = int(datetime.datetime(2024, 1, 1, 0, 0, 4).timestamp())
+            stored = data.conn.execute("SELECT created_at FROM msg WHERE id = 5").fetchone()
+            assert stored[0] == expected
+
+            tables = {row[0] for row in data.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )}
+            assert tables == {'msg', 'msg_count', 'msg_token', 'inbox_checkpoint', 'mailbox',
+                              'mailbox_stats', 'msg_rollup', 'msg_header', 'msg_change',
+                              'sqlite_sequence', 'webhook_cursor', 'webhook_queue',
+                              'schema_backfill'}
+            # The single-column indexes are replaced by the covering ones
+            indexes = {row[0] for row in data.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )}
+            assert not indexes & {'index_to0', 'index_frm_canon', 'index_to0_canon', 'index_created_at'}
+
+            # New ids continue after the migrated ones
+            data.store_message({'from': 'x@y.com', 'to': ['bob@example.com'],
+                                'subject': 'New', 'content': 'c'})
+            assert data.get_messages_to('bob@example.com')[0]['id'] == 6
+            assert data.get_message_count() == 6
+            data.close()
+
+    def test_replaced_indexes_dropped(self):
+        """Test the last covering index step drops the single-column indexes of versions 1 and 2."""
+        data = EmailData()
+        for name, column in (('index_frm_canon', 'frm_canon'), ('index_to0_canon', 'to0_canon'),
+                             ('index_created_at', 'created_at')):
+            data.conn.execute(f"CREATE INDEX {name} ON msg ({column})")
+
+        assert AddCoveringIndexes().backfill(data.conn, len(INDEXES_V4) + 1, 100, None) is None
+        indexes = {row[0] for row in data.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )}
+        assert not indexes & {'index_frm_canon', 'index_to0_canon', 'index_created_at'}
+        data.close()
+
+    def test_resumable_backfill(self):
+        """Test an interrupted backfill resumes and picks up mail stored meanwhile."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = Path(temp_dir) / 'legacy.db'
+            create_legacy_db(db_path, 7)
+
+            conn = sqlite3.connect(str(db_path))
+            migrator = Migrator(conn)
+            assert migrator.upgrade() == [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13]
+            for _ in range(12):
+                assert migrator.backfill_step(batch_size=2)
+            pending = migrator.pending_backfills()
+            assert list(pending) == [3, 4, 5, 7, 8, 9, 10, 11, 13]
+
+            # Mail arriving mid-copy still goes to the old table
+            conn.execute(
+                "INSERT INTO msg (frm, to0, tos, subject, content, created_at, to0_canon) "
+                "VALUES ('late@b.com', 'bob@example.com', '[]', 'Late', 'c', 1, 'bob@example.com')"
+            )
+            conn.commit()
+            conn.close()
+
+            data = EmailData(str(db_path))
+            assert data.get_message_count(recipient='bob@example.com') == 8
+            assert data.get_message(8)['subject'] == 'Late'
+            assert data.schema_status()['pending_backfills'] == {}
+            data.close()
+
+    def test_token_backfill(self):
+        """Test codes and links are extracted from messages stored before the token table."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = Path(temp_dir) / 'legacy.db'
+            create_legacy_db(db_path, 2)
+            conn = sqlite3.connect(str(db_path))
+            conn.execute(
+                "UPDATE msg SET content = 'Your code is 731904, or open https://example.com/v/1' "
+                "WHERE rowid = 1"
+            )
+            conn.commit()
+            conn.close()
+
+            data = EmailData(str(db_path))
+            assert data.get_latest_token('bob@example.com')['value'] == '731904'
+            links = data.get_tokens('bob@example.com', 'link')
+            assert [(t['value'], t['id']) for t in links] == [('https://example.com/v/1', 1)]
+
+            # Deleting a message drops its tokens
+            data.conn.execute("DELETE FROM msg WHERE id = 1")
+            assert data.get_latest_token('bob@example.com') is None
+            data.close()
+
+    def test_mailbox_backfill(self):
+        """Test stored messages are filed under every recipient."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = Path(temp_dir) / 'legacy.db'
+            create_legacy_db(db_path, 3)
+            conn = sqlite3.connect(str(db_path))
+            conn.execute(
+                "UPDATE msg SET tos = '[\"Bob@Example.com\", \"carol@example.com\", \"BOB@example.com\"]' "
+                "WHERE rowid = 2"
+            )
+            conn.commit()
+            conn.close()
+
+            data = EmailData(str(db_path))
+            assert data.get_message_count(recipient='bob@example.com') == 3
+            assert [m['id'] for m in data.get_messages_to('carol@example.com')] == [2]
+            assert data.get_unread_count('carol@example.com') == 1
+
+            index_names = {row[0] for row in data.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )}
+            assert 'idx_msg_to0_created' not in index_names
+
+            # Deleting a message takes it out of every mailbox
+            data.conn.execute("DELETE FROM msg WHERE id = 2")
+            assert data.get_message_count(recipient='carol@example.com') == 0
+            assert data.get_message_count(recipient='bob@example.com') == 2
+            data.close()
+
+    def test_rollup_backfill(self):
+        """Test stored messages are counted once, whether before or after the upgrade."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = Path(temp_dir) / 'legacy.db'
+            create_legacy_db(db_path, 5)
+            conn = sqlite3.connect(str(db_path))
+            conn.execute(
+                "UPDATE msg SET tos = '[\"Bob@Example.com\", \"carol@example.com\", \"dan@other.org\"]' "
+                "WHERE rowid = 2"
+            )
+            conn.commit()
+            conn.close()
+
+            data = EmailData(str(db_path))
+            conn = data.conn
+            migrator = Migrator(conn)
+            # Mail stored while the backfill runs is counted by the triggers
+            conn.execute("DELETE FROM msg_rollup")
+            conn.execute("INSERT INTO schema_backfill (version, position) VALUES (9, 0)")
+            for name in ('msg_rollup_insert', 'mailbox_rollup_insert', 'msg_rollup_delete'):
+                conn.execute(f"DROP TRIGGER {name}")
+            conn.commit()
+            migrator.backfill_step(2)
+            data.store_message({'from': 'x@y.com', 'to': ['bob@example.com'], 'subject': 'New',
+                                'content': 'c', 'date': datetime.datetime(2024, 1, 1, 0, 30)})
+            assert migrator.run_backfills(2) == 4
+
+            assert data.get_stats('domain') == [
+                {'domain': 'example.com', 'messages': 6, 'bytes': 4 * 5 + 1},
+                {'domain': 'other.org', 'messages': 1, 'bytes': 4},
+            ]
+            assert data.get_stats('sender') == [
+                {'sender': 'a@b.com', 'messages': 5, 'bytes': 20},
+                {'sender': 'x@y.com', 'messages': 1, 'bytes': 1},
+            ]
+
+            # Deleting a message takes it out of its rollups
+            data.conn.execute("DELETE FROM msg WHERE id = 2")
+            assert [row['messages'] for row in data.get_stats('domain')] == [5]
+            assert [row['messages'] for row in data.get_stats('hour')] == [5]
+            data.close()
+
+    def test_change_log_backfill(self):
+        """Test messages stored before the upgrade enter the change feed in id order."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = Path(temp_dir) / 'legacy.db'
+            create_legacy_db(db_path, 5)
+
+            data = EmailData(str(db_path))
+            conn = data.conn
+            migrator = Migrator(conn)
+            conn.execute("DELETE FROM msg_change")
+            conn.execute("INSERT INTO schema_backfill (version, position) VALUES (11, 0)")
+            for name in ('msg_change_insert', 'msg_change_delete'):
+                conn.execute(f"DROP TRIGGER {name}")
+            conn.commit()
+            migrator.backfill_step(2)
+            # Stored before the insert trigger exists, deleted after the delete trigger does
+            data.store_message({'from': 'x@y.com', 'to': ['bob@example.com'], 'subject': 'New',
+                                'content': 'c'})
+            conn.execute("DELETE FROM msg WHERE id = 1")
+            conn.commit()
+            assert migrator.run_backfills(2) == 3
+            data.store_message({'from': 'x@y.com', 'to': ['bob@example.com'], 'subject': 'Newer',
+                                'content': 'c'})
+
+            changes = data.get_changes()
+            assert [(c['op'], c['id']) for c in changes] == [
+                ('insert', 1), ('insert', 2), ('delete', 1), ('insert', 3), ('insert', 4),
+                ('insert', 5), ('insert', 6), ('insert', 7),
+            ]
+            seqs = [c['seq'] for c in changes]
+            assert seqs == sorted(seqs)
+            assert changes[-1]['message']['subject'] == 'Newer'
+            data.close()
+
+    def test_renditions_backfill(self):
+        """Test combined content is split by the backfill, never by a read."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = Path(temp_dir) / 'legacy.db'
+            create_legacy_db(db_path, 3)
+            conn = sqlite3.connect(str(db_path))
+            conn.execute(
+                "UPDATE msg SET content = 'Text part\n<!-- HTML_CONTENT -->\n"
+                "<p onclick=\"x()\">HTML part</p>'"
+            )
+            conn.commit()
+            conn.close()
+
+            data = EmailData(str(db_path))
+            assert data.get_message_part(2, 'text') == 'Text part'
+            conn = data.conn
+            # Back to before the backfill
+            conn.execute("INSERT INTO schema_backfill (version, position) VALUES (13, 0)")
+            conn.execute("UPDATE msg SET text_body = NULL, html_body = NULL")
+            conn.commit()
+            # Read before the backfill: split on the fly, nothing written
+            assert data.get_message_part(1, 'html') == '<p>HTML part</p>'
+            assert conn.execute("SELECT html_body FROM msg WHERE id = 1").fetchone() == (None,)
+
+            assert Migrator(conn).run_backfills(2) == 3
+            assert conn.execute("SELECT text_body, html_body FROM msg ORDER BY id").fetchall() == \
+                [('Text part', '<p>HTML part</p>')] * 3
+            assert data.schema_status()['pending_backfills'] == {}
+            data.close()
+
+    def test_background_backfill(self):
+        """Test backfills can run on a background thread."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = Path(temp_dir) / 'legacy.db'
+            create_legacy_db(db_path, 50)
+
+            data = EmailData(str(db_path), background_migrations=True)
+            assert data.migration_thread is not None
+            data.migration_thread.join(timeout=30)
+
+            assert data.schema_status()['pending_backfills'] == {}
+            assert data.get_message_count(recipient='bob@example.com') == 50
+            data.close()
+
+    def test_newer_schema(self):
+        """Test a database from a newer version is refused."""
+        conn = sqlite3.connect(':memory:')
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION + 1}")
+        with pytest.raises(RuntimeError):
+            Migrator(conn).upgrade()
+        conn.close()
@@ -0,0 +1,184 @@
+"""
+Tests for the message-processing pipeline.
+"""
+
+import threading
+from typing import Optional
+
+import pytest
+
+from aemail.config import Config
+from aemail.data import EmailData
+from aemail.email_handler import BUILTIN_STAGES, DEFAULT_STAGES, SMTPHandler
+from aemail.pipeline import MessageContext, Pipeline, Stage, StageMetrics
+
+
+RAW = b'Subject: Your code\r\n\r\nCode: 481516\r\n'
+SPAM = b'Subject: Cheap\r\nX-Spam-Flag: YES\r\n\r\nBuy now\r\n'
+
+
+class Envelope:
+    """Minimal stand-in for aiosmtpd's Envelope."""
+
+    def __init__(self, content: bytes):
+        self.mail_from = 'sender@example.com'
+        self.rcpt_tos = ['user@example.com']
+        self.content = content
+
+
+class RejectStage(Stage):
+    """Rejects every message whose subject mentions 'reject'."""
+
+    name = "reject"
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        if 'reject' in context.data.get('subject', '').lower():
+            return '550 5.7.1 Message rejected'
+        return None
+
+
+class FailingStage(Stage):
+    """Raises on every message."""
+
+    name = "failing"
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        raise RuntimeError("broken stage")
+
+
+class ThreadStage(Stage):
+    """Records the thread it ran on."""
+
+    name = "thread"
+
+    def __init__(self):
+        self.thread = None
+
+    def process(self, context: MessageContext) -> Optional[str]:
+        self.thread = threading.current_thread().name
+        return None
+
+
+def pipeline_config(**options) -> Config:
+    config = Config('/nonexistent.ini')
+    config.config.read_dict({'pipeline': options})
+    return config
+
+
+class TestPipeline:
+    """Test stages run in order, are timed, and can stop a message."""
+
+    def test_default_stages(self):
+        """Test the default pipeline builds the full message."""
+        pipeline = Pipeline.from_config(Config('/nonexistent.ini'), BUILTIN_STAGES, DEFAULT_STAGES)
+        assert [stage.name for stage in pipeline.stages] == DEFAULT_STAGES
+
+        context = MessageContext(RAW, 'sender@example.com', ['user@example.com'])
+        assert pipeline.process(context) is None
+        assert context.data['subject'] == 'Your code'
+        assert context.data['size'] == len(RAW)
+        assert context.data['tokens'] == [('code', '481516')]
+
+        stats = pipeline.stats()
+        assert list(stats) == DEFAULT_STAGES
+        assert all(stage['calls'] == 1 and stage['errors'] == 0 for stage in stats.values())
+        assert sum(stats['parse']['histogram'].values()) == 1
+
+    def test_histogram(self):
+        """Test runs land in the bucket of their latency."""
+        metrics = StageMetrics()
+        metrics.record(0.00005)
+        metrics.record(0.003)
+        metrics.record(5.0, error=True)
+
+        stats = metrics.stats()
+        assert stats['calls'] == 3 and stats['errors'] == 1
+        assert stats['histogram']['0.1'] == 1
+        assert stats['histogram']['5'] == 1
+        assert stats['histogram']['+Inf'] == 1
+
+    def test_custom_stage_stops(self):
+        """Test a module:Class stage is loaded and its reply stops the pipeline."""
+        pipeline = Pipeline.from_config(
+            pipeline_config(stages='parse, subject, tests.test_pipeline:RejectStage, content'),
+            BUILTIN_STAGES, DEFAULT_STAGES
+        )
+        context = MessageContext(b'Subject: Please reject\r\n\r\nx\r\n', 'a@example.com', [])
+
+        assert pipeline.process(context) == '550 5.7.1 Message rejected'
+        assert 'content' not in context.data
+        stats = pipeline.stats()
+        assert stats['reject']['stopped'] == 1
+        assert stats['content']['calls'] == 0
+
+    def test_invalid_config(self):
+        """Test unknown stages and offloading stages not in the pipeline are refused."""
+        with pytest.raises(ValueError):
+            Pipeline.from_config(pipeline_config(stages='parse, virus'), BUILTIN_STAGES, DEFAULT_STAGES)
+        with pytest.raises(ValueError):
+            Pipeline.from_config(pipeline_config(stages='parse', offload='content'),
+                                 BUILTIN_STAGES, DEFAULT_STAGES)
+        with pytest.raises(ValueError):
+            Pipeline.from_config(pipeline_config(stages='subject, parse, content'),
+                                 BUILTIN_STAGES, DEFAULT_STAGES)
+
+    async def test_offload(self):
+        """Test offloaded stages run in the worker pool, the others on the loop."""
+        inline, offloaded = ThreadStage(), ThreadStage()
+        offloaded.name = 'offloaded'
+        pipeline = Pipeline([inline, offloaded], offload=['offloaded'])
+
+        await pipeline.process_async(MessageContext(RAW, 'a@example.com', []))
+        assert inline.thread == threading.current_thread().name
+        assert offloaded.thread.startswith('aemail-stage')
+        pipeline.close()
+
+
+class TestHandlerPipeline:
+    """Test the SMTP handler stores through the pipeline."""
+
+    async def test_spam_dropped(self):
+        """Test flagged spam is acknowledged but not stored."""
+        data = EmailData()
+        pipeline = Pipeline.from_config(
+            pipeline_config(stages='parse, spam, subject, content, tokens'),
+            BUILTIN_STAGES, DEFAULT_STAGES
+        )
+        handler = SMTPHandler(data, pipeline=pipeline)
+
+        assert (await handler.handle_DATA(None, None, Envelope(SPAM))).startswith('250')
+        assert data.get_message_count() == 0
+        assert (await handler.handle_DATA(None, None, Envelope(RAW))).startswith('250')
+        assert data.get_message_count() == 1
+
+        stats = pipeline.stats()
+        assert stats['spam']['stopped'] == 1
+        assert stats['subject']['calls'] == 1
+        assert stats['store']['calls'] == 1
+        assert handler.parse_message(SPAM, 'a@example.com', []) is None
+        data.close()
+
+    async def test_optional_stages(self):
+        """Test a pipeline without the subject stage stores and acknowledges once."""
+        data = EmailData()
+        pipeline = Pipeline.from_config(pipeline_config(stages='parse, content'),
+                                        BUILTIN_STAGES, DEFAULT_STAGES)
+        handler = SMTPHandler(data, pipeline=pipeline)
+
+        assert (await handler.handle_DATA(None, None, Envelope(RAW))).startswith('250')
+        assert data.get_message_count() == 1
+        data.close()
+
+    async def test_stage_error(self):
+        """Test a failing stage is counted and the message is refused for retry."""
+        data = EmailData()
+        pipeline = Pipeline.from_config(
+            pipeline_config(stages='parse, tests.test_pipeline:FailingStage'),
+            BUILTIN_STAGES, DEFAULT_STAGES
+        )
+        handler = SMTPHandler(data, pipeline=pipeline)
+
+        assert (await handler.handle_DATA(None, None, Envelope(RAW))).startswith('451')
+        assert pipeline.stats()['failing']['errors'] == 1
+        assert data.get_message_count() == 0
+        data.close()
@@ -0,0 +1,218 @@
+"""
+Tests for the SMTP protocol profile: pipelining, BDAT and spooling.
+"""
+
+import smtplib
+import socket
+import threading
+from typing import List
+
+import pytest
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import SMTP
+
+from aemail.data import EmailData
+from aemail.email_handler import SMTPHandler
+from aemail.protocol import SMTPController, SMTPProfile, SMTPProtocol, check_aiosmtpd
+from tests.test_limits import free_port
+
+
+MESSAGE = (
+    b"From: a@example.com\r\nTo: b@example.com\r\nSubject: Hello\r\n\r\n"
+    b"first line\r\n..leading dot\r\n"
+)
+
+
+class RawClient:
+    """Line-level SMTP client that can pipeline commands and send BDAT chunks."""
+
+    def __init__(self, port: int):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.buffer = b''
+        self.replies(1)  # greeting
+
+    def send(self, data: bytes):
+        self.sock.sendall(data)
+
+    def line(self) -> str:
+        """Read one reply line."""
+        while b'\r\n' not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('connection closed')
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line.decode()
+
+    def replies(self, count: int) -> List[str]:
+        """Read count replies, keeping the last line of multi-line ones."""
+        replies = []
+        while len(replies) < count:
+            line = self.line()
+            if line[3:4] == ' ':
+                replies.append(line)
+        return replies
+
+    def ehlo(self) -> List[str]:
+        """Send EHLO and return every line of the reply."""
+        self.send(b'EHLO client\r\n')
+        lines = [self.line()]
+        while lines[-1][3:4] == '-':
+            lines.append(self.line())
+        return lines
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def server():
+    """SMTP server with a small spool threshold and size limit."""
+    data = EmailData()
+    handler = SMTPHandler(data)
+    profile = SMTPProfile(data_size_limit=4096, spool_threshold=256, line_length_limit=1001)
+    controller = Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.factory = lambda: SMTPProtocol(handler, profile=profile, enable_SMTPUTF8=True)
+    controller.start()
+    yield controller, data, profile
+    controller.stop()
+    data.close()
+
+
+class TestSMTPProfile:
+    """Test the tuned SMTP session."""
+
+    def test_ehlo_extensions(self, server):
+        """Test PIPELINING, CHUNKING and SIZE are advertised."""
+        controller, _, _ = server
+        client = RawClient(controller.port)
+        lines = client.ehlo()
+        assert '250-PIPELINING' in lines
+        assert '250-CHUNKING' in lines
+        assert '250-SIZE 4096' in lines
+        client.close()
+
+    def test_pipelined_data(self, server):
+        """Test several pipelined transactions in one write are all stored."""
+        controller, data, profile = server
+        client = RawClient(controller.port)
+        client.ehlo()
+        transaction = (
+            b'MAIL FROM:<a@example.com>\r\nRCPT TO:<b@example.com>\r\nDATA\r\n'
+            + MESSAGE + b'.\r\n'
+        )
+        client.send(transaction * 3)
+        replies = client.replies(12)
+        assert [r[:3] for r in replies] == ['250', '250', '354', '250'] * 3
+        client.close()
+
+        messages = data.get_messages_to('b@example.com')
+        assert len(messages) == 3
+        assert '.leading dot' in messages[0]['content']
+        assert '..leading dot' not in messages[0]['content']
+        assert profile.counters['messages_data'] == 3
+
+    def test_bdat_spooled(self, server):
+        """Test a chunked message larger than the threshold is spooled and stored."""
+        controller, data, profile = server
+        client = RawClient(controller.port)
+        client.ehlo()
+        body = MESSAGE + b'x' * 600 + b'\r\n'
+        first, second = body[:300], body[300:]
+        client.send(b'MAIL FROM:<a@example.com>\r\nRCPT TO:<b@example.com>\r\n')
+        client.send(b'BDAT %d\r\n' % len(first) + first)
+        client.send(b'BDAT %d LAST\r\n' % len(second) + second)
+        replies = client.replies(4)
+        assert replies[2].startswith('250 2.0.0 300 octets')
+        assert replies[3].startswith('250')
+        client.close()
+
+        message = data.get_messages_to('b@example.com', summary=True)[0]
+        assert message['subject'] == 'Hello'
+        assert message['size'] == len(body)
+        assert profile.counters['messages_bdat'] == 1
+        assert profile.counters['spooled_to_disk'] == 1
+
+    def test_refused_bodies(self, server):
+        """Test oversized and out-of-transaction bodies are drained and refused."""
+        controller, data, profile = server
+        client = RawClient(controller.port)
+        client.ehlo()
+
+        # BDAT without a recipient: the chunk is still consumed
+        client.send(b'BDAT 5 LAST\r\nhello')
+        assert client.replies(1)[0].startswith('503')
+
+        client.send(b'MAIL FROM:<a@example.com>\r\nRCPT TO:<b@example.com>\r\n')
+        client.send(b'BDAT 5000 LAST\r\n' + b'y' * 5000)
+        assert [r[:3] for r in client.replies(3)] == ['250', '250', '552']
+
+        client.send(b'MAIL FROM:<a@example.com>\r\nRCPT TO:<b@example.com>\r\nDATA\r\n')
+        client.send(b'z' * 2000 + b'\r\n.\r\n')
+        assert [r[:3] for r in client.replies(4)] == ['250', '250', '354', '500']
+        client.close()
+
+        assert data.get_message_count() == 0
+        assert profile.counters['rejected_too_large'] == 1
+        assert profile.counters['rejected_line_too_long'] == 1
+
+    def test_smtplib(self, server):
+        """Test a standard client is unaffected."""
+        controller, data, _ = server
+        with smtplib.SMTP('127.0.0.1', controller.port) as client:
+            client.ehlo()
+            assert client.has_extn('pipelining') and client.has_extn('chunking')
+            client.sendmail('a@example.com', ['b@example.com'], MESSAGE)
+        assert data.get_message_count() == 1
+
+
+class TestDrain:
+    """Test draining the SMTP server on shutdown."""
+
+    def test_drain(self):
+        """Test idle sessions are closed and open transactions finish."""
+        data = EmailData()
+        handler = SMTPHandler(data)
+        profile = SMTPProfile(drain_timeout=5)
+        controller = SMTPController(handler, profile, hostname='127.0.0.1', port=free_port())
+        controller.start()
+
+        idle = RawClient(controller.port)
+        idle.ehlo()
+        busy = RawClient(controller.port)
+        busy.ehlo()
+        busy.send(b'MAIL FROM:<a@example.com>\r\nRCPT TO:<b@example.com>\r\nDATA\r\n')
+        assert [r[:3] for r in busy.replies(3)] == ['250', '250', '354']
+
+        result = []
+        drainer = threading.Thread(target=lambda: result.append(controller.drain()))
+        drainer.start()
+
+        assert idle.replies(1)[0].startswith('421')
+        with pytest.raises(OSError):
+            RawClient(controller.port)
+
+        busy.send(MESSAGE + b'.\r\n')
+        assert busy.replies(2)[0].startswith('250')
+        drainer.join(10)
+
+        assert result == [0]
+        assert data.get_message_count() == 1
+        assert profile.counters['closed_by_drain'] == 2
+        idle.close()
+        busy.close()
+        data.close()
+
+
+class TestAiosmtpdCheck:
+    """Test the check of the aiosmtpd internals the sessions build on."""
+
+    def test_installed_release(self):
+        """Test the installed aiosmtpd has everything the sessions use."""
+        check_aiosmtpd()
+
+    def test_missing_member(self, monkeypatch):
+        """Test the server refuses to start on an aiosmtpd without a member it uses."""
+        monkeypatch.delattr(SMTP, '_reset_timeout')
+        with pytest.raises(RuntimeError, match=r'SMTP\._reset_timeout'):
+            SMTPController(SMTPHandler(EmailData()), SMTPProfile(), hostname='127.0.0.1', port=free_port())
@@ -0,0 +1,75 @@
+"""
+Tests for the statement catalog.
+"""
+
+import threading
+
+from aemail.data import STATEMENTS, EmailData
+from aemail.queries import QueryProfile
+
+
+class TestStatementCatalog:
+    """Test named statements, cursors and profiling."""
+
+    def _store(self, data: EmailData, count: int):
+        data.store_messages(
+            {'from': 'a@x.com', 'to': ['b@x.com'], 'subject': f'S{i}', 'content': 'c'}
+            for i in range(count)
+        )
+
+    def test_only_catalog_statements(self):
+        """Test the lookups issue nothing but catalog statements."""
+        data = EmailData()
+        self._store(data, 5)
+        issued = []
+        data.conn.set_trace_callback(issued.append)
+
+        data.get_messages_to('b@x.com', limit=2)
+        data.get_all_messages(summary=True)
+        data.get_message_count()
+        data.get_message(1)
+        data.get_message_part(1, 'text')
+        data.conn.set_trace_callback(None)
+
+        # Traced statements have their parameters bound into the text
+        templates = [sql.split('?')[0] for sql in STATEMENTS.values()]
+        for sql in issued:
+            if sql.startswith(('BEGIN', 'COMMIT')):
+                continue
+            assert any(sql.startswith(t) for t in templates), sql
+        data.close()
+
+    def test_per_thread_cursors(self):
+        """Test each thread gets its own cursor, reused across calls."""
+        data = EmailData()
+        main_cursor = data.queries.cursor()
+        assert data.queries.cursor() is main_cursor
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(data.queries.cursor()))
+        thread.start()
+        thread.join()
+        assert other[0] is not main_cursor
+        data.close()
+
+    def test_profile(self):
+        """Test call counts and cumulative time per statement."""
+        profile = QueryProfile()
+        data = EmailData(profile=profile)
+        self._store(data, 3)
+
+        for _ in range(4):
+            data.get_messages_to('b@x.com', limit=2)
+        assert len(data.get_messages_to('b@x.com', limit=2)) == 2
+        data.get_message_count()
+
+        stats = profile.stats()
+        assert stats['messages_to']['calls'] == 5
+        assert stats['messages_to']['total_ms'] >= 0
+        assert stats['count_all']['calls'] == 1
+        assert stats['insert']['calls'] == 3
+        assert stats['insert_mailbox']['calls'] == 1
+
+        profile.reset()
+        assert profile.stats() == {}
+        data.close()
@@ -0,0 +1,167 @@
+"""
+Query-plan regression tests for the data access layer.
+
+Every statement EmailData issues while serving lookups is captured and
+run through EXPLAIN QUERY PLAN; none may scan a table or sort
+through a temporary B-tree. Walking an index in order is only allowed for
+statements with a LIMIT, where the walk stops after the page. benchmarks/bench_queries.py times the same
+lookups at a million rows.
+"""
+
+import re
+from typing import List
+
+import pytest
+
+from aemail.cache import MessageCache
+from aemail.data import EmailData
+
+
+# Plan steps that grow with the table instead of the result. Any table or
+# alias counts (msg_token, or msg joined as m); subquery results and
+# json_each over a parameter list do not.
+TABLE_SCAN = re.compile(r'^SCAN (?!json_each VIRTUAL TABLE)\w')
+TEMP_SORT = 'TEMP B-TREE'
+
+
+def offending_steps(sql: str, plan: List[str]) -> List[str]:
+    """Plan steps whose cost grows with the table size."""
+    offending = []
+    for step in plan:
+        if TEMP_SORT in step:
+            offending.append(step)
+        elif TABLE_SCAN.search(step) and ('USING' not in step or 'LIMIT' not in sql):
+            offending.append(step)
+    return offending
+
+
+def query_plan(data: EmailData, sql: str) -> List[str]:
+    """EXPLAIN QUERY PLAN details of a statement."""
+    return [row[3] for row in data.conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+@pytest.fixture
+def data():
+    """Data store with a spread of senders, recipients and dates."""
+    data = EmailData()
+    data.store_messages(
+        {
+            'from': f'sender{i % 7}@example.com',
+            'to': [f'user{i % 11}@example.com'],
+            'subject': f'Message {i}',
+            'content': f'Body {i}',
+            'tokens': [('code', f'{i:06d}')] if i % 3 == 0 else [],
+            'headers': [('message-id', f'{i}@example.com'), ('x-run', f'run{i % 5}')],
+        }
+        for i in range(300)
+    )
+    data.conn.execute("ANALYZE")
+    yield data
+    data.close()
+
+
+def capture_statements(data: EmailData) -> List[str]:
+    """Run every lookup EmailData offers and return the statements issued."""
+    statements = []
+    data.conn.set_trace_callback(statements.append)
+    try:
+        for summary in (False, True):
+            data.get_messages_to('User3@Example.com', limit=20, offset=5, summary=summary)
+            data.get_messages_from('sender2@example.com', limit=20, summary=summary)
+            data.get_all_messages(limit=20, offset=40, summary=summary)
+            data.get_message(10, summary=summary)
+        data.get_message_count()
+        data.get_message_count(sender='sender2@example.com')
+        data.get_message_count(recipient='user3@example.com')
+        data.get_message_part(10, 'text')
+        data.get_message_part(10, 'html')
+        data.get_message_parts(10)
+        data.get_latest_token('user3@example.com')
+        data.get_tokens('user3@example.com', 'link')
+        data.get_messages_to('user3@example.com', unread=True, summary=True)
+        data.get_unread_count('user3@example.com')
+        data.mark_read('user3@example.com', 10)
+        data.mark_read('user3@example.com')
+        data.search_messages(recipient='user3@example.com', sender='sender2@example.com', subject='Message')
+        data.search_messages(sender='sender2@example.com', since=0, until=2 ** 40, summary=True)
+        data.search_messages(domain='example.com', subject='Message 1', limit=5)
+        data.search_messages(since=0, domain='example.com', recipient='user4@example.com')
+        data.get_messages_by_header('Message-ID', '<10@example.com>')
+        data.get_messages_by_header('X-Run', 'run2', limit=20, offset=5, summary=True)
+        data.get_changes(after=100, limit=50)
+        data.get_changes(after=250, summary=True)
+
+        # Cache fills and first-message probes
+        data.cache = MessageCache()
+        data.get_messages_to('user3@example.com', summary=True)
+        data.store_message({'from': 'new@example.com', 'to': ['new@example.com'],
+                            'subject': 'First', 'content': 'c'})
+    finally:
+        data.cache = None
+        data.conn.set_trace_callback(None)
+    return [s for s in statements if s.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE'))]
+
+
+class TestQueryPlans:
+    """Test the lookups are served from indexes."""
+
+    def test_no_scans_or_sorts(self, data):
+        """Test no lookup scans msg or sorts in a temporary B-tree."""
+        statements = capture_statements(data)
+        assert len(statements) >= 18
+
+        for sql in statements:
+            plan = query_plan(data, sql)
+            offending = offending_steps(sql, plan)
+            assert not offending, f"{sql}\n  -> {plan}"
+
+    def test_summaries_are_covered(self, data):
+        """Test summary lists are answered from the index alone."""
+        statements = []
+        data.conn.set_trace_callback(statements.append)
+        data.get_messages_from('sender2@example.com', summary=True)
+        data.get_all_messages(summary=True)
+        data.conn.set_trace_callback(None)
+
+        for sql in statements:
+            plan = ' '.join(query_plan(data, sql))
+            assert 'COVERING INDEX' in plan, f"{sql}\n  -> {plan}"
+
+    def test_recipient_lists_walk_the_mailbox(self, data):
+        """Test recipient lists walk mailbox entries and fetch messages by id."""
+        statements = []
+        data.conn.set_trace_callback(statements.append)
+        data.get_messages_to('user3@example.com', summary=True)
+        data.get_messages_to('user3@example.com', unread=True)
+        data.conn.set_trace_callback(None)
+
+        for sql in statements:
+            plan = query_plan(data, sql)
+            assert plan[0] == 'SEARCH b USING PRIMARY KEY (address=?)', f"{sql}\n  -> {plan}"
+            assert plan[1] == 'SEARCH m USING INTEGER PRIMARY KEY (rowid=?)', f"{sql}\n  -> {plan}"
+
+    def test_stats_read_the_rollups(self, data):
+        """Test statistics are answered from the rollups, never from msg."""
+        statements = []
+        data.conn.set_trace_callback(statements.append)
+        data.get_stats('domain', since=0)
+        data.get_stats('sender')
+        data.get_stats('hour', domain='example.com')
+        data.get_stats('hour')
+        data.conn.set_trace_callback(None)
+
+        for sql in statements:
+            plan = query_plan(data, sql)
+            assert all('msg_rollup' in step for step in plan if 'SCAN' in step or 'SEARCH' in step), \
+                f"{sql}\n  -> {plan}"
+        # Hourly series walk one key's entries in order
+        for sql in statements[2:]:
+            assert not any(TEMP_SORT in step for step in query_plan(data, sql)), sql
+
+    def test_newest_first_with_ties(self, data):
+        """Test messages stored within the same second keep insertion order."""
+        messages = data.get_messages_to('user3@example.com', limit=100)
+        ids = [m['id'] for m in messages]
+
+        assert ids == sorted(ids, reverse=True)
+        assert data.get_message_count(recipient='user3@example.com') == len(ids)
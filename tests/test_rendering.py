@@ -0,0 +1,182 @@
+"""
+Tests for message renditions.
+"""
+
+import email
+from email.message import EmailMessage
+
+from aemail.data import EmailData
+from aemail.email_handler import EmailProcessor, default_pipeline
+from aemail.pipeline import MessageContext
+from aemail.rendering import html_to_text, sanitize_html
+from aemail.web_api import EmailAPI
+
+
+def parse(message, mail_from: str, rcpt_tos: list) -> dict:
+    """Run a message through the default pipeline stages."""
+    context = MessageContext(message.as_bytes(), mail_from, rcpt_tos)
+    default_pipeline().process(context)
+    return context.data
+
+
+class TestRendering:
+    """Test HTML sanitization and text conversion."""
+
+    def test_sanitize_html(self):
+        """Test active content is removed and markup kept."""
+        dirty = (
+            '<p onclick="steal()">Hi <b>there</b></p>'
+            '<script>alert(1)</script>'
+            '<a href="javascript:alert(1)">bad</a>'
+            '<a href="https://example.com/x?a=1&amp;b=2">good</a>'
+            '<iframe src="https://evil"><p>inside</p></iframe>'
+            '<img src="cid:logo" onerror="x()">'
+        )
+        clean = sanitize_html(dirty)
+
+        assert '<p>Hi <b>there</b></p>' in clean
+        assert 'script' not in clean and 'alert' not in clean
+        assert 'onclick' not in clean and 'onerror' not in clean
+        assert 'iframe' not in clean and 'inside' not in clean
+        assert '<a>bad</a>' in clean
+        assert 'href="https://example.com/x?a=1&amp;b=2"' in clean
+        assert '<img src="cid:logo">' in clean
+
+    def test_sanitize_svg_animations(self):
+        """Test SVG animations cannot set a link's href after sanitizing."""
+        dirty = (
+            '<svg><a><animate attributeName="href" values="javascript:alert(1)" />'
+            '<set attributeName="href" to="javascript:alert(2)"></set>'
+            '<animateTransform attributeName="transform" from="0" to="1">'
+            '<text>click</text></a></svg><p>after</p>'
+        )
+        clean = sanitize_html(dirty)
+
+        assert 'animate' not in clean.lower() and '<set' not in clean
+        assert 'javascript' not in clean and 'attributename' not in clean
+        assert clean == '<svg><a><text>click</text></a></svg><p>after</p>'
+
+    def test_html_to_text(self):
+        """Test visible text extraction."""
+        text = html_to_text(
+            '<html><head><title>T</title><style>p {}</style></head>'
+            '<body><h1>Code</h1><p>Your code is <b>123456</b>.</p>'
+            '<a href="https://example.com/verify">Verify</a></body></html>'
+        )
+
+        assert text.splitlines()[0] == 'Code'
+        assert 'Your code is 123456.' in text
+        assert 'Verify (https://example.com/verify)' in text
+        assert 'p {}' not in text
+
+
+class TestRenditions:
+    """Test renditions computed at ingest and served by id."""
+
+    def _message(self) -> EmailMessage:
+        message = EmailMessage()
+        message['Subject'] = 'Renditions'
+        message.set_content('Plain body')
+        message.add_alternative('<p>HTML <script>x()</script>body</p>', subtype='html')
+        return message
+
+    def test_extract_renditions(self):
+        """Test separate text and sanitized HTML parts."""
+        text, html = EmailProcessor.extract_renditions(self._message())
+
+        assert text.strip() == 'Plain body'
+        assert html.strip() == '<p>HTML body</p>'
+
+    def test_html_only_fallback(self):
+        """Test the text rendition is derived when there is no plain part."""
+        message = email.message_from_string(
+            'Subject: x\nContent-Type: text/html\n\n<div>Only <i>HTML</i></div>'
+        )
+        text, html = EmailProcessor.extract_renditions(message)
+
+        assert text == 'Only HTML'
+        assert html == '<div>Only <i>HTML</i></div>'
+
+    def test_served_by_id(self):
+        """Test /message/<id> serves both renditions."""
+        data = EmailData()
+        data.store_message(parse(self._message(), 'a@x.com', ['b@x.com']))
+        msg_id = data.get_all_messages()[0]['id']
+        client = EmailAPI(data).app.test_client()
+
+        meta = client.get(f'/message/{msg_id}').get_json()
+        assert meta['subject'] == 'Renditions'
+        assert meta['parts'] == ['text', 'html']
+
+        response = client.get(f'/message/{msg_id}?part=html')
+        assert response.mimetype == 'text/html'
+        assert response.get_data(as_text=True).strip() == '<p>HTML body</p>'
+        assert 'sandbox' in response.headers['Content-Security-Policy']
+
+        response = client.get(f'/message/{msg_id}?part=text', headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 200
+        cached = client.get(f'/message/{msg_id}?part=text', headers={'If-None-Match': response.headers['ETag']})
+        assert cached.status_code == 304
+
+        assert client.get('/message/999?part=text').status_code == 404
+        assert client.get(f'/message/{msg_id}?part=pdf').status_code == 400
+        data.close()
+
+    def test_lazy_split_of_legacy_content(self):
+        """Test messages stored without renditions are split on first access."""
+        data = EmailData()
+        data.store_message({
+            'from': 'a@x.com',
+            'to': ['b@x.com'],
+            'subject': 'Legacy',
+            'content': 'Text part\n<!-- HTML_CONTENT -->\n<p onload="x()">HTML part</p>'
+        })
+        msg_id = data.get_all_messages()[0]['id']
+
+        assert data.get_message_part(msg_id, 'text') == 'Text part'
+        assert data.get_message_part(msg_id, 'html') == '<p>HTML part</p>'
+
+        stored = data.conn.execute(
+            "SELECT text_body, html_body FROM msg WHERE rowid = ?", (msg_id,)
+        ).fetchone()
+        assert stored == ('Text part', '<p>HTML part</p>')
+        assert data.get_message_part(12345, 'text') is None
+        data.close()
+
+    def test_parts_without_bodies(self):
+        """Test /message/<id> lists the renditions without reading or splitting them."""
+        data = EmailData()
+        data.store_message(parse(self._message(), 'a@x.com', ['b@x.com']))
+        data.store_message({'from': 'a@x.com', 'to': ['b@x.com'], 'subject': 'Plain', 'content': 'Text'})
+        data.store_message({'from': 'a@x.com', 'to': ['b@x.com'], 'subject': 'Legacy',
+                            'content': 'Text part\n<!-- HTML_CONTENT -->\n<p>HTML part</p>'})
+        data.conn.execute("UPDATE msg SET text_body = NULL, html_body = NULL WHERE id = 3")
+        client = EmailAPI(data).app.test_client()
+
+        issued = []
+        data.conn.set_trace_callback(issued.append)
+        assert [client.get(f'/message/{i}').get_json()['parts'] for i in (1, 2, 3)] == [
+            ['text', 'html'], ['text'], ['text', 'html']
+        ]
+        data.conn.set_trace_callback(None)
+
+        assert not [sql for sql in issued if sql.startswith('UPDATE') or 'html_body FROM' in sql]
+        assert data.conn.execute("SELECT html_body FROM msg WHERE id = 3").fetchone() == (None,)
+        data.close()
+
+    def test_summary_view(self):
+        """Test ?view=summary lists messages without their bodies."""
+        data = EmailData()
+        data.store_message(parse(self._message(), 'a@x.com', ['b@x.com']))
+        client = EmailAPI(data).app.test_client()
+
+        summaries = client.get('/all?view=summary').get_json()['messages']
+        assert len(summaries) == 1
+        assert 'content' not in summaries[0]
+        assert summaries[0]['size'] > 0
+        assert summaries[0]['subject'] == 'Renditions'
+
+        meta = client.get(f"/message/{summaries[0]['id']}?view=summary").get_json()
+        assert 'content' not in meta and 'parts' not in meta
+        assert 'content' in client.get('/to/b@x.com').get_json()['messages'][0]
+        data.close()
@@ -0,0 +1,123 @@
+"""
+Tests for recipient routing.
+"""
+
+import os
+import tempfile
+import time
+
+import pytest
+
+from aemail.config import Config
+from aemail.data import EmailData
+from aemail.email_handler import SMTPHandler
+from aemail.routing import ACCEPT, DISCARD, REJECT, Router, RoutingTable
+
+
+class Envelope:
+    """Minimal stand-in for aiosmtpd's Envelope."""
+
+    def __init__(self):
+        self.mail_from = 'sender@example.com'
+        self.rcpt_tos = []
+        self.content = b'Subject: Hi\r\n\r\nBody\r\n'
+
+
+class TestRoutingTable:
+    """Test routing table lookups."""
+
+    def test_precedence(self):
+        """Test the most specific rule wins."""
+        table = RoutingTable({
+            'vip@spam.com': 'accept',
+            'spam.com': 'discard',
+            '*.example.com': 'reject',
+            '.ok.example.com': 'accept',
+            'example.com': 'accept',
+        }, default_action='reject')
+
+        assert table.lookup('VIP@spam.com') == (ACCEPT, 'vip@spam.com')
+        assert table.lookup('x@spam.com') == (DISCARD, 'spam.com')
+        assert table.lookup('x@example.com') == (ACCEPT, 'example.com')
+        assert table.lookup('x@a.example.com') == (REJECT, '*.example.com')
+        assert table.lookup('x@b.a.example.com') == (REJECT, '*.example.com')
+        assert table.lookup('x@ok.example.com') == (ACCEPT, '.ok.example.com')
+        assert table.lookup('x@deep.ok.example.com') == (ACCEPT, '.ok.example.com')
+        assert table.lookup('x@other.org') == (REJECT, '*')
+
+    def test_counters(self):
+        """Test matches are counted per rule."""
+        table = RoutingTable({'.test.io': 'accept'})
+
+        table.route('a@test.io')
+        table.route('b@x.test.io')
+        table.route('c@elsewhere.io')
+
+        stats = table.stats()
+        assert stats['rules'] == 1
+        assert stats['matches'] == {'.test.io': 2, '*': 1}
+
+    def test_invalid_action(self):
+        """Test unknown actions are refused."""
+        with pytest.raises(ValueError):
+            RoutingTable({'example.com': 'bounce'})
+
+    def test_many_rules(self):
+        """Test lookups with tens of thousands of rules."""
+        rules = {f'.tenant{i}.example.com': 'accept' for i in range(20000)}
+        table = RoutingTable(rules, default_action='reject')
+
+        assert table.lookup('x@tenant19999.example.com')[0] == ACCEPT
+        assert table.lookup('x@tenant20000.example.com')[0] == REJECT
+
+
+class TestRouter:
+    """Test config-driven routing with hot reload."""
+
+    def test_hot_reload(self):
+        """Test rules are reloaded when the config file changes."""
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.ini', delete=False) as f:
+            f.write("[routing]\ndefault = reject\n\n[routes]\nexample.com = accept\n")
+            config_file = f.name
+
+        try:
+            router = Router(Config(config_file))
+            assert router.route('a@example.com') == ACCEPT
+            assert router.route('a@other.com') == REJECT
+
+            with open(config_file, 'w') as f:
+                f.write("[routing]\ndefault = reject\n\n[routes]\n"
+                        "example.com = accept\nother.com = accept\n")
+            stamp = time.time() + 10
+            os.utime(config_file, (stamp, stamp))
+
+            router.reload_if_changed()
+            assert router.route('a@other.com') == ACCEPT
+            # Counters of unchanged rules survive the reload
+            assert router.stats()['matches']['example.com'] == 1
+        finally:
+            os.unlink(config_file)
+
+
+class TestHandlerRouting:
+    """Test routing in the SMTP handler."""
+
+    async def test_reject_and_discard(self):
+        """Test rejected recipients are refused and discarded ones not stored."""
+        data = EmailData()
+        handler = SMTPHandler(data, router=Router(Config('/nonexistent.ini')))
+        handler.router.table = RoutingTable({'spam.com': 'discard', 'bad.com': 'reject'})
+
+        envelope = Envelope()
+        assert (await handler.handle_RCPT(None, None, envelope, 'x@bad.com', [])).startswith('550')
+        assert (await handler.handle_RCPT(None, None, envelope, 'x@spam.com', [])) == '250 OK'
+        assert (await handler.handle_DATA(None, None, envelope)).startswith('250')
+        assert data.get_message_count() == 0
+
+        await handler.handle_RCPT(None, None, envelope, 'user@good.com', [])
+        await handler.handle_DATA(None, None, envelope)
+        messages = data.get_all_messages()
+        assert len(messages) == 1
+        assert messages[0]['to'] == ['user@good.com']
+
+        data.close()
@@ -0,0 +1,150 @@
+"""
+Tests for the read-only database snapshot.
+"""
+
+import json
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+from aemail.async_api import AsyncEmailAPI
+from aemail.config import Config
+from aemail.data import EmailData
+from aemail.snapshot import SnapshotReplica
+from aemail.web_api import EmailAPI
+from tests.test_async_api import request
+
+
+def message(i: int) -> dict:
+    return {
+        'from': 'shop@example.org',
+        'to': [f'user{i % 3}@example.com'],
+        'subject': f'Order {i}',
+        'content': 'x' * 2000,
+    }
+
+
+@pytest.fixture
+def workdir():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        yield Path(temp_dir)
+
+
+class TestSnapshotReplica:
+    """Test snapshots are consistent, read-only and refreshed in turns."""
+
+    def test_refresh(self, workdir):
+        """Test a snapshot holds the mail stored before it, and only that."""
+        data = EmailData(str(workdir / 'mail.db'))
+        data.store_messages(message(i) for i in range(10))
+        replica = SnapshotReplica(data, str(workdir / 'snapshots'), pages_per_step=4)
+        assert replica.data is None and replica.stats()['age_seconds'] is None
+
+        replica.refresh()
+        data.store_message(message(10))
+        assert replica.data.get_message_count() == 10
+        assert data.get_message_count() == 11
+        assert replica.data.search_messages(recipient='USER1@example.com', limit=100)[0]['subject'] == 'Order 7'
+        assert replica.describe()['age_seconds'] >= 0
+        with pytest.raises(sqlite3.OperationalError):
+            replica.data.mark_read('user1@example.com')
+
+        first = replica.data
+        replica.refresh()
+        assert replica.data.get_message_count() == 11
+        assert replica.data.get_stats('sender')[0]['messages'] == 11
+        # The previous snapshot stays open until it is written over
+        assert first.get_message_count() == 10
+        replica.refresh()
+        assert replica.stats()['refreshes'] == 3
+
+        replica.stop()
+        assert not list((workdir / 'snapshots').iterdir())
+        data.close()
+
+    def test_refresh_while_storing(self, workdir):
+        """Test a snapshot taken during ingestion never holds part of a transaction."""
+        data = EmailData(str(workdir / 'mail.db'))
+        replica = SnapshotReplica(data, str(workdir / 'snapshots'), pages_per_step=2, step_pause=0)
+        stop = threading.Event()
+
+        def store():
+            for i in range(0, 2000, 5):
+                if stop.is_set():
+                    break
+                data.store_messages(message(j) for j in range(i, i + 5))
+        writer = threading.Thread(target=store)
+        writer.start()
+        try:
+            for _ in range(3):
+                replica.refresh()
+                count = replica.data.get_message_count()
+                assert count % 5 == 0
+                assert count == replica.data.conn.execute("SELECT COUNT(*) FROM msg").fetchone()[0]
+                assert sum(row['messages'] for row in replica.data.get_stats('mailbox')) == count
+        finally:
+            stop.set()
+            writer.join()
+        replica.stop()
+        data.close()
+
+    def test_from_config(self, workdir):
+        """Test snapshots are off unless an interval is configured."""
+        data = EmailData()
+        config = Config()
+        assert SnapshotReplica.from_config(config, data) is None
+
+        config.config.read_string(f"[snapshot]\ninterval = 60\ndir = {workdir}\n")
+        replica = SnapshotReplica.from_config(config, data)
+        assert replica.interval == 60 and replica.directory == workdir
+        data.close()
+
+    def test_api_consistency(self, workdir):
+        """Test ?consistency=snapshot reads the snapshot and reports its age."""
+        data = EmailData()
+        data.store_message(message(0))
+        replica = SnapshotReplica(data, str(workdir))
+        client = EmailAPI(data, snapshot=replica).app.test_client()
+
+        assert client.get('/all?consistency=snapshot').status_code == 503
+        replica.refresh()
+        data.store_message(message(1))
+
+        page = client.get('/all?consistency=snapshot').get_json()
+        assert page['pagination']['total'] == 1
+        assert page['snapshot']['age_seconds'] >= 0
+        assert 'snapshot' not in client.get('/all').get_json()
+        assert client.get('/all').get_json()['pagination']['total'] == 2
+
+        stats = client.get('/stats?by=sender&consistency=snapshot').get_json()
+        assert stats['stats'][0]['messages'] == 1 and 'snapshot' in stats
+        assert len(client.get('/messages?to=user1@example.com&consistency=snapshot').get_json()['messages']) == 0
+        replica.stop()
+        data.close()
+
+    async def test_async_api_consistency(self, workdir):
+        """Test the asyncio front end reads the snapshot on a thread of its own."""
+        data = EmailData()
+        data.store_message(message(0))
+        replica = SnapshotReplica(data, str(workdir))
+        replica.refresh()
+        data.store_message(message(1))
+        api = AsyncEmailAPI(data, snapshot=replica)
+        await api.start('127.0.0.1', 0)
+
+        status, _, body, connection = await request(api, '/all?consistency=snapshot')
+        assert status == 200
+        page = json.loads(body)
+        assert page['pagination']['total'] == 1 and 'age_seconds' in page['snapshot']
+        status, _, body, _ = await request(api, '/stats?by=sender&consistency=snapshot', connection=connection)
+        assert json.loads(body)['stats'][0]['messages'] == 1
+        status, _, body, _ = await request(api, '/messages?consistency=snapshot', connection=connection)
+        assert len(json.loads(body)['messages']) == 1
+        connection[1].close()
+
+        await api.shutdown(1)
+        replica.stop()
+        data.close()
@@ -0,0 +1,45 @@
+"""
+Tests for utility functions.
+"""
+
+from aemail.utils import AddressNormalizer, normalize_domain, validate_email
+
+
+class TestAddressNormalization:
+    """Test address validation and normalization."""
+
+    def test_validate_email(self):
+        """Test address validation with the precompiled pattern."""
+        assert validate_email('user@example.com')
+        assert validate_email(' user+tag@sub.example.org ')
+        assert not validate_email('no-at-sign')
+        assert not validate_email('')
+        assert not validate_email(None)
+
+    def test_normalize_domain(self):
+        """Test only the domain part is lowercased."""
+        assert normalize_domain(' <Foo@X.COM> ') == 'Foo@x.com'
+        assert normalize_domain('postmaster') == 'postmaster'
+
+    def test_default_policy(self):
+        """Test the default policy only lowercases."""
+        normalizer = AddressNormalizer()
+
+        assert normalizer.canonicalize('Foo.Bar+x@X.com') == 'foo.bar+x@x.com'
+        assert normalizer.canonicalize('') == ''
+
+    def test_domain_policy(self):
+        """Test per-domain plus-tag stripping and dot folding."""
+        normalizer = AddressNormalizer(['gmail.com', 'example.org'], ['gmail.com'])
+
+        assert normalizer.canonicalize('First.Last+news@Gmail.com') == 'firstlast@gmail.com'
+        assert normalizer.canonicalize('a.b+c@mail.example.org') == 'a.b@mail.example.org'
+        assert normalizer.canonicalize('a.b+c@example.net') == 'a.b+c@example.net'
+
+    def test_wildcard_policy_is_memoized(self):
+        """Test the * policy and per-domain memoization."""
+        normalizer = AddressNormalizer(['*'])
+
+        assert normalizer.canonicalize('x+1@a.com') == 'x@a.com'
+        assert normalizer.canonicalize('y+2@a.com') == 'y@a.com'
+        assert normalizer.policy_for.cache_info().hits == 1
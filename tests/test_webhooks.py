@@ -0,0 +1,211 @@
+"""
+Tests for outbound webhook delivery.
+"""
+
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from aemail.config import Config
+from aemail.data import EmailData
+from aemail.webhooks import WebhookDispatcher, WebhookTarget
+
+
+def message(i: int) -> dict:
+    return {'from': 'shop@example.org', 'to': ['user@example.com'],
+            'subject': f'Order {i}', 'content': f'Order {i} shipped'}
+
+
+class StubServer:
+    """Local HTTP endpoint recording the batches POSTed to it."""
+
+    def __init__(self, fail: int = 0, delay: float = 0.0):
+        """
+        Start the server.
+
+        Args:
+            fail: Requests to answer with 500 before accepting
+            delay: Seconds to wait before answering
+        """
+        self.batches = []
+        self.requests = 0
+        self.connections = set()
+        self.fail = fail
+        self.delay = delay
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                stub.requests += 1
+                stub.connections.add(self.client_address)
+                time.sleep(stub.delay)
+                if stub.fail > 0:
+                    stub.fail -= 1
+                    status = 500
+                else:
+                    status = 200
+                    stub.batches.append((json.loads(body), self.headers.get('Authorization')))
+                self.send_response(status)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/hook'
+
+    @property
+    def subjects(self) -> list:
+        return [m['subject'] for batch, _ in self.batches for m in batch['messages']]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def wait_until(condition, timeout: float = 5.0):
+    """Poll until condition() holds."""
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def stub():
+    stub = StubServer()
+    yield stub
+    stub.close()
+
+
+class TestWebhookDispatcher:
+    """Test batching, retries, persistence and isolation from ingestion."""
+
+    def test_batches(self, stub):
+        """Test mail stored after start is POSTed in batches over pooled connections."""
+        data = EmailData()
+        data.store_message(message(0))
+        target = WebhookTarget('orchestrator', stub.url, batch_size=3, concurrency=1,
+                               authorization='Bearer t0ken')
+        dispatcher = WebhookDispatcher(data, [target], linger=0.1)
+        dispatcher.start()
+
+        data.store_messages(message(i) for i in range(1, 8))
+        wait_until(lambda: len(stub.subjects) == 7)
+        # Mail stored before the target existed is not sent
+        assert stub.subjects == [f'Order {i}' for i in range(1, 8)]
+        assert [len(batch['messages']) for batch, _ in stub.batches] == [3, 3, 1]
+        assert all(auth == 'Bearer t0ken' for _, auth in stub.batches)
+        assert len(stub.connections) == 1
+
+        wait_until(lambda: dispatcher.stats()['orchestrator']['queued'] == 0)
+        stats = dispatcher.stats()['orchestrator']
+        assert (stats['batches'], stats['messages'], stats['failures']) == (3, 7, 0)
+        dispatcher.stop(5)
+        data.close()
+
+    def test_retries(self):
+        """Test failed batches are retried with backoff, and dropped after max_attempts."""
+        stub = StubServer(fail=2)
+        data = EmailData()
+        target = WebhookTarget('flaky', stub.url, backoff=0.01, max_attempts=5)
+        dispatcher = WebhookDispatcher(data, [target], linger=0)
+        dispatcher.start()
+
+        data.store_message(message(1))
+        wait_until(lambda: dispatcher.stats()['flaky']['batches'] == 1)
+        assert stub.subjects == ['Order 1']
+        stats = dispatcher.stats()['flaky']
+        assert (stats['failures'], stats['batches'], stats['dropped']) == (2, 1, 0)
+        assert target.retry_delay(1) == 0.01 and target.retry_delay(3) == 0.04
+
+        stub.fail = 10
+        data.store_message(message(2))
+        wait_until(lambda: dispatcher.stats()['flaky']['dropped'] == 1)
+        assert dispatcher.stats()['flaky']['queued'] == 0
+        dispatcher.stop(5)
+        stub.close()
+        data.close()
+
+    def test_queue_survives_restart(self):
+        """Test batches an unreachable target missed are delivered after a restart."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = str(Path(temp_dir) / 'mail.db')
+            stub = StubServer()
+            url = stub.url
+            stub.close()
+
+            data = EmailData(db_path)
+            dispatcher = WebhookDispatcher(data, [WebhookTarget('down', url, backoff=60)], linger=0)
+            dispatcher.start()
+            data.store_message(message(1))
+            wait_until(lambda: dispatcher.stats()['down']['failures'] == 1)
+            dispatcher.stop(5)
+            data.close()
+
+            data = EmailData(db_path)
+            assert data.conn.execute("SELECT attempts, last_error IS NOT NULL FROM webhook_queue").fetchall() \
+                == [(1, 1)]
+            data.conn.execute("UPDATE webhook_queue SET next_attempt = 0")
+            data.conn.commit()
+            stub = StubServer()
+            dispatcher = WebhookDispatcher(data, [WebhookTarget('down', stub.url)], linger=0)
+            dispatcher.start()
+            wait_until(lambda: stub.subjects == ['Order 1'])
+            dispatcher.stop(5)
+            stub.close()
+            data.close()
+
+    def test_slow_target(self):
+        """Test a slow target neither holds up storing nor gets more than its concurrency."""
+        stub = StubServer(delay=0.3)
+        data = EmailData()
+        target = WebhookTarget('slow', stub.url, batch_size=1, concurrency=2)
+        dispatcher = WebhookDispatcher(data, [target], linger=0)
+        dispatcher.start()
+
+        start = time.perf_counter()
+        for i in range(6):
+            data.store_message(message(i))
+        assert time.perf_counter() - start < 0.25
+        time.sleep(0.1)
+        assert dispatcher.stats()['slow']['in_flight'] <= 2
+        wait_until(lambda: len(stub.subjects) == 6)
+        assert len(stub.connections) <= 2
+        dispatcher.stop(5)
+        stub.close()
+        data.close()
+
+    def test_from_config(self):
+        """Test every [webhook:<name>] section is a target."""
+        data = EmailData()
+        config = Config('/nonexistent.ini')
+        assert WebhookDispatcher.from_config(config, data) is None
+
+        config.config.read_string(
+            "[webhook:ci]\nurl = https://ci.example.com/mail\nbatch_size = 20\nconcurrency = 4\n"
+            "[webhooks]\nlinger_ms = 10\n"
+        )
+        dispatcher = WebhookDispatcher.from_config(config, data)
+        target = dispatcher.targets['ci']
+        assert (target.batch_size, target.concurrency, dispatcher.linger) == (20, 4, 0.01)
+        assert dispatcher.pools['ci'].port == 443
+        with pytest.raises(ValueError):
+            WebhookTarget('bad', 'ftp://example.com/')
+        data.close()